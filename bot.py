@@ -2,11 +2,22 @@ import telebot
 import os
 import config
 import sqlite3
-from threading import Thread
 import logging
-import time # For scheduler
+import time
 from modules import db_utils
 from modules import payment_monitor # Import the new payment monitor
+from modules import finalization_queue
+from modules import worker_runtime
+from modules import address_recycling
+from modules import address_pool
+from modules import deposit_addresses
+from modules import metrics
+from modules import qr_service
+from modules import exchange_rate_utils
+from modules import quote_engine
+from modules import catalog_index
+from modules import item_reservations
+from modules import bot_instrumentation
 from modules.utils import update_user_state, get_user_state, clear_user_state
 from modules import text_utils # Import text_utils
 
@@ -38,16 +49,19 @@ logger.info("Initializing database...")
 initialize_database()
 logger.info("Performing initial filesystem to DB sync...")
 initial_sync_filesystem_to_db()
+qr_service.cleanup_legacy_qr_files() # Invoice QR codes are rendered in memory now; drop files older versions left behind
+catalog_index.start() # Catalog browsing is served from memory; outside changes to data/items are picked up in the background
 logger.info("Initial sync complete.")
 
 # Validate HD Wallet Seed Phrase
-from modules.hd_wallet_utils import validate_seed_phrase
+from modules.hd_wallet_utils import validate_seed_phrase, warm_up_derivation_contexts
 if not validate_seed_phrase():
     logger.critical("CRITICAL: HD Wallet seed phrase is invalid or not configured properly. Payment functionalities will FAIL. Please check config.py and ensure SEED_PHRASE is a valid BIP39 mnemonic.")
     # Depending on desired behavior, you might want to exit or prevent the bot from fully starting here.
     # For now, it will log critically and continue, but payments will not work.
 else:
     logger.info("HD Wallet seed phrase validated successfully.")
+    warm_up_derivation_contexts() # Seed and account keys are derived once here, not per invoice
 
 # Import handlers
 logger.info("Importing handlers...")
@@ -262,6 +276,10 @@ def admin_cancel_action_wrapper(message):
 def admin_close_ticket_wrapper(call):
     admin_handler.handle_admin_close_ticket_callback(bot, clear_user_state, get_user_state, update_user_state, call)
 
+@bot.message_handler(commands=['paymentlatency'], func=lambda message: admin_handler.is_admin(message.from_user.id))
+def admin_payment_latency_wrapper(message):
+    admin_handler.handle_admin_payment_latency_command(bot, clear_user_state, get_user_state, update_user_state, message)
+
 
 # --- Admin User Management Handlers ---
 @bot.message_handler(commands=['viewusers'], func=lambda message: admin_handler.is_admin(message.from_user.id))
@@ -292,131 +310,161 @@ def handle_updates(updates):
         # You could add logic here to manually process updates if needed
         # For now, just logging to see what updates are received
 
-# --- Scheduled Tasks ---
-def scheduled_ticket_expiration_check():
-    logger.info("Scheduler: Ticket expiration check thread started.")
-    # Use getattr for config values with defaults
-    init_delay = getattr(config, 'SCHEDULER_INIT_DELAY_TICKET_EXPIRY_SECONDS', 10)
-    interval = getattr(config, 'SCHEDULER_INTERVAL_TICKET_EXPIRY_SECONDS', 3600)
-    logger.info(f"Ticket Expiry: Initial delay {init_delay}s, Interval {interval}s")
-    time.sleep(init_delay)
-    while True:
-        current_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-        logger.info(f"Scheduler: Running ticket expiration check at {current_time_str} UTC...")
-        try:
-            expired_ticket_details_list = db_utils.expire_old_tickets()
-            if expired_ticket_details_list:
-                logger.info(f"Scheduler: Found {len(expired_ticket_details_list)} tickets to auto-expire.")
-                for ticket_info in expired_ticket_details_list:
-                    try:
-                        user_id_to_notify = ticket_info['user_id']
-                        ticket_id_expired = ticket_info['ticket_id']
-                        bot.send_message(user_id_to_notify,
-                                         f"Your support ticket #{ticket_id_expired} has been automatically closed due to 24 hours of inactivity. "
-                                         f"If you still need help, please open a new ticket by sending another message in the support channel.")
-                        logger.info(f"Scheduler: Notified user {user_id_to_notify} about auto-expired ticket {ticket_id_expired}.")
-                        if config.ADMIN_ID and str(config.ADMIN_ID).strip():
-                            try:
-                                admin_id_int = int(config.ADMIN_ID)
-                                bot.send_message(admin_id_int, f"Ticket #{ticket_id_expired} (User {user_id_to_notify}) was auto-expired due to inactivity.")
-                                logger.info(f"Scheduler: Notified admin {admin_id_int} about auto-expired ticket {ticket_id_expired}.")
-                            except ValueError: logger.error(f"Scheduler: ADMIN_ID '{config.ADMIN_ID}' is not valid int for auto-expiry notice of ticket #{ticket_id_expired}.")
-                            except Exception as e_admin: logger.error(f"Scheduler: Failed to send auto-expiration notice for ticket #{ticket_id_expired} to ADMIN_ID {config.ADMIN_ID}: {e_admin}")
-                    except Exception as e_notify: logger.error(f"Scheduler: Error notifying user {user_id_to_notify} about auto-expired ticket #{ticket_id_expired}: {e_notify}")
-            else:
-                logger.info(f"Scheduler: No tickets for auto-expiration at {current_time_str} UTC.")
-        except Exception as e_task: logger.exception(f"Scheduler: Critical error in ticket expiration task: {e_task}")
-        time.sleep(interval)
-
-def scheduled_item_sync():
-    logger.info("Scheduler: Item availability sync thread started.")
-    init_delay = getattr(config, 'SCHEDULER_INIT_DELAY_ITEM_SYNC_SECONDS', 20)
-    interval = getattr(config, 'SCHEDULER_INTERVAL_ITEM_SYNC_SECONDS', 3600) # Default 1 hour
-    logger.info(f"Item Sync: Initial delay {init_delay}s, Interval {interval}s")
-    time.sleep(init_delay)
-    while True:
-        current_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-        logger.info(f"Scheduler: Running item availability sync at {current_time_str} UTC...")
-        try:
-            if hasattr(db_utils, 'periodic_filesystem_to_db_sync'):
-                sync_summary = db_utils.periodic_filesystem_to_db_sync()
-                logger.info(f"Scheduler: Item sync finished. Summary: {sync_summary}")
-            else:
-                logger.error("Scheduler: periodic_filesystem_to_db_sync function not found in db_utils.")
-                time.sleep(3600 * 24) # Sleep long if function missing
+# --- Background Jobs ---
+# Periodic work runs as jobs in the durable job queue (modules/worker_runtime.py), either inside this
+# process (RUN_JOB_WORKER_IN_PROCESS) or in one or more separate `python main.py worker` processes.
+RUN_JOB_WORKER_IN_PROCESS = getattr(config, 'RUN_JOB_WORKER_IN_PROCESS', True)
+JOB_PURGE_AFTER_DAYS = getattr(config, 'JOB_PURGE_AFTER_DAYS', 7)
+
+def job_expire_tickets(payload):
+    current_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    logger.info(f"Jobs: Running ticket expiration check at {current_time_str} UTC...")
+    expired_ticket_details_list = db_utils.expire_old_tickets()
+    if not expired_ticket_details_list:
+        logger.info(f"Jobs: No tickets for auto-expiration at {current_time_str} UTC.")
+        return
+    logger.info(f"Jobs: Found {len(expired_ticket_details_list)} tickets to auto-expire.")
+    for ticket_info in expired_ticket_details_list:
+        user_id_to_notify = ticket_info['user_id']
+        ticket_id_expired = ticket_info['ticket_id']
+        # Notifications are separate jobs so a Telegram error is retried without re-running the expiry.
+        worker_runtime.enqueue('send_user_notification', {
+            'user_id': user_id_to_notify,
+            'text': (f"Your support ticket #{ticket_id_expired} has been automatically closed due to 24 hours of inactivity. "
+                     f"If you still need help, please open a new ticket by sending another message in the support channel.")
+        }, priority=50)
+        if config.ADMIN_ID and str(config.ADMIN_ID).strip():
+            try:
+                admin_id_int = int(config.ADMIN_ID)
+            except ValueError:
+                logger.error(f"Jobs: ADMIN_ID '{config.ADMIN_ID}' is not valid int for auto-expiry notice of ticket #{ticket_id_expired}.")
                 continue
-        except Exception as e: logger.exception(f"Scheduler: Critical error in item availability sync task: {e}")
-        time.sleep(interval)
-
-# --- HD Wallet Payment Monitoring Tasks ---
-def scheduled_check_pending_crypto_payments():
-    logger.info("Scheduler: Pending crypto payment check thread started.")
-    init_delay = getattr(config, 'SCHEDULER_INIT_DELAY_PAYMENT_CHECK_SECONDS', 30)
-    interval = getattr(config, 'SCHEDULER_INTERVAL_PAYMENT_CHECK_SECONDS', 120) # Default 2 minutes
-    if interval < 60: logger.warning(f"Payment check interval {interval}s is very frequent. Consider increasing.")
-    logger.info(f"Pending Payment Check: Initial delay {init_delay}s, Interval {interval}s")
-    time.sleep(init_delay)
-    while True:
-        logger.info("Scheduler: Running pending crypto payment check...")
-        try:
-            payment_monitor.check_pending_payments()
-        except Exception as e:
-            logger.exception("Scheduler: Critical error in check_pending_payments task.")
-        time.sleep(interval)
-
-def scheduled_process_confirmed_crypto_payments():
-    logger.info("Scheduler: Process confirmed crypto payment thread started.")
-    init_delay = getattr(config, 'SCHEDULER_INIT_DELAY_PROCESS_CONFIRMED_SECONDS', 15)
-    interval = getattr(config, 'SCHEDULER_INTERVAL_PROCESS_CONFIRMED_SECONDS', 60) # Default 1 minute
-    logger.info(f"Process Confirmed Payments: Initial delay {init_delay}s, Interval {interval}s")
-    time.sleep(init_delay)
-    while True:
-        logger.info("Scheduler: Running process confirmed crypto payments...")
-        try:
-            payment_monitor.process_confirmed_payments(bot)
-        except Exception as e:
-            logger.exception("Scheduler: Critical error in process_confirmed_payments task.")
-        time.sleep(interval)
-
-def scheduled_expire_stale_crypto_payments():
-    logger.info("Scheduler: Expire stale crypto payment thread started.")
-    init_delay = getattr(config, 'SCHEDULER_INIT_DELAY_EXPIRE_PAYMENTS_SECONDS', 60)
-    interval = getattr(config, 'SCHEDULER_INTERVAL_EXPIRE_PAYMENTS_SECONDS', 300) # Default 5 minutes
-    logger.info(f"Expire Stale Payments: Initial delay {init_delay}s, Interval {interval}s")
-    time.sleep(init_delay)
-    while True:
-        logger.info("Scheduler: Running expire stale crypto payments...")
-        try:
-            payment_monitor.expire_stale_monitoring_payments(bot)
-        except Exception as e:
-            logger.exception("Scheduler: Critical error in expire_stale_monitoring_payments task.")
-        time.sleep(interval)
+            worker_runtime.enqueue('send_user_notification', {
+                'user_id': admin_id_int,
+                'text': f"Ticket #{ticket_id_expired} (User {user_id_to_notify}) was auto-expired due to inactivity."
+            }, priority=50)
+
+def job_item_sync(payload):
+    logger.info("Jobs: Running item availability sync...")
+    sync_summary = db_utils.periodic_filesystem_to_db_sync()
+    logger.info(f"Jobs: Item sync finished. Summary: {sync_summary}")
+
+def job_check_pending_payments(payload):
+    payment_monitor.check_pending_payments()
+
+def job_process_confirmed_payments(payload):
+    payment_monitor.process_confirmed_payments(bot)
+
+def job_expire_stale_payments(payload):
+    payment_monitor.expire_stale_monitoring_payments(bot)
+
+def job_finalize_payment(payload):
+    payment_id = payload['payment_id']
+    if not payment_monitor.process_confirmed_payment_by_id(payment_id, bot):
+        payment = db_utils.get_pending_payment_by_id(payment_id)
+        if payment and payment['status'] == 'confirmed_unprocessed':
+            raise RuntimeError(f"Finalization of payment_id {payment_id} did not complete")
+
+def job_send_user_notification(payload):
+    try:
+        bot.send_message(payload['user_id'], payload['text'], parse_mode=payload.get('parse_mode'))
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code in (400, 403): # Chat not found / bot blocked: retrying will not help
+            logger.warning(f"Jobs: Dropping notification for user {payload['user_id']}: {e}")
+            return
+        raise
+    logger.info(f"Jobs: Sent notification to user {payload['user_id']}.")
+
+def job_purge_finished_jobs(payload):
+    purged = db_utils.purge_finished_jobs(JOB_PURGE_AFTER_DAYS)
+    logger.info(f"Jobs: Purged {purged} finished job(s) older than {JOB_PURGE_AFTER_DAYS} days.")
+
+def job_recheck_recycled_addresses(payload):
+    address_recycling.recheck_recycle_candidates()
+
+def job_refill_address_pool(payload):
+    address_pool.refill_pools()
+
+def job_scan_deposit_addresses(payload):
+    deposit_addresses.scan_deposit_addresses()
+
+def job_purge_exchange_rates(payload):
+    exchange_rate_utils.purge_rate_history()
+
+def job_purge_item_reservations(payload):
+    item_reservations.purge_history()
+
+def register_jobs():
+    payment_check_interval = getattr(config, 'SCHEDULER_INTERVAL_PAYMENT_CHECK_SECONDS', 120) # Default 2 minutes
+    if payment_check_interval < 60: logger.warning(f"Payment check interval {payment_check_interval}s is very frequent. Consider increasing.")
+
+    worker_runtime.register_recurring_job('expire_tickets', job_expire_tickets,
+        interval_seconds=getattr(config, 'SCHEDULER_INTERVAL_TICKET_EXPIRY_SECONDS', 3600),
+        initial_delay_seconds=getattr(config, 'SCHEDULER_INIT_DELAY_TICKET_EXPIRY_SECONDS', 10))
+    worker_runtime.register_recurring_job('item_sync', job_item_sync,
+        interval_seconds=getattr(config, 'SCHEDULER_INTERVAL_ITEM_SYNC_SECONDS', 3600),
+        initial_delay_seconds=getattr(config, 'SCHEDULER_INIT_DELAY_ITEM_SYNC_SECONDS', 20))
+    # Each slot is an independent monitor run; payments are leased per batch, so slots run in parallel
+    # on whichever workers pick them up without checking the same payment twice.
+    worker_runtime.register_recurring_job('check_pending_payments', job_check_pending_payments,
+        interval_seconds=payment_check_interval,
+        initial_delay_seconds=getattr(config, 'SCHEDULER_INIT_DELAY_PAYMENT_CHECK_SECONDS', 30), priority=20,
+        slots=getattr(config, 'PAYMENT_MONITOR_PARALLELISM', 1))
+    # Confirmed payments are normally finalized immediately via finalization_queue; this sweep is a safety net.
+    worker_runtime.register_recurring_job('process_confirmed_payments', job_process_confirmed_payments,
+        interval_seconds=getattr(config, 'SCHEDULER_INTERVAL_PROCESS_CONFIRMED_SECONDS', 300),
+        initial_delay_seconds=getattr(config, 'SCHEDULER_INIT_DELAY_PROCESS_CONFIRMED_SECONDS', 15), priority=10)
+    worker_runtime.register_recurring_job('expire_stale_payments', job_expire_stale_payments,
+        interval_seconds=getattr(config, 'SCHEDULER_INTERVAL_EXPIRE_PAYMENTS_SECONDS', 300),
+        initial_delay_seconds=getattr(config, 'SCHEDULER_INIT_DELAY_EXPIRE_PAYMENTS_SECONDS', 60), priority=30)
+    if address_recycling.ADDRESS_RECYCLING_ENABLED:
+        worker_runtime.register_recurring_job('recheck_recycled_addresses', job_recheck_recycled_addresses,
+            interval_seconds=getattr(config, 'ADDRESS_RECYCLE_RECHECK_INTERVAL_SECONDS', 1800),
+            initial_delay_seconds=120, priority=150)
+    if address_pool.ADDRESS_POOL_ENABLED:
+        worker_runtime.register_recurring_job('refill_address_pool', job_refill_address_pool,
+            interval_seconds=getattr(config, 'ADDRESS_POOL_REFILL_INTERVAL_SECONDS', 60),
+            initial_delay_seconds=5, priority=15)
+    if deposit_addresses.PERSISTENT_DEPOSIT_ADDRESSES_ENABLED:
+        worker_runtime.register_recurring_job('scan_deposit_addresses', job_scan_deposit_addresses,
+            interval_seconds=deposit_addresses.DEPOSIT_SCAN_INTERVAL_SECONDS,
+            initial_delay_seconds=45, priority=25)
+    worker_runtime.register_recurring_job('purge_finished_jobs', job_purge_finished_jobs,
+        interval_seconds=24 * 3600, initial_delay_seconds=600, priority=200)
+    worker_runtime.register_recurring_job('purge_exchange_rates', job_purge_exchange_rates,
+        interval_seconds=24 * 3600, initial_delay_seconds=900, priority=200)
+    worker_runtime.register_recurring_job('purge_item_reservations', job_purge_item_reservations,
+        interval_seconds=24 * 3600, initial_delay_seconds=1200, priority=200)
+    worker_runtime.register_job_handler('finalize_payment', job_finalize_payment, max_attempts=10)
+    worker_runtime.register_job_handler('send_user_notification', job_send_user_notification, max_attempts=5)
+
+def start_worker():
+    """Entry point for `python main.py worker`: runs background jobs without Telegram polling."""
+    logger.info("Job worker starting...")
+    register_jobs()
+    exchange_rate_utils.start_background_refresh()
+    # A separate worker process on the same host needs its own metrics port
+    bot_instrumentation.start(port=getattr(config, 'METRICS_WORKER_PORT', metrics.METRICS_PORT + 1))
+    finalization_queue.start_finalization_workers(bot)
+    worker_runtime.run_forever()
 
 # Main function
 def start_bot():
     logger.info("Bot starting...")
+    bot_instrumentation.start(bot)
 
-    # Existing scheduled tasks
-    logger.info("Starting scheduled ticket expiration check thread...")
-    expiration_thread = Thread(target=scheduled_ticket_expiration_check, daemon=True)
-    expiration_thread.start()
+    quote_engine.start() # Crypto prices for the catalog, recomputed on every rate refresh
+    exchange_rate_utils.start_background_refresh() # Rates are refreshed ahead of expiry, off the request path
 
-    logger.info("Scheduler: Starting item availability sync thread...")
-    item_sync_thread = Thread(target=scheduled_item_sync, daemon=True)
-    item_sync_thread.start()
+    logger.info("Starting finalization workers...")
+    finalization_queue.start_finalization_workers(bot)
 
-    # New HD Wallet payment monitoring tasks
-    logger.info("Starting scheduled pending crypto payment check thread...")
-    pending_crypto_check_thread = Thread(target=scheduled_check_pending_crypto_payments, daemon=True)
-    pending_crypto_check_thread.start()
-
-    logger.info("Starting scheduled process confirmed crypto payment thread...")
-    process_confirmed_crypto_thread = Thread(target=scheduled_process_confirmed_crypto_payments, daemon=True)
-    process_confirmed_crypto_thread.start()
-
-    logger.info("Starting scheduled expire stale crypto payment thread...")
-    expire_stale_crypto_thread = Thread(target=scheduled_expire_stale_crypto_payments, daemon=True)
-    expire_stale_crypto_thread.start()
+    if RUN_JOB_WORKER_IN_PROCESS:
+        logger.info("Starting in-process job workers...")
+        register_jobs()
+        worker_runtime.start_workers()
+    else:
+        logger.info("RUN_JOB_WORKER_IN_PROCESS is disabled. Background jobs must be run with `python main.py worker`.")
 
     logger.info("Starting Telegram bot polling...")
     bot.delete_webhook() # Ensure no webhook is active before polling
@@ -28,7 +28,10 @@ BUY_FLOW_IMAGE_PATH = "assets/images/buy_flow_initiate_image.png" # Example loca
 SEED_PHRASE = "merit step nuclear digital appear project innocent doll genre educate swing pluck"
 
 # Standard gap limit for address discovery in HD wallets.
+# Used by tools/discover_wallet_addresses.py (modules/wallet_discovery.py) to recover hd_address_indices.
 ACCOUNT_DISCOVERY_GAP_LIMIT = 20
+# WALLET_DISCOVERY_BATCH_SIZE = 50 # Addresses derived and looked up per batch.
+# WALLET_DISCOVERY_CONCURRENCY = 8 # Concurrent provider lookups during discovery.
 
 # Minimum number of confirmations required for a transaction to be considered valid.
 MIN_CONFIRMATIONS_BTC = 1
@@ -51,6 +54,12 @@ BLOCKCYPHER_API_TOKEN = "" # Optional, some endpoints might work without it but
 # Example for TronGrid API (for TRX and TRC20 tokens like USDT)
 TRONGRID_API_KEY = "" # Optional, but recommended for higher rate limits if using TronGrid
 
+# API base URLs default to the public services. Override them only for testing, e.g. against
+# tools/fake_blockchain_provider.py (http://127.0.0.1:8765/btc, /ltc and /tron).
+# BLOCKSTREAM_API_BASE_URL_BTC = "https://blockstream.info/api"
+# BLOCKCYPHER_API_BASE_URL_LTC = "https://api.blockcypher.com/v1/ltc/main"
+# TRONGRID_API_BASE_URL = "https://api.trongrid.io"
+
 # Official USDT TRC20 contract address on the Tron network. This is a fixed value.
 USDT_TRC20_CONTRACT_ADDRESS = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
 
@@ -71,11 +80,117 @@ USDT_TRC20_CONTRACT_ADDRESS = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
 # SCHEDULER_INIT_DELAY_PAYMENT_CHECK_SECONDS = 30 # Initial delay (seconds) before the first pending crypto payment check.
 # SCHEDULER_INTERVAL_PAYMENT_CHECK_SECONDS = 120 # Interval (seconds) between pending crypto payment checks (e.g., 2 minutes).
 # SCHEDULER_INIT_DELAY_PROCESS_CONFIRMED_SECONDS = 15 # Initial delay (seconds) before first processing of confirmed payments.
-# SCHEDULER_INTERVAL_PROCESS_CONFIRMED_SECONDS = 60 # Interval (seconds) for processing confirmed payments (e.g., 1 minute).
+# SCHEDULER_INTERVAL_PROCESS_CONFIRMED_SECONDS = 300 # Interval (seconds) of the safety-net sweep for confirmed payments (e.g., 5 minutes).
 # SCHEDULER_INIT_DELAY_EXPIRE_PAYMENTS_SECONDS = 60 # Initial delay (seconds) before first check for expiring stale payments.
 # SCHEDULER_INTERVAL_EXPIRE_PAYMENTS_SECONDS = 300 # Interval (seconds) for expiring stale payments (e.g., 5 minutes).
 
+# --- Job Queue (Defaults used in bot.py and modules/worker_runtime.py if not set here) ---
+# The tasks above run as jobs in the database-backed job queue.
+# RUN_JOB_WORKER_IN_PROCESS = True # Run job workers inside the bot process. Set to False when using `python main.py worker`.
+# JOB_WORKER_THREADS = 2 # Worker threads per process.
+# JOB_POLL_INTERVAL_SECONDS = 2 # How often an idle worker looks for due jobs.
+# JOB_VISIBILITY_TIMEOUT_SECONDS = 300 # Lease length; a job not finished or renewed in time is retried by another worker.
+# JOB_MAX_ATTEMPTS = 5 # Default attempts before a failing job is moved to 'dead'.
+# JOB_RETRY_BASE_DELAY_SECONDS = 10 # First retry delay; doubles on each further attempt.
+# JOB_RETRY_MAX_DELAY_SECONDS = 900 # Upper bound for the retry delay.
+# JOB_PURGE_AFTER_DAYS = 7 # Completed jobs older than this are deleted (dead jobs are kept).
+# PAYMENT_MONITOR_PARALLELISM = 1 # Concurrent payment monitor runs across all workers (each leases its own batches).
+# PAYMENT_MONITOR_BATCH_SIZE = 25 # Payments leased per batch by one monitor run.
+# PAYMENT_LEASE_SECONDS = 120 # Lease on a payment being checked; renewed after each payment, reclaimed once expired.
+
 # --- Blockchain API Call Delays (Defaults used in modules if not set here) ---
 # This can help manage rate limiting if you are using public API endpoints without keys.
 # BLOCKCHAIN_API_CALL_DELAY_SECONDS = 2.0 # General delay (seconds) between calls in payment_monitor loops to different APIs.
                                          # Individual API modules might have their own specific internal delays or logic.
+# BLOCKCHAIN_TIP_HEIGHT_CACHE_SECONDS = 20 # How long (seconds) the BTC/LTC chain tip height is cached for computing confirmations.
+
+# --- On-demand "Check Payment" (Defaults used in modules/payment_monitor.py if not set here) ---
+# ON_DEMAND_CHECK_WORKERS = 4 # Worker threads running user-triggered payment checks off the Telegram polling thread.
+# PAYMENT_CHECK_RESULT_CACHE_SECONDS = 15 # Check results younger than this are reused instead of calling the API again.
+# FINALIZATION_WORKERS = 2 # Worker threads finalizing payments as soon as they are confirmed.
+# PAYMENT_PROCESSING_RECLAIM_SECONDS = 600 # A payment stuck in 'processing' this long (worker crashed) is finalized again.
+
+# --- Shared-Address Invoicing (Defaults used in modules/payment_invoicing.py if not set here) ---
+# Opt-in per coin: invoices share a small pool of addresses and are told apart by a unique exact amount.
+# Best suited to USDT-TRC20, where wallets send exact token amounts.
+# SHARED_ADDRESS_INVOICING_COINS = ['USDT_TRX'] # Pending-payment coin symbols using shared addresses ('USDT_TRX', 'BTC', 'LTC'). Default: none.
+# SHARED_ADDRESS_POOL_SIZE = 3 # Addresses per coin in the shared pool.
+# SHARED_ADDRESS_MAX_AMOUNT_OFFSET_UNITS = 999 # Max smallest units added to make an amount unique (999 = 0.000999 USDT).
+# SHARED_ADDRESS_AMOUNT_REUSE_GUARD_MINUTES = 360 # An expired invoice's amount is not reused on the same address for this long.
+# SHARED_ADDRESS_HISTORY_RETENTION_MINUTES = 1440 # Transfers older than this are dropped from a shared address's history cursor.
+
+# --- Address Recycling (Defaults used in modules/address_recycling.py and bot.py if not set here) ---
+# Addresses of expired invoices that never received a transaction are rechecked once and then reused,
+# instead of deriving a new HD index for every invoice.
+# ADDRESS_RECYCLING_ENABLED = True
+# ADDRESS_RECYCLE_GRACE_MINUTES = 1440 # Wait this long after expiry (late payments) before the final on-chain recheck.
+# ADDRESS_RECYCLE_RECHECK_INTERVAL_SECONDS = 1800 # How often due candidates are rechecked.
+# ADDRESS_RECYCLE_RECHECK_BATCH_SIZE = 50 # Candidates rechecked per run.
+
+# --- Address Pool (Defaults used in modules/address_pool.py and bot.py if not set here) ---
+# Invoice addresses are derived ahead of time by a background job, so creating an invoice only claims a row.
+# ADDRESS_POOL_ENABLED = True
+# ADDRESS_POOL_LOW_WATER_MARK = 5 # Refill a coin's pool once fewer addresses than this are available.
+# ADDRESS_POOL_HIGH_WATER_MARK = 15 # Refill up to this many. Keep it within the wallet gap limit (usually 20).
+# ADDRESS_POOL_REFILL_INTERVAL_SECONDS = 60 # How often pool levels are checked.
+
+# --- Exchange Rates (Defaults used in modules/exchange_rate_utils.py if not set here) ---
+# All coins are fetched in one round over the rate sources below and refreshed in the background ahead of expiry.
+# EXCHANGE_RATE_TTL_SECONDS = 300 # Rates count as fresh for this long.
+# EXCHANGE_RATE_REFRESH_AHEAD_SECONDS = 60 # Background refresh starts this long before rates expire.
+# EXCHANGE_RATE_MAX_STALENESS_SECONDS = 1800 # Expired rates are still served (while refreshing) up to this age; older ones are never used.
+# EXCHANGE_RATE_OUTAGE_MAX_STALENESS_SECONDS = 10800 # While CoinGecko is failing, stored rates are used up to this age instead.
+# EXCHANGE_RATE_HISTORY_DAYS = 90 # Fetched rates are kept in the exchange_rates table this long (rows an invoice refers to are kept).
+
+# --- Exchange Rate Sources (Defaults used in modules/rate_sources.py if not set here) ---
+# Rates are the median of several public tickers, fetched concurrently; quotes far from the median are dropped.
+# RATE_SOURCES_ENABLED = ('coingecko', 'kraken', 'coinbase')
+# RATE_SOURCE_QUORUM = 2 # Once this many sources have answered (and agree), the rest get only the grace period below.
+# RATE_SOURCE_QUORUM_GRACE_SECONDS = 0.5
+# RATE_SOURCE_DEADLINE_SECONDS = 5 # Sources that have not answered by then are left out of the round.
+# RATE_SOURCE_MAX_DEVIATION = 0.02 # Quotes more than 2% from the median are rejected as outliers.
+# Base URLs default to the public APIs. Override them only for testing, e.g. against tools/fake_rate_provider.py.
+# COINGECKO_API_BASE_URL = "https://api.coingecko.com/api/v3"
+# KRAKEN_API_BASE_URL = "https://api.kraken.com/0/public"
+# COINBASE_API_BASE_URL = "https://api.coinbase.com/v2"
+
+# --- Item Catalog Index (Defaults used in modules/catalog_index.py if not set here) ---
+# The catalog under ITEMS_BASE_DIR is indexed in memory. Folders added or removed outside the bot are detected
+# with the optional 'watchdog' package (pip install watchdog) or, without it, by polling directory mtimes.
+# CATALOG_WATCH_MODE = 'auto' # 'auto' (watchdog if installed, else polling), 'watchdog', 'poll' or 'off'
+# CATALOG_POLL_INTERVAL_SECONDS = 15
+
+# --- Item Reservations (Defaults used in modules/item_reservations.py if not set here) ---
+# Picking a size reserves one instance for the buyer; creating the invoice extends the hold to the invoice expiry.
+# ITEM_RESERVATION_HOLD_MINUTES = 15 # How long an instance is held between size selection and invoice creation.
+# ITEM_RESERVATION_HISTORY_DAYS = 30 # Finished reservations are kept in the item_reservations table this long.
+
+# --- QR Codes (Defaults used in modules/qr_service.py if not set here) ---
+# QR_CACHE_MAX_ENTRIES = 256 # Rendered payment QR codes kept in memory (LRU, keyed by payment URI).
+
+# --- Persistent Deposit Addresses (Defaults used in modules/deposit_addresses.py and bot.py if not set here) ---
+# Opt-in: balance top-ups go to a stable per-user address instead of a one-off invoice. Every confirmed
+# deposit is credited at the exchange rate when it was first seen, minus ADD_BALANCE_SERVICE_FEE_EUR.
+# PERSISTENT_DEPOSIT_ADDRESSES_ENABLED = False
+# PERSISTENT_DEPOSIT_COINS = ['BTC', 'LTC', 'USDT_TRX'] # Coins using deposit addresses when enabled.
+# DEPOSIT_SCAN_INTERVAL_SECONDS = 180 # How often the deposit watcher runs.
+# DEPOSIT_SCAN_BATCH_SIZE = 60 # Deposit addresses checked per run, least recently checked first. Capped so that
+#                             # batch x BLOCKCHAIN_API_CALL_DELAY_SECONDS stays within 3/4 of the scan interval.
+
+# --- Outbound HTTP Client (Defaults used in modules/http_client.py if not set here) ---
+# All block explorer and exchange-rate requests share one pooled keep-alive client.
+# HTTP_CONNECT_TIMEOUT_SECONDS = 5 # Timeout (seconds) for establishing a TCP/TLS connection.
+# HTTP_READ_TIMEOUT_SECONDS = 15 # Default timeout (seconds) waiting for a response once connected.
+# HTTP_POOL_CONNECTIONS = 10 # Number of per-host connection pools to keep.
+# HTTP_POOL_MAXSIZE = 20 # Maximum keep-alive connections per host.
+# HTTP_GET_RETRIES = 2 # Automatic retries for GET requests on connection errors and 5xx responses.
+# HTTP_RETRY_BACKOFF_FACTOR = 0.5 # Exponential backoff factor (seconds) between GET retries.
+# HTTP_RETRY_STATUS_CODES = (500, 502, 503, 504) # Status codes retried for GET requests (429 is left to the payment monitor).
+# HTTP_CLIENT_HTTP2_ENABLED = False # Use HTTP/2 via httpx (requires `pip install httpx[http2]`).
+
+# --- Metrics (Defaults used in modules/metrics.py and bot.py if not set here) ---
+# Prometheus text-format endpoint served from a background thread at http://<host>:<port>/metrics.
+# METRICS_ENABLED = True
+# METRICS_BIND_HOST = '127.0.0.1' # Keep on localhost unless the scraper runs on another machine.
+# METRICS_PORT = 9464 # Port of the bot process.
+# METRICS_WORKER_PORT = 9465 # Port of a separate `python main.py worker` process.
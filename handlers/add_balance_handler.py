@@ -1,6 +1,5 @@
 # handlers/add_balance_handler.py
 import logging
-import os
 import datetime
 from decimal import Decimal, ROUND_UP
 
@@ -11,11 +10,13 @@ from modules.db_utils import (
     update_transaction_status, get_pending_payment_by_transaction_id,
     update_pending_payment_status, get_next_address_index,
     create_pending_payment, update_main_transaction_for_hd_payment,
-    get_transaction_by_id, increment_user_transaction_count
+    get_transaction_by_id, increment_user_transaction_count,
+    apply_balance_change_once, record_payment_funnel_event
 )
-from modules import hd_wallet_utils, exchange_rate_utils, payment_monitor
+from modules import qr_service, exchange_rate_utils, payment_monitor, payment_invoicing, deposit_addresses, quote_engine
 from modules.text_utils import escape_md
 from modules.message_utils import send_or_edit_message, delete_message
+from modules.utils import get_user_state, update_user_state, clear_user_state # Used by the finalizer, which runs outside handler callbacks
 import config
 from handlers.main_menu_handler import get_main_menu_text_and_markup
 import sqlite3 # For specific exception handling
@@ -159,6 +160,11 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
        return
 
     bot_instance.answer_callback_query(call.id)
+    if deposit_addresses.uses_persistent_deposits(payment_invoicing.get_payment_coin_details(crypto_currency_selected)['db_coin']):
+        _show_persistent_deposit_address(bot_instance, chat_id, user_id, original_message_id, crypto_currency_selected,
+                                         requested_eur_float, total_due_eur_float)
+        return
+
     if original_message_id:
         ack_msg = send_or_edit_message(bot_instance, chat_id, escape_md("⏳ Generating your payment address..."), existing_message_id=original_message_id, reply_markup=None)
     else:
@@ -168,12 +174,11 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
 
     transaction_notes = f"User adding {requested_eur_float:.2f} EUR to balance. Total due: {total_due_eur_float:.2f} EUR via {crypto_currency_selected}."
     main_transaction_id = record_transaction(
-        user_id=user_id, product_id=None, type='balance_top_up',
+        user_id=user_id, type='balance_top_up',
         eur_amount=total_due_eur_float,
         original_add_balance_amount=requested_eur_float, # Store the original amount user wanted to add
         payment_status='pending_address_generation',
-        notes=transaction_notes,
-        charge_id=None # No charge_id for HD Wallet
+        notes=transaction_notes
     )
     if not main_transaction_id:
         logger.error(f"HD Wallet: Failed to create transaction record for add balance, user {user_id}.")
@@ -181,46 +186,39 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
         return
     update_user_state(user_id, 'add_balance_transaction_id', main_transaction_id)
 
-    coin_symbol_for_hd_wallet = crypto_currency_selected
     display_coin_symbol = crypto_currency_selected
-    network_for_db = crypto_currency_selected
-
-    if crypto_currency_selected == "USDT":
-        coin_symbol_for_hd_wallet = "TRX"
-        network_for_db = "TRC20 (Tron)"
-
-    try:
-        next_idx = get_next_address_index(coin_symbol_for_hd_wallet)
-    except Exception as e_idx:
-        logger.exception(f"HD Wallet: Error getting next address index for {coin_symbol_for_hd_wallet} (user {user_id}, tx {main_transaction_id}): {e_idx}")
-        send_or_edit_message(bot_instance, chat_id, escape_md("Error generating payment address (index). Please try again later or contact support."), existing_message_id=current_message_id_for_invoice)
-        update_transaction_status(main_transaction_id, 'error_address_generation')
-        return
-
-    unique_address = hd_wallet_utils.generate_address(coin_symbol_for_hd_wallet, next_idx)
-    if not unique_address:
-        logger.error(f"HD Wallet: Failed to generate address for {coin_symbol_for_hd_wallet}, index {next_idx} (user {user_id}, tx {main_transaction_id}).")
-        send_or_edit_message(bot_instance, chat_id, escape_md("Error generating payment address (HD). Please try again later or contact support."), existing_message_id=current_message_id_for_invoice)
-        update_transaction_status(main_transaction_id, 'error_address_generation')
-        return
 
-    rate = exchange_rate_utils.get_current_exchange_rate("EUR", display_coin_symbol)
-    if not rate:
+    crypto_quote = quote_engine.get_quote(total_due_eur_float, display_coin_symbol)
+    if not crypto_quote:
         logger.error(f"HD Wallet: Could not get exchange rate for EUR to {display_coin_symbol} (user {user_id}, tx {main_transaction_id}).")
         send_or_edit_message(bot_instance, chat_id, escape_md(f"Could not retrieve exchange rate for {escape_md(display_coin_symbol)}. Please try again or contact support."), existing_message_id=current_message_id_for_invoice, parse_mode='MarkdownV2')
         update_transaction_status(main_transaction_id, 'error_exchange_rate')
         return
-
-    precision_map = {"BTC": 8, "LTC": 8, "USDT": 6}
-    num_decimals = precision_map.get(display_coin_symbol, 8)
+    quoted_crypto_amount_hr = crypto_quote['amount_hr']
     total_due_eur_decimal = Decimal(str(total_due_eur_float))
-    expected_crypto_amount_decimal_hr = (total_due_eur_decimal / rate).quantize(Decimal('1e-' + str(num_decimals)), rounding=ROUND_UP)
-    smallest_unit_multiplier = Decimal('1e-' + str(num_decimals))
-    expected_crypto_amount_smallest_unit_str = str(int(expected_crypto_amount_decimal_hr * smallest_unit_multiplier))
 
     payment_window_minutes = getattr(config, 'PAYMENT_WINDOW_MINUTES', 60)
     expires_at_dt = datetime.datetime.utcnow() + datetime.timedelta(minutes=payment_window_minutes)
 
+    # Allocates the address (dedicated or shared pool) and the final amount, and creates the pending payment.
+    try:
+        invoice_payment = payment_invoicing.create_invoice_payment(
+            main_transaction_id, user_id, crypto_currency_selected, quoted_crypto_amount_hr, expires_at_dt,
+            paid_from_balance_eur=0.0, exchange_rate_id=crypto_quote['rate_id']
+        )
+    except Exception as e_alloc:
+        logger.exception(f"HD Wallet: Error allocating payment address for {crypto_currency_selected} (user {user_id}, tx {main_transaction_id}): {e_alloc}")
+        invoice_payment = None
+    if not invoice_payment:
+        logger.error(f"HD Wallet: Failed to create pending_crypto_payment for add balance main_tx {main_transaction_id} (user {user_id}).")
+        update_transaction_status(main_transaction_id, 'error_address_generation')
+        send_or_edit_message(bot_instance, chat_id, escape_md("Error generating payment address. Please try again later or contact support."), existing_message_id=current_message_id_for_invoice)
+        return
+
+    unique_address = invoice_payment['address']
+    network_for_db = invoice_payment['network']
+    expected_crypto_amount_decimal_hr = invoice_payment['expected_crypto_amount_hr']
+
     update_success = update_main_transaction_for_hd_payment(
        main_transaction_id,
        status='awaiting_payment',
@@ -229,33 +227,13 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
     )
     if not update_success:
         logger.error(f"HD Wallet: Failed to update main transaction {main_transaction_id} for add balance, user {user_id}.")
+        update_pending_payment_status(invoice_payment['payment_id'], 'cancelled_error')
         send_or_edit_message(bot_instance, chat_id, escape_md("Database error updating transaction. Please try again."), existing_message_id=current_message_id_for_invoice)
         return
 
-    db_coin_symbol_for_pending = "USDT_TRX" if crypto_currency_selected == "USDT" else display_coin_symbol
-    pending_payment_id = create_pending_payment(
-       transaction_id=main_transaction_id,
-       user_id=user_id,
-       address=unique_address,
-       coin_symbol=db_coin_symbol_for_pending,
-       network=network_for_db,
-       expected_crypto_amount=expected_crypto_amount_smallest_unit_str,
-       expires_at=expires_at_dt,
-       paid_from_balance_eur=0.0
-    )
-    if not pending_payment_id:
-       logger.error(f"HD Wallet: Failed to create pending_crypto_payment for add balance main_tx {main_transaction_id} (user {user_id}).")
-       update_transaction_status(main_transaction_id, 'error_creating_pending_payment')
-       send_or_edit_message(bot_instance, chat_id, escape_md("Error preparing payment record. Please try again or contact support."), existing_message_id=current_message_id_for_invoice)
-       return
-
-    qr_code_path = None
+    qr_photo = None
     try:
-        qr_code_path = hd_wallet_utils.generate_qr_code_for_address(
-           unique_address,
-           str(expected_crypto_amount_decimal_hr),
-           display_coin_symbol
-        )
+        qr_photo = qr_service.get_payment_qr(unique_address, str(expected_crypto_amount_decimal_hr), display_coin_symbol)
     except Exception as e_qr_gen:
         logger.error(f"HD Wallet (add balance): QR code generation failed for {unique_address} (user {user_id}, tx {main_transaction_id}): {e_qr_gen}")
 
@@ -271,7 +249,7 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
         f"Address: `{escape_md(unique_address)}`\n\n"
         f"*AMOUNT TO SEND:*\n`{escape_md(str(expected_crypto_amount_decimal_hr))} {escape_md(display_coin_symbol)}`\n\n"
         f"⏳ Expires: *{escape_md(expires_at_dt.strftime('%Y-%m-%d %H:%M:%S UTC'))}*\n\n"
-        f"⚠️ Send the exact amount using the correct network. This address is for single use only."
+        + payment_invoicing.get_invoice_warning(invoice_payment['invoice_mode'])
     )
 
     markup_invoice = types.InlineKeyboardMarkup(row_width=1)
@@ -284,19 +262,14 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
          except Exception: pass
 
     sent_invoice_msg = None
-    if qr_code_path and os.path.exists(qr_code_path):
+    if qr_photo:
         try:
-            with open(qr_code_path, 'rb') as qr_photo:
-                sent_invoice_msg = bot_instance.send_photo(chat_id, photo=qr_photo, caption=escape_md(invoice_text_md), reply_markup=markup_invoice, parse_mode="MarkdownV2")
+            sent_invoice_msg = bot_instance.send_photo(chat_id, photo=qr_photo, caption=escape_md(invoice_text_md), reply_markup=markup_invoice, parse_mode="MarkdownV2")
         except Exception as e_qr_send:
             logger.error(f"HD Wallet (add balance): Failed to send QR code photo for {unique_address} (user {user_id}, tx {main_transaction_id}): {e_qr_send}. Sending text only.")
             sent_invoice_msg = bot_instance.send_message(chat_id, escape_md(invoice_text_md), reply_markup=markup_invoice, parse_mode="MarkdownV2")
-        finally:
-            if os.path.exists(qr_code_path):
-                try: os.remove(qr_code_path)
-                except Exception as e_rm_qr: logger.error(f"Failed to remove QR code file {qr_code_path}: {e_rm_qr}")
     else:
-        logger.warning(f"HD Wallet (add balance): QR code not generated or not found for {unique_address} (user {user_id}, tx {main_transaction_id}). Sending text invoice.")
+        logger.warning(f"HD Wallet (add balance): QR code not generated for {unique_address} (user {user_id}, tx {main_transaction_id}). Sending text invoice.")
         sent_invoice_msg = bot_instance.send_message(chat_id, escape_md(invoice_text_md), reply_markup=markup_invoice, parse_mode="MarkdownV2")
 
     if sent_invoice_msg:
@@ -304,10 +277,62 @@ def handle_pay_balance_crypto_callback(bot_instance, clear_user_state, get_user_
     update_user_state(user_id, 'current_flow', 'add_balance_awaiting_hd_payment_confirmation')
 
 
+def _show_persistent_deposit_address(bot_instance, chat_id, user_id, original_message_id, crypto_currency_selected,
+                                     requested_eur_float, total_due_eur_float):
+    """Persistent deposit mode: shows the user's stable address instead of creating an invoice. The deposit watcher credits it."""
+    deposit_address = deposit_addresses.get_or_create_deposit_address(user_id, crypto_currency_selected)
+    if not deposit_address:
+        send_or_edit_message(bot_instance, chat_id, escape_md("Error generating your deposit address. Please try again later or contact support."), existing_message_id=original_message_id)
+        return
+
+    address = deposit_address['address']
+    coin_details = payment_invoicing.get_payment_coin_details(crypto_currency_selected)
+    total_due_eur_decimal = Decimal(str(total_due_eur_float))
+    suggested_amount_line = ""
+    rate = exchange_rate_utils.get_current_exchange_rate("EUR", crypto_currency_selected)
+    if rate:
+        suggested_amount_hr, _ = payment_invoicing.quote_crypto_amount(total_due_eur_decimal, rate, crypto_currency_selected)
+        suggested_amount_line = f"To add *{escape_md(f'{Decimal(str(requested_eur_float)):.2f}')} EUR* now, send about `{escape_md(str(suggested_amount_hr))} {escape_md(crypto_currency_selected)}`\\.\n\n"
+
+    service_fee_display = total_due_eur_decimal - Decimal(str(requested_eur_float))
+    deposit_text_md = (
+        f"🏦 *Your {escape_md(crypto_currency_selected)} Deposit Address*\n\n"
+        f"Network: *{escape_md(coin_details['network'])}*\n"
+        f"Address: `{escape_md(address)}`\n\n"
+        + suggested_amount_line +
+        f"This address is yours permanently\\. Any amount you send to it is added to your balance once confirmed, "
+        f"at the exchange rate when the transfer is detected, minus a *{escape_md(f'{service_fee_display:.2f}')} EUR* service fee per deposit\\.\n\n"
+        f"⚠️ Only send {escape_md(crypto_currency_selected)} on the {escape_md(coin_details['network'])} network\\."
+    )
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
+
+    if original_message_id:
+        try: delete_message(bot_instance, chat_id, original_message_id)
+        except Exception: pass
+
+    sent_msg = None
+    qr_photo = None
+    try:
+        qr_photo = qr_service.get_payment_qr(address, None, crypto_currency_selected)
+    except Exception as e_qr_gen:
+        logger.error(f"Deposit address: QR code generation failed for {address} (user {user_id}): {e_qr_gen}")
+    if qr_photo:
+        try:
+            sent_msg = bot_instance.send_photo(chat_id, photo=qr_photo, caption=deposit_text_md, reply_markup=markup, parse_mode="MarkdownV2")
+        except Exception as e_qr_send:
+            logger.error(f"Deposit address: Failed to send QR code photo for {address} (user {user_id}): {e_qr_send}. Sending text only.")
+    if not sent_msg:
+        sent_msg = bot_instance.send_message(chat_id, deposit_text_md, reply_markup=markup, parse_mode="MarkdownV2")
+
+    if sent_msg:
+        update_user_state(user_id, 'last_bot_message_id', sent_msg.message_id)
+    update_user_state(user_id, 'current_flow', None)
+
+
 def handle_check_add_balance_payment_callback(bot_instance, clear_user_state, get_user_state, update_user_state, call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
-    ack_msg = None
     original_invoice_message_id = get_user_state(user_id, 'last_bot_message_id') or call.message.message_id
     logger.info(f"User {user_id} checking add balance payment status for callback data: {call.data}")
 
@@ -328,24 +353,29 @@ def handle_check_add_balance_payment_callback(bot_instance, clear_user_state, ge
         bot_instance.answer_callback_query(call.id, status_msg, show_alert=True)
         if main_tx and main_tx['payment_status'] in ['completed', 'cancelled_by_user', 'expired_payment_window', 'error_finalizing_data']:
             new_markup = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
-    if original_invoice_message_id and call.message.message_id == original_invoice_message_id:
-        try:
-            if call.message.photo: bot_instance.edit_message_caption(caption=escape_md(status_msg), chat_id=chat_id, message_id=original_invoice_message_id, reply_markup=new_markup, parse_mode="MarkdownV2")
-            else: bot_instance.edit_message_text(text=escape_md(status_msg), chat_id=chat_id, message_id=original_invoice_message_id, reply_markup=new_markup, parse_mode="MarkdownV2")
-        except Exception as e_edit_final: logger.error(f"Error editing final state message {original_invoice_message_id} for user {user_id}, tx {transaction_id}: {e_edit_final}")
+            if original_invoice_message_id and call.message.message_id == original_invoice_message_id:
+                try:
+                    if call.message.photo: bot_instance.edit_message_caption(caption=escape_md(status_msg), chat_id=chat_id, message_id=original_invoice_message_id, reply_markup=new_markup, parse_mode="MarkdownV2")
+                    else: bot_instance.edit_message_text(text=escape_md(status_msg), chat_id=chat_id, message_id=original_invoice_message_id, reply_markup=new_markup, parse_mode="MarkdownV2")
+                except Exception as e_edit_final: logger.error(f"Error editing final state message {original_invoice_message_id} for user {user_id}, tx {transaction_id}: {e_edit_final}")
         return
 
-    bot_instance.answer_callback_query(call.id)
-    ack_msg = bot_instance.send_message(chat_id, escape_md("⏳ Checking payment status (on-demand)..."))
+    # Answer right away; the API check runs off the polling thread and edits the invoice when done.
+    bot_instance.answer_callback_query(call.id, "⏳ Checking payment status...")
+    payment_monitor.submit_on_demand_check(
+        transaction_id,
+        on_complete=lambda result: _show_add_balance_check_result(bot_instance, call, transaction_id, original_invoice_message_id, *result)
+    )
 
-    try:
-        newly_confirmed, status_info = payment_monitor.check_specific_pending_payment(transaction_id)
-        if ack_msg: delete_message(bot_instance, chat_id, ack_msg.message_id)
 
-        if newly_confirmed and status_info == 'confirmed_unprocessed':
-            logger.info(f"On-demand check for add balance tx {transaction_id} (user {user_id}) resulted in new confirmation. Processing...")
+def _show_add_balance_check_result(bot_instance, call, transaction_id: int, original_invoice_message_id, newly_confirmed: bool, status_info: str | None):
+    """Edits the invoice with the outcome of an on-demand check. Runs on a payment-check worker thread."""
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    try:
+        if status_info in ('confirmed_unprocessed', 'processing'):
+            logger.info(f"On-demand check for add balance tx {transaction_id} (user {user_id}) found a confirmed payment (newly_confirmed={newly_confirmed}). Finalization is queued by payment_monitor.")
             bot_instance.send_message(chat_id, escape_md("✅ Payment detected! Processing your balance update..."))
-            payment_monitor.process_confirmed_payments(bot_instance)
         else:
             logger.info(f"On-demand check for add balance tx {transaction_id} (user {user_id}): newly_confirmed={newly_confirmed}, status_info='{status_info}'")
             pending_payment_latest = get_pending_payment_by_transaction_id(transaction_id)
@@ -354,62 +384,48 @@ def handle_check_add_balance_payment_callback(bot_instance, clear_user_state, ge
             base_invoice_text = "\n".join([line for line in (current_invoice_text or "").split('\n') if not line.strip().startswith("Status:")])
 
             new_status_line = ""
-            alert_message = ""
-            show_alert_flag = True
             reply_markup_to_use = call.message.reply_markup
 
             if status_info == 'monitoring':
                 confs = pending_payment_latest['confirmations'] if pending_payment_latest else 'N/A'
                 new_status_line = f"Status: Still monitoring for sufficient confirmations. Current: {confs}."
-                alert_message = f"Still monitoring. Confirmations: {confs}."
-                show_alert_flag = False
             elif status_info == 'monitoring_updated':
                 confs = pending_payment_latest['confirmations'] if pending_payment_latest else 'N/A'
                 new_status_line = f"Status: Monitoring updated. Current confirmations: {confs}."
-                alert_message = f"Monitoring updated. Confirmations: {confs}."
-                show_alert_flag = False
             elif status_info == 'expired':
                 new_status_line = f"Status: This payment request has expired."
-                alert_message = "This payment request has expired."
                 new_markup = types.InlineKeyboardMarkup(row_width=1)
                 new_markup.add(types.InlineKeyboardButton("⬅️ Try Again", callback_data="main_add_balance"))
                 new_markup.add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
                 reply_markup_to_use = new_markup
             elif status_info == 'error_api':
                 new_status_line = f"Status: Could not check status due to a temporary API error. Please try again in a moment."
-                alert_message = "Could not check status due to an API error. Please try again."
             elif status_info == 'not_found':
                 new_status_line = f"Status: Payment record not found."
-                alert_message = "Payment record not found. This is unexpected."
                 reply_markup_to_use = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
             elif status_info in ['processed', 'cancelled_by_user', 'error_finalizing', 'error_finalizing_data', 'error_monitoring_unsupported', 'error_processing_tx_missing', 'processed_tx_already_complete']:
-                new_status_line = f"Status: Payment is in a final state: {escape_md(status_info)}."
-                alert_message = f"Payment status: {status_info}."
+                new_status_line = f"Status: Payment is in a final state: {status_info}."
                 reply_markup_to_use = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
             else:
-                new_status_line = f"Status: Current status: {escape_md(status_info)}."
-                alert_message = f"Current status: {status_info}."
+                new_status_line = f"Status: Current status: {status_info}."
                 if status_info != 'monitoring':
                      reply_markup_to_use = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
 
             updated_text_for_invoice = f"{new_status_line}\n\n{base_invoice_text}".strip()
-            if len(updated_text_for_invoice) > (1024 if call.message.photo else 4096):
-                updated_text_for_invoice = updated_text_for_invoice[:(1021 if call.message.photo else 4093)] + "..."
+            if len(updated_text_for_invoice) > (1000 if call.message.photo else 4000): # Truncate, leaving room for escaping
+                updated_text_for_invoice = updated_text_for_invoice[:(997 if call.message.photo else 3997)] + "..."
 
             try:
                 if call.message.photo:
                     bot_instance.edit_message_caption(caption=escape_md(updated_text_for_invoice), chat_id=chat_id, message_id=original_invoice_message_id, reply_markup=reply_markup_to_use, parse_mode="MarkdownV2")
                 else:
                     bot_instance.edit_message_text(text=escape_md(updated_text_for_invoice), chat_id=chat_id, message_id=original_invoice_message_id, reply_markup=reply_markup_to_use, parse_mode="MarkdownV2")
-                bot_instance.answer_callback_query(call.id, alert_message, show_alert=show_alert_flag)
             except Exception as e_edit:
+                # Telegram rejects edits that don't change the message (e.g. repeated "still monitoring").
                 logger.error(f"Error editing message {original_invoice_message_id} for on-demand add balance check (tx {transaction_id}): {e_edit}")
-                bot_instance.answer_callback_query(call.id, "Status updated, but message display failed to refresh.", show_alert=True)
 
     except Exception as e:
-        logger.exception(f"Error in handle_check_add_balance_payment_callback (on-demand) for user {user_id}, tx {transaction_id_str}: {e}")
-        if ack_msg and hasattr(ack_msg, 'message_id'): delete_message(bot_instance, chat_id, ack_msg.message_id)
-        bot_instance.answer_callback_query(call.id, "An error occurred while checking payment status. Please try again.", show_alert=True)
+        logger.exception(f"Error showing on-demand add balance check result for user {user_id}, tx {transaction_id}: {e}")
 
 
 def handle_cancel_add_balance_payment_callback(bot_instance, clear_user_state, get_user_state, update_user_state, call):
@@ -496,19 +512,24 @@ def finalize_successful_top_up(bot_instance, main_transaction_id: int, user_id:
             update_transaction_status(main_transaction_id, 'error_finalizing_data')
             return False
 
-        user_data = get_or_create_user(user_id)
-        if not user_data:
+        if not get_or_create_user(user_id):
             logger.error(f"finalize_successful_top_up: Failed to get/create user {user_id} for tx {main_transaction_id}.")
             update_transaction_status(main_transaction_id, 'error_finalizing_user_data')
             return False
 
-        current_balance_decimal = Decimal(str(user_data['balance'])).quantize(Decimal('0.01'))
-        new_balance_decimal = current_balance_decimal + original_add_balance_amount_decimal
-
-        if not update_user_balance(user_id, float(new_balance_decimal), increment_transactions=True): # Main transaction already created, this increments user's total count
+        # Credited at most once per transaction, even if finalization is retried.
+        credit_applied = apply_balance_change_once(f"tx:{main_transaction_id}:top_up_credit", user_id,
+                                                   float(original_add_balance_amount_decimal),
+                                                   increment_transactions=True, # Main transaction already created, this increments user's total count
+                                                   transaction_id=main_transaction_id)
+        if credit_applied is None:
             logger.error(f"finalize_successful_top_up: Failed to update balance for user {user_id}, tx {main_transaction_id}.")
             update_transaction_status(main_transaction_id, 'error_finalizing_balance_update')
             return False
+        if not credit_applied:
+            logger.warning(f"finalize_successful_top_up: Balance for tx {main_transaction_id} was already credited to user {user_id}. Completing without crediting again.")
+
+        new_balance_decimal = Decimal(str(get_or_create_user(user_id)['balance'])).quantize(Decimal('0.01'))
 
         if not update_transaction_status(main_transaction_id, 'completed'):
             logger.warning(f"finalize_successful_top_up: Failed to update main transaction {main_transaction_id} status to completed, but balance was updated for user {user_id}.")
@@ -535,6 +556,7 @@ def finalize_successful_top_up(bot_instance, main_transaction_id: int, user_id:
 
         sent_msg = bot_instance.send_message(chat_id, escape_md(success_text), reply_markup=markup_main_menu, parse_mode="MarkdownV2")
         update_user_state(user_id, 'last_bot_message_id', sent_msg.message_id) # Store the new message ID
+        record_payment_funnel_event('user_notified', transaction_id=main_transaction_id)
         logger.info(f"finalize_successful_top_up: Successfully processed top-up for user {user_id}, tx {main_transaction_id}. New balance: {new_balance_decimal:.2f} EUR.")
         return True
 
@@ -19,6 +19,7 @@ from modules.message_utils import send_or_edit_message, delete_message
 from modules.text_utils import escape_md
 import config
 from modules import db_utils
+from modules import payment_funnel
 from handlers.utils import format_transaction_history_display, TX_HISTORY_PAGE_SIZE
 
 
@@ -360,6 +361,22 @@ def handle_admin_close_ticket_callback(bot_instance, clear_user_state_fn, get_us
         update_user_state_fn(admin_id, 'admin_current_ticket_id', None)
         update_user_state_fn(admin_id, 'admin_flow', None)
 
+# --- Admin Payment Latency Report ---
+def handle_admin_payment_latency_command(bot_instance, clear_user_state_fn, get_user_state_fn, update_user_state_fn, message):
+    """/paymentlatency [days]: funnel latency percentiles per coin and provider."""
+    admin_id = message.from_user.id
+    chat_id = message.chat.id
+    command_parts = message.text.split()
+    try:
+        days = int(command_parts[1]) if len(command_parts) > 1 else 7
+        if days <= 0: raise ValueError
+    except ValueError:
+        bot_instance.send_message(chat_id, "Usage: /paymentlatency [days]  (days must be a positive number, default 7)")
+        return
+    logger.info(f"Admin {admin_id} requested the payment latency report for the last {days} days.")
+    report_text = payment_funnel.format_latency_report(payment_funnel.build_latency_report(days))
+    bot_instance.send_message(chat_id, report_text) # Plain text: the report is preformatted
+
 # --- Admin Item Addition Flow (Filesystem Based) ---
 
 # Placeholder for product_fs_utils, will be imported properly later
@@ -11,7 +11,9 @@ from modules.db_utils import (
     increment_user_transaction_count, # Keep user related
     get_next_address_index, create_pending_payment, # HD Wallet specific
     update_main_transaction_for_hd_payment, # HD Wallet specific
-    get_transaction_by_id # transaction related
+    get_transaction_by_id, # transaction related
+    apply_balance_change_once, is_finalization_step_done, mark_finalization_step_done, # Idempotent finalization
+    record_payment_funnel_event, # Payment latency tracking
     # Removed: get_cities_with_available_items, get_available_items_in_city,
     # get_product_details_by_id, sync_item_from_fs_to_db (these will be handled by product_fs_utils)
 )
@@ -19,7 +21,8 @@ from modules.db_utils import (
 from modules import product_fs_utils # New FS utility for products
 from modules.message_utils import send_or_edit_message, delete_message
 from modules.text_utils import escape_md
-from modules import hd_wallet_utils, exchange_rate_utils, payment_monitor
+from modules.utils import get_user_state, update_user_state, clear_user_state # Used by the finalizer, which runs outside handler callbacks
+from modules import qr_service, exchange_rate_utils, payment_monitor, payment_invoicing, quote_engine, item_reservations
 import config
 import os
 import datetime # Ensure datetime is imported
@@ -43,7 +46,7 @@ def handle_buy_initiate_callback(bot_instance, clear_user_state, get_user_state,
         clear_user_state(user_id)
         update_user_state(user_id, 'current_flow', 'buy_selecting_city')
 
-        available_cities = product_fs_utils.get_available_cities() # Use new FS util
+        available_cities = product_fs_utils.get_cities_in_stock(user_id) # (city, instance count), cities without stock left out
         markup = types.InlineKeyboardMarkup(row_width=2)
         prompt_text = "🏙️ Please select a city:"
 
@@ -55,15 +58,9 @@ def handle_buy_initiate_callback(bot_instance, clear_user_state, get_user_state,
             # However, the current structure sends/edits then answers callback.
         else:
             city_buttons = []
-            for city_name in available_cities:
-                # Check if city actually has any item instance available down the hierarchy
-                # This could be slow if done for every city here.
-                # Assuming get_available_cities only returns cities that *could* have items.
-                # A more robust check: loop through areas, types, sizes to see if any get_oldest_available_item_instance is not None.
-                # For now, we'll list all cities returned by get_available_cities.
-                # The check will happen at a later stage (e.g. when selecting item type or size).
+            for city_name, stock_count in available_cities:
                 city_name_escaped_for_button = escape_md(city_name)
-                city_buttons.append(types.InlineKeyboardButton(text=f"🏙️ {city_name_escaped_for_button}", callback_data=f"select_city_{city_name}"))
+                city_buttons.append(types.InlineKeyboardButton(text=f"🏙️ {city_name_escaped_for_button} ({stock_count})", callback_data=f"select_city_{city_name}"))
 
             for i in range(0, len(city_buttons), 2):
                 if i + 1 < len(city_buttons):
@@ -142,7 +139,7 @@ def handle_city_selection_callback(bot_instance, clear_user_state, get_user_stat
     update_user_state(user_id, 'buy_selected_city', city_name)
     update_user_state(user_id, 'current_flow', 'buy_selecting_area') # Next step is area
 
-    available_areas = product_fs_utils.get_available_areas(city_name)
+    available_areas = product_fs_utils.get_areas_in_stock(city_name, user_id)
     markup = types.InlineKeyboardMarkup(row_width=2) # Can use 2 for areas too
     escaped_city_name = escape_md(city_name)
 
@@ -159,10 +156,9 @@ def handle_city_selection_callback(bot_instance, clear_user_state, get_user_stat
     else:
         prompt_text = f"You selected city: *{escaped_city_name}*\\.\nNow, please select an area:"
         area_buttons = []
-        for area_name in available_areas:
+        for area_name, stock_count in available_areas:
             area_name_escaped = escape_md(area_name)
-            # TODO: Potentially check if area has item types before listing
-            area_buttons.append(types.InlineKeyboardButton(text=f"📍 {area_name_escaped}", callback_data=f"select_area_{area_name}"))
+            area_buttons.append(types.InlineKeyboardButton(text=f"📍 {area_name_escaped} ({stock_count})", callback_data=f"select_area_{area_name}"))
 
         for i in range(0, len(area_buttons), 2):
             if i + 1 < len(area_buttons):
@@ -211,7 +207,7 @@ def handle_area_selection_callback(bot_instance, clear_user_state, get_user_stat
     update_user_state(user_id, 'buy_selected_area', area_name)
     update_user_state(user_id, 'current_flow', 'buy_selecting_item_type')
 
-    available_item_types = product_fs_utils.get_available_item_types(selected_city, area_name)
+    available_item_types = product_fs_utils.get_item_types_in_stock(selected_city, area_name, user_id)
     markup = types.InlineKeyboardMarkup(row_width=1) # Usually 1 for item types / sizes
     escaped_area_name = escape_md(area_name)
 
@@ -221,10 +217,9 @@ def handle_area_selection_callback(bot_instance, clear_user_state, get_user_stat
         markup = types.InlineKeyboardMarkup(row_width=1) # Ensure only back button if none
     else:
         prompt_text = f"City: *{escape_md(selected_city)}* / Area: *{escaped_area_name}*\\.\nPlease select an item type:"
-        for item_type_name in available_item_types:
-            # TODO: Check if item_type has sizes and instances before listing
+        for item_type_name, stock_count in available_item_types:
             item_type_escaped = escape_md(item_type_name)
-            markup.add(types.InlineKeyboardButton(text=f"🏷️ {item_type_escaped}", callback_data=f"select_type_{item_type_name}"))
+            markup.add(types.InlineKeyboardButton(text=f"🏷️ {item_type_escaped} ({stock_count})", callback_data=f"select_type_{item_type_name}"))
 
     markup.add(types.InlineKeyboardButton("⬅️ Back to Area Selection", callback_data=f"select_city_{selected_city}"))
 
@@ -265,7 +260,7 @@ def handle_type_selection_callback(bot_instance, clear_user_state, get_user_stat
     update_user_state(user_id, 'buy_selected_item_type', item_type_name)
     update_user_state(user_id, 'current_flow', 'buy_selecting_size')
 
-    available_sizes = product_fs_utils.get_available_sizes(selected_city, selected_area, item_type_name)
+    available_sizes = product_fs_utils.get_sizes_in_stock(selected_city, selected_area, item_type_name, user_id)
     markup = types.InlineKeyboardMarkup(row_width=1)
     escaped_item_type_name = escape_md(item_type_name)
 
@@ -275,10 +270,9 @@ def handle_type_selection_callback(bot_instance, clear_user_state, get_user_stat
         markup = types.InlineKeyboardMarkup(row_width=1)
     else:
         prompt_text = f"...Type: *{escaped_item_type_name}*\\.\nPlease select a size:"
-        for size_name in available_sizes:
-            # TODO: Check if size has actual instances before listing
+        for size_name, stock_count in available_sizes:
             size_name_escaped = escape_md(size_name)
-            markup.add(types.InlineKeyboardButton(text=f"📏 {size_name_escaped}", callback_data=f"select_size_{size_name}"))
+            markup.add(types.InlineKeyboardButton(text=f"📏 {size_name_escaped} ({stock_count})", callback_data=f"select_size_{size_name}"))
 
     markup.add(types.InlineKeyboardButton("⬅️ Back to Item Type Selection", callback_data=f"select_area_{selected_area}"))
 
@@ -320,8 +314,9 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
 
     update_user_state(user_id, 'buy_selected_size', size_name)
 
-    # Get the OLDEST available item instance for this selection
-    instance_path = product_fs_utils.get_oldest_available_item_instance(selected_city, selected_area, selected_item_type, size_name)
+    # Reserve the OLDEST instance for this selection that no other buyer holds
+    reservation = item_reservations.reserve_oldest_instance(user_id, selected_city, selected_area, selected_item_type, size_name)
+    instance_path = reservation['instance_path'] if reservation else None
 
     if not instance_path:
         logger.warning(f"No instance available for {selected_city}/{selected_area}/{selected_item_type}/{size_name} for user {user_id}.")
@@ -344,6 +339,7 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
 
     # Store details for payment step
     update_user_state(user_id, 'buy_selected_instance_path', instance_path)
+    update_user_state(user_id, 'buy_reservation_id', reservation['reservation_id'])
     update_user_state(user_id, 'buy_selected_item_name_display', f"{selected_item_type} ({size_name})") # For display
     update_user_state(user_id, 'buy_selected_item_price', item_details_fs['price'])
     update_user_state(user_id, 'buy_selected_item_description', item_details_fs['description'])
@@ -369,14 +365,18 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
         update_user_balance(user_id, float(new_balance), increment_transactions=True)
 
         move_success = product_fs_utils.move_item_instance_to_purchased(instance_path, user_id)
+        if move_success:
+            item_reservations.consume(reservation_id=reservation['reservation_id'])
+        else:
+            item_reservations.release(reservation_id=reservation['reservation_id'])
 
         transaction_item_details_json = json.dumps({
             'city': selected_city, 'area': selected_area, 'type': selected_item_type,
             'size': size_name, 'price': float(item_price), 'instance_path_original': instance_path
         })
         record_transaction(
-            user_id=user_id, product_id=None, item_details_json=transaction_item_details_json, # Using new field
-            charge_id=None, type='purchase_balance', eur_amount=float(total_cost),
+            user_id=user_id, item_details_json=transaction_item_details_json, # Using new field
+            type='purchase_balance', eur_amount=float(total_cost),
             payment_status='completed' if move_success else 'completed_fs_move_error',
             notes=f"Paid from balance. Instance: {os.path.basename(instance_path)}. FS Move: {'OK' if move_success else 'FAIL'}"
         )
@@ -495,10 +495,12 @@ def handle_size_selection_callback(bot_instance, clear_user_state, get_user_stat
     if len(final_caption) > 1024: # Telegram caption limit
         final_caption = final_caption[:1021] + "..."
 
+    crypto_amounts = quote_engine.get_display_amounts(amount_to_pay_externally) # Price matrix lookup; coins without a cached rate are left out
     markup = types.InlineKeyboardMarkup(row_width=1)
-    markup.add(types.InlineKeyboardButton("🪙 USDT (TRC20)", callback_data="pay_buy_USDT"))
-    markup.add(types.InlineKeyboardButton("🪙 BTC (Bitcoin)", callback_data="pay_buy_BTC"))
-    markup.add(types.InlineKeyboardButton("🪙 LTC (Litecoin)", callback_data="pay_buy_LTC"))
+    for coin, label in (("USDT", "USDT (TRC20)"), ("BTC", "BTC (Bitcoin)"), ("LTC", "LTC (Litecoin)")):
+        if coin in crypto_amounts:
+            label += f" · {crypto_amounts[coin]} {coin}"
+        markup.add(types.InlineKeyboardButton(f"🪙 {label}", callback_data=f"pay_buy_{coin}"))
     # Back button should return to item list for the selected city (which is size selection)
     # The callback for size selection was `select_size_{size_name}`
     # The previous step was `select_type_{item_type_name}`
@@ -609,10 +611,9 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
                          f"Due via {crypto_currency}: {amount_due_eur_float:.2f} EUR.")
 
     main_transaction_id = record_transaction(
-        user_id=user_id, product_id=None, item_details_json=transaction_item_details_json,
+        user_id=user_id, item_details_json=transaction_item_details_json,
         type='purchase_crypto', eur_amount=total_cost_eur_float, # This is the total value of the transaction
-        payment_status='pending_address_generation', notes=transaction_notes,
-        charge_id=None
+        payment_status='pending_address_generation', notes=transaction_notes
     )
     if not main_transaction_id:
         logger.error(f"Failed to create transaction record for user {user_id}, item '{item_name_display}'.")
@@ -620,47 +621,49 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
         return
     update_user_state(user_id, 'buy_transaction_id', main_transaction_id)
 
-    coin_symbol_for_hd_wallet = crypto_currency
     display_coin_symbol = crypto_currency
-    network_for_db = crypto_currency # Default for BTC, LTC
-
-    if crypto_currency == "USDT":
-        coin_symbol_for_hd_wallet = "TRX" # USDT (TRC20) uses TRX addresses
-        network_for_db = "TRC20 (Tron)"
-        # display_coin_symbol remains "USDT"
-
-    try:
-        next_idx = get_next_address_index(coin_symbol_for_hd_wallet)
-    except Exception as e_idx:
-        logger.exception(f"HD Wallet: Error getting next address index for {coin_symbol_for_hd_wallet} (user {user_id}, tx {main_transaction_id}): {e_idx}")
-        send_or_edit_message(bot_instance, chat_id, "Error generating payment address (index). Please try again later or contact support.", existing_message_id=current_message_id_for_invoice)
-        update_transaction_status(main_transaction_id, 'error_address_generation')
-        return
-
-    unique_address = hd_wallet_utils.generate_address(coin_symbol_for_hd_wallet, next_idx)
-    if not unique_address:
-        logger.error(f"HD Wallet: Failed to generate address for {coin_symbol_for_hd_wallet}, index {next_idx} (user {user_id}, tx {main_transaction_id}).")
-        send_or_edit_message(bot_instance, chat_id, "Error generating payment address (HD). Please try again later or contact support.", existing_message_id=current_message_id_for_invoice)
-        update_transaction_status(main_transaction_id, 'error_address_generation')
-        return
 
-    rate = exchange_rate_utils.get_current_exchange_rate("EUR", display_coin_symbol)
-    if not rate:
+    crypto_quote = quote_engine.get_quote(amount_due_eur_float, display_coin_symbol) # From the price matrix when possible
+    if not crypto_quote:
         logger.error(f"HD Wallet: Could not get exchange rate for EUR to {display_coin_symbol} (user {user_id}, tx {main_transaction_id}).")
         send_or_edit_message(bot_instance, chat_id, f"Could not retrieve exchange rate for {escape_md(display_coin_symbol)}. Please try again or contact support.", existing_message_id=current_message_id_for_invoice, parse_mode='MarkdownV2')
         update_transaction_status(main_transaction_id, 'error_exchange_rate')
         return
-
-    precision_map = {"BTC": 8, "LTC": 8, "USDT": 6} # TODO: Move to config or coin_utils
-    num_decimals = precision_map.get(display_coin_symbol, 8)
-    amount_due_eur_decimal = Decimal(str(amount_due_eur_float))
-    expected_crypto_amount_decimal_hr = (amount_due_eur_decimal / rate).quantize(Decimal('1e-' + str(num_decimals)), rounding=ROUND_UP)
-    smallest_unit_multiplier = Decimal('1e-' + str(num_decimals))
-    expected_crypto_amount_smallest_unit_str = str(int(expected_crypto_amount_decimal_hr * smallest_unit_multiplier))
+    quoted_crypto_amount_hr = crypto_quote['amount_hr']
 
     payment_window_minutes = getattr(config, 'PAYMENT_WINDOW_MINUTES', 60)
     expires_at_dt = datetime.datetime.utcnow() + datetime.timedelta(minutes=payment_window_minutes)
 
+    # The instance stays reserved for this buyer until the invoice expires (released on cancel/expiry)
+    reservation_id = get_user_state(user_id, 'buy_reservation_id')
+    if not reservation_id or not item_reservations.attach_to_invoice(reservation_id, user_id, main_transaction_id, expires_at_dt):
+        logger.warning(f"Reservation {reservation_id} for {selected_instance_path} could not be kept for user {user_id} (tx {main_transaction_id}).")
+        update_transaction_status(main_transaction_id, 'error_item_unavailable')
+        markup_unavailable = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Size Selection", callback_data=f"select_type_{selected_item_type}"))
+        send_or_edit_message(bot_instance, chat_id, "Sorry, this item was reserved by another buyer while you were choosing. Please select again.",
+                             reply_markup=markup_unavailable, existing_message_id=current_message_id_for_invoice)
+        return
+
+    # Allocates the address (dedicated or shared pool) and the final amount, and creates the pending payment.
+    try:
+        invoice_payment = payment_invoicing.create_invoice_payment(
+            main_transaction_id, user_id, crypto_currency, quoted_crypto_amount_hr, expires_at_dt,
+            paid_from_balance_eur=paid_from_balance_float, exchange_rate_id=crypto_quote['rate_id']
+        )
+    except Exception as e_alloc:
+        logger.exception(f"HD Wallet: Error allocating payment address for {crypto_currency} (user {user_id}, tx {main_transaction_id}): {e_alloc}")
+        invoice_payment = None
+    if not invoice_payment:
+        logger.error(f"HD Wallet: Failed to create pending_crypto_payment for main_tx {main_transaction_id} (user {user_id}, buy flow).")
+        update_transaction_status(main_transaction_id, 'error_address_generation')
+        item_reservations.release(transaction_id=main_transaction_id)
+        send_or_edit_message(bot_instance, chat_id, "Error generating payment address. Please try again later or contact support.", existing_message_id=current_message_id_for_invoice)
+        return
+
+    unique_address = invoice_payment['address']
+    network_for_db = invoice_payment['network']
+    expected_crypto_amount_decimal_hr = invoice_payment['expected_crypto_amount_hr']
+
     update_success = update_main_transaction_for_hd_payment(
        main_transaction_id,
        status='awaiting_payment',
@@ -669,37 +672,18 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
     )
     if not update_success:
         logger.error(f"HD Wallet: Failed to update main transaction {main_transaction_id} for user {user_id} (buy flow).")
+        update_pending_payment_status(invoice_payment['payment_id'], 'cancelled_error')
+        item_reservations.release(transaction_id=main_transaction_id)
         send_or_edit_message(bot_instance, chat_id, "Database error updating transaction. Please try again.", existing_message_id=current_message_id_for_invoice)
         return
 
-    db_coin_symbol_for_pending = "USDT_TRX" if crypto_currency == "USDT" else display_coin_symbol
-    pending_payment_id = create_pending_payment(
-       transaction_id=main_transaction_id,
-       user_id=user_id,
-       address=unique_address,
-       coin_symbol=db_coin_symbol_for_pending,
-       network=network_for_db,
-       expected_crypto_amount=expected_crypto_amount_smallest_unit_str,
-       expires_at=expires_at_dt,
-       paid_from_balance_eur=paid_from_balance_float
-    )
-    if not pending_payment_id:
-       logger.error(f"HD Wallet: Failed to create pending_crypto_payment for main_tx {main_transaction_id} (user {user_id}, buy flow).")
-       update_transaction_status(main_transaction_id, 'error_creating_pending_payment')
-       send_or_edit_message(bot_instance, chat_id, "Error preparing payment record. Please try again or contact support.", existing_message_id=current_message_id_for_invoice)
-       return
-
-    qr_code_path = None
+    qr_photo = None
     try:
-        qr_code_path = hd_wallet_utils.generate_qr_code_for_address(
-           unique_address,
-           str(expected_crypto_amount_decimal_hr),
-           display_coin_symbol
-        )
+        qr_photo = qr_service.get_payment_qr(unique_address, str(expected_crypto_amount_decimal_hr), display_coin_symbol)
     except Exception as e_qr_gen:
         logger.error(f"HD Wallet (buy): QR code generation failed for {unique_address} (user {user_id}, tx {main_transaction_id}): {e_qr_gen}")
 
-    product_name_escaped = escape_md(product_db_data['name'])
+    product_name_escaped = escape_md(item_name_display)
     invoice_text_md = (f"🧾 *INVOICE - Item Purchase*\n\n"
                        f"Item: *{product_name_escaped}*\n")
     if paid_from_balance_float > 0:
@@ -712,7 +696,7 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
                         f"*AMOUNT TO SEND:*\n`{escape_md(str(expected_crypto_amount_decimal_hr))} {escape_md(display_coin_symbol)}`\n\n")
     expires_at_formatted = escape_md(expires_at_dt.strftime('%Y-%m-%d %H:%M:%S UTC'))
     invoice_text_md += f"⏳ Expires: *{expires_at_formatted}*\n\n"
-    invoice_text_md += "⚠️ Send the exact amount using the correct network. This address is for single use only."
+    invoice_text_md += escape_md(payment_invoicing.get_invoice_warning(invoice_payment['invoice_mode']))
 
     markup_invoice = types.InlineKeyboardMarkup(row_width=1)
     markup_invoice.add(types.InlineKeyboardButton("✅ Check Payment", callback_data=f"check_buy_payment_{main_transaction_id}"))
@@ -726,19 +710,14 @@ def handle_pay_buy_crypto_callback(bot_instance, clear_user_state, get_user_stat
         except Exception: pass
 
     sent_invoice_msg = None
-    if qr_code_path and os.path.exists(qr_code_path):
+    if qr_photo:
         try:
-            with open(qr_code_path, 'rb') as qr_photo:
-                sent_invoice_msg = bot_instance.send_photo(chat_id, photo=qr_photo, caption=invoice_text_md, reply_markup=markup_invoice, parse_mode="MarkdownV2")
+            sent_invoice_msg = bot_instance.send_photo(chat_id, photo=qr_photo, caption=invoice_text_md, reply_markup=markup_invoice, parse_mode="MarkdownV2")
         except Exception as e_qr:
             logger.error(f"Failed to send QR photo for buy item {main_transaction_id}: {e_qr}")
             sent_invoice_msg = bot_instance.send_message(chat_id, invoice_text_md, reply_markup=markup_invoice, parse_mode="MarkdownV2")
-        finally:
-            if os.path.exists(qr_code_path):
-                try: os.remove(qr_code_path)
-                except Exception as e_rm: logger.error(f"Failed to remove QR code {qr_code_path}: {e_rm}")
     else:
-        logger.warning(f"HD Wallet (buy): QR code not generated or not found for {unique_address} (user {user_id}, tx {main_transaction_id}). Sending text invoice.")
+        logger.warning(f"HD Wallet (buy): QR code not generated for {unique_address} (user {user_id}, tx {main_transaction_id}). Sending text invoice.")
         sent_invoice_msg = bot_instance.send_message(chat_id, invoice_text_md, reply_markup=markup_invoice, parse_mode="MarkdownV2")
 
     if sent_invoice_msg:
@@ -777,17 +756,22 @@ def handle_buy_check_payment_callback(bot_instance, clear_user_state, get_user_s
                 except: pass # Best effort
         return
 
-    bot_instance.answer_callback_query(call.id)
-    ack_msg = bot_instance.send_message(chat_id, "⏳ Checking payment status (on-demand)...")
+    # Answer right away; the API check runs off the polling thread and edits the invoice when done.
+    bot_instance.answer_callback_query(call.id, "⏳ Checking payment status...")
+    payment_monitor.submit_on_demand_check(
+        transaction_id,
+        on_complete=lambda result: _show_buy_check_result(bot_instance, get_user_state, call, transaction_id, original_invoice_message_id, *result)
+    )
 
-    try:
-        newly_confirmed, status_info = payment_monitor.check_specific_pending_payment(transaction_id)
-        if ack_msg: delete_message(bot_instance, chat_id, ack_msg.message_id)
 
-        if newly_confirmed and status_info == 'confirmed_unprocessed':
-            logger.info(f"On-demand check for buy tx {transaction_id} (user {user_id}) resulted in new confirmation. Processing...")
+def _show_buy_check_result(bot_instance, get_user_state, call, transaction_id: int, original_invoice_message_id, newly_confirmed: bool, status_info: str | None):
+    """Edits the invoice with the outcome of an on-demand check. Runs on a payment-check worker thread."""
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    try:
+        if status_info in ('confirmed_unprocessed', 'processing'):
+            logger.info(f"On-demand check for buy tx {transaction_id} (user {user_id}) found a confirmed payment (newly_confirmed={newly_confirmed}). Finalization is queued by payment_monitor.")
             bot_instance.send_message(chat_id, "✅ Payment detected! Processing your purchase...")
-            payment_monitor.process_confirmed_payments(bot_instance) # This will call finalize
         else:
             logger.info(f"On-demand check for buy tx {transaction_id} (user {user_id}): newly_confirmed={newly_confirmed}, status_info='{status_info}'")
             pending_payment_latest = get_pending_payment_by_transaction_id(transaction_id) # Refresh data
@@ -796,8 +780,6 @@ def handle_buy_check_payment_callback(bot_instance, clear_user_state, get_user_s
             base_invoice_text = "\n".join([line for line in (current_invoice_text or "").split('\n') if not line.strip().startswith("Status:")])
 
             new_status_line = ""
-            alert_message = ""
-            show_alert_flag = True
             reply_markup_to_use = call.message.reply_markup # Keep existing buttons by default
 
             # For "Try Different Payment Method" button, we need the item context
@@ -808,16 +790,11 @@ def handle_buy_check_payment_callback(bot_instance, clear_user_state, get_user_s
             if status_info == 'monitoring':
                 confs = pending_payment_latest['confirmations'] if pending_payment_latest else 'N/A'
                 new_status_line = f"Status: Still monitoring for sufficient confirmations. Current: {confs}."
-                alert_message = f"Still monitoring. Confirmations: {confs}."
-                show_alert_flag = False
             elif status_info == 'monitoring_updated':
                 confs = pending_payment_latest['confirmations'] if pending_payment_latest else 'N/A'
                 new_status_line = f"Status: Monitoring updated. Current confirmations: {confs}."
-                alert_message = f"Monitoring updated. Confirmations: {confs}."
-                show_alert_flag = False
             elif status_info == 'expired':
                 new_status_line = f"Status: This payment request has expired."
-                alert_message = "This payment request has expired."
                 new_markup = types.InlineKeyboardMarkup(row_width=1)
                 if selected_size_for_back: # If we have size, we can go back to that item's payment options
                     new_markup.add(types.InlineKeyboardButton("⬅️ Try Different Payment Method", callback_data=f"select_size_{selected_size_for_back}"))
@@ -825,39 +802,34 @@ def handle_buy_check_payment_callback(bot_instance, clear_user_state, get_user_s
                 reply_markup_to_use = new_markup
             elif status_info == 'error_api':
                 new_status_line = f"Status: Could not check status due to a temporary API error. Please try again in a moment."
-                alert_message = "Could not check status due to an API error. Please try again."
             elif status_info == 'not_found':
                 new_status_line = f"Status: Payment record not found."
-                alert_message = "Payment record not found. This is unexpected."
                 reply_markup_to_use = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
             elif status_info in ['processed', 'cancelled_by_user', 'error_finalizing', 'error_finalizing_data', 'error_monitoring_unsupported', 'error_processing_tx_missing', 'processed_tx_already_complete']:
-                new_status_line = f"Status: Payment is in a final state: {escape_md(status_info)}."
-                alert_message = f"Payment status: {status_info}."
+                new_status_line = f"Status: Payment is in a final state: {status_info}."
                 reply_markup_to_use = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
             else:
-                new_status_line = f"Status: Current status: {escape_md(status_info)}."
-                alert_message = f"Current status: {status_info}."
+                new_status_line = f"Status: Current status: {status_info}."
                 if status_info != 'monitoring': # Non-monitoring, non-expired usually means terminal or error
                      reply_markup_to_use = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
 
+            # Message text comes back from Telegram without formatting, so the whole caption is escaped once here.
             updated_text_for_invoice = f"{new_status_line}\n\n{base_invoice_text}".strip()
-            if len(updated_text_for_invoice) > (1024 if call.message.photo else 4096): # Truncate
-                updated_text_for_invoice = updated_text_for_invoice[:(1021 if call.message.photo else 4093)] + "..."
+            if len(updated_text_for_invoice) > (1000 if call.message.photo else 4000): # Truncate, leaving room for escaping
+                updated_text_for_invoice = updated_text_for_invoice[:(997 if call.message.photo else 3997)] + "..."
+            updated_text_for_invoice = escape_md(updated_text_for_invoice)
 
             try:
                 if call.message.photo:
                     bot_instance.edit_message_caption(caption=updated_text_for_invoice, chat_id=chat_id, message_id=original_invoice_message_id, reply_markup=reply_markup_to_use, parse_mode="MarkdownV2")
                 else:
                     bot_instance.edit_message_text(text=updated_text_for_invoice, chat_id=chat_id, message_id=original_invoice_message_id, reply_markup=reply_markup_to_use, parse_mode="MarkdownV2")
-                bot_instance.answer_callback_query(call.id, alert_message, show_alert=show_alert_flag)
             except Exception as e_edit:
+                # Telegram rejects edits that don't change the message (e.g. repeated "still monitoring").
                 logger.error(f"Error editing message {original_invoice_message_id} for on-demand buy check (tx {transaction_id}): {e_edit}")
-                bot_instance.answer_callback_query(call.id, "Status updated, but message display failed to refresh.", show_alert=True)
 
     except Exception as e:
-        logger.exception(f"Error in handle_check_buy_payment_callback (on-demand) for user {user_id}, tx {transaction_id_str}: {e}")
-        if ack_msg: delete_message(bot_instance, chat_id, ack_msg.message_id)
-        bot_instance.answer_callback_query(call.id, "An error occurred while checking payment status. Please try again.", show_alert=True)
+        logger.exception(f"Error showing on-demand buy check result for user {user_id}, tx {transaction_id}: {e}")
 
 
 def handle_cancel_buy_payment_callback(bot_instance, clear_user_state, get_user_state, update_user_state, call):
@@ -894,6 +866,9 @@ def handle_cancel_buy_payment_callback(bot_instance, clear_user_state, get_user_
 
     if transaction_id:
         update_transaction_status(transaction_id, 'cancelled_by_user')
+        # A payment that was already confirmed still gets its item, so its reservation is kept
+        if not pending_payment or pending_payment['status'] in ('monitoring', 'expired'):
+            item_reservations.release(transaction_id=transaction_id)
     else:
         logger.error(f"Cancel buy callback with no valid transaction_id from data: {call.data}")
 
@@ -947,7 +922,7 @@ def finalize_successful_crypto_purchase(bot_instance, main_transaction_id: int,
         # Cannot notify user as we don't have chat_id if user_id is not chat_id
         return False # Critical error
 
-    item_details_json_str = transaction_details.get('item_details_json')
+    item_details_json_str = transaction_details['item_details_json']
     if not item_details_json_str:
         logger.error(f"finalize_successful_crypto_purchase: CRITICAL - item_details_json missing for tx {main_transaction_id}.")
         bot_instance.send_message(chat_id, f"Payment confirmed for TXID {main_transaction_id}, but there was a CRITICAL error fetching item details for delivery. Please contact support immediately.")
@@ -981,35 +956,40 @@ def finalize_successful_crypto_purchase(bot_instance, main_transaction_id: int,
     try:
         # 1. Adjust user balance if part of the payment was from balance
         if paid_from_balance_eur > Decimal('0.0'):
-            user_current_data = get_or_create_user(user_id)
-            if not user_current_data: # Should not happen if user exists for transaction
+            if not get_or_create_user(user_id): # Should not happen if user exists for transaction
                 logger.error(f"finalize_successful_crypto_purchase: Failed to get/create user {user_id} for tx {main_transaction_id} while adjusting balance.")
                 update_transaction_status(main_transaction_id, 'error_finalizing_user_data')
                 bot_instance.send_message(chat_id, f"Payment confirmed for {escape_md(item_display_name)}, TXID {main_transaction_id}. User data error during finalization. Please contact support.")
                 return False
 
-            current_balance_decimal = Decimal(str(user_current_data['balance']))
-            new_user_balance_decimal = current_balance_decimal - paid_from_balance_eur
-
-            if not update_user_balance(user_id, float(new_user_balance_decimal), increment_transactions=False): # Transaction already recorded, just adjust balance
+            # Debited at most once per transaction, even if finalization is retried.
+            debit_applied = apply_balance_change_once(f"tx:{main_transaction_id}:balance_debit", user_id,
+                                                      -float(paid_from_balance_eur), increment_transactions=False,
+                                                      transaction_id=main_transaction_id)
+            if debit_applied is None:
                 logger.error(f"finalize_successful_crypto_purchase: Failed to update balance for user {user_id} (tx {main_transaction_id}) after partial balance payment.")
                 update_transaction_status(main_transaction_id, 'error_finalizing_balance_update')
                 bot_instance.send_message(chat_id, f"Payment confirmed for {escape_md(item_display_name)}, TXID {main_transaction_id}. Balance update error. Please contact support.")
                 return False
 
-        # 2. Update main transaction status to 'completed'
-        if not update_transaction_status(main_transaction_id, 'completed'):
-            logger.warning(f"finalize_successful_crypto_purchase: Failed to update main transaction {main_transaction_id} status to 'completed'. Balance adjustment (if any) was done. User: {user_id}.")
-            # Continue, as payment is confirmed. Fulfillment is next.
-
         # 3. Increment user's overall transaction count for this purchase (if not already done by balance update)
         # The `update_user_balance` in the balance purchase path does `increment_transactions=True`.
-        # For crypto, this is the place to do it.
-        if not increment_user_transaction_count(user_id):
+        # For crypto, this is the place to do it: a zero balance change that counts the transaction, recorded in the
+        # ledger in the same DB transaction, so a failed increment is retried with the finalization.
+        if apply_balance_change_once(f"tx:{main_transaction_id}:transaction_count", user_id, 0.0,
+                                     increment_transactions=True, transaction_id=main_transaction_id) is None:
             logger.warning(f"finalize_successful_crypto_purchase: Failed to increment transaction count for user {user_id} (tx {main_transaction_id}).")
 
         # 4. Move the specific item instance to purchased folder using product_fs_utils
-        move_success = product_fs_utils.move_item_instance_to_purchased(original_instance_path, str(user_id))
+        # (skipped if a previous attempt at this finalization already moved it).
+        item_move_key = f"tx:{main_transaction_id}:item_moved"
+        if is_finalization_step_done(item_move_key):
+            logger.warning(f"finalize_successful_crypto_purchase: Item for tx {main_transaction_id} was already moved by an earlier attempt. Not moving again.")
+            move_success = True
+        else:
+            move_success = product_fs_utils.move_item_instance_to_purchased(original_instance_path, str(user_id))
+            if move_success:
+                mark_finalization_step_done(item_move_key, main_transaction_id)
 
         if not move_success:
             logger.error(f"finalize_successful_crypto_purchase: CRITICAL - Filesystem move FAILED for TXID {main_transaction_id}, instance path {original_instance_path}, user {user_id}.")
@@ -1018,6 +998,12 @@ def finalize_successful_crypto_purchase(bot_instance, main_transaction_id: int,
             return False
 
         logger.info(f"finalize_successful_crypto_purchase: Item instance '{original_instance_path}' moved for tx {main_transaction_id}, user {user_id}.")
+        item_reservations.consume(transaction_id=main_transaction_id)
+
+        # 2. Update main transaction status to 'completed' (only once the item is delivered, so a retried
+        # finalization is not short-circuited as "already completed" before the item has moved)
+        if not update_transaction_status(main_transaction_id, 'completed'):
+            logger.warning(f"finalize_successful_crypto_purchase: Failed to update main transaction {main_transaction_id} status to 'completed'. Balance adjustment (if any) and item move were done. User: {user_id}.")
 
         # 5. Send confirmation and delivery messages to user
         # Item details for delivery message (description, images) should be fetched from the *original* instance path *before* it's moved,
@@ -1048,20 +1034,20 @@ def finalize_successful_crypto_purchase(bot_instance, main_transaction_id: int,
 
 
         bot_instance.send_message(chat_id, f"✅ Payment confirmed for TXID {main_transaction_id}!")
-        bot_instance.send_message(chat_id, f"Funds have been successfully processed for your purchase of *{escape_md(product_db_data['name'])}*\\.", parse_mode="MarkdownV2")
+        bot_instance.send_message(chat_id, f"Funds have been successfully processed for your purchase of *{escape_md(item_display_name)}*\\.", parse_mode="MarkdownV2")
 
-        delivery_text = f"Item Details:\n{escape_md(item_display_details['description'])}"
+        delivery_text = f"Item Details:\n{escape_md(item_final_description)}"
         delivery_markup = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="back_to_main"))
 
         new_msg_id_for_state = None
-        delivery_images = item_display_details.get('image_paths', [])
+        delivery_images = item_final_images
         if delivery_images and isinstance(delivery_images, list) and len(delivery_images) > 0 and os.path.exists(delivery_images[0]):
             try:
                 with open(delivery_images[0], 'rb') as photo:
                     sent_delivery_msg = bot_instance.send_photo(chat_id, photo, caption=delivery_text, reply_markup=delivery_markup, parse_mode="MarkdownV2")
                     new_msg_id_for_state = sent_delivery_msg.message_id
             except Exception as e_photo:
-                logger.error(f"finalize_successful_crypto_purchase: Error sending delivery photo for product {product_id} (User {user_id}, TX {main_transaction_id}): {e_photo}")
+                logger.error(f"finalize_successful_crypto_purchase: Error sending delivery photo for item {original_instance_path} (User {user_id}, TX {main_transaction_id}): {e_photo}")
                 sent_delivery_msg = bot_instance.send_message(chat_id, delivery_text, reply_markup=delivery_markup, parse_mode="MarkdownV2")
                 new_msg_id_for_state = sent_delivery_msg.message_id
         else:
@@ -1070,8 +1056,9 @@ def finalize_successful_crypto_purchase(bot_instance, main_transaction_id: int,
 
         if new_msg_id_for_state:
             update_user_state(user_id, 'last_bot_message_id', new_msg_id_for_state)
+        record_payment_funnel_event('user_notified', transaction_id=main_transaction_id)
 
-        logger.info(f"finalize_successful_crypto_purchase: Successfully processed and delivered item for user {user_id}, tx {main_transaction_id}, product {product_id}.")
+        logger.info(f"finalize_successful_crypto_purchase: Successfully processed and delivered item for user {user_id}, tx {main_transaction_id}, item {original_instance_path}.")
         return True
 
     except sqlite3.Error as e_sql: # More specific for database issues during finalization
@@ -1,4 +1,9 @@
+import sys
+
 import bot
 
 if __name__ == '__main__':
-    bot.start_bot()
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        bot.start_worker() # Background jobs only (payment checks, finalization, expiry notices)
+    else:
+        bot.start_bot()
@@ -0,0 +1,85 @@
+import logging
+import datetime
+
+import config
+from modules import db_utils
+from modules import hd_wallet_utils
+from modules import metrics
+
+logger = logging.getLogger(__name__)
+
+# Keeps a stock of pre-derived, validated receiving addresses per derivation coin in the address_pool
+# table, so creating a dedicated-address invoice only has to claim a row instead of allocating an HD
+# index and deriving while the user waits. QR codes are rendered per invoice, since they carry the amount.
+#
+# The refill job tops a coin up to ADDRESS_POOL_HIGH_WATER_MARK once it drops below
+# ADDRESS_POOL_LOW_WATER_MARK. The block is derived first and then stored together with the HD index
+# update in one transaction, so indices are never used up by a failed derivation. Addresses are
+# handed out lowest index first. Unclaimed pool addresses are indices nobody has paid to yet, so keep the
+# high-water mark within the gap limit wallets use for recovery (20 by default).
+
+ADDRESS_POOL_ENABLED = getattr(config, 'ADDRESS_POOL_ENABLED', True)
+ADDRESS_POOL_LOW_WATER_MARK = getattr(config, 'ADDRESS_POOL_LOW_WATER_MARK', 5)
+ADDRESS_POOL_HIGH_WATER_MARK = getattr(config, 'ADDRESS_POOL_HIGH_WATER_MARK', 15)
+ADDRESS_POOL_CLAIMED_RETENTION_DAYS = 7 # Claimed rows are only kept for troubleshooting
+ADDRESS_POOL_REFILL_ATTEMPTS = 3 # Derivations retried when invoices take the next index meanwhile
+
+POOL_HD_COINS = tuple(hd_wallet_utils.COIN_MAP) # 'BTC', 'LTC', 'TRX'
+
+
+def refill_pool(hd_coin_symbol: str) -> int:
+    """Tops up one coin's pool if it is below the low-water mark. Returns the number of addresses added."""
+    available = db_utils.get_address_pool_counts().get(hd_coin_symbol, 0)
+    if available >= ADDRESS_POOL_LOW_WATER_MARK:
+        return 0
+    count = ADDRESS_POOL_HIGH_WATER_MARK - available
+    for _ in range(ADDRESS_POOL_REFILL_ATTEMPTS):
+        last_used_index = db_utils.get_last_used_address_index(hd_coin_symbol)
+        first_index = (last_used_index if last_used_index is not None else -1) + 1
+        addresses = hd_wallet_utils.generate_addresses(hd_coin_symbol, first_index, count)
+        if not addresses:
+            logger.error(f"Address pool: failed to derive {hd_coin_symbol} addresses {first_index}..{first_index + count - 1}; no indices used.")
+            return 0
+
+        entries = []
+        for hd_index, address in enumerate(addresses, start=first_index):
+            if not hd_wallet_utils.validate_address(hd_coin_symbol, address):
+                logger.error(f"Address pool: derived {hd_coin_symbol} address {address} at index {hd_index} failed validation; skipped.")
+                continue
+            entries.append((address, hd_index))
+        added = db_utils.add_address_pool_block(hd_coin_symbol, first_index, count, entries)
+        if added is None:
+            logger.info(f"Address pool: {hd_coin_symbol} index {first_index} was taken while deriving; deriving again.")
+            continue
+        logger.info(f"Address pool: added {added} {hd_coin_symbol} address(es) (indices {first_index}..{first_index + count - 1}); {available + added} available.")
+        return added
+    logger.warning(f"Address pool: {hd_coin_symbol} indices kept moving during refill; retrying next run.")
+    return 0
+
+
+def refill_pools():
+    """Refill job: tops up every coin's pool and drops old claimed rows."""
+    for hd_coin_symbol in POOL_HD_COINS:
+        try:
+            refill_pool(hd_coin_symbol)
+        except Exception as e:
+            logger.exception(f"Address pool: refill of {hd_coin_symbol} failed: {e}")
+    db_utils.delete_claimed_address_pool_entries(datetime.datetime.utcnow() - datetime.timedelta(days=ADDRESS_POOL_CLAIMED_RETENTION_DAYS))
+
+
+def claim_pool_address(hd_coin_symbol: str) -> tuple[str, int] | None:
+    """Takes the next pooled address as (address, hd_index), or None if the pool is empty or disabled."""
+    if not ADDRESS_POOL_ENABLED:
+        return None
+    row = db_utils.claim_address_pool_entry(hd_coin_symbol)
+    metrics.record_cache_lookup('address_pool', row is not None)
+    if row is None:
+        logger.warning(f"Address pool for {hd_coin_symbol} is empty; deriving on the request path.")
+        return None
+    return row['address'], row['hd_index']
+
+
+def return_unused_address(address: str):
+    """Puts a claimed address back when its invoice could not be created."""
+    if db_utils.release_address_pool_entry(address):
+        logger.info(f"Address pool: returned unused address {address}.")
@@ -0,0 +1,94 @@
+import logging
+import datetime
+
+import config
+from modules import db_utils
+from modules import blockchain_apis
+from modules.blockchain_apis import BlockchainAPIError
+
+logger = logging.getLogger(__name__)
+
+# Returns the dedicated addresses of expired, never-funded invoices to a per-coin free pool, so that
+# abandoned invoices do not permanently consume HD indices (and widen the range wallet recovery has to scan).
+#
+# An expired invoice without any detected transaction registers its address as a 'candidate'. Once
+# ADDRESS_RECYCLE_GRACE_MINUTES have passed (late or slow payments), the address history is fetched once
+# more; an address that still never received anything becomes 'free', anything else is 'retired' for good.
+# payment_invoicing hands out 'free' addresses before deriving a new index. Invoices on a recycled address
+# only accept transactions seen after they were created (see payment_monitor._fetch_api_transactions).
+
+ADDRESS_RECYCLING_ENABLED = getattr(config, 'ADDRESS_RECYCLING_ENABLED', True)
+ADDRESS_RECYCLE_GRACE_MINUTES = getattr(config, 'ADDRESS_RECYCLE_GRACE_MINUTES', 24 * 60)
+ADDRESS_RECYCLE_RECHECK_BATCH_SIZE = getattr(config, 'ADDRESS_RECYCLE_RECHECK_BATCH_SIZE', 50)
+
+HD_COIN_BY_PAYMENT_COIN = {"BTC": "BTC", "LTC": "LTC", "USDT_TRX": "TRX"}
+
+
+def register_expired_invoice_address(payment) -> bool:
+    """Queues a dedicated invoice's address for a recheck if the invoice expired without any transaction."""
+    if not ADDRESS_RECYCLING_ENABLED:
+        return False
+    keys = payment.keys()
+    if 'invoice_mode' in keys and payment['invoice_mode'] == 'shared':
+        return False
+    if payment['blockchain_tx_id']:
+        return False
+    hd_index = payment['hd_index'] if 'hd_index' in keys else None
+    hd_coin_symbol = HD_COIN_BY_PAYMENT_COIN.get(payment['coin_symbol'])
+    if hd_index is None or hd_coin_symbol is None:
+        return False
+
+    recheck_after = datetime.datetime.utcnow() + datetime.timedelta(minutes=ADDRESS_RECYCLE_GRACE_MINUTES)
+    registered = db_utils.add_address_recycle_candidate(hd_coin_symbol, payment['coin_symbol'], payment['address'],
+                                                       hd_index, payment['payment_id'], recheck_after)
+    if registered:
+        logger.info(f"Address {payment['address']} of expired payment {payment['payment_id']} queued for recycling recheck after {recheck_after.isoformat()}.")
+    return registered
+
+
+def recheck_recycle_candidates():
+    """Rechecks candidates whose grace period has passed and frees or retires them."""
+    candidates = db_utils.get_due_address_recycle_candidates(ADDRESS_RECYCLE_RECHECK_BATCH_SIZE)
+    if not candidates:
+        logger.debug("No address recycle candidates due for a recheck.")
+        return
+
+    freed_count = retired_count = 0
+    for candidate in candidates:
+        address = candidate['address']
+        try:
+            transactions = blockchain_apis.get_incoming_transactions(candidate['payment_coin_symbol'], address)
+        except BlockchainAPIError as e_api:
+            logger.warning(f"Recycling recheck of {address} failed, will retry next run: {e_api}")
+            continue
+        if transactions is None:
+            logger.error(f"Recycling recheck: unsupported coin '{candidate['payment_coin_symbol']}' for address {address}; retiring it.")
+            db_utils.set_recycled_address_status(address, 'retired', expected_current_status='candidate')
+            retired_count += 1
+            continue
+
+        if transactions:
+            logger.warning(f"Address {address} (payment {candidate['source_payment_id']}) received {len(transactions)} transaction(s) "
+                           f"after its invoice expired; retiring it. Review for a late payment.")
+            db_utils.set_recycled_address_status(address, 'retired', expected_current_status='candidate')
+            retired_count += 1
+        elif db_utils.set_recycled_address_status(address, 'free', expected_current_status='candidate'):
+            freed_count += 1
+
+    logger.info(f"Address recycling recheck: {freed_count} freed, {retired_count} retired, {len(candidates) - freed_count - retired_count} deferred.")
+
+
+def claim_recycled_address(hd_coin_symbol: str) -> tuple[str, int] | None:
+    """Takes a free recycled address for the derivation coin. Returns (address, hd_index) or None."""
+    if not ADDRESS_RECYCLING_ENABLED:
+        return None
+    row = db_utils.claim_free_recycled_address(hd_coin_symbol)
+    if not row:
+        return None
+    logger.info(f"Reusing recycled {hd_coin_symbol} address {row['address']} (index {row['hd_index']}).")
+    return row['address'], row['hd_index']
+
+
+def return_unused_address(address: str):
+    """Puts a claimed address back into the free pool when the invoice using it could not be created."""
+    db_utils.set_recycled_address_status(address, 'free', expected_current_status='claimed')
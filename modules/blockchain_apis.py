@@ -1,9 +1,12 @@
 import logging
 import requests
 import time
+import threading
 import config
 from decimal import Decimal, InvalidOperation
 import json # For JSONDecodeError
+from modules import http_client
+from modules import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -36,32 +39,30 @@ class BlockchainAPIBadResponseError(BlockchainAPIError):
     pass
 
 
-# API Base URLs
-BLOCKSTREAM_API_BASE_URL_BTC = "https://blockstream.info/api"
-BLOCKCYPHER_API_BASE_URL_LTC = "https://api.blockcypher.com/v1/ltc/main"
-TRONGRID_API_BASE_URL = "https://api.trongrid.io"
+# API Base URLs (overridable in config, e.g. to point at tools/fake_blockchain_provider.py)
+BLOCKSTREAM_API_BASE_URL_BTC = getattr(config, 'BLOCKSTREAM_API_BASE_URL_BTC', "https://blockstream.info/api")
+BLOCKCYPHER_API_BASE_URL_LTC = getattr(config, 'BLOCKCYPHER_API_BASE_URL_LTC', "https://api.blockcypher.com/v1/ltc/main")
+TRONGRID_API_BASE_URL = getattr(config, 'TRONGRID_API_BASE_URL', "https://api.trongrid.io")
+
+# Provider serving each pending-payment coin, recorded on payments for latency reporting.
+PROVIDER_BY_COIN = {"BTC": "blockstream", "LTC": "blockcypher", "USDT_TRX": "trongrid"}
 
 REQUESTS_HEADERS = {
     'User-Agent': 'TelegramCryptoBot/1.0'
 }
-DEFAULT_TIMEOUT = 15 # seconds
+DEFAULT_TIMEOUT = 15 # Read timeout in seconds; the connect timeout comes from http_client
 
 def _make_request(url: str, method: str = "GET", params: dict = None, headers: dict = None, data: dict = None) -> requests.Response:
-    """Makes an HTTP request and handles common errors, raising custom exceptions."""
+    """Makes an HTTP request through the shared pooled client and handles common errors, raising custom exceptions."""
     effective_headers = REQUESTS_HEADERS.copy()
     if headers:
         effective_headers.update(headers)
 
     try:
-        if method.upper() == "GET":
-            response = requests.get(url, params=params, headers=effective_headers, timeout=DEFAULT_TIMEOUT)
-        elif method.upper() == "POST":
-            response = requests.post(url, params=params, headers=effective_headers, json=data, timeout=DEFAULT_TIMEOUT)
-        else:
+        if method.upper() not in ("GET", "POST"):
             raise ValueError(f"Unsupported HTTP method: {method}")
-
-        response.raise_for_status() # Raises HTTPError for 4xx/5xx
-        return response
+        # http_client raises HTTPError for 4xx/5xx, GETs are retried on transient 5xx/connection errors.
+        return http_client.request(method, url, params=params, headers=effective_headers, json_body=data, timeout=DEFAULT_TIMEOUT)
     except requests.exceptions.Timeout as e:
         logger.warning(f"API Timeout for URL: {url}. Error: {e}")
         raise BlockchainAPITimeoutError(f"Request timed out: {url}", underlying_exception=e)
@@ -85,51 +86,123 @@ def _make_request(url: str, method: str = "GET", params: dict = None, headers: d
         raise BlockchainAPIError(f"Generic API request error for: {url}", underlying_exception=e)
 
 
-def get_address_transactions_btc(address: str) -> list[dict]:
+# --- Chain tip heights (shared by all addresses of a coin) ---
+# Confirmations for already-known transactions are computed as tip - block_height + 1,
+# so one cached tip lookup per coin replaces a history download per address.
+TIP_HEIGHT_CACHE_SECONDS = getattr(config, 'BLOCKCHAIN_TIP_HEIGHT_CACHE_SECONDS', 20)
+LTC_CURSOR_REORG_MARGIN_BLOCKS = 2 # BlockCypher `after` is set this many blocks below the tip to tolerate races/reorgs
+TRONGRID_MAX_PAGES_PER_CHECK = 5
+_tip_height_cache = {} # {"BTC": {"height": 850000, "fetched_at": 1700000000.0}}
+_tip_height_lock = threading.Lock()
+
+
+def get_chain_tip_height(coin_symbol: str) -> int | None:
+    """Returns the current block height for BTC or LTC, cached for TIP_HEIGHT_CACHE_SECONDS. None on failure."""
+    with _tip_height_lock:
+        cached = _tip_height_cache.get(coin_symbol)
+        if cached and time.time() - cached['fetched_at'] < TIP_HEIGHT_CACHE_SECONDS:
+            metrics.record_cache_lookup('chain_tip_height', True)
+            return cached['height']
+    metrics.record_cache_lookup('chain_tip_height', False)
+    try:
+        if coin_symbol == "BTC":
+            height = int(_make_request(f"{BLOCKSTREAM_API_BASE_URL_BTC}/blocks/tip/height").text)
+        elif coin_symbol == "LTC":
+            params = {'token': config.BLOCKCYPHER_API_TOKEN} if config.BLOCKCYPHER_API_TOKEN else None
+            height = int(_make_request(BLOCKCYPHER_API_BASE_URL_LTC, params=params).json()['height'])
+        else:
+            return None
+    except Exception as e_tip:
+        logger.warning(f"Could not fetch {coin_symbol} current block height: {e_tip}. Confirmations might be less accurate.")
+        return None
+    with _tip_height_lock:
+        _tip_height_cache[coin_symbol] = {'height': height, 'fetched_at': time.time()}
+    return height
+
+
+def _make_conditional_request(url: str, cursor: dict, etag_key: str, params: dict = None, headers: dict = None) -> requests.Response | None:
+    """GET with If-None-Match when the cursor holds an ETag for this resource. Returns None on 304 Not Modified."""
+    effective_headers = dict(headers or {})
+    etags = cursor.setdefault('etags', {})
+    if etags.get(etag_key):
+        effective_headers['If-None-Match'] = etags[etag_key]
+    response = _make_request(url, params=params, headers=effective_headers)
+    if response.status_code == 304:
+        return None
+    if response.headers.get('ETag'):
+        etags[etag_key] = response.headers['ETag']
+    else:
+        etags.pop(etag_key, None)
+    return response
+
+
+def _merge_btc_txs(raw_txs: list, address: str, known_txs: dict):
+    """Merges incoming Blockstream txs into known_txs ({txid: {...}}). Blockstream lists mempool txs first,
+    then confirmed txs newest first, so parsing stops at the first already-known confirmed tx."""
+    for tx in raw_txs:
+        tx_status = tx.get('status', {})
+        is_confirmed_api = tx_status.get('confirmed', False)
+        known = known_txs.get(tx['txid'])
+        if known and known['block_height'] is not None and is_confirmed_api:
+            break
+
+        total_value_to_address = Decimal('0')
+        for vout in tx.get('vout', []):
+            if vout.get('scriptpubkey_address') == address:
+                total_value_to_address += Decimal(vout['value'])
+
+        if total_value_to_address > 0:
+            known_txs[tx['txid']] = {
+                'amount': str(total_value_to_address),
+                'block_height': tx_status.get('block_height') if is_confirmed_api else None,
+                'block_time': tx_status.get('block_time'),
+            }
+
+
+def get_address_transactions_btc(address: str, cursor: dict | None = None) -> list[dict]:
+    """
+    Returns incoming BTC transactions for `address`.
+    When a `cursor` dict (persisted per pending payment) is passed, it is updated in place and the full
+    history is only downloaded when a small /address/{addr} stats probe shows new activity. Known txs are
+    kept in the cursor and their confirmations recomputed from the shared chain tip height.
+    """
     url = f"{BLOCKSTREAM_API_BASE_URL_BTC}/address/{address}/txs"
     logger.debug(f"Fetching BTC transactions for address {address} from URL: {url}")
     try:
-        response = _make_request(url)
-        raw_txs = response.json()
-        processed_txs = []
+        if cursor is None:
+            known_txs = {}
+            _merge_btc_txs(_make_request(url).json(), address, known_txs)
+        else:
+            known_txs = cursor.setdefault('txs', {})
+            stats_response = _make_conditional_request(f"{BLOCKSTREAM_API_BASE_URL_BTC}/address/{address}", cursor, 'stats')
+            if stats_response is not None:
+                stats = stats_response.json()
+                fingerprint = f"{stats['chain_stats']['tx_count']}:{stats['mempool_stats']['tx_count']}"
+                if fingerprint != cursor.get('fingerprint'):
+                    _merge_btc_txs(_make_request(url).json(), address, known_txs)
+                    cursor['fingerprint'] = fingerprint
+                else:
+                    logger.debug(f"No new BTC activity for address {address} (fingerprint {fingerprint}).")
 
-        # To get actual confirmations, we need the current block height.
-        # Fetching it for every call to this function might be too much.
-        # For now, if Blockstream says 'confirmed', we'll use a high number.
-        # The payment_monitor will ultimately decide based on its configured min_confirmations.
         current_btc_height = None
-        try:
-            tip_height_url = f"{BLOCKSTREAM_API_BASE_URL_BTC}/blocks/tip/height"
-            tip_response = _make_request(tip_height_url) # Shorter timeout for this one maybe
-            current_btc_height = int(tip_response.text)
-        except Exception as e_tip:
-            logger.warning(f"Could not fetch BTC current block height: {e_tip}. Confirmations might be less accurate.")
+        if any(tx_info['block_height'] is not None for tx_info in known_txs.values()):
+            current_btc_height = get_chain_tip_height("BTC")
 
-
-        for tx in raw_txs:
-            total_value_to_address = Decimal('0')
-            for vout in tx.get('vout', []):
-                if vout.get('scriptpubkey_address') == address:
-                    total_value_to_address += Decimal(vout['value'])
-
-            if total_value_to_address > 0:
-                tx_status = tx.get('status', {})
-                is_confirmed_api = tx_status.get('confirmed', False)
-                tx_block_height = tx_status.get('block_height')
-                confirmations = 0
-
-                if is_confirmed_api and tx_block_height is not None and current_btc_height is not None:
-                    confirmations = current_btc_height - tx_block_height + 1
-                elif is_confirmed_api: # Confirmed but couldn't get tip or block_height from this tx
-                    confirmations = getattr(config, "MIN_CONFIRMATIONS_BTC", 1) # Default to configured min if confirmed by API
-
-                processed_txs.append({
-                    'txid': tx['txid'],
-                    'amount_satoshi': str(total_value_to_address),
-                    'confirmations': confirmations,
-                    'block_height': tx_block_height,
-                    'block_time': tx_status.get('block_time'),
-                })
+        processed_txs = []
+        for txid, tx_info in known_txs.items():
+            confirmations = 0
+            if tx_info['block_height'] is not None and current_btc_height is not None:
+                confirmations = current_btc_height - tx_info['block_height'] + 1
+            elif tx_info['block_height'] is not None: # Confirmed but couldn't get tip height
+                confirmations = getattr(config, "MIN_CONFIRMATIONS_BTC", 1) # Default to configured min if confirmed by API
+
+            processed_txs.append({
+                'txid': txid,
+                'amount_satoshi': tx_info['amount'],
+                'confirmations': confirmations,
+                'block_height': tx_info['block_height'],
+                'block_time': tx_info['block_time'],
+            })
         logger.info(f"Found {len(processed_txs)} incoming BTC transactions for address {address}.")
         return processed_txs
     except json.JSONDecodeError as e:
@@ -142,17 +215,27 @@ def get_address_transactions_btc(address: str) -> list[dict]:
         raise BlockchainAPIError(f"Unexpected error during BTC API call for {address}", underlying_exception=e)
 
 
-def get_address_transactions_ltc(address: str) -> list[dict]:
-    url = f"{BLOCKCYPHER_API_BASE_URL_LTC}/addrs/{address}/full?limit=50"
-    params = {}
+def get_address_transactions_ltc(address: str, cursor: dict | None = None) -> list[dict]:
+    """
+    Returns incoming LTC transactions for `address`.
+    With a `cursor`, only blocks above the cursor's `after_height` are requested from BlockCypher
+    (a full page is re-read only while a known tx is still unconfirmed), and confirmations of
+    known txs are recomputed from the shared chain tip height.
+    """
+    url = f"{BLOCKCYPHER_API_BASE_URL_LTC}/addrs/{address}/full"
+    params = {'limit': 50}
     if config.BLOCKCYPHER_API_TOKEN:
         params['token'] = config.BLOCKCYPHER_API_TOKEN
 
-    logger.debug(f"Fetching LTC transactions for address {address} from BlockCypher.")
+    known_txs = {} if cursor is None else cursor.setdefault('txs', {})
+    if cursor is not None and cursor.get('after_height') is not None:
+        if all(tx_info['block_height'] is not None for tx_info in known_txs.values()):
+            params['after'] = cursor['after_height']
+
+    logger.debug(f"Fetching LTC transactions for address {address} from BlockCypher (after={params.get('after')}).")
     try:
         response = _make_request(url, params=params)
         data = response.json()
-        processed_txs = []
 
         for tx in data.get('txs', []):
             total_value_to_address = Decimal('0')
@@ -161,14 +244,32 @@ def get_address_transactions_ltc(address: str) -> list[dict]:
                     total_value_to_address += Decimal(vout['value'])
 
             if total_value_to_address > 0:
-                confirmations = tx.get('confirmations', 0) # Blockcypher provides this directly
-                processed_txs.append({
-                    'txid': tx['hash'],
-                    'amount_litoshi': str(total_value_to_address),
-                    'confirmations': confirmations,
-                    'block_height': tx.get('block_height'),
+                block_height = tx.get('block_height')
+                known_txs[tx['hash']] = {
+                    'amount': str(total_value_to_address),
+                    'block_height': block_height if block_height is not None and block_height >= 0 else None,
                     'received_time': tx.get('received'),
-                })
+                    'confirmations': tx.get('confirmations', 0), # Blockcypher provides this directly
+                }
+
+        current_ltc_height = None
+        if cursor is not None:
+            current_ltc_height = get_chain_tip_height("LTC")
+            if current_ltc_height is not None:
+                cursor['after_height'] = max(0, current_ltc_height - LTC_CURSOR_REORG_MARGIN_BLOCKS)
+
+        processed_txs = []
+        for txid, tx_info in known_txs.items():
+            confirmations = tx_info['confirmations']
+            if tx_info['block_height'] is not None and current_ltc_height is not None:
+                confirmations = max(confirmations, current_ltc_height - tx_info['block_height'] + 1)
+            processed_txs.append({
+                'txid': txid,
+                'amount_litoshi': tx_info['amount'],
+                'confirmations': confirmations,
+                'block_height': tx_info['block_height'],
+                'received_time': tx_info['received_time'],
+            })
         logger.info(f"Found {len(processed_txs)} incoming LTC transactions for address {address}.")
         return processed_txs
     except json.JSONDecodeError as e:
@@ -181,50 +282,76 @@ def get_address_transactions_ltc(address: str) -> list[dict]:
         raise BlockchainAPIError(f"Unexpected error during LTC API call for {address}", underlying_exception=e)
 
 
-def get_trc20_transfers_usdt_trx(address: str, since_timestamp_ms: int = 0) -> list[dict]:
+def get_trc20_transfers_usdt_trx(address: str, since_timestamp_ms: int = 0, cursor: dict | None = None) -> list[dict]:
+    """
+    Returns incoming USDT-TRC20 transfers for `address` since `since_timestamp_ms`.
+    With a `cursor`, min_block_timestamp resumes from the newest transfer already seen (or the oldest one
+    still unconfirmed), and TronGrid's `fingerprint` is followed if a check spans more than one page.
+    """
     url = f"{TRONGRID_API_BASE_URL}/v1/accounts/{address}/transactions/trc20"
+    known_txs = {} if cursor is None else cursor.setdefault('txs', {})
+    min_block_timestamp = since_timestamp_ms
+    if cursor is not None:
+        unconfirmed_timestamps = [tx_info['timestamp_ms'] for tx_info in known_txs.values() if not tx_info['confirmed']]
+        if unconfirmed_timestamps:
+            min_block_timestamp = max(since_timestamp_ms, min(unconfirmed_timestamps))
+        elif cursor.get('min_block_timestamp') is not None:
+            min_block_timestamp = max(since_timestamp_ms, cursor['min_block_timestamp'])
+
     params = {
         'limit': 50,
         'contract_address': config.USDT_TRC20_CONTRACT_ADDRESS,
         'only_to': 'true',
-        'min_block_timestamp': since_timestamp_ms,
+        'min_block_timestamp': min_block_timestamp,
     }
     headers = {} # Local headers for this function
     if config.TRONGRID_API_KEY:
         headers['TRON-PRO-API-KEY'] = config.TRONGRID_API_KEY # Corrected header key
 
-    logger.debug(f"Fetching TRC20 USDT transactions for address {address} since {since_timestamp_ms} from TronGrid.")
+    logger.debug(f"Fetching TRC20 USDT transactions for address {address} since {min_block_timestamp} from TronGrid.")
     try:
-        response = _make_request(url, params=params, headers=headers)
-        data = response.json()
-        processed_txs = []
+        for _ in range(TRONGRID_MAX_PAGES_PER_CHECK if cursor is not None else 1):
+            response = _make_request(url, params=params, headers=headers)
+            data = response.json()
+
+            if not (data.get('success') and 'data' in data):
+                logger.error(f"TronGrid API error for address {address}: Success flag false or no data. Response: {data.get('meta', data)}")
+                # Consider raising BlockchainAPIBadResponseError if success is consistently false
+                raise BlockchainAPIBadResponseError(f"TronGrid API indicated failure for {address}. Meta: {data.get('meta')}")
 
-        if data.get('success') and 'data' in data:
             for transfer in data['data']:
                 # Ensure it's the correct token and an incoming transfer
                 if transfer.get('token_info', {}).get('symbol') == 'USDT' and \
                    transfer.get('to', '').lower() == address.lower():
+                    known_txs[transfer['transaction_id']] = {
+                        'amount': str(transfer['value']),
+                        'decimals': int(transfer['token_info'].get('decimals', 6)),
+                        # TronGrid /trc20 endpoint data objects have a 'confirmed' boolean.
+                        'confirmed': bool(transfer.get('confirmed', False)), # Default to False if not present
+                        'timestamp_ms': transfer['block_timestamp'],
+                    }
 
-                    amount_smallest_unit = transfer['value']
+            next_fingerprint = data.get('meta', {}).get('fingerprint')
+            if not next_fingerprint:
+                break
+            params['fingerprint'] = next_fingerprint
 
-                    # TronGrid /trc20 endpoint data objects have a 'confirmed' boolean.
-                    is_confirmed_api = transfer.get('confirmed', False) # Default to False if not present
-                    confirmations = getattr(config, "MIN_CONFIRMATIONS_TRX", 10) if is_confirmed_api else 0
+        if cursor is not None and known_txs:
+            # min_block_timestamp is inclusive; transfers at the boundary are de-duplicated by txid.
+            cursor['min_block_timestamp'] = max(tx_info['timestamp_ms'] for tx_info in known_txs.values())
 
-                    processed_txs.append({
-                        'txid': transfer['transaction_id'],
-                        'amount_smallest_unit': str(amount_smallest_unit),
-                        'token_symbol': 'USDT',
-                        'decimals': int(transfer['token_info'].get('decimals', 6)),
-                        'confirmations': confirmations, # Use API confirmed status
-                        'timestamp_ms': transfer['block_timestamp'],
-                    })
-            logger.info(f"Found {len(processed_txs)} incoming TRC20 USDT transfers for address {address}.")
-            return processed_txs
-        else:
-            logger.error(f"TronGrid API error for address {address}: Success flag false or no data. Response: {data.get('meta', data)}")
-            # Consider raising BlockchainAPIBadResponseError if success is consistently false
-            raise BlockchainAPIBadResponseError(f"TronGrid API indicated failure for {address}. Meta: {data.get('meta')}")
+        processed_txs = []
+        for txid, tx_info in known_txs.items():
+            processed_txs.append({
+                'txid': txid,
+                'amount_smallest_unit': tx_info['amount'],
+                'token_symbol': 'USDT',
+                'decimals': tx_info['decimals'],
+                'confirmations': getattr(config, "MIN_CONFIRMATIONS_TRX", 10) if tx_info['confirmed'] else 0, # Use API confirmed status
+                'timestamp_ms': tx_info['timestamp_ms'],
+            })
+        logger.info(f"Found {len(processed_txs)} incoming TRC20 USDT transfers for address {address}.")
+        return processed_txs
 
     except json.JSONDecodeError as e:
         logger.exception(f"TRC20 API JSONDecodeError for address {address}. URL: {url}. Error: {e}")
@@ -236,6 +363,54 @@ def get_trc20_transfers_usdt_trx(address: str, since_timestamp_ms: int = 0) -> l
         raise BlockchainAPIError(f"Unexpected error during TRC20 API call for {address}", underlying_exception=e)
 
 
+def get_incoming_transactions(coin_symbol: str, address: str) -> list[dict] | None:
+    """Full incoming history of an address for a pending-payment coin ('BTC', 'LTC', 'USDT_TRX'); None for other coins."""
+    if coin_symbol == "BTC":
+        return get_address_transactions_btc(address)
+    if coin_symbol == "LTC":
+        return get_address_transactions_ltc(address)
+    if coin_symbol == "USDT_TRX":
+        return get_trc20_transfers_usdt_trx(address)
+    return None
+
+
+def get_address_summary(coin_symbol: str, address: str) -> dict:
+    """
+    Returns {'tx_count': int, 'received': int, 'balance': int} for an address, amounts in smallest units,
+    from the providers' lightweight address endpoints (used by wallet discovery to find used indices).
+    For USDT_TRX, tx_count and received cover the first page of incoming USDT transfers only, and
+    'account_active' tells whether the Tron account exists at all (it is created by any incoming TRX or
+    token transfer), so addresses that only ever saw TRX are not mistaken for unused ones.
+    """
+    try:
+        if coin_symbol == "BTC":
+            stats = _make_request(f"{BLOCKSTREAM_API_BASE_URL_BTC}/address/{address}").json()
+            chain_stats, mempool_stats = stats['chain_stats'], stats['mempool_stats']
+            funded = chain_stats.get('funded_txo_sum', 0) + mempool_stats.get('funded_txo_sum', 0)
+            spent = chain_stats.get('spent_txo_sum', 0) + mempool_stats.get('spent_txo_sum', 0)
+            return {'tx_count': chain_stats['tx_count'] + mempool_stats['tx_count'], 'received': funded, 'balance': funded - spent}
+        if coin_symbol == "LTC":
+            params = {'token': config.BLOCKCYPHER_API_TOKEN} if config.BLOCKCYPHER_API_TOKEN else None
+            data = _make_request(f"{BLOCKCYPHER_API_BASE_URL_LTC}/addrs/{address}/balance", params=params).json()
+            return {'tx_count': int(data.get('final_n_tx', data.get('n_tx', 0))), 'received': int(data.get('total_received', 0)),
+                    'balance': int(data.get('final_balance', 0))}
+        if coin_symbol == "USDT_TRX":
+            transfers = get_trc20_transfers_usdt_trx(address)
+            headers = {'TRON-PRO-API-KEY': config.TRONGRID_API_KEY} if config.TRONGRID_API_KEY else None
+            account_data = _make_request(f"{TRONGRID_API_BASE_URL}/v1/accounts/{address}", headers=headers).json().get('data') or []
+            balance = 0
+            for token_balance in (account_data[0].get('trc20') or []) if account_data else []:
+                if config.USDT_TRC20_CONTRACT_ADDRESS in token_balance:
+                    balance = int(token_balance[config.USDT_TRC20_CONTRACT_ADDRESS])
+            return {'tx_count': len(transfers), 'received': sum(int(transfer['amount_smallest_unit']) for transfer in transfers),
+                    'balance': balance, 'account_active': bool(account_data)}
+    except json.JSONDecodeError as e:
+        raise BlockchainAPIBadResponseError(f"Failed to decode address summary for {coin_symbol} {address}", underlying_exception=e)
+    except (KeyError, TypeError, ValueError) as e:
+        raise BlockchainAPIBadResponseError(f"Unexpected address summary format for {coin_symbol} {address}: {e}", underlying_exception=e)
+    raise ValueError(f"Unsupported coin for address summary: {coin_symbol}")
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     logger.info("Blockchain API module - Self-Test Mode (most tests skipped if placeholder addresses are not changed).")
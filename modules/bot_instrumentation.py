@@ -0,0 +1,120 @@
+import logging
+import time
+import datetime
+
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+
+from modules import db_utils
+from modules import metrics
+
+logger = logging.getLogger(__name__)
+
+# Hooks the bot process into the metrics registry (see modules/metrics.py):
+# per-update handler latency, Telegram Bot API call latency/errors and scrape-time gauges for the
+# payment and job backlogs. db_utils, http_client, worker_runtime and the caches record their own metrics.
+
+HANDLER_SECONDS = metrics.histogram('bot_update_handler_seconds', 'Time to process one Telegram update, by handler key.', ('handler',))
+TELEGRAM_API_SECONDS = metrics.histogram('bot_telegram_api_seconds', 'Telegram Bot API call latency by method.', ('method',))
+TELEGRAM_API_ERRORS = metrics.counter('bot_telegram_api_errors_total', 'Failed Telegram Bot API calls by method and error code.', ('method', 'error_code'))
+
+MAX_CALLBACK_PREFIX_TOKENS = 4
+
+
+def callback_prefix(callback_data: str) -> str:
+    """'check_bal_payment_42' -> 'check_bal_payment': leading lowercase words only, so ids do not become labels."""
+    tokens = []
+    for token in callback_data.split('_'):
+        if len(tokens) == MAX_CALLBACK_PREFIX_TOKENS or not (token.isalpha() and token.islower()):
+            break
+        tokens.append(token)
+    return '_'.join(tokens) or 'unknown'
+
+
+def update_handler_key(update) -> str:
+    if update.callback_query is not None:
+        return f"callback:{callback_prefix(update.callback_query.data or '')}"
+    if update.message is not None:
+        text = update.message.text or ''
+        if text.startswith('/'):
+            return f"command:{text.split()[0].split('@')[0]}"
+        return f"message:{update.message.content_type or 'unknown'}"
+    return "update:other"
+
+
+def instrument_update_processing(bot_instance):
+    """Times each update through the bot's handlers. Updates are processed one at a time, as before (threaded=False)."""
+    if getattr(bot_instance, '_metrics_instrumented', False):
+        return
+    original_process_new_updates = bot_instance.process_new_updates
+
+    def process_new_updates(updates):
+        for update in updates:
+            started = time.perf_counter()
+            try:
+                original_process_new_updates([update])
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, update_handler_key(update))
+
+    bot_instance.process_new_updates = process_new_updates
+    bot_instance._metrics_instrumented = True
+
+
+def instrument_telegram_api():
+    """Wraps telebot's request function so every Bot API call is timed and failures are counted."""
+    if getattr(apihelper._make_request, '_metrics_instrumented', False):
+        return
+    original_make_request = apihelper._make_request
+
+    def _make_request(token, method_name, method='get', params=None, files=None):
+        started = time.perf_counter()
+        try:
+            return original_make_request(token, method_name, method=method, params=params, files=files)
+        except ApiTelegramException as e:
+            TELEGRAM_API_ERRORS.inc(method_name, str(e.error_code))
+            raise
+        except Exception:
+            TELEGRAM_API_ERRORS.inc(method_name, 'network')
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method_name)
+
+    _make_request._metrics_instrumented = True
+    apihelper._make_request = _make_request
+
+
+def _payment_backlog_counts() -> dict:
+    return {(status, ): stats['count'] for status, stats in db_utils.get_payment_backlog_stats().items()}
+
+
+def _payment_backlog_oldest_age() -> dict:
+    now = datetime.datetime.utcnow()
+    ages = {}
+    for status, stats in db_utils.get_payment_backlog_stats().items():
+        if stats['oldest_created_at']:
+            ages[(status, )] = max(0.0, (now - datetime.datetime.fromisoformat(stats['oldest_created_at'])).total_seconds())
+    return ages
+
+
+def _job_counts() -> dict:
+    return {(status, ): count for status, count in db_utils.get_job_counts_by_status().items()}
+
+
+def register_backlog_gauges():
+    metrics.gauge_function('bot_payment_backlog', 'Payments waiting on the monitor or finalization, by status.',
+                           _payment_backlog_counts, ('status',))
+    metrics.gauge_function('bot_payment_backlog_oldest_age_seconds', 'Age of the oldest payment in each backlog status.',
+                           _payment_backlog_oldest_age, ('status',))
+    metrics.gauge_function('bot_jobs', 'Jobs in the job queue by status.', _job_counts, ('status',))
+
+
+def start(bot_instance=None, port: int = None) -> bool:
+    """Installs the hooks and starts the /metrics endpoint. Returns False if the endpoint is disabled or could not start."""
+    if not metrics.METRICS_ENABLED:
+        logger.info("Metrics disabled; skipping instrumentation.")
+        return False
+    instrument_telegram_api()
+    if bot_instance is not None:
+        instrument_update_processing(bot_instance)
+    register_backlog_gauges()
+    return metrics.start_metrics_server(port=port)
@@ -0,0 +1,457 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import config
+
+try:
+    from watchdog.observers import Observer # Optional: inotify (or the platform equivalent) change notifications
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+logger = logging.getLogger(__name__)
+
+# In-memory index of the item catalog on disk: city -> area -> item type -> size -> instances, oldest first.
+# Browsing queries are answered from memory instead of listing and stat-ing data/items on every step.
+#
+# The index is built on first use (or by start()) with one os.scandir per directory. product_fs_utils
+# updates it synchronously when it adds or moves an instance. Changes made outside the bot (folders copied
+# in or deleted by hand) are picked up by a watchdog observer when the package is installed, otherwise by
+# polling the mtimes of the indexed directories every CATALOG_POLL_INTERVAL_SECONDS; a changed directory
+# has its subtree re-scanned. Entries whose names start with '.' are not part of the catalog.
+#
+# Every node also carries the number of instances below it (_counts), adjusted incrementally on each add,
+# move and re-scan, so menus can leave out branches without stock without walking the tree.
+#
+# Instances are sold in the order they were added. Each size directory has a manifest (INSTANCE_MANIFEST_NAME)
+# holding a monotonic sequence number per instance folder; add_instance assigns the next one, and folders
+# found on disk without one (existing catalogs, folders copied in by hand) are numbered by creation time
+# when their directory is scanned. A size's instances are kept as a deque in sequence order, so the
+# oldest is at the front and a sale pops it without sorting or stat-ing anything.
+
+BASE_PRODUCT_DIR = getattr(config, 'ITEMS_BASE_DIR', "data/items")
+CATALOG_WATCH_MODE = getattr(config, 'CATALOG_WATCH_MODE', 'auto') # 'auto', 'watchdog', 'poll' or 'off'
+CATALOG_POLL_INTERVAL_SECONDS = getattr(config, 'CATALOG_POLL_INTERVAL_SECONDS', 15)
+CATALOG_WATCH_DEBOUNCE_SECONDS = 0.5 # Filesystem events are batched for this long before re-scanning
+CATALOG_DEPTH = 4 # city / area / item type / size; instance folders sit below the size level
+INSTANCE_MANIFEST_NAME = ".instances.json" # {"next_sequence": int, "instances": {instance_name: sequence}}
+
+_tree = None # {city: {area: {item_type: {size: deque([(sequence, instance_name), ...])}}}}, None until built
+_counts = {} # (city, area, ...) prefix -> available instances below it; () is the whole catalog
+_dir_mtimes = {} # Indexed directory path -> st_mtime_ns when it was last scanned (for polling)
+_lock = threading.RLock()
+_dirty_paths = set() # Directories reported changed by the watcher, waiting for the debounce
+_dirty_event = threading.Event()
+_watcher_started = False
+_manifest_lock = threading.Lock() # Serializes read-modify-write of the size manifests
+
+
+def _is_catalog_entry(entry: os.DirEntry) -> bool:
+    return not entry.name.startswith('.') and entry.is_dir()
+
+
+def _scan(path: str, depth_remaining: int, mtimes: dict):
+    """Scans one directory and everything below it down to the instance folders. Returns the index node."""
+    try:
+        mtimes[path] = os.stat(path).st_mtime_ns
+        with os.scandir(path) as entries:
+            children = [entry for entry in entries if _is_catalog_entry(entry)]
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.error(f"Catalog index: could not scan {path}: {e}")
+        return None
+    if depth_remaining == 0: # Size directory: its children are the instances
+        return _sequence_instances(path, children, mtimes)
+    node = {}
+    for entry in children:
+        child = _scan(entry.path, depth_remaining - 1, mtimes)
+        if child is not None:
+            node[entry.name] = child
+    return node
+
+
+def _read_manifest(size_path: str) -> dict:
+    try:
+        with open(os.path.join(size_path, INSTANCE_MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return {'next_sequence': int(manifest['next_sequence']),
+                'instances': {name: int(sequence) for name, sequence in manifest['instances'].items()}}
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.error(f"Catalog index: manifest in {size_path} is unreadable ({e}); renumbering its instances by creation time.")
+    return {'next_sequence': 1, 'instances': {}}
+
+
+def _write_manifest(size_path: str, manifest: dict):
+    temp_path = os.path.join(size_path, f"{INSTANCE_MANIFEST_NAME}.{os.getpid()}.tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, os.path.join(size_path, INSTANCE_MANIFEST_NAME))
+
+
+def _sequence_instances(size_path: str, children: list, mtimes: dict) -> deque:
+    """
+    Instances of a size directory in sequence order. Folders missing from the manifest get the next sequence
+    numbers in creation time order (this is also the migration for catalogs created before manifests).
+    """
+    with _manifest_lock:
+        manifest = _read_manifest(size_path)
+        sequences = manifest['instances']
+        unnumbered = []
+        for entry in children:
+            if entry.name not in sequences:
+                try:
+                    unnumbered.append((entry.stat().st_ctime, entry.name))
+                except FileNotFoundError:
+                    continue
+        if unnumbered:
+            present = {entry.name for entry in children}
+            sequences = {name: sequence for name, sequence in sequences.items() if name in present} # Drop sold instances
+            for _, name in sorted(unnumbered):
+                sequences[name] = manifest['next_sequence']
+                manifest['next_sequence'] += 1
+            manifest['instances'] = sequences
+            try:
+                _write_manifest(size_path, manifest)
+                mtimes[size_path] = os.stat(size_path).st_mtime_ns # Writing the manifest touched the directory
+                logger.info(f"Catalog index: numbered {len(unnumbered)} instance(s) in {size_path} by creation time.")
+            except OSError as e:
+                logger.error(f"Catalog index: could not write manifest in {size_path}: {e}")
+    return deque(sorted((sequences[entry.name], entry.name) for entry in children if entry.name in sequences))
+
+
+def _assign_sequence(size_path: str, instance_name: str) -> int:
+    """Sequence number of an instance, assigning the next one if it has none yet."""
+    with _manifest_lock:
+        manifest = _read_manifest(size_path)
+        sequence = manifest['instances'].get(instance_name)
+        if sequence is None:
+            present = {name for name in os.listdir(size_path) if not name.startswith('.')}
+            manifest['instances'] = {name: seq for name, seq in manifest['instances'].items() if name in present}
+            sequence = manifest['instances'][instance_name] = manifest['next_sequence']
+            manifest['next_sequence'] += 1
+            _write_manifest(size_path, manifest)
+        return sequence
+
+
+def _count_subtree(node, prefix: tuple, counts: dict) -> int:
+    """Fills counts with the instance count of node and every node below it. Returns node's count."""
+    if isinstance(node, deque):
+        total = len(node)
+    else:
+        total = sum(_count_subtree(child, prefix + (name,), counts) for name, child in node.items())
+    counts[prefix] = total
+    return total
+
+
+def _adjust_ancestor_counts(prefix: tuple, delta: int):
+    """Adds delta to the counts of prefix's ancestors (not prefix itself). Caller holds _lock."""
+    if delta:
+        for length in range(len(prefix)):
+            _counts[prefix[:length]] = _counts.get(prefix[:length], 0) + delta
+
+
+def _relative_parts(path: str) -> list[str] | None:
+    """Path components below BASE_PRODUCT_DIR, or None if path is outside it."""
+    relative = os.path.relpath(os.path.abspath(path), os.path.abspath(BASE_PRODUCT_DIR))
+    if relative == '.':
+        return []
+    parts = relative.split(os.sep)
+    return None if parts[0] == '..' else parts
+
+
+def build() -> int:
+    """(Re)builds the whole index from disk. Returns the number of instances indexed."""
+    global _tree
+    started = time.monotonic()
+    mtimes = {}
+    tree = _scan(BASE_PRODUCT_DIR, CATALOG_DEPTH, mtimes) or {}
+    counts = {}
+    instance_count = _count_subtree(tree, (), counts)
+    with _lock:
+        _tree = tree
+        _counts.clear()
+        _counts.update(counts)
+        _dir_mtimes.clear()
+        _dir_mtimes.update(mtimes)
+    logger.info(f"Catalog index built: {len(tree)} cities, {instance_count} instances in {time.monotonic() - started:.3f}s.")
+    return instance_count
+
+
+def _ensure_built():
+    if _tree is None:
+        with _lock:
+            if _tree is None:
+                build()
+
+
+def refresh_path(dir_path: str):
+    """Re-scans one catalog directory (base, city, area, item type or size level) and replaces its subtree."""
+    parts = _relative_parts(dir_path)
+    if parts is None or len(parts) > CATALOG_DEPTH or any(part.startswith('.') for part in parts):
+        return
+    _ensure_built()
+    if not parts:
+        build()
+        return
+    dir_path = os.path.join(BASE_PRODUCT_DIR, *parts) # Same spelling as the paths recorded by _scan
+    mtimes = {}
+    node = _scan(dir_path, CATALOG_DEPTH - len(parts), mtimes) if os.path.isdir(dir_path) else None
+    prefix = tuple(parts)
+    counts = {}
+    if node is not None:
+        _count_subtree(node, prefix, counts)
+    with _lock:
+        parent = _tree
+        for part in parts[:-1]:
+            parent = parent.get(part)
+            if parent is None: # An ancestor is not indexed yet; scan from there instead
+                break
+        else:
+            for path in [path for path in _dir_mtimes if path == dir_path or path.startswith(dir_path + os.sep)]:
+                del _dir_mtimes[path]
+            _dir_mtimes.update(mtimes)
+            _adjust_ancestor_counts(prefix, counts.get(prefix, 0) - _counts.get(prefix, 0))
+            for key in [key for key in _counts if key[:len(prefix)] == prefix]:
+                del _counts[key]
+            _counts.update(counts)
+            if node is None:
+                parent.pop(parts[-1], None)
+            else:
+                parent[parts[-1]] = node
+            return
+    refresh_path(os.path.dirname(dir_path))
+
+
+def add_instance(instance_path: str):
+    """Records an instance folder product_fs_utils has just created."""
+    parts = _relative_parts(instance_path)
+    if parts is None or len(parts) != CATALOG_DEPTH + 1:
+        logger.warning(f"Catalog index: {instance_path} is not an instance folder; re-indexing instead.")
+        refresh_path(os.path.dirname(instance_path))
+        return
+    _ensure_built()
+    try:
+        sequence = _assign_sequence(os.path.dirname(instance_path), parts[-1])
+        ancestor_mtimes = {}
+        ancestor = BASE_PRODUCT_DIR
+        for part in [None] + parts[:-1]:
+            ancestor = os.path.join(ancestor, part) if part else ancestor
+            ancestor_mtimes[ancestor] = os.stat(ancestor).st_mtime_ns
+    except OSError as e:
+        logger.error(f"Catalog index: could not record new instance {instance_path}: {e}")
+        return
+    with _lock:
+        node = _tree
+        for part in parts[:-2]:
+            node = node.setdefault(part, {})
+        instances = node.setdefault(parts[-2], deque())
+        if (sequence, parts[-1]) not in instances:
+            if instances and instances[-1][0] > sequence: # Numbered by a concurrent re-scan; keep the order
+                instances.append((sequence, parts[-1]))
+                node[parts[-2]] = instances = deque(sorted(instances))
+            else:
+                instances.append((sequence, parts[-1]))
+            _adjust_ancestor_counts(tuple(parts), 1)
+        _dir_mtimes.update(ancestor_mtimes)
+
+
+def remove_instance(instance_path: str):
+    """Drops an instance folder that was moved or deleted by product_fs_utils."""
+    parts = _relative_parts(instance_path)
+    if parts is None or len(parts) != CATALOG_DEPTH + 1:
+        return
+    _ensure_built()
+    size_path = os.path.dirname(instance_path)
+    with _lock:
+        node = _tree
+        for part in parts[:-1]:
+            node = node.get(part) if isinstance(node, dict) else None
+            if node is None:
+                return
+        if node and node[0][1] == parts[-1]: # The usual case: the oldest instance was sold
+            node.popleft()
+            _adjust_ancestor_counts(tuple(parts), -1)
+        else:
+            for entry in node:
+                if entry[1] == parts[-1]:
+                    node.remove(entry)
+                    _adjust_ancestor_counts(tuple(parts), -1)
+                    break
+        try:
+            _dir_mtimes[size_path] = os.stat(size_path).st_mtime_ns
+        except OSError:
+            pass
+
+
+def _get_node(parts: tuple):
+    _ensure_built()
+    node = _tree
+    for part in parts:
+        if not isinstance(node, dict):
+            return None
+        node = node.get(part)
+        if node is None:
+            return None
+    return node
+
+
+def get_children(*parts: str) -> list[str]:
+    """Sorted names below a node: get_children() -> cities, get_children(city) -> areas, and so on down to sizes."""
+    with _lock:
+        node = _get_node(parts)
+        return sorted(node) if isinstance(node, dict) else []
+
+
+def get_stock_count(*parts: str) -> int:
+    """Available instances below a node: get_stock_count() for the whole catalog, get_stock_count(city), ..."""
+    _ensure_built()
+    with _lock:
+        return _counts.get(parts, 0)
+
+
+def get_children_in_stock(*parts: str, reserved: dict = None) -> list[tuple[str, int]]:
+    """
+    Like get_children, but only children with available instances, as sorted (name, count) pairs.
+    reserved ({node parts: count}, see item_reservations.get_reserved_counts) is subtracted from the counts.
+    """
+    reserved = reserved or {}
+    with _lock:
+        node = _get_node(parts)
+        if not isinstance(node, dict):
+            return []
+        children = [(name, _counts.get(parts + (name,), 0) - reserved.get(parts + (name,), 0)) for name in sorted(node)]
+    return [(name, count) for name, count in children if count > 0]
+
+
+def get_instances(city: str, area: str, item_type: str, size: str) -> list[str]:
+    """Instance folder paths of one size, oldest first."""
+    with _lock:
+        node = _get_node((city, area, item_type, size))
+        names = [name for _, name in node] if isinstance(node, deque) else []
+    size_path = os.path.join(BASE_PRODUCT_DIR, city, area, item_type, size)
+    return [os.path.join(size_path, name) for name in names]
+
+
+def get_all_instances() -> list[str]:
+    """Every indexed instance folder path in the catalog."""
+    paths = []
+    with _lock:
+        _ensure_built()
+        stack = [(BASE_PRODUCT_DIR, _tree)]
+        while stack:
+            path, node = stack.pop()
+            if isinstance(node, deque):
+                paths.extend(os.path.join(path, name) for _, name in node)
+            else:
+                stack.extend((os.path.join(path, name), child) for name, child in node.items())
+    return paths
+
+
+def get_oldest_instance(city: str, area: str, item_type: str, size: str, exclude: set = None) -> str | None:
+    """
+    Oldest instance folder of one size, or None. With exclude (instance paths, e.g. reserved ones) the deque is
+    walked from the front and the first path not in it is returned. Folders that vanished from disk are dropped
+    from the index.
+    """
+    size_path = os.path.join(BASE_PRODUCT_DIR, city, area, item_type, size)
+    while True:
+        with _lock:
+            node = _get_node((city, area, item_type, size))
+            if not isinstance(node, deque):
+                return None
+            instance_path = next((path for path in (os.path.join(size_path, name) for _, name in node)
+                                  if not exclude or path not in exclude), None)
+            if instance_path is None:
+                return None
+        if os.path.isdir(instance_path):
+            return instance_path
+        logger.warning(f"Catalog index: instance {instance_path} no longer exists; dropping it.")
+        remove_instance(instance_path)
+
+
+# --- Change detection ---
+class _CatalogEventHandler(FileSystemEventHandler):
+    def on_any_event(self, event):
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if path and not os.path.basename(path).startswith('.'): # Manifest writes do not change the catalog
+                _dirty_paths.add(os.path.dirname(path)) # The directory whose listing changed
+        _dirty_event.set()
+
+
+def _outermost(paths) -> list[str]:
+    """Drops paths that lie below another path in the set; re-scanning the parent covers them."""
+    paths = set(paths)
+    return sorted(path for path in paths if not any(path.startswith(parent + os.sep) for parent in paths))
+
+
+def _process_dirty_paths():
+    while True:
+        _dirty_event.wait()
+        time.sleep(CATALOG_WATCH_DEBOUNCE_SECONDS)
+        _dirty_event.clear()
+        paths = set()
+        while _dirty_paths:
+            paths.add(_dirty_paths.pop())
+        for path in _outermost(paths):
+            try:
+                refresh_path(path)
+            except Exception as e:
+                logger.exception(f"Catalog index: refresh of {path} failed: {e}")
+
+
+def poll_for_changes() -> int:
+    """Re-scans every indexed directory whose mtime changed. Returns the number of directories re-scanned."""
+    _ensure_built()
+    with _lock:
+        known = dict(_dir_mtimes)
+    changed = []
+    for path, mtime in known.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                changed.append(path)
+        except FileNotFoundError:
+            changed.append(os.path.dirname(path)) # Removed: its parent's listing changed
+    changed = _outermost(changed)
+    for path in changed:
+        refresh_path(path)
+    return len(changed)
+
+
+def _poll_loop():
+    while True:
+        time.sleep(CATALOG_POLL_INTERVAL_SECONDS)
+        try:
+            refreshed = poll_for_changes()
+            if refreshed:
+                logger.info(f"Catalog index: re-scanned {refreshed} changed director{'y' if refreshed == 1 else 'ies'}.")
+        except Exception as e:
+            logger.exception(f"Catalog index: polling failed: {e}")
+
+
+def start():
+    """Builds the index and starts watching the catalog for outside changes. Safe to call more than once."""
+    global _watcher_started
+    build()
+    if _watcher_started or CATALOG_WATCH_MODE == 'off':
+        return
+    _watcher_started = True
+    if CATALOG_WATCH_MODE in ('auto', 'watchdog') and Observer is not None:
+        observer = Observer()
+        observer.schedule(_CatalogEventHandler(), BASE_PRODUCT_DIR, recursive=True)
+        observer.daemon = True
+        observer.start()
+        threading.Thread(target=_process_dirty_paths, name="catalog-index-watch", daemon=True).start()
+        logger.info(f"Catalog index: watching {BASE_PRODUCT_DIR} for changes.")
+        return
+    if CATALOG_WATCH_MODE == 'watchdog':
+        logger.warning("CATALOG_WATCH_MODE is 'watchdog' but the watchdog package is not installed. Falling back to polling.")
+    threading.Thread(target=_poll_loop, name="catalog-index-poll", daemon=True).start()
+    logger.info(f"Catalog index: polling {BASE_PRODUCT_DIR} for changes every {CATALOG_POLL_INTERVAL_SECONDS}s.")
@@ -2,9 +2,13 @@ import sqlite3
 import json
 import config
 import os
+import sys
+import time
 import datetime
 import logging
 
+from modules import metrics
+
 logger = logging.getLogger(__name__)
 
 try:
@@ -17,6 +21,20 @@ except ImportError:
 
 DATABASE_NAME = config.DATABASE_NAME
 
+DB_CALL_SECONDS = metrics.histogram('bot_db_call_seconds', 'Time a db_utils function held its database connection.', ('function',))
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Connection that reports how long it was open (one db_utils call) to the metrics registry on close()."""
+
+    def close(self):
+        super().close()
+        opened_at = getattr(self, 'opened_at', None)
+        if opened_at is not None:
+            self.opened_at = None
+            DB_CALL_SECONDS.observe(time.perf_counter() - opened_at, self.caller_name)
+
+
 def get_db_connection():
     db_dir = os.path.dirname(DATABASE_NAME)
     logger.info(f"Attempting to connect to database at: {DATABASE_NAME}")
@@ -25,15 +43,28 @@ def get_db_connection():
     if not os.path.exists(db_dir):
         os.makedirs(db_dir, exist_ok=True)
         logger.info(f"Created database directory: {db_dir}")
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = sqlite3.connect(DATABASE_NAME, factory=_TimedConnection)
     conn.row_factory = sqlite3.Row
+    conn.caller_name = sys._getframe(1).f_code.co_name
+    conn.opened_at = time.perf_counter()
     return conn
 
+def _ensure_column(cursor, table_name: str, column_name: str, column_definition: str):
+    """Adds a column to an existing table if it is missing (lightweight schema migration)."""
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    existing_columns = {row['name'] for row in cursor.fetchall()}
+    if column_name not in existing_columns:
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_definition}")
+        logger.info(f"Added column '{column_name}' to '{table_name}'.")
+
 def initialize_database():
     conn = get_db_connection()
     cursor = conn.cursor()
     logger.info("Initializing database schema for HD wallet integration...")
 
+    # WAL lets the bot process and separate worker processes read while one of them writes.
+    cursor.execute("PRAGMA journal_mode=WAL")
+
     conn.execute('BEGIN')
     try:
         cursor.execute('''
@@ -114,12 +145,23 @@ def initialize_database():
             cursor.execute("INSERT OR IGNORE INTO hd_address_indices (coin_symbol, last_used_index) VALUES (?, -1)", (coin,))
         logger.info(f"Seeded hd_address_indices with: {', '.join(initial_coins)} (if not already present).")
 
+        # Shared-address invoicing puts several invoices on one address, so the old UNIQUE(address)
+        # constraint is dropped by rebuilding the table (SQLite cannot drop a constraint in place).
+        pending_payments_rebuild_source = None
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='pending_crypto_payments';")
+        existing_pending_table = cursor.fetchone()
+        if existing_pending_table and 'address TEXT UNIQUE' in existing_pending_table['sql']:
+            pending_payments_rebuild_source = "pending_crypto_payments_old_unique_address"
+            logger.info(f"Rebuilding 'pending_crypto_payments' without UNIQUE(address) (old table renamed to '{pending_payments_rebuild_source}').")
+            cursor.execute(f"DROP TABLE IF EXISTS {pending_payments_rebuild_source}")
+            cursor.execute(f"ALTER TABLE pending_crypto_payments RENAME TO {pending_payments_rebuild_source}")
+
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS pending_crypto_payments (
                 payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 transaction_id INTEGER UNIQUE NOT NULL,
                 user_id INTEGER NOT NULL,
-                address TEXT UNIQUE NOT NULL,
+                address TEXT NOT NULL, -- Unique per active dedicated invoice; shared addresses carry many invoices
                 coin_symbol TEXT NOT NULL,
                 network TEXT,
                 expected_crypto_amount TEXT NOT NULL,
@@ -131,16 +173,182 @@ def initialize_database():
                 blockchain_tx_id TEXT,
                 confirmations INTEGER DEFAULT 0 NOT NULL,
                 paid_from_balance_eur REAL DEFAULT 0.0 NOT NULL,
+                history_cursor TEXT, -- JSON cursor for incremental address-history fetching
+                lease_owner TEXT, -- Monitor worker currently checking this payment
+                lease_until DATETIME, -- Lease expiry; an expired lease can be claimed by another worker
+                processing_owner TEXT, -- Finalization worker that claimed this payment ('processing' status)
+                processing_started_at DATETIME,
+                invoice_mode TEXT DEFAULT 'dedicated' NOT NULL, -- 'dedicated' (own address) or 'shared' (matched by exact amount)
+                hd_index INTEGER, -- HD derivation index of a dedicated address
+                recycled_address INTEGER DEFAULT 0 NOT NULL, -- 1 if the address came from the recycling pool
+                provider TEXT, -- Blockchain API provider that first reported the payment's transaction
+                first_seen_at DATETIME, -- Payment funnel timestamps, see record_payment_funnel_event()
+                confirmed_at DATETIME,
+                finalization_started_at DATETIME,
+                finalization_finished_at DATETIME,
+                user_notified_at DATETIME,
+                late_funds_detected_at DATETIME, -- Set by wallet discovery when funds arrived after the invoice expired
+                exchange_rate_id INTEGER, -- exchange_rates row the invoice amount was priced with
                 FOREIGN KEY (transaction_id) REFERENCES transactions (transaction_id) ON DELETE CASCADE,
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
         ''')
         logger.debug("pending_crypto_payments table ensured.")
+        _ensure_column(cursor, 'pending_crypto_payments', 'history_cursor', 'TEXT')
+        _ensure_column(cursor, 'pending_crypto_payments', 'lease_owner', 'TEXT')
+        _ensure_column(cursor, 'pending_crypto_payments', 'lease_until', 'DATETIME')
+        _ensure_column(cursor, 'pending_crypto_payments', 'processing_owner', 'TEXT')
+        _ensure_column(cursor, 'pending_crypto_payments', 'processing_started_at', 'DATETIME')
+        _ensure_column(cursor, 'pending_crypto_payments', 'invoice_mode', "TEXT DEFAULT 'dedicated' NOT NULL")
+        _ensure_column(cursor, 'pending_crypto_payments', 'hd_index', 'INTEGER')
+        _ensure_column(cursor, 'pending_crypto_payments', 'recycled_address', 'INTEGER DEFAULT 0 NOT NULL')
+        _ensure_column(cursor, 'pending_crypto_payments', 'late_funds_detected_at', 'DATETIME')
+        _ensure_column(cursor, 'pending_crypto_payments', 'exchange_rate_id', 'INTEGER')
+        for funnel_column in ('provider TEXT', 'first_seen_at DATETIME', 'confirmed_at DATETIME', 'finalization_started_at DATETIME',
+                              'finalization_finished_at DATETIME', 'user_notified_at DATETIME'):
+            column_name, column_type = funnel_column.split(' ', 1)
+            _ensure_column(cursor, 'pending_crypto_payments', column_name, column_type)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_created_at ON pending_crypto_payments (created_at);")
+        if pending_payments_rebuild_source:
+            cursor.execute(f"PRAGMA table_info({pending_payments_rebuild_source})")
+            old_columns = {row['name'] for row in cursor.fetchall()}
+            cursor.execute("PRAGMA table_info(pending_crypto_payments)")
+            copied_columns = ', '.join(row['name'] for row in cursor.fetchall() if row['name'] in old_columns)
+            cursor.execute(f"INSERT INTO pending_crypto_payments ({copied_columns}) SELECT {copied_columns} FROM {pending_payments_rebuild_source}")
+            logger.info(f"Copied {cursor.rowcount} rows into rebuilt 'pending_crypto_payments'.")
+            cursor.execute(f"DROP TABLE {pending_payments_rebuild_source}")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_status ON pending_crypto_payments (status);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_address ON pending_crypto_payments (address);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_transaction_id ON pending_crypto_payments (transaction_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_lease ON pending_crypto_payments (status, lease_until);")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_payments_active_dedicated_address ON pending_crypto_payments (address) WHERE invoice_mode = 'dedicated' AND status = 'monitoring';")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_payments_active_shared_amount ON pending_crypto_payments (address, expected_crypto_amount) WHERE invoice_mode = 'shared' AND status = 'monitoring';")
         logger.debug("Indexes for pending_crypto_payments ensured.")
 
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shared_invoice_addresses (
+                address_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                coin_symbol TEXT NOT NULL, -- Pending-payment coin symbol, e.g. 'USDT_TRX'
+                address TEXT UNIQUE NOT NULL,
+                hd_index INTEGER NOT NULL,
+                history_cursor TEXT, -- JSON cursor shared by all invoices on this address
+                created_at DATETIME NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_shared_invoice_addresses_coin ON shared_invoice_addresses (coin_symbol);")
+        logger.debug("shared_invoice_addresses table ensured.")
+
+        # Optional stable per-user deposit addresses for balance top-ups (see modules/deposit_addresses.py).
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_deposit_addresses (
+                deposit_address_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                coin_symbol TEXT NOT NULL, -- Pending-payment style symbol: 'BTC', 'LTC', 'USDT_TRX'
+                address TEXT UNIQUE NOT NULL,
+                hd_index INTEGER NOT NULL,
+                history_cursor TEXT, -- JSON cursor for incremental blockchain API checks
+                last_checked_at DATETIME,
+                created_at DATETIME NOT NULL,
+                UNIQUE (user_id, coin_symbol),
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_deposit_addresses_scan ON user_deposit_addresses (last_checked_at);")
+        # One row per incoming transfer to a deposit address. The EUR rate is fixed when the transfer is first seen.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS deposit_credits (
+                credit_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                deposit_address_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                coin_symbol TEXT NOT NULL,
+                blockchain_tx_id TEXT NOT NULL,
+                amount_smallest_unit TEXT NOT NULL,
+                rate_eur TEXT NOT NULL, -- EUR per whole coin when the transfer was first seen
+                confirmations INTEGER DEFAULT 0,
+                status TEXT NOT NULL, -- 'seen', 'credited', 'ignored_dust'
+                transaction_id INTEGER, -- transactions row recording the credit
+                seen_at DATETIME NOT NULL,
+                credited_at DATETIME,
+                UNIQUE (deposit_address_id, blockchain_tx_id),
+                FOREIGN KEY (deposit_address_id) REFERENCES user_deposit_addresses(deposit_address_id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_deposit_credits_status ON deposit_credits (status);")
+        logger.debug("user_deposit_addresses and deposit_credits tables ensured.")
+
+        # Dedicated addresses of expired, never-funded invoices. A 'candidate' is rechecked on-chain once
+        # recheck_after has passed; if still unused it becomes 'free' and is handed out again before a new
+        # HD index is derived. Addresses found to have received anything are 'retired' for good.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS recycled_addresses (
+                recycled_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hd_coin_symbol TEXT NOT NULL, -- Derivation coin, e.g. 'TRX' for USDT_TRX invoices
+                payment_coin_symbol TEXT NOT NULL, -- Coin of the invoice that last used it, e.g. 'USDT_TRX'
+                address TEXT UNIQUE NOT NULL,
+                hd_index INTEGER NOT NULL,
+                status TEXT NOT NULL, -- 'candidate', 'free', 'claimed', 'retired'
+                source_payment_id INTEGER,
+                recheck_after DATETIME,
+                created_at DATETIME NOT NULL,
+                updated_at DATETIME NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_recycled_addresses_status ON recycled_addresses (hd_coin_symbol, status, recheck_after);")
+        logger.debug("recycled_addresses table ensured.")
+
+        # Addresses derived ahead of time by the address pool refill job (modules/address_pool.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS address_pool (
+                pool_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hd_coin_symbol TEXT NOT NULL, -- Derivation coin, e.g. 'TRX' (also serves USDT_TRX invoices)
+                address TEXT UNIQUE NOT NULL,
+                hd_index INTEGER NOT NULL,
+                qr_png BLOB, -- No longer written (QR codes are rendered per invoice, with the amount)
+                status TEXT DEFAULT 'available' NOT NULL, -- 'available', 'claimed'
+                created_at DATETIME NOT NULL,
+                claimed_at DATETIME
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_address_pool_status ON address_pool (hd_coin_symbol, status, hd_index);")
+        logger.debug("address_pool table ensured.")
+
+        # Every fetched exchange rate (modules/exchange_rate_utils.py): warm start after restarts, outage fallback, audit
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS exchange_rates (
+                rate_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                coin_symbol TEXT NOT NULL, -- 'BTC', 'LTC', 'USDT'
+                vs_currency TEXT NOT NULL, -- 'EUR'
+                rate TEXT NOT NULL, -- Decimal string: vs_currency per coin
+                fetched_at DATETIME NOT NULL,
+                source TEXT NOT NULL -- Sources that agreed, e.g. 'median:coingecko,kraken'
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_exchange_rates_coin_fetched ON exchange_rates (coin_symbol, vs_currency, fetched_at);")
+        logger.debug("exchange_rates table ensured.")
+
+        # Item instances held for a buyer (modules/item_reservations.py). At most one 'active' row per instance
+        # (partial unique index), so two buyers can never be handed the same folder.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS item_reservations (
+                reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                instance_path TEXT NOT NULL,
+                city TEXT NOT NULL,
+                area TEXT NOT NULL,
+                item_type TEXT NOT NULL,
+                size TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                transaction_id INTEGER, -- Set once an invoice is created for the held instance
+                status TEXT DEFAULT 'active' NOT NULL, -- 'active', 'consumed', 'released', 'expired'
+                created_at DATETIME NOT NULL,
+                expires_at DATETIME NOT NULL, -- Selection hold, then the invoice expiry; open-ended once paid
+                closed_at DATETIME
+            )
+        ''')
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_item_reservations_active_instance ON item_reservations (instance_path) WHERE status = 'active';")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_item_reservations_status ON item_reservations (status, expires_at);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_item_reservations_transaction_id ON item_reservations (transaction_id);")
+        logger.debug("item_reservations table ensured.")
+
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS support_tickets (
                 ticket_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -156,6 +364,39 @@ def initialize_database():
         ''')
         logger.debug("Support tickets table ensured.")
 
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_type TEXT NOT NULL,
+                payload_json TEXT,
+                priority INTEGER DEFAULT 100 NOT NULL, -- Lower value runs first
+                status TEXT DEFAULT 'queued' NOT NULL, -- 'queued', 'running', 'done', 'dead'
+                attempts INTEGER DEFAULT 0 NOT NULL,
+                max_attempts INTEGER DEFAULT 5 NOT NULL,
+                run_at DATETIME NOT NULL,
+                lease_owner TEXT,
+                lease_until DATETIME,
+                last_error TEXT,
+                dedupe_key TEXT, -- At most one queued/running job per key (e.g. recurring jobs)
+                created_at DATETIME NOT NULL,
+                updated_at DATETIME NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (status, run_at, priority);")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_dedupe ON jobs (dedupe_key) WHERE dedupe_key IS NOT NULL AND status IN ('queued', 'running');")
+        logger.debug("Jobs table ensured.")
+
+        # One row per finalization side effect (balance credit/debit, item delivery, ...). Inserting the key
+        # and applying the effect happen in one transaction, so a retried finalization never applies it twice.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS finalization_ledger (
+                idempotency_key TEXT PRIMARY KEY,
+                transaction_id INTEGER,
+                created_at DATETIME NOT NULL
+            )
+        ''')
+        logger.debug("Finalization ledger table ensured.")
+
         conn.commit()
         logger.info("Database schema initialization and HD wallet table setup complete.")
     except sqlite3.Error as e:
@@ -199,8 +440,8 @@ def get_next_address_index(coin_symbol: str) -> int:
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
+        conn.execute('BEGIN IMMEDIATE') # Must come first: the INSERT below would otherwise open an implicit transaction
         cursor.execute("INSERT OR IGNORE INTO hd_address_indices (coin_symbol, last_used_index) VALUES (?, -1)", (coin_symbol,))
-        conn.execute('BEGIN IMMEDIATE')
         cursor.execute("SELECT last_used_index FROM hd_address_indices WHERE coin_symbol = ?", (coin_symbol,))
         row = cursor.fetchone()
         if row is None:
@@ -223,10 +464,335 @@ def get_next_address_index(coin_symbol: str) -> int:
     finally:
         if conn: conn.close()
 
+def get_last_used_address_index(coin_symbol: str) -> int | None:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT last_used_index FROM hd_address_indices WHERE coin_symbol = ?", (coin_symbol,))
+        row = cursor.fetchone()
+        return row['last_used_index'] if row else None
+    except sqlite3.Error as e:
+        logger.exception(f"HD Wallet Index: Failed to read last used index for {coin_symbol}: {e}")
+        return None
+    finally:
+        conn.close()
+
+def raise_address_index_floor(coin_symbol: str, last_used_index: int) -> int:
+    """Moves last_used_index up to at least last_used_index (never down). Returns the resulting value."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("INSERT OR IGNORE INTO hd_address_indices (coin_symbol, last_used_index) VALUES (?, -1)", (coin_symbol,))
+        cursor.execute("UPDATE hd_address_indices SET last_used_index = MAX(last_used_index, ?) WHERE coin_symbol = ?", (last_used_index, coin_symbol))
+        cursor.execute("SELECT last_used_index FROM hd_address_indices WHERE coin_symbol = ?", (coin_symbol,))
+        new_value = cursor.fetchone()['last_used_index']
+        conn.commit()
+        logger.info(f"HD Wallet Index: {coin_symbol} last used index is now {new_value} (floor {last_used_index}).")
+        return new_value
+    except sqlite3.Error as e:
+        logger.exception(f"HD Wallet Index: Failed to raise index floor for {coin_symbol}: {e}")
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def get_max_known_hd_index(hd_coin_symbol: str, payment_coin_symbols: list[str]) -> int | None:
+    """Highest HD index recorded anywhere in the database for a derivation coin (invoices, deposit and pooled addresses)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    placeholders = ', '.join('?' for _ in payment_coin_symbols)
+    try:
+        cursor.execute(f"""
+            SELECT MAX(hd_index) AS max_index FROM (
+                SELECT hd_index FROM pending_crypto_payments WHERE coin_symbol IN ({placeholders})
+                UNION ALL SELECT hd_index FROM shared_invoice_addresses WHERE coin_symbol IN ({placeholders})
+                UNION ALL SELECT hd_index FROM user_deposit_addresses WHERE coin_symbol IN ({placeholders})
+                UNION ALL SELECT hd_index FROM recycled_addresses WHERE hd_coin_symbol = ?
+                UNION ALL SELECT hd_index FROM address_pool WHERE hd_coin_symbol = ?
+            )
+        """, (*payment_coin_symbols, *payment_coin_symbols, *payment_coin_symbols, hd_coin_symbol, hd_coin_symbol))
+        return cursor.fetchone()['max_index']
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to read the highest known HD index for {hd_coin_symbol}: {e}")
+        return None
+    finally:
+        conn.close()
+
+# --- Exchange Rate History ---
+def insert_exchange_rates(vs_currency: str, rates: dict, fetched_at: datetime.datetime, sources: dict) -> dict:
+    """Stores one fetch {coin_symbol: Decimal} with its source per coin. Returns {coin_symbol: rate_id} (empty on failure)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        rate_ids = {}
+        for coin_symbol, rate in rates.items():
+            cursor.execute("INSERT INTO exchange_rates (coin_symbol, vs_currency, rate, fetched_at, source) VALUES (?, ?, ?, ?, ?)",
+                           (coin_symbol, vs_currency, str(rate), fetched_at.isoformat(), sources[coin_symbol]))
+            rate_ids[coin_symbol] = cursor.lastrowid
+        conn.commit()
+        return rate_ids
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to store {vs_currency} exchange rates: {e}")
+        conn.rollback()
+        return {}
+    finally:
+        conn.close()
+
+def get_latest_exchange_rates(vs_currency: str) -> list[sqlite3.Row]:
+    """The most recent stored rate per coin for vs_currency."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT er.* FROM exchange_rates er
+            JOIN (SELECT coin_symbol, MAX(rate_id) AS rate_id FROM exchange_rates WHERE vs_currency = ? GROUP BY coin_symbol) latest
+              ON latest.rate_id = er.rate_id
+        """, (vs_currency,))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to load latest {vs_currency} exchange rates: {e}")
+        return []
+    finally:
+        conn.close()
+
+def purge_exchange_rates(older_than: datetime.datetime) -> int:
+    """Deletes rate history older than older_than, except rows still referenced by invoices."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("""
+            DELETE FROM exchange_rates
+            WHERE fetched_at < ?
+              AND rate_id NOT IN (SELECT exchange_rate_id FROM pending_crypto_payments WHERE exchange_rate_id IS NOT NULL)
+        """, (older_than.isoformat(),))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to purge exchange rate history: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+# --- Item Reservations ---
+ITEM_RESERVATION_OPEN_ENDED = '9999-12-31T23:59:59' # expires_at of holds on paid invoices; ended by consume or release
+
+def _expire_lapsed_item_reservations(cursor, now_iso: str):
+    cursor.execute("UPDATE item_reservations SET status = 'expired', closed_at = ? WHERE status = 'active' AND expires_at <= ?",
+                   (now_iso, now_iso))
+
+def get_held_item_instances(city: str, area: str, item_type: str, size: str, exclude_user_id: int = None) -> set[str]:
+    """Instance paths of one size under an unexpired reservation, leaving out exclude_user_id's selection hold."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT instance_path FROM item_reservations
+            WHERE status = 'active' AND expires_at > ? AND city = ? AND area = ? AND item_type = ? AND size = ?
+              AND NOT (user_id IS ? AND transaction_id IS NULL)
+        """, (datetime.datetime.utcnow().isoformat(), city, area, item_type, size, exclude_user_id))
+        return {row['instance_path'] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to read held instances of {city}/{area}/{item_type}/{size}: {e}")
+        return set()
+    finally:
+        conn.close()
+
+def claim_item_instance(user_id: int, city: str, area: str, item_type: str, size: str,
+                        instance_path: str, hold_until: datetime.datetime) -> sqlite3.Row | None:
+    """
+    Atomically reserves instance_path for a buyer until hold_until. A buyer's own unexpired hold on the same size
+    is renewed and returned instead of taking a second instance; their holds on other selections are released.
+    Returns the reservation row, or None if another buyer holds instance_path by now.
+    """
+    now_iso = datetime.datetime.utcnow().isoformat()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        _expire_lapsed_item_reservations(cursor, now_iso)
+        cursor.execute("""
+            SELECT * FROM item_reservations
+            WHERE status = 'active' AND user_id = ? AND transaction_id IS NULL
+              AND city = ? AND area = ? AND item_type = ? AND size = ?
+        """, (user_id, city, area, item_type, size))
+        own_hold = cursor.fetchone()
+        if own_hold:
+            cursor.execute("UPDATE item_reservations SET expires_at = ? WHERE reservation_id = ?",
+                           (hold_until.isoformat(), own_hold['reservation_id']))
+            cursor.execute("SELECT * FROM item_reservations WHERE reservation_id = ?", (own_hold['reservation_id'],))
+            row = cursor.fetchone()
+            conn.commit()
+            return row
+
+        cursor.execute("UPDATE item_reservations SET status = 'released', closed_at = ? WHERE status = 'active' AND user_id = ? AND transaction_id IS NULL",
+                       (now_iso, user_id))
+        try:
+            cursor.execute("""
+                INSERT INTO item_reservations (instance_path, city, area, item_type, size, user_id, status, created_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'active', ?, ?)
+            """, (instance_path, city, area, item_type, size, user_id, now_iso, hold_until.isoformat()))
+        except sqlite3.IntegrityError:
+            logger.info(f"{instance_path} was reserved by another buyer first.")
+            conn.rollback()
+            return None
+        cursor.execute("SELECT * FROM item_reservations WHERE reservation_id = ?", (cursor.lastrowid,))
+        row = cursor.fetchone()
+        conn.commit()
+        return row
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to reserve an instance of {city}/{area}/{item_type}/{size} for user {user_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def attach_item_reservation(reservation_id: int, user_id: int, transaction_id: int, expires_at: datetime.datetime) -> bool:
+    """
+    Ties a buyer's hold to their invoice and extends it to the invoice expiry. If the hold already lapsed, the
+    instance is reserved again as long as nobody else took it in the meantime. Returns False otherwise.
+    """
+    now_iso = datetime.datetime.utcnow().isoformat()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        _expire_lapsed_item_reservations(cursor, now_iso)
+        cursor.execute("SELECT * FROM item_reservations WHERE reservation_id = ?", (reservation_id,))
+        row = cursor.fetchone()
+        attached = False
+        if row and row['user_id'] == user_id:
+            if row['status'] == 'active':
+                cursor.execute("UPDATE item_reservations SET transaction_id = ?, expires_at = ? WHERE reservation_id = ?",
+                               (transaction_id, expires_at.isoformat(), reservation_id))
+                attached = True
+            elif row['status'] == 'expired':
+                try:
+                    cursor.execute("""
+                        INSERT INTO item_reservations (instance_path, city, area, item_type, size, user_id, transaction_id, status, created_at, expires_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, 'active', ?, ?)
+                    """, (row['instance_path'], row['city'], row['area'], row['item_type'], row['size'], user_id,
+                          transaction_id, now_iso, expires_at.isoformat()))
+                    attached = True
+                except sqlite3.IntegrityError:
+                    logger.info(f"Reservation {reservation_id} lapsed and {row['instance_path']} is now held by another buyer.")
+        conn.commit()
+        return attached
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to attach item reservation {reservation_id} to transaction {transaction_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def hold_item_reservation_until_closed(transaction_id: int) -> bool:
+    """
+    Makes the hold of a paid invoice open-ended, so it cannot lapse while finalization is retried; it ends when
+    the item is consumed or the reservation released. A hold that already lapsed is taken again if nobody else
+    holds the instance. Returns False if the transaction has no hold (or lost it to another buyer).
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("UPDATE item_reservations SET expires_at = ? WHERE transaction_id = ? AND status = 'active'",
+                       (ITEM_RESERVATION_OPEN_ENDED, transaction_id))
+        held = cursor.rowcount > 0
+        if not held:
+            cursor.execute("""
+                SELECT reservation_id, instance_path FROM item_reservations
+                WHERE transaction_id = ? AND status = 'expired'
+                ORDER BY reservation_id DESC LIMIT 1
+            """, (transaction_id,))
+            lapsed = cursor.fetchone()
+            if lapsed:
+                try:
+                    cursor.execute("UPDATE item_reservations SET status = 'active', closed_at = NULL, expires_at = ? WHERE reservation_id = ?",
+                                   (ITEM_RESERVATION_OPEN_ENDED, lapsed['reservation_id']))
+                    held = True
+                except sqlite3.IntegrityError:
+                    logger.warning(f"Hold for transaction {transaction_id} lapsed before payment and {lapsed['instance_path']} is now held by another buyer.")
+        conn.commit()
+        return held
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to extend the item reservation of transaction {transaction_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def close_item_reservations(status: str, reservation_id: int = None, transaction_id: int = None) -> int:
+    """
+    Ends active reservations by id or by transaction: 'released' (cancel, expiry) frees the instance for other
+    buyers, 'consumed' records that it was delivered. Returns the number of rows changed.
+    """
+    if reservation_id is None and transaction_id is None:
+        return 0
+    column, value = ('reservation_id', reservation_id) if reservation_id is not None else ('transaction_id', transaction_id)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute(f"""
+            UPDATE item_reservations SET status = ?, closed_at = ?
+            WHERE {column} = ? AND status = 'active'
+        """, (status, datetime.datetime.utcnow().isoformat(), value))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to mark item reservations ({column} {value}) as {status}: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+def get_active_item_reservation_counts(exclude_user_id: int = None) -> list[sqlite3.Row]:
+    """
+    Unexpired reservations per size: rows of (city, area, item_type, size, reserved). With exclude_user_id, that
+    buyer's selection holds (not yet tied to an invoice) are left out, since picking a size again reuses them.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT city, area, item_type, size, COUNT(*) AS reserved FROM item_reservations
+            WHERE status = 'active' AND expires_at > ?
+              AND NOT (user_id IS ? AND transaction_id IS NULL)
+            GROUP BY city, area, item_type, size
+        """, (datetime.datetime.utcnow().isoformat(), exclude_user_id))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to count active item reservations: {e}")
+        return []
+    finally:
+        conn.close()
+
+def purge_item_reservations(older_than: datetime.datetime) -> int:
+    """Deletes reservations that ended before older_than."""
+    now_iso = datetime.datetime.utcnow().isoformat()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        _expire_lapsed_item_reservations(cursor, now_iso)
+        cursor.execute("DELETE FROM item_reservations WHERE status != 'active' AND closed_at < ?", (older_than.isoformat(),))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to purge item reservations: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
 # --- Pending Crypto Payments CRUD ---
 def create_pending_payment(transaction_id: int, user_id: int, address: str, coin_symbol: str,
                            network: str | None, expected_crypto_amount: str, expires_at: datetime.datetime,
-                           paid_from_balance_eur: float = 0.0, status: str = 'monitoring') -> int | None:
+                           paid_from_balance_eur: float = 0.0, status: str = 'monitoring',
+                           hd_index: int | None = None, recycled_address: bool = False, exchange_rate_id: int | None = None) -> int | None:
     conn = get_db_connection()
     cursor = conn.cursor()
     now_iso = datetime.datetime.utcnow().isoformat()
@@ -234,9 +800,11 @@ def create_pending_payment(transaction_id: int, user_id: int, address: str, coin
     try:
         cursor.execute("""
             INSERT INTO pending_crypto_payments
-            (transaction_id, user_id, address, coin_symbol, network, expected_crypto_amount, paid_from_balance_eur, status, created_at, last_checked_at, expires_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (transaction_id, user_id, address, coin_symbol, network, expected_crypto_amount, paid_from_balance_eur, status, now_iso, now_iso, expires_at_iso))
+            (transaction_id, user_id, address, coin_symbol, network, expected_crypto_amount, paid_from_balance_eur, status, created_at, last_checked_at, expires_at,
+             hd_index, recycled_address, exchange_rate_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (transaction_id, user_id, address, coin_symbol, network, expected_crypto_amount, paid_from_balance_eur, status, now_iso, now_iso, expires_at_iso,
+              hd_index, 1 if recycled_address else 0, exchange_rate_id))
         payment_id = cursor.lastrowid
         conn.commit()
         logger.info(f"Created pending payment record ID {payment_id} for main tx {transaction_id}, address {address}, paid_from_balance_eur: {paid_from_balance_eur}.")
@@ -248,25 +816,646 @@ def create_pending_payment(transaction_id: int, user_id: int, address: str, coin
     finally:
         conn.close()
 
-def get_pending_payments_to_monitor(limit: int = 100) -> list[sqlite3.Row]:
+# --- Shared-Address Invoicing ---
+def get_shared_invoice_addresses(coin_symbol: str) -> list[sqlite3.Row]:
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute("""
-            SELECT * FROM pending_crypto_payments
-            WHERE status = 'monitoring' AND datetime('now', 'utc') < expires_at
-            ORDER BY last_checked_at ASC NULLS FIRST, created_at ASC
-            LIMIT ?
-        """, (limit,))
-        payments = cursor.fetchall()
-        logger.debug(f"Fetched {len(payments)} pending payments to monitor.")
-        return payments
+        cursor.execute("SELECT * FROM shared_invoice_addresses WHERE coin_symbol = ? ORDER BY address_id ASC", (coin_symbol,))
+        return cursor.fetchall()
     except sqlite3.Error as e:
-        logger.exception(f"Failed to fetch pending payments to monitor: {e}")
+        logger.exception(f"Failed to fetch shared invoice addresses for {coin_symbol}: {e}")
         return []
     finally:
         conn.close()
 
+def add_shared_invoice_address(coin_symbol: str, address: str, hd_index: int) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT OR IGNORE INTO shared_invoice_addresses (coin_symbol, address, hd_index, created_at)
+            VALUES (?, ?, ?, ?)
+        """, (coin_symbol, address, hd_index, datetime.datetime.utcnow().isoformat()))
+        conn.commit()
+        logger.info(f"Added shared invoice address {address} (index {hd_index}) to the {coin_symbol} pool.")
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to add shared invoice address {address} for {coin_symbol}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def get_shared_address_history_cursor(address: str) -> str | None:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT history_cursor FROM shared_invoice_addresses WHERE address = ?", (address,))
+        row = cursor.fetchone()
+        return row['history_cursor'] if row else None
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch history cursor for shared address {address}: {e}")
+        return None
+    finally:
+        conn.close()
+
+def update_shared_address_history_cursor(address: str, history_cursor_json: str) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("UPDATE shared_invoice_addresses SET history_cursor = ? WHERE address = ?", (history_cursor_json, address))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to update history cursor for shared address {address}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def create_shared_address_pending_payment(transaction_id: int, user_id: int, coin_symbol: str, network: str | None,
+                                          base_amount_smallest_unit: int, max_offset_units: int,
+                                          expires_at: datetime.datetime, paid_from_balance_eur: float = 0.0,
+                                          amount_reuse_guard_seconds: int = 3600, exchange_rate_id: int | None = None) -> tuple[int, str, int] | None:
+    """
+    Creates a 'shared' pending payment on the least busy address of the coin's shared pool, with the
+    expected amount raised by the smallest offset (0..max_offset_units smallest units) that no other invoice
+    on that address is using. Amounts of invoices that expired less than amount_reuse_guard_seconds ago are
+    also avoided, so a late payment for an old invoice cannot match a new one.
+    Runs in one IMMEDIATE transaction. Returns (payment_id, address, expected_amount_smallest_unit) or None.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = datetime.datetime.utcnow()
+    now_iso = now.isoformat()
+    guard_cutoff_iso = (now - datetime.timedelta(seconds=amount_reuse_guard_seconds)).isoformat()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("""
+            SELECT sia.address,
+                   (SELECT COUNT(*) FROM pending_crypto_payments pcp
+                    WHERE pcp.address = sia.address AND pcp.status = 'monitoring') AS active_invoices
+            FROM shared_invoice_addresses sia
+            WHERE sia.coin_symbol = ?
+            ORDER BY active_invoices ASC, sia.address_id ASC
+        """, (coin_symbol,))
+        pool_addresses = [row['address'] for row in cursor.fetchall()]
+        if not pool_addresses:
+            conn.rollback()
+            logger.error(f"No shared invoice addresses configured for {coin_symbol}.")
+            return None
+
+        for address in pool_addresses:
+            cursor.execute("""
+                SELECT expected_crypto_amount FROM pending_crypto_payments
+                WHERE address = ? AND invoice_mode = 'shared' AND (status = 'monitoring' OR expires_at > ?)
+            """, (address, guard_cutoff_iso))
+            amounts_in_use = {row['expected_crypto_amount'] for row in cursor.fetchall()}
+            for offset in range(max_offset_units + 1):
+                candidate_amount = base_amount_smallest_unit + offset
+                if str(candidate_amount) in amounts_in_use:
+                    continue
+                cursor.execute("""
+                    INSERT INTO pending_crypto_payments
+                    (transaction_id, user_id, address, coin_symbol, network, expected_crypto_amount, paid_from_balance_eur,
+                     status, created_at, last_checked_at, expires_at, invoice_mode, exchange_rate_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 'monitoring', ?, ?, ?, 'shared', ?)
+                """, (transaction_id, user_id, address, coin_symbol, network, str(candidate_amount), paid_from_balance_eur,
+                      now_iso, now_iso, expires_at.isoformat(), exchange_rate_id))
+                payment_id = cursor.lastrowid
+                conn.commit()
+                logger.info(f"Created shared pending payment {payment_id} for main tx {transaction_id} on {address}: "
+                            f"{candidate_amount} smallest units (base {base_amount_smallest_unit}, offset {offset}).")
+                return payment_id, address, candidate_amount
+
+        conn.rollback()
+        logger.error(f"All {len(pool_addresses)} shared {coin_symbol} addresses have no free amount within "
+                     f"{max_offset_units} units of {base_amount_smallest_unit} (main tx {transaction_id}).")
+        return None
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to create shared pending payment for main tx {transaction_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def get_claimed_blockchain_tx_ids(address: str) -> dict:
+    """Returns {blockchain_tx_id: payment_id} for all payments on an address that already recorded a transaction."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT blockchain_tx_id, payment_id FROM pending_crypto_payments
+            WHERE address = ? AND blockchain_tx_id IS NOT NULL
+        """, (address,))
+        return {row['blockchain_tx_id']: row['payment_id'] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch claimed transaction ids for address {address}: {e}")
+        return {}
+    finally:
+        conn.close()
+
+# --- Persistent Deposit Addresses ---
+def get_user_deposit_address(user_id: int, coin_symbol: str) -> sqlite3.Row | None:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT * FROM user_deposit_addresses WHERE user_id = ? AND coin_symbol = ?", (user_id, coin_symbol))
+        return cursor.fetchone()
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch {coin_symbol} deposit address for user {user_id}: {e}")
+        return None
+    finally:
+        conn.close()
+
+def create_user_deposit_address(user_id: int, coin_symbol: str, address: str, hd_index: int) -> sqlite3.Row | None:
+    """Stores the user's deposit address for a coin. If one was stored concurrently, that one is returned instead."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT OR IGNORE INTO user_deposit_addresses (user_id, coin_symbol, address, hd_index, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (user_id, coin_symbol, address, hd_index, datetime.datetime.utcnow().isoformat()))
+        conn.commit()
+        cursor.execute("SELECT * FROM user_deposit_addresses WHERE user_id = ? AND coin_symbol = ?", (user_id, coin_symbol))
+        return cursor.fetchone()
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to create {coin_symbol} deposit address for user {user_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def get_deposit_addresses_to_scan(limit: int = 100) -> list[sqlite3.Row]:
+    """Deposit addresses checked least recently first (never-checked ones before all others)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT * FROM user_deposit_addresses
+            ORDER BY last_checked_at IS NOT NULL, last_checked_at ASC
+            LIMIT ?
+        """, (limit,))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch deposit addresses to scan: {e}")
+        return []
+    finally:
+        conn.close()
+
+def update_deposit_address_scan(deposit_address_id: int, history_cursor_json: str | None) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("UPDATE user_deposit_addresses SET history_cursor = ?, last_checked_at = ? WHERE deposit_address_id = ?",
+                       (history_cursor_json, datetime.datetime.utcnow().isoformat(), deposit_address_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to update scan state of deposit address {deposit_address_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def get_deposit_credits_for_address(deposit_address_id: int) -> dict:
+    """Returns {blockchain_tx_id: deposit_credits row} for a deposit address."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT * FROM deposit_credits WHERE deposit_address_id = ?", (deposit_address_id,))
+        return {row['blockchain_tx_id']: row for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch deposit credits of deposit address {deposit_address_id}: {e}")
+        return {}
+    finally:
+        conn.close()
+
+def record_deposit_seen(deposit_address_id: int, user_id: int, coin_symbol: str, blockchain_tx_id: str,
+                        amount_smallest_unit: str, rate_eur: str, confirmations: int) -> int | None:
+    """Records a newly seen transfer to a deposit address. Returns the credit_id (existing rows are left unchanged)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT OR IGNORE INTO deposit_credits
+                (deposit_address_id, user_id, coin_symbol, blockchain_tx_id, amount_smallest_unit, rate_eur, confirmations, status, seen_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'seen', ?)
+        """, (deposit_address_id, user_id, coin_symbol, blockchain_tx_id, amount_smallest_unit, rate_eur, confirmations,
+              datetime.datetime.utcnow().isoformat()))
+        conn.commit()
+        cursor.execute("SELECT credit_id FROM deposit_credits WHERE deposit_address_id = ? AND blockchain_tx_id = ?",
+                       (deposit_address_id, blockchain_tx_id))
+        row = cursor.fetchone()
+        return row['credit_id'] if row else None
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to record deposit {blockchain_tx_id} to deposit address {deposit_address_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def update_deposit_credit(credit_id: int, confirmations: int | None = None, status: str | None = None,
+                          transaction_id: int | None = None) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        fields, params = [], []
+        if confirmations is not None:
+            fields.append("confirmations = ?"); params.append(confirmations)
+        if status is not None:
+            fields.append("status = ?"); params.append(status)
+            if status == 'credited':
+                fields.append("credited_at = ?"); params.append(datetime.datetime.utcnow().isoformat())
+        if transaction_id is not None:
+            fields.append("transaction_id = ?"); params.append(transaction_id)
+        if not fields:
+            return True
+        params.append(credit_id)
+        cursor.execute(f"UPDATE deposit_credits SET {', '.join(fields)} WHERE credit_id = ?", tuple(params))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to update deposit credit {credit_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def record_deposit_credit_transaction(credit_id: int, user_id: int, eur_amount: float, crypto_amount: str, currency: str,
+                                     original_add_balance_amount: float, notes: str) -> int | None:
+    """
+    Records the 'balance_top_up' transaction of a deposit credit and links it to the credit in one database
+    transaction. If the credit already has a transaction, that one is returned instead.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("SELECT transaction_id FROM deposit_credits WHERE credit_id = ?", (credit_id,))
+        credit = cursor.fetchone()
+        if credit is None:
+            conn.rollback()
+            logger.error(f"Deposit credit {credit_id} not found; no transaction recorded.")
+            return None
+        if credit['transaction_id']:
+            conn.commit()
+            return credit['transaction_id']
+        cursor.execute("""
+            INSERT INTO transactions
+                (user_id, type, eur_amount, crypto_amount, currency, payment_status, original_add_balance_amount, notes, created_at, updated_at)
+            VALUES (?, 'balance_top_up', ?, ?, ?, 'processing', ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        """, (user_id, eur_amount, crypto_amount, currency, original_add_balance_amount, notes))
+        transaction_id = cursor.lastrowid
+        cursor.execute("UPDATE deposit_credits SET transaction_id = ? WHERE credit_id = ?", (transaction_id, credit_id))
+        conn.commit()
+        logger.info(f"Transaction recorded: ID {transaction_id} for user {user_id}, type balance_top_up (deposit credit {credit_id}).")
+        return transaction_id
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to record transaction for deposit credit {credit_id} (user {user_id}): {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+# --- Address Recycling ---
+def add_address_recycle_candidate(hd_coin_symbol: str, payment_coin_symbol: str, address: str, hd_index: int,
+                                  source_payment_id: int, recheck_after: datetime.datetime) -> bool:
+    """Registers an expired invoice's address for an on-chain recheck. Retired addresses stay retired."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    try:
+        cursor.execute("""
+            INSERT INTO recycled_addresses
+                (hd_coin_symbol, payment_coin_symbol, address, hd_index, status, source_payment_id, recheck_after, created_at, updated_at)
+            VALUES (?, ?, ?, ?, 'candidate', ?, ?, ?, ?)
+            ON CONFLICT(address) DO UPDATE SET
+                status = 'candidate', payment_coin_symbol = excluded.payment_coin_symbol,
+                source_payment_id = excluded.source_payment_id, recheck_after = excluded.recheck_after, updated_at = excluded.updated_at
+            WHERE recycled_addresses.status != 'retired'
+        """, (hd_coin_symbol, payment_coin_symbol, address, hd_index, source_payment_id, recheck_after.isoformat(), now_iso, now_iso))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to add recycle candidate {address} (payment {source_payment_id}): {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def get_due_address_recycle_candidates(limit: int = 50) -> list[sqlite3.Row]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT * FROM recycled_addresses
+            WHERE status = 'candidate' AND recheck_after <= ?
+            ORDER BY recheck_after ASC
+            LIMIT ?
+        """, (datetime.datetime.utcnow().isoformat(), limit))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch due address recycle candidates: {e}")
+        return []
+    finally:
+        conn.close()
+
+def set_recycled_address_status(address: str, status: str, expected_current_status: str | None = None) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    try:
+        if expected_current_status:
+            cursor.execute("UPDATE recycled_addresses SET status = ?, updated_at = ? WHERE address = ? AND status = ?",
+                           (status, now_iso, address, expected_current_status))
+        else:
+            cursor.execute("UPDATE recycled_addresses SET status = ?, updated_at = ? WHERE address = ?", (status, now_iso, address))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to set recycled address {address} to '{status}': {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def claim_free_recycled_address(hd_coin_symbol: str) -> sqlite3.Row | None:
+    """Atomically takes the longest-free recycled address for a derivation coin, or returns None."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("""
+            SELECT * FROM recycled_addresses
+            WHERE hd_coin_symbol = ? AND status = 'free'
+            ORDER BY updated_at ASC
+            LIMIT 1
+        """, (hd_coin_symbol,))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute("UPDATE recycled_addresses SET status = 'claimed', updated_at = ? WHERE recycled_id = ?", (now_iso, row['recycled_id']))
+        conn.commit()
+        return row
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to claim a recycled {hd_coin_symbol} address: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def add_address_pool_block(hd_coin_symbol: str, first_index: int, count: int, entries: list[tuple]) -> int | None:
+    """
+    Adds pre-derived (address, hd_index) rows for HD indices first_index..first_index + count - 1 and marks those
+    indices used, in one transaction. Nothing is written, and None is returned, if another allocation took
+    first_index meanwhile; the caller derives again from the new position. Returns the number of rows inserted.
+    Indices are only consumed together with their addresses, so a failed derivation never loses any.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("INSERT OR IGNORE INTO hd_address_indices (coin_symbol, last_used_index) VALUES (?, -1)", (hd_coin_symbol,))
+        cursor.execute("SELECT last_used_index FROM hd_address_indices WHERE coin_symbol = ?", (hd_coin_symbol,))
+        if cursor.fetchone()['last_used_index'] + 1 != first_index:
+            conn.rollback()
+            return None
+        cursor.execute("UPDATE hd_address_indices SET last_used_index = ? WHERE coin_symbol = ?", (first_index + count - 1, hd_coin_symbol))
+        cursor.executemany("""
+            INSERT OR IGNORE INTO address_pool (hd_coin_symbol, address, hd_index, status, created_at)
+            VALUES (?, ?, ?, 'available', ?)
+        """, [(hd_coin_symbol, address, hd_index, now_iso) for address, hd_index in entries])
+        inserted = cursor.rowcount
+        conn.commit()
+        logger.info(f"HD Wallet Index: Used {count} {hd_coin_symbol} indices starting at {first_index} for the address pool.")
+        return inserted
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to add {len(entries)} {hd_coin_symbol} addresses to the address pool: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+def claim_address_pool_entry(hd_coin_symbol: str) -> sqlite3.Row | None:
+    """Atomically takes the lowest-index available pool address for a derivation coin, or returns None."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("""
+            SELECT * FROM address_pool
+            WHERE hd_coin_symbol = ? AND status = 'available'
+            ORDER BY hd_index ASC
+            LIMIT 1
+        """, (hd_coin_symbol,))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute("UPDATE address_pool SET status = 'claimed', qr_png = NULL, claimed_at = ? WHERE pool_id = ?",
+                           (datetime.datetime.utcnow().isoformat(), row['pool_id']))
+        conn.commit()
+        return row
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to claim a pooled {hd_coin_symbol} address: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def release_address_pool_entry(address: str) -> bool:
+    """Puts a claimed pool address back (its invoice could not be created)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("UPDATE address_pool SET status = 'available', claimed_at = NULL WHERE address = ? AND status = 'claimed'", (address,))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to release pooled address {address}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def delete_claimed_address_pool_entries(claimed_before: datetime.datetime) -> int:
+    """Drops claimed pool rows; the invoice's pending payment keeps the address and HD index."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("DELETE FROM address_pool WHERE status = 'claimed' AND claimed_at < ?", (claimed_before.isoformat(),))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to purge claimed address pool entries: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+def get_address_pool_counts() -> dict:
+    """Returns {hd_coin_symbol: number of available pool addresses}."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT hd_coin_symbol, COUNT(*) AS address_count FROM address_pool WHERE status = 'available' GROUP BY hd_coin_symbol")
+        return {row['hd_coin_symbol']: row['address_count'] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to count address pool entries: {e}")
+        return {}
+    finally:
+        conn.close()
+
+def get_recycled_address_counts() -> dict:
+    """Returns {hd_coin_symbol: {status: count}}."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT hd_coin_symbol, status, COUNT(*) AS address_count FROM recycled_addresses GROUP BY hd_coin_symbol, status")
+        counts = {}
+        for row in cursor.fetchall():
+            counts.setdefault(row['hd_coin_symbol'], {})[row['status']] = row['address_count']
+        return counts
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to count recycled addresses: {e}")
+        return {}
+    finally:
+        conn.close()
+
+def get_pending_payments_to_monitor(limit: int = 100) -> list[sqlite3.Row]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT * FROM pending_crypto_payments
+            WHERE status = 'monitoring' AND datetime('now', 'utc') < expires_at
+            ORDER BY last_checked_at ASC NULLS FIRST, created_at ASC
+            LIMIT ?
+        """, (limit,))
+        payments = cursor.fetchall()
+        logger.debug(f"Fetched {len(payments)} pending payments to monitor.")
+        return payments
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch pending payments to monitor: {e}")
+        return []
+    finally:
+        conn.close()
+
+def claim_pending_payments_for_monitoring(worker_id: str, limit: int = 25, lease_seconds: int = 120,
+                                          checked_before_iso: str | None = None) -> list[sqlite3.Row]:
+    """
+    Atomically leases up to `limit` unexpired 'monitoring' payments to worker_id and returns them.
+    Payments leased to another worker are skipped until that lease expires, so concurrent monitor
+    workers always get disjoint batches. With checked_before_iso, payments already checked at or after
+    that time are skipped (lets one cycle walk through all payments without re-claiming its own work).
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = datetime.datetime.utcnow()
+    now_iso = now.isoformat()
+    lease_until_iso = (now + datetime.timedelta(seconds=lease_seconds)).isoformat()
+    checked_filter = ""
+    params = [now_iso, now_iso]
+    if checked_before_iso:
+        checked_filter = " AND (last_checked_at IS NULL OR last_checked_at < ?)"
+        params.append(checked_before_iso)
+    params.append(limit)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute(f"""
+            SELECT payment_id FROM pending_crypto_payments
+            WHERE status = 'monitoring' AND expires_at > ?
+              AND (lease_until IS NULL OR lease_until < ?){checked_filter}
+            ORDER BY last_checked_at ASC NULLS FIRST, created_at ASC
+            LIMIT ?
+        """, params)
+        payment_ids = [row['payment_id'] for row in cursor.fetchall()]
+        if not payment_ids:
+            conn.commit()
+            return []
+        placeholders = ','.join('?' for _ in payment_ids)
+        cursor.execute(f"UPDATE pending_crypto_payments SET lease_owner = ?, lease_until = ? WHERE payment_id IN ({placeholders})",
+                       [worker_id, lease_until_iso] + payment_ids)
+        cursor.execute(f"""
+            SELECT * FROM pending_crypto_payments WHERE payment_id IN ({placeholders})
+            ORDER BY last_checked_at ASC NULLS FIRST, created_at ASC
+        """, payment_ids)
+        payments = cursor.fetchall()
+        conn.commit()
+        logger.debug(f"Worker {worker_id} leased {len(payments)} pending payments for monitoring.")
+        return payments
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to claim pending payments for worker {worker_id}: {e}")
+        conn.rollback()
+        return []
+    finally:
+        conn.close()
+
+def try_lease_pending_payment(payment_id: int, worker_id: str, lease_seconds: int = 120) -> bool:
+    """Leases a single payment (e.g. for an on-demand check). Fails if another worker holds an unexpired lease."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = datetime.datetime.utcnow()
+    now_iso = now.isoformat()
+    lease_until_iso = (now + datetime.timedelta(seconds=lease_seconds)).isoformat()
+    try:
+        cursor.execute("""
+            UPDATE pending_crypto_payments SET lease_owner = ?, lease_until = ?
+            WHERE payment_id = ? AND (lease_until IS NULL OR lease_until < ? OR lease_owner = ?)
+        """, (worker_id, lease_until_iso, payment_id, now_iso, worker_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to lease pending payment {payment_id} for worker {worker_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def renew_pending_payment_leases(worker_id: str, payment_ids: list[int], lease_seconds: int = 120) -> int:
+    """Heartbeat: extends this worker's leases on the given payments. Returns the number of leases still held."""
+    if not payment_ids:
+        return 0
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    lease_until_iso = (datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_seconds)).isoformat()
+    placeholders = ','.join('?' for _ in payment_ids)
+    try:
+        cursor.execute(f"""
+            UPDATE pending_crypto_payments SET lease_until = ?
+            WHERE lease_owner = ? AND payment_id IN ({placeholders})
+        """, [lease_until_iso, worker_id] + list(payment_ids))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to renew pending payment leases for worker {worker_id}: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+def release_pending_payment_leases(worker_id: str, payment_ids: list[int]):
+    if not payment_ids:
+        return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    placeholders = ','.join('?' for _ in payment_ids)
+    try:
+        cursor.execute(f"""
+            UPDATE pending_crypto_payments SET lease_owner = NULL, lease_until = NULL
+            WHERE lease_owner = ? AND payment_id IN ({placeholders})
+        """, [worker_id] + list(payment_ids))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to release pending payment leases for worker {worker_id}: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
 def update_pending_payment_check_details(payment_id: int, confirmations: int, received_amount: str | None = None, blockchain_tx_id: str | None = None):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -294,6 +1483,37 @@ def update_pending_payment_check_details(payment_id: int, confirmations: int, re
     finally:
         conn.close()
 
+def mark_pending_payment_checked(payment_id: int) -> bool:
+    """Records a check attempt (e.g. one that failed on a transient API error) without changing anything else."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("UPDATE pending_crypto_payments SET last_checked_at = ? WHERE payment_id = ?",
+                       (datetime.datetime.utcnow().isoformat(), payment_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to mark pending payment ID {payment_id} as checked: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def update_pending_payment_history_cursor(payment_id: int, history_cursor_json: str) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("UPDATE pending_crypto_payments SET history_cursor = ? WHERE payment_id = ?", (history_cursor_json, payment_id))
+        conn.commit()
+        logger.debug(f"Updated history cursor for pending payment ID {payment_id}.")
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to update history cursor for pending payment ID {payment_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
 def update_pending_payment_status(payment_id: int, new_status: str):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -336,6 +1556,190 @@ def get_confirmed_unprocessed_payments(limit: int = 100) -> list[sqlite3.Row]:
     finally:
         conn.close()
 
+# Payment funnel: each event's timestamp is recorded once (the first time it happens).
+PAYMENT_FUNNEL_EVENT_COLUMNS = {
+    'first_seen': 'first_seen_at',
+    'confirmed': 'confirmed_at',
+    'finalization_started': 'finalization_started_at',
+    'finalization_finished': 'finalization_finished_at',
+    'user_notified': 'user_notified_at',
+}
+
+def record_payment_funnel_event(event: str, payment_id: int | None = None, transaction_id: int | None = None,
+                                provider: str | None = None) -> bool:
+    """Stamps a funnel event on a pending payment, identified by payment_id or by its main transaction_id."""
+    column = PAYMENT_FUNNEL_EVENT_COLUMNS.get(event)
+    if column is None or (payment_id is None and transaction_id is None):
+        logger.error(f"record_payment_funnel_event: invalid event '{event}' or no payment reference given.")
+        return False
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    try:
+        where_clause, where_value = ("payment_id = ?", payment_id) if payment_id is not None else ("transaction_id = ?", transaction_id)
+        cursor.execute(f"""
+            UPDATE pending_crypto_payments
+            SET {column} = COALESCE({column}, ?), provider = COALESCE(provider, ?)
+            WHERE {where_clause}
+        """, (now_iso, provider, where_value))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to record funnel event '{event}' for payment {payment_id} / tx {transaction_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def get_payment_funnel_rows(created_since: datetime.datetime) -> list[sqlite3.Row]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT payment_id, coin_symbol, provider, invoice_mode, created_at, first_seen_at, confirmed_at,
+                   finalization_started_at, finalization_finished_at, user_notified_at
+            FROM pending_crypto_payments
+            WHERE created_at >= ?
+        """, (created_since.isoformat(),))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch payment funnel rows: {e}")
+        return []
+    finally:
+        conn.close()
+
+def claim_confirmed_payment_for_processing(payment_id: int, owner: str) -> sqlite3.Row | None:
+    """
+    Atomically moves a payment from 'confirmed_unprocessed' to 'processing' for `owner` and returns the row.
+    Returns None if another worker already claimed it (or it is in any other status).
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    try:
+        cursor.execute("""
+            UPDATE pending_crypto_payments
+            SET status = 'processing', processing_owner = ?, processing_started_at = ?
+            WHERE payment_id = ? AND status = 'confirmed_unprocessed'
+        """, (owner, now_iso, payment_id))
+        if cursor.rowcount == 0:
+            conn.commit()
+            return None
+        cursor.execute("SELECT * FROM pending_crypto_payments WHERE payment_id = ?", (payment_id,))
+        payment = cursor.fetchone()
+        conn.commit()
+        logger.debug(f"Payment {payment_id} claimed for processing by {owner}.")
+        return payment
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to claim payment {payment_id} for processing by {owner}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def reclaim_stale_processing_payments(older_than_seconds: int) -> list[int]:
+    """Returns payments stuck in 'processing' (worker died mid-finalization) to 'confirmed_unprocessed'."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cutoff_iso = (datetime.datetime.utcnow() - datetime.timedelta(seconds=older_than_seconds)).isoformat()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("""
+            SELECT payment_id FROM pending_crypto_payments
+            WHERE status = 'processing' AND (processing_started_at IS NULL OR processing_started_at < ?)
+        """, (cutoff_iso,))
+        payment_ids = [row['payment_id'] for row in cursor.fetchall()]
+        if payment_ids:
+            placeholders = ','.join('?' for _ in payment_ids)
+            cursor.execute(f"""
+                UPDATE pending_crypto_payments
+                SET status = 'confirmed_unprocessed', processing_owner = NULL, processing_started_at = NULL
+                WHERE payment_id IN ({placeholders})
+            """, payment_ids)
+            logger.warning(f"Reclaimed {len(payment_ids)} payments stuck in 'processing': {payment_ids}")
+        conn.commit()
+        return payment_ids
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to reclaim stale processing payments: {e}")
+        conn.rollback()
+        return []
+    finally:
+        conn.close()
+
+def apply_balance_change_once(idempotency_key: str, user_id: int, delta_eur: float,
+                              increment_transactions: bool = False, transaction_id: int | None = None) -> bool | None:
+    """
+    Adds delta_eur (negative to debit) to the user's balance exactly once per idempotency_key.
+    Returns True if applied now, False if it had already been applied, None on database error.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("INSERT OR IGNORE INTO finalization_ledger (idempotency_key, transaction_id, created_at) VALUES (?, ?, ?)",
+                       (idempotency_key, transaction_id, now_iso))
+        if cursor.rowcount == 0:
+            conn.commit()
+            logger.info(f"Balance change '{idempotency_key}' for user {user_id} was already applied. Skipping.")
+            return False
+        transaction_count_increment = 1 if increment_transactions else 0
+        cursor.execute("""
+            UPDATE users SET balance = ROUND(balance + ?, 2), transaction_count = transaction_count + ?
+            WHERE user_id = ?
+        """, (delta_eur, transaction_count_increment, user_id))
+        if cursor.rowcount == 0:
+            raise sqlite3.IntegrityError(f"User {user_id} not found")
+        conn.commit()
+        logger.info(f"Balance change '{idempotency_key}' applied for user {user_id}: {delta_eur:+.2f} EUR.")
+        return True
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to apply balance change '{idempotency_key}' for user {user_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def is_finalization_step_done(idempotency_key: str) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT 1 FROM finalization_ledger WHERE idempotency_key = ?", (idempotency_key,))
+        return cursor.fetchone() is not None
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to look up finalization step '{idempotency_key}': {e}")
+        return False
+    finally:
+        conn.close()
+
+def mark_finalization_step_done(idempotency_key: str, transaction_id: int | None = None) -> bool:
+    """Records a non-database side effect (e.g. item delivery) as done. Returns False if it was already recorded."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("INSERT OR IGNORE INTO finalization_ledger (idempotency_key, transaction_id, created_at) VALUES (?, ?, ?)",
+                       (idempotency_key, transaction_id, datetime.datetime.utcnow().isoformat()))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to record finalization step '{idempotency_key}': {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def get_pending_payment_by_id(payment_id: int) -> sqlite3.Row | None:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT * FROM pending_crypto_payments WHERE payment_id = ?", (payment_id,))
+        return cursor.fetchone()
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch pending payment by payment_id {payment_id}: {e}")
+        return None
+    finally:
+        conn.close()
+
 def get_pending_payment_by_transaction_id(transaction_id: int) -> sqlite3.Row | None:
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -362,6 +1766,42 @@ def get_pending_payment_by_address(address: str) -> sqlite3.Row | None:
     finally:
         conn.close()
 
+def get_pending_payments_by_addresses(addresses: list[str]) -> list[sqlite3.Row]:
+    """All pending payments on any of the addresses (an address can carry several invoices over time)."""
+    if not addresses:
+        return []
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    payments = []
+    try:
+        for chunk_start in range(0, len(addresses), 500): # Stay below SQLite's host parameter limit
+            chunk = addresses[chunk_start:chunk_start + 500]
+            cursor.execute(f"SELECT * FROM pending_crypto_payments WHERE address IN ({', '.join('?' for _ in chunk)}) ORDER BY created_at ASC", chunk)
+            payments.extend(cursor.fetchall())
+        return payments
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch pending payments for {len(addresses)} addresses: {e}")
+        return []
+    finally:
+        conn.close()
+
+def flag_payment_late_funds(payment_id: int) -> bool:
+    """Marks a payment whose address received funds after it expired or was cancelled. Returns True if newly flagged."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("UPDATE pending_crypto_payments SET late_funds_detected_at = ? WHERE payment_id = ? AND late_funds_detected_at IS NULL",
+                       (datetime.datetime.utcnow().isoformat(), payment_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to flag late funds on payment {payment_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
 def get_stale_monitoring_payments(limit: int = 100) -> list[sqlite3.Row]:
     """Fetches 'monitoring' payments that have passed their 'expires_at' time."""
     conn = get_db_connection()
@@ -776,3 +2216,229 @@ def get_all_users_admin(limit: int = 10, offset: int = 0) -> tuple[list[sqlite3.
     finally:
         if conn:
             conn.close()
+
+
+# --- Durable Job Queue ---
+# Jobs are claimed with a lease (visibility timeout). A job whose lease expires without being
+# completed (e.g. the worker crashed) becomes claimable again. Failed jobs are retried with
+# exponential backoff and moved to 'dead' after max_attempts.
+
+def enqueue_job(job_type: str, payload: dict | None = None, priority: int = 100, run_at: datetime.datetime | None = None,
+                max_attempts: int = 5, dedupe_key: str | None = None) -> int | None:
+    """Adds a job. If dedupe_key is set and an active job with the same key exists, nothing is added and None is returned."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    run_at_iso = (run_at or datetime.datetime.utcnow()).isoformat()
+    try:
+        cursor.execute("""
+            INSERT OR IGNORE INTO jobs
+                (job_type, payload_json, priority, status, attempts, max_attempts, run_at, dedupe_key, created_at, updated_at)
+            VALUES (?, ?, ?, 'queued', 0, ?, ?, ?, ?, ?)
+        """, (job_type, json.dumps(payload or {}), priority, max_attempts, run_at_iso, dedupe_key, now_iso, now_iso))
+        conn.commit()
+        if cursor.rowcount == 0:
+            logger.debug(f"Job '{job_type}' with dedupe_key '{dedupe_key}' already active. Not enqueued again.")
+            return None
+        logger.debug(f"Enqueued job {cursor.lastrowid} ({job_type}) to run at {run_at_iso}, priority {priority}.")
+        return cursor.lastrowid
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to enqueue job '{job_type}': {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def claim_jobs(worker_id: str, job_types: list[str] | None = None, limit: int = 1,
+               visibility_timeout_seconds: int = 300) -> list[sqlite3.Row]:
+    """
+    Atomically leases up to `limit` due jobs (queued and ready, or running with an expired lease) to worker_id.
+    Jobs whose lease expired after their last allowed attempt are left for dead_letter_expired_jobs.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = datetime.datetime.utcnow()
+    now_iso = now.isoformat()
+    lease_until_iso = (now + datetime.timedelta(seconds=visibility_timeout_seconds)).isoformat()
+    type_filter = ""
+    type_params = []
+    if job_types:
+        type_filter = f" AND job_type IN ({','.join('?' for _ in job_types)})"
+        type_params = list(job_types)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute(f"""
+            SELECT job_id FROM jobs
+            WHERE ((status = 'queued' AND run_at <= ?) OR (status = 'running' AND lease_until < ? AND attempts < max_attempts)){type_filter}
+            ORDER BY priority ASC, run_at ASC
+            LIMIT ?
+        """, [now_iso, now_iso] + type_params + [limit])
+        job_ids = [row['job_id'] for row in cursor.fetchall()]
+        if not job_ids:
+            conn.commit()
+            return []
+        placeholders = ','.join('?' for _ in job_ids)
+        cursor.execute(f"""
+            UPDATE jobs SET status = 'running', lease_owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?
+            WHERE job_id IN ({placeholders})
+        """, [worker_id, lease_until_iso, now_iso] + job_ids)
+        cursor.execute(f"SELECT * FROM jobs WHERE job_id IN ({placeholders}) ORDER BY priority ASC, run_at ASC", job_ids)
+        jobs = cursor.fetchall()
+        conn.commit()
+        logger.debug(f"Worker {worker_id} claimed {len(jobs)} job(s): {job_ids}.")
+        return jobs
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to claim jobs for worker {worker_id}: {e}")
+        conn.rollback()
+        return []
+    finally:
+        conn.close()
+
+def dead_letter_expired_jobs(job_types: list[str] | None = None) -> list[sqlite3.Row]:
+    """Moves jobs whose lease expired on their final attempt to 'dead'. Returns the dead-lettered jobs."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    type_filter = ""
+    type_params = []
+    if job_types:
+        type_filter = f" AND job_type IN ({','.join('?' for _ in job_types)})"
+        type_params = list(job_types)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute(f"""
+            SELECT * FROM jobs
+            WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts{type_filter}
+        """, [now_iso] + type_params)
+        jobs = cursor.fetchall()
+        if jobs:
+            placeholders = ','.join('?' for _ in jobs)
+            cursor.execute(f"""
+                UPDATE jobs SET status = 'dead', lease_owner = NULL, lease_until = NULL, updated_at = ?,
+                                last_error = COALESCE(last_error, 'Lease expired on final attempt')
+                WHERE job_id IN ({placeholders})
+            """, [now_iso] + [job['job_id'] for job in jobs])
+            logger.warning(f"Dead-lettered {len(jobs)} job(s) whose lease expired on their final attempt.")
+        conn.commit()
+        return jobs
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to dead-letter expired jobs: {e}")
+        conn.rollback()
+        return []
+    finally:
+        conn.close()
+
+def extend_job_lease(job_id: int, worker_id: str, visibility_timeout_seconds: int = 300) -> bool:
+    """Heartbeat: pushes the lease of a running job forward. Returns False if the worker no longer owns it."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = datetime.datetime.utcnow()
+    lease_until_iso = (now + datetime.timedelta(seconds=visibility_timeout_seconds)).isoformat()
+    try:
+        cursor.execute("""
+            UPDATE jobs SET lease_until = ?, updated_at = ?
+            WHERE job_id = ? AND lease_owner = ? AND status = 'running'
+        """, (lease_until_iso, now.isoformat(), job_id, worker_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to extend lease of job {job_id} for worker {worker_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def complete_job(job_id: int, worker_id: str) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now_iso = datetime.datetime.utcnow().isoformat()
+    try:
+        cursor.execute("""
+            UPDATE jobs SET status = 'done', lease_owner = NULL, lease_until = NULL, updated_at = ?
+            WHERE job_id = ? AND lease_owner = ? AND status = 'running'
+        """, (now_iso, job_id, worker_id))
+        conn.commit()
+        if cursor.rowcount == 0:
+            logger.warning(f"Job {job_id} could not be completed by {worker_id}: lease lost (it may run again).")
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to complete job {job_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def fail_job(job_id: int, worker_id: str, error_message: str, retry_delay_seconds: float) -> str | None:
+    """Records a failed attempt. Requeues with the given delay, or dead-letters when attempts are exhausted.
+    Returns the new status ('queued' or 'dead'), or None if the lease was lost."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = datetime.datetime.utcnow()
+    retry_at_iso = (now + datetime.timedelta(seconds=retry_delay_seconds)).isoformat()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute("SELECT attempts, max_attempts FROM jobs WHERE job_id = ? AND lease_owner = ? AND status = 'running'", (job_id, worker_id))
+        row = cursor.fetchone()
+        if not row:
+            conn.commit()
+            logger.warning(f"Job {job_id} failed but {worker_id} no longer holds its lease.")
+            return None
+        new_status = 'dead' if row['attempts'] >= row['max_attempts'] else 'queued'
+        cursor.execute("""
+            UPDATE jobs SET status = ?, run_at = ?, lease_owner = NULL, lease_until = NULL, last_error = ?, updated_at = ?
+            WHERE job_id = ?
+        """, (new_status, retry_at_iso, (error_message or '')[:1000], now.isoformat(), job_id))
+        conn.commit()
+        return new_status
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to record failure of job {job_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def purge_finished_jobs(older_than_days: int = 7) -> int:
+    """Deletes 'done' jobs older than the given age. Dead-lettered jobs are kept for inspection."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cutoff_iso = (datetime.datetime.utcnow() - datetime.timedelta(days=older_than_days)).isoformat()
+    try:
+        cursor.execute("DELETE FROM jobs WHERE status = 'done' AND updated_at < ?", (cutoff_iso,))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to purge finished jobs: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+def get_payment_backlog_stats() -> dict:
+    """Returns {status: {'count': n, 'oldest_created_at': iso}} for payments still waiting on the monitor or finalization."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT status, COUNT(*) AS payment_count, MIN(created_at) AS oldest_created_at
+            FROM pending_crypto_payments
+            WHERE status IN ('monitoring', 'confirmed_unprocessed', 'processing')
+            GROUP BY status
+        """)
+        return {row['status']: {'count': row['payment_count'], 'oldest_created_at': row['oldest_created_at']} for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to fetch payment backlog stats: {e}")
+        return {}
+    finally:
+        conn.close()
+
+def get_job_counts_by_status() -> dict:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT status, COUNT(*) AS job_count FROM jobs GROUP BY status")
+        return {row['status']: row['job_count'] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logger.exception(f"Failed to count jobs by status: {e}")
+        return {}
+    finally:
+        conn.close()
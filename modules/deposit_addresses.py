@@ -0,0 +1,221 @@
+import logging
+import json
+import time
+import datetime
+from decimal import Decimal, InvalidOperation, ROUND_DOWN
+
+import config
+from modules import db_utils
+from modules import hd_wallet_utils
+from modules import exchange_rate_utils
+from modules import blockchain_apis
+from modules import payment_invoicing
+from modules import worker_runtime
+from modules.blockchain_apis import BlockchainAPIError
+from modules.text_utils import escape_md
+
+logger = logging.getLogger(__name__)
+
+# Optional stable deposit addresses for balance top-ups (PERSISTENT_DEPOSIT_ADDRESSES_ENABLED).
+# Each user gets one address per coin, derived once and kept. There is no invoice or payment window:
+# a recurring watcher job scans deposit addresses in batches (least recently checked first, resuming
+# from a per-address history cursor) and credits every incoming transfer once it has enough
+# confirmations. The EUR value is fixed at the exchange rate in effect when the transfer was first
+# seen, minus ADD_BALANCE_SERVICE_FEE_EUR per deposit.
+
+PERSISTENT_DEPOSIT_ADDRESSES_ENABLED = getattr(config, 'PERSISTENT_DEPOSIT_ADDRESSES_ENABLED', False)
+PERSISTENT_DEPOSIT_COINS = set(getattr(config, 'PERSISTENT_DEPOSIT_COINS', ('BTC', 'LTC', 'USDT_TRX')))
+DEPOSIT_SCAN_INTERVAL_SECONDS = getattr(config, 'DEPOSIT_SCAN_INTERVAL_SECONDS', 180)
+DEPOSIT_SCAN_BATCH_SIZE = getattr(config, 'DEPOSIT_SCAN_BATCH_SIZE', 60)
+API_CALL_DELAY_SECONDS = getattr(config, 'BLOCKCHAIN_API_CALL_DELAY_SECONDS', 2.0)
+
+AMOUNT_KEY_MAP = {"BTC": "amount_satoshi", "LTC": "amount_litoshi", "USDT_TRX": "amount_smallest_unit"}
+DISPLAY_COIN_BY_DEPOSIT_COIN = {"BTC": "BTC", "LTC": "LTC", "USDT_TRX": "USDT"}
+
+
+def uses_persistent_deposits(db_coin_symbol: str) -> bool:
+    return PERSISTENT_DEPOSIT_ADDRESSES_ENABLED and db_coin_symbol in PERSISTENT_DEPOSIT_COINS
+
+
+def get_or_create_deposit_address(user_id: int, crypto_currency: str):
+    """Returns the user's user_deposit_addresses row for the currency ('BTC', 'LTC', 'USDT'), deriving it on first use."""
+    coin_details = payment_invoicing.get_payment_coin_details(crypto_currency)
+    existing = db_utils.get_user_deposit_address(user_id, coin_details['db_coin'])
+    if existing:
+        return existing
+    hd_index = db_utils.get_next_address_index(coin_details['hd_coin'])
+    address = hd_wallet_utils.generate_address(coin_details['hd_coin'], hd_index)
+    if not address:
+        logger.error(f"Failed to derive {coin_details['hd_coin']} deposit address at index {hd_index} for user {user_id}.")
+        return None
+    deposit_address = db_utils.create_user_deposit_address(user_id, coin_details['db_coin'], address, hd_index)
+    if deposit_address:
+        logger.info(f"Assigned {coin_details['db_coin']} deposit address {deposit_address['address']} to user {user_id}.")
+    return deposit_address
+
+
+def _epoch_ms(naive_utc_iso: str) -> int:
+    return int(datetime.datetime.fromisoformat(naive_utc_iso).replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def _min_confirmations(db_coin_symbol: str) -> int:
+    hd_coin_symbol = payment_invoicing.get_payment_coin_details(DISPLAY_COIN_BY_DEPOSIT_COIN[db_coin_symbol])['hd_coin']
+    return getattr(config, f"MIN_CONFIRMATIONS_{hd_coin_symbol}", 1)
+
+
+def _fetch_deposit_transactions(deposit_address, history_cursor: dict) -> list[dict] | None:
+    coin_symbol = deposit_address['coin_symbol']
+    address = deposit_address['address']
+    if coin_symbol == "BTC":
+        return blockchain_apis.get_address_transactions_btc(address, cursor=history_cursor)
+    if coin_symbol == "LTC":
+        return blockchain_apis.get_address_transactions_ltc(address, cursor=history_cursor)
+    if coin_symbol == "USDT_TRX":
+        since_timestamp_ms = _epoch_ms(deposit_address['created_at']) - 5 * 60 * 1000
+        return blockchain_apis.get_trc20_transfers_usdt_trx(address, since_timestamp_ms=since_timestamp_ms, cursor=history_cursor)
+    return None
+
+
+def _notify_user(user_id: int, text: str, dedupe_key: str):
+    try:
+        worker_runtime.enqueue('send_user_notification', {'user_id': user_id, 'text': text, 'parse_mode': "MarkdownV2"},
+                               priority=50, dedupe_key=dedupe_key)
+    except Exception as e:
+        logger.error(f"Failed to queue deposit notification for user {user_id}: {e}")
+
+
+def _credit_deposit(credit_id: int, deposit_address, amount_smallest_unit: str, rate_eur: str, existing_transaction_id: int | None):
+    """Credits a confirmed deposit to the user's balance. Safe to repeat: each step is idempotent per credit_id."""
+    user_id = deposit_address['user_id']
+    coin_symbol = deposit_address['coin_symbol']
+    display_coin = DISPLAY_COIN_BY_DEPOSIT_COIN[coin_symbol]
+    amount_coin = payment_invoicing.smallest_units_to_display_amount(int(amount_smallest_unit), display_coin)
+    gross_eur = (amount_coin * Decimal(rate_eur)).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
+    net_eur = gross_eur - Decimal(str(getattr(config, 'ADD_BALANCE_SERVICE_FEE_EUR', 0)))
+
+    if net_eur <= 0:
+        logger.warning(f"Deposit credit {credit_id}: {amount_coin} {display_coin} ({gross_eur} EUR) for user {user_id} does not cover the service fee. Not credited.")
+        db_utils.update_deposit_credit(credit_id, status='ignored_dust')
+        return
+
+    transaction_id = existing_transaction_id
+    if not transaction_id:
+        # The transaction row and its link from the credit are written together, so a failed write
+        # cannot leave an orphaned transaction that the next scan would duplicate.
+        transaction_id = db_utils.record_deposit_credit_transaction(
+            credit_id, user_id=user_id, eur_amount=float(gross_eur),
+            crypto_amount=str(amount_coin), currency=display_coin,
+            original_add_balance_amount=float(net_eur),
+            notes=f"Deposit to persistent address {deposit_address['address']} (credit {credit_id}) at {rate_eur} EUR/{display_coin}.")
+        if not transaction_id:
+            logger.error(f"Deposit credit {credit_id}: failed to record transaction for user {user_id}; will retry next scan.")
+            return
+
+    applied = db_utils.apply_balance_change_once(f"deposit:{credit_id}:credit", user_id, float(net_eur),
+                                                 increment_transactions=True, transaction_id=transaction_id)
+    if applied is None:
+        logger.error(f"Deposit credit {credit_id}: failed to credit {net_eur} EUR to user {user_id}; will retry next scan.")
+        return
+    db_utils.update_transaction_status(transaction_id, 'completed')
+    db_utils.update_deposit_credit(credit_id, status='credited')
+    logger.info(f"Deposit credit {credit_id}: credited {net_eur} EUR to user {user_id} for {amount_coin} {display_coin} (tx {transaction_id}).")
+    if applied:
+        _notify_user(user_id,
+                     f"✅ Deposit received: `{escape_md(str(amount_coin))} {escape_md(display_coin)}`\\. "
+                     f"*{escape_md(f'{net_eur:.2f}')} EUR* has been added to your balance\\.",
+                     dedupe_key=f"deposit_credit:{credit_id}")
+
+
+def _scan_deposit_address(deposit_address, rates: dict):
+    coin_symbol = deposit_address['coin_symbol']
+    deposit_address_id = deposit_address['deposit_address_id']
+    try:
+        history_cursor = json.loads(deposit_address['history_cursor'] or '{}')
+    except (TypeError, ValueError):
+        history_cursor = {}
+
+    api_transactions = _fetch_deposit_transactions(deposit_address, history_cursor)
+    if api_transactions is None:
+        logger.error(f"Deposit watcher: unsupported coin '{coin_symbol}' for deposit address {deposit_address_id}.")
+        return
+
+    amount_key = AMOUNT_KEY_MAP[coin_symbol]
+    min_confirmations = _min_confirmations(coin_symbol)
+    credits = db_utils.get_deposit_credits_for_address(deposit_address_id)
+    for tx_info in api_transactions:
+        txid = tx_info.get('txid')
+        amount_smallest_unit = tx_info.get(amount_key)
+        try:
+            if not txid or not amount_smallest_unit or Decimal(amount_smallest_unit) <= 0:
+                continue
+        except InvalidOperation:
+            logger.warning(f"Deposit watcher: unreadable amount in tx {txid} for deposit address {deposit_address_id}: {amount_smallest_unit}")
+            continue
+        confirmations = tx_info.get('confirmations', 0)
+
+        credit = credits.get(txid)
+        if credit is None:
+            if coin_symbol not in rates:
+                rates[coin_symbol] = exchange_rate_utils.get_current_exchange_rate("EUR", DISPLAY_COIN_BY_DEPOSIT_COIN[coin_symbol])
+            if not rates[coin_symbol]:
+                logger.warning(f"Deposit watcher: no EUR rate for {coin_symbol}; tx {txid} will be recorded on a later scan.")
+                continue
+            credit_id = db_utils.record_deposit_seen(deposit_address_id, deposit_address['user_id'], coin_symbol, txid,
+                                                     str(amount_smallest_unit), str(rates[coin_symbol]), confirmations)
+            if not credit_id:
+                continue
+            logger.info(f"Deposit watcher: new deposit {txid} of {amount_smallest_unit} ({coin_symbol}) to deposit address {deposit_address_id}, "
+                        f"rate {rates[coin_symbol]} EUR.")
+            rate_eur, transaction_id = str(rates[coin_symbol]), None
+        elif credit['status'] != 'seen':
+            continue
+        else:
+            credit_id, rate_eur, transaction_id = credit['credit_id'], credit['rate_eur'], credit['transaction_id']
+            if confirmations != credit['confirmations']:
+                db_utils.update_deposit_credit(credit_id, confirmations=confirmations)
+
+        if confirmations >= min_confirmations:
+            _credit_deposit(credit_id, deposit_address, str(amount_smallest_unit), rate_eur, transaction_id)
+
+    # Settled transfers are dropped from the cursor so it does not grow with the address's lifetime;
+    # if an API returns them again they are skipped via deposit_credits.
+    settled_txids = {txid for txid, row in db_utils.get_deposit_credits_for_address(deposit_address_id).items() if row['status'] != 'seen'}
+    known_txs = history_cursor.get('txs')
+    if isinstance(known_txs, dict):
+        for txid in settled_txids & known_txs.keys():
+            del known_txs[txid]
+    db_utils.update_deposit_address_scan(deposit_address_id, json.dumps(history_cursor, sort_keys=True))
+
+
+def _scan_batch_size() -> int:
+    """DEPOSIT_SCAN_BATCH_SIZE, capped so the API call delays of one batch fit in 3/4 of the scan interval."""
+    if API_CALL_DELAY_SECONDS <= 0:
+        return DEPOSIT_SCAN_BATCH_SIZE
+    fitting = max(1, int(DEPOSIT_SCAN_INTERVAL_SECONDS * 0.75 / API_CALL_DELAY_SECONDS))
+    if fitting < DEPOSIT_SCAN_BATCH_SIZE:
+        logger.warning(f"Deposit watcher: DEPOSIT_SCAN_BATCH_SIZE {DEPOSIT_SCAN_BATCH_SIZE} x {API_CALL_DELAY_SECONDS}s API delay "
+                       f"exceeds the {DEPOSIT_SCAN_INTERVAL_SECONDS}s scan interval; scanning {fitting} per run.")
+    return min(DEPOSIT_SCAN_BATCH_SIZE, fitting)
+
+
+def scan_deposit_addresses():
+    """Checks one batch of deposit addresses (least recently checked first) and credits confirmed deposits."""
+    deposit_addresses = db_utils.get_deposit_addresses_to_scan(_scan_batch_size())
+    if not deposit_addresses:
+        logger.debug("Deposit watcher: no deposit addresses to scan.")
+        return
+
+    rates = {} # One rate lookup per coin and scan
+    started = time.monotonic()
+    for position, deposit_address in enumerate(deposit_addresses):
+        if position:
+            time.sleep(API_CALL_DELAY_SECONDS)
+        try:
+            _scan_deposit_address(deposit_address, rates)
+        except BlockchainAPIError as e_api:
+            logger.warning(f"Deposit watcher: API error for deposit address {deposit_address['deposit_address_id']} ({deposit_address['address']}): {e_api}")
+            db_utils.update_deposit_address_scan(deposit_address['deposit_address_id'], deposit_address['history_cursor'])
+        except Exception as e:
+            logger.exception(f"Deposit watcher: unexpected error for deposit address {deposit_address['deposit_address_id']}: {e}")
+            db_utils.update_deposit_address_scan(deposit_address['deposit_address_id'], deposit_address['history_cursor'])
+    logger.info(f"Deposit watcher: scanned {len(deposit_addresses)} deposit address(es) in {time.monotonic() - started:.1f}s.")
@@ -1,96 +1,241 @@
 import logging
-import requests
+import threading
 import time
-import json # For json.JSONDecodeError
+import datetime
 from decimal import Decimal, InvalidOperation
+import config
+from modules import db_utils
+from modules import metrics
+from modules import rate_sources
 
 logger = logging.getLogger(__name__)
 
-COINGECKO_API_BASE_URL = "https://api.coingecko.com/api/v3"
-COINGECKO_COIN_IDS = {
-    "BTC": "bitcoin",
-    "LTC": "litecoin",
-    "USDT": "tether", # Used for USDT_TRX as well
-    # Add more mappings if other cryptocurrencies are supported by the bot
-}
+SUPPORTED_SYMBOLS = ("BTC", "LTC", "USDT") # USDT covers USDT_TRX as well
 
-# Simple in-memory cache: {"EUR_BTC": {"rate": Decimal("..."), "expiry": timestamp}, ...}
-RATES_CACHE = {}
-CACHE_DURATION_SECONDS = 300  # Cache rates for 5 minutes (300 seconds)
+# Rate service: all coins in SUPPORTED_SYMBOLS are fetched in one round over the aggregated sources in
+# modules/rate_sources.py (CoinGecko, Kraken, Coinbase; median with outlier rejection). A background
+# thread (start_background_refresh) refreshes the rates EXCHANGE_RATE_REFRESH_AHEAD_SECONDS before they
+# go stale, so lookups on the user's request path are normally served from memory. Past the TTL a rate is
+# still served (stale-while-revalidate, with a refresh kicked off) until EXCHANGE_RATE_MAX_STALENESS_SECONDS;
+# older rates are never used for pricing. Fetches are single-flight: concurrent misses share one request.
+#
+# Every successful fetch is also written to the exchange_rates table. On startup the latest stored rates are
+# loaded (load_persisted_rates), so the first invoices after a restart do not wait on CoinGecko. While the
+# most recent fetch attempt has failed, rates are accepted up to EXCHANGE_RATE_OUTAGE_MAX_STALENESS_SECONDS
+# instead, so invoices can still be created through a CoinGecko outage. Invoices store the rate_id they
+# were priced with (get_rate_quote).
+CACHE_DURATION_SECONDS = getattr(config, 'EXCHANGE_RATE_TTL_SECONDS', 300) # Rates count as fresh for 5 minutes
+EXCHANGE_RATE_REFRESH_AHEAD_SECONDS = getattr(config, 'EXCHANGE_RATE_REFRESH_AHEAD_SECONDS', 60)
+EXCHANGE_RATE_MAX_STALENESS_SECONDS = getattr(config, 'EXCHANGE_RATE_MAX_STALENESS_SECONDS', 1800)
+EXCHANGE_RATE_OUTAGE_MAX_STALENESS_SECONDS = getattr(config, 'EXCHANGE_RATE_OUTAGE_MAX_STALENESS_SECONDS', 10800)
+EXCHANGE_RATE_HISTORY_DAYS = getattr(config, 'EXCHANGE_RATE_HISTORY_DAYS', 90)
+EXCHANGE_RATE_RETRY_SECONDS = 30 # Background retry delay after a failed refresh
+VS_CURRENCY = "EUR"
 
-def get_current_exchange_rate(from_currency: str, to_currency: str) -> Decimal | None:
+_rates = {} # {"BTC": {"rate": Decimal("..."), "fetched_at": time.time(), "rate_id": 12}}, EUR per coin
+_rates_lock = threading.Lock()
+_fetch_lock = threading.Lock() # Held for the duration of a fetch (single-flight)
+_fetch_generation = 0 # Incremented after every completed fetch attempt
+_last_refresh_at = None # time.time() of the last successful fetch
+_last_fetch_failed = False # True while the most recent fetch attempt failed (rate source outage)
+_refresh_thread = None
+_refresh_listeners = [] # Called with no arguments after the cached rates changed
+
+
+def _fetch_all_rates() -> dict | None:
+    """One aggregated round over all rate sources. Returns {"BTC": (Decimal, [source names]), ...} or None on failure."""
+    try:
+        with _rates_lock:
+            reference_rates = {symbol: entry['rate'] for symbol, entry in _rates.items()}
+        return rate_sources.fetch_rates(list(SUPPORTED_SYMBOLS), VS_CURRENCY, reference_rates) or None
+    except Exception as e: # Catch-all for any other unexpected errors
+        logger.exception(f"An unexpected error occurred while fetching exchange rates: {e}")
+        return None
+
+
+def refresh_rates() -> bool:
     """
-    Fetches the current exchange rate from from_currency to to_currency using CoinGecko API.
-    Currently, it's designed to fetch EUR to Crypto rates (e.g., EUR to BTC).
-    The rate returned is: 1 unit of to_currency = X units of from_currency.
-    Example: if from_currency="EUR", to_currency="BTC", rate is EUR per BTC.
+    Fetches all rates and updates the cache. Single-flight: a caller that had to wait for an in-flight
+    fetch uses its result instead of fetching again. Returns True if the cache was updated.
     """
-    logger.info(f"Attempting to get exchange rate for {from_currency} to {to_currency}")
+    global _fetch_generation, _last_refresh_at, _last_fetch_failed
+    generation_before = _fetch_generation
+    with _fetch_lock:
+        if _fetch_generation != generation_before:
+            with _rates_lock:
+                return bool(_rates) # Another thread fetched while we waited
+        try:
+            fetched_rates = _fetch_all_rates()
+            _last_fetch_failed = not fetched_rates
+            if fetched_rates:
+                fetched_at = time.time()
+                rate_ids = db_utils.insert_exchange_rates(
+                    VS_CURRENCY, {symbol: rate for symbol, (rate, _) in fetched_rates.items()},
+                    datetime.datetime.utcfromtimestamp(fetched_at),
+                    {symbol: "median:" + ",".join(sources) for symbol, (_, sources) in fetched_rates.items()})
+                with _rates_lock:
+                    for symbol, (rate, _) in fetched_rates.items():
+                        _rates[symbol] = {"rate": rate, "fetched_at": fetched_at, "rate_id": rate_ids.get(symbol)}
+                _last_refresh_at = fetched_at
+                _notify_refresh_listeners()
+                logger.info(f"Refreshed exchange rates: {', '.join(f'{symbol}={rate} ({len(sources)} sources)' for symbol, (rate, sources) in sorted(fetched_rates.items()))} {VS_CURRENCY}")
+            return bool(fetched_rates)
+        finally:
+            _fetch_generation += 1
+
+
+def register_refresh_listener(listener):
+    """Registers a callable run (in the refreshing thread) whenever the cached rates change."""
+    if listener not in _refresh_listeners:
+        _refresh_listeners.append(listener)
+
+
+def _notify_refresh_listeners():
+    for listener in list(_refresh_listeners):
+        try:
+            listener()
+        except Exception as e:
+            logger.exception(f"Exchange rate refresh listener {getattr(listener, '__name__', listener)} failed: {e}")
+
+
+def get_cached_rates() -> dict:
+    """Snapshot of the rate cache: {"BTC": {"rate", "fetched_at", "rate_id"}, ...}, regardless of age."""
+    with _rates_lock:
+        return {symbol: dict(entry) for symbol, entry in _rates.items()}
+
+
+def load_persisted_rates() -> int:
+    """Warm start: fills the cache with the latest stored rate per coin. Returns the number of rates loaded."""
+    global _last_refresh_at
+    loaded = 0
+    for row in db_utils.get_latest_exchange_rates(VS_CURRENCY):
+        try:
+            rate = Decimal(row['rate'])
+            fetched_at = datetime.datetime.fromisoformat(row['fetched_at']).replace(tzinfo=datetime.timezone.utc).timestamp()
+        except (InvalidOperation, ValueError) as e:
+            logger.error(f"Ignoring unreadable stored rate {row['rate_id']} for {row['coin_symbol']}: {e}")
+            continue
+        with _rates_lock:
+            current = _rates.get(row['coin_symbol'])
+            if current is not None and current['fetched_at'] >= fetched_at:
+                continue
+            _rates[row['coin_symbol']] = {"rate": rate, "fetched_at": fetched_at, "rate_id": row['rate_id']}
+        loaded += 1
+        if _last_refresh_at is None or fetched_at > _last_refresh_at:
+            _last_refresh_at = fetched_at
+    if loaded:
+        _notify_refresh_listeners()
+        logger.info(f"Loaded {loaded} stored exchange rate(s); newest is {time.time() - _last_refresh_at:.0f}s old.")
+    return loaded
+
+
+def purge_rate_history() -> int:
+    """Deletes stored rates older than EXCHANGE_RATE_HISTORY_DAYS that no invoice refers to."""
+    purged = db_utils.purge_exchange_rates(datetime.datetime.utcnow() - datetime.timedelta(days=EXCHANGE_RATE_HISTORY_DAYS))
+    logger.info(f"Purged {purged} exchange rate(s) older than {EXCHANGE_RATE_HISTORY_DAYS} days.")
+    return purged
+
+
+def _refresh_in_background():
+    """Starts a one-off refresh thread unless a fetch is already running."""
+    if _fetch_lock.locked():
+        return
+    threading.Thread(target=refresh_rates, name="exchange-rate-refresh-once", daemon=True).start()
+
+
+def _seconds_until_refresh_due() -> float:
+    if _last_refresh_at is None:
+        return 0
+    return max(0.0, _last_refresh_at + CACHE_DURATION_SECONDS - EXCHANGE_RATE_REFRESH_AHEAD_SECONDS - time.time())
 
+
+def _refresh_loop():
+    while True:
+        wait_seconds = _seconds_until_refresh_due()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        elif not refresh_rates():
+            time.sleep(EXCHANGE_RATE_RETRY_SECONDS)
+
+
+def start_background_refresh():
+    """Loads the stored rates and starts the thread that keeps them fresh ahead of expiry. Safe to call more than once."""
+    global _refresh_thread
+    if _refresh_thread is not None:
+        return
+    load_persisted_rates()
+    _refresh_thread = threading.Thread(target=_refresh_loop, name="exchange-rate-refresh", daemon=True)
+    _refresh_thread.start()
+    logger.info("Started background exchange rate refresh.")
+
+
+def _get_cached_rate(symbol: str) -> tuple[dict, float] | None:
+    with _rates_lock:
+        entry = _rates.get(symbol)
+        return (dict(entry), time.time() - entry['fetched_at']) if entry else None
+
+
+def _max_staleness_seconds() -> int:
+    return EXCHANGE_RATE_OUTAGE_MAX_STALENESS_SECONDS if _last_fetch_failed else EXCHANGE_RATE_MAX_STALENESS_SECONDS
+
+
+def get_rate_quote(from_currency: str, to_currency: str, fetch: bool = True) -> dict | None:
+    """
+    Like get_current_exchange_rate, but returns {'rate': Decimal, 'rate_id': int | None, 'fetched_at': time.time()},
+    so callers can record which stored rate priced an invoice. rate_id is None if the rate could not be stored.
+    With fetch=False a cache miss returns None instead of waiting for the rate sources (for display only).
+    """
     normalized_from_currency = from_currency.upper()
     normalized_to_currency = to_currency.upper()
 
-    # Handle USDT_TRX specifically by mapping it to the general USDT CoinGecko ID
+    # Handle USDT_TRX specifically by mapping it to the general USDT rate
     if "USDT" in normalized_to_currency: # Handles "USDT", "USDT_TRX"
         normalized_to_currency = "USDT"
 
-    if normalized_from_currency != "EUR":
+    if normalized_from_currency != VS_CURRENCY:
         logger.error(f"Exchange rate lookup currently only supports EUR as the 'from_currency'. Requested: {from_currency} to {to_currency}")
         return None
 
-    coingecko_id = COINGECKO_COIN_IDS.get(normalized_to_currency)
-    if not coingecko_id:
-        logger.error(f"No CoinGecko ID mapping found for currency: {normalized_to_currency} (original: {to_currency})")
+    if normalized_to_currency not in SUPPORTED_SYMBOLS:
+        logger.error(f"No exchange rate source covers currency: {normalized_to_currency} (original: {to_currency})")
         return None
 
-    cache_key = f"{normalized_from_currency}_{normalized_to_currency}"
-
-    # Check cache first
-    cached_entry = RATES_CACHE.get(cache_key)
-    if cached_entry and cached_entry['expiry'] > time.time():
-        logger.info(f"Returning cached rate for {cache_key}: {cached_entry['rate']}")
-        return cached_entry['rate']
-
-    # API Call if not cached or expired
-    api_url = f"{COINGECKO_API_BASE_URL}/simple/price?ids={coingecko_id}&vs_currencies={normalized_from_currency.lower()}"
+    cached = _get_cached_rate(normalized_to_currency)
+    usable = cached is not None and cached[1] < _max_staleness_seconds()
+    metrics.record_cache_lookup('exchange_rate', usable)
+    if usable:
+        entry, age_seconds = cached
+        if age_seconds >= CACHE_DURATION_SECONDS:
+            logger.warning(f"Serving stale {normalized_to_currency} rate ({age_seconds:.0f}s old) while refreshing.")
+            _refresh_in_background()
+        elif age_seconds >= CACHE_DURATION_SECONDS - EXCHANGE_RATE_REFRESH_AHEAD_SECONDS and _refresh_thread is None:
+            _refresh_in_background() # No background refresher in this process; refresh ahead of expiry anyway
+        return {'rate': entry['rate'], 'rate_id': entry['rate_id'], 'fetched_at': entry['fetched_at']}
+    if not fetch:
+        return None
 
-    logger.debug(f"Fetching live rate from CoinGecko: {api_url}")
+    logger.info(f"No usable cached rate for {normalized_to_currency}; fetching.")
+    refresh_rates()
+    cached = _get_cached_rate(normalized_to_currency)
+    if cached is not None and cached[1] < _max_staleness_seconds():
+        if _last_fetch_failed:
+            logger.warning(f"Rate source unavailable; using stored {normalized_to_currency} rate from {cached[1]:.0f}s ago.")
+        entry = cached[0]
+        return {'rate': entry['rate'], 'rate_id': entry['rate_id'], 'fetched_at': entry['fetched_at']}
+    logger.error(f"No exchange rate available for {normalized_from_currency} to {normalized_to_currency}.")
+    return None
 
-    try:
-        response = requests.get(api_url, timeout=10) # 10-second timeout
-        response.raise_for_status()  # Raises HTTPError for bad responses (4XX or 5XX)
-        data = response.json()
-
-        rate_value = data.get(coingecko_id, {}).get(normalized_from_currency.lower())
-
-        if rate_value is not None:
-            try:
-                rate_decimal = Decimal(str(rate_value)) # Convert to Decimal
-                # Update Cache
-                RATES_CACHE[cache_key] = {"rate": rate_decimal, "expiry": time.time() + CACHE_DURATION_SECONDS}
-                logger.info(f"Fetched and cached new rate for {cache_key}: {rate_decimal}")
-                return rate_decimal
-            except InvalidOperation:
-                logger.error(f"Invalid rate value received from CoinGecko for {cache_key}: {rate_value}")
-                return None
-        else:
-            logger.error(f"Rate not found in CoinGecko response for {cache_key}. Response: {data}")
-            return None
-
-    except requests.exceptions.Timeout:
-        logger.error(f"Timeout while fetching exchange rate from CoinGecko for {cache_key}: {api_url}")
-    except requests.exceptions.HTTPError as http_err:
-        logger.error(f"HTTP error occurred while fetching exchange rate for {cache_key}: {http_err} - URL: {api_url}")
-    except requests.exceptions.RequestException as req_err: # Catch other requests errors (network, etc.)
-        logger.error(f"Request exception occurred while fetching exchange rate for {cache_key}: {req_err} - URL: {api_url}")
-    except json.JSONDecodeError as json_err:
-        logger.error(f"Failed to decode JSON response from CoinGecko for {cache_key}: {json_err}. Response text: {response.text if 'response' in locals() else 'N/A'}")
-    except (KeyError, TypeError) as e_parse: # Catch potential errors if response structure is unexpected
-        logger.error(f"Error parsing CoinGecko response for {cache_key}: {e_parse}. Data: {data if 'data' in locals() else 'N/A'}")
-    except Exception as e: # Catch-all for any other unexpected errors
-        logger.exception(f"An unexpected error occurred in get_current_exchange_rate for {cache_key}: {e}")
 
-    return None
+def get_current_exchange_rate(from_currency: str, to_currency: str) -> Decimal | None:
+    """
+    Returns the current exchange rate from from_currency to to_currency (aggregated sources, via the rate cache).
+    Currently, it's designed to fetch EUR to Crypto rates (e.g., EUR to BTC).
+    The rate returned is: 1 unit of to_currency = X units of from_currency.
+    Example: if from_currency="EUR", to_currency="BTC", rate is EUR per BTC.
+    Returns None if no rate within the staleness bound is available (see _max_staleness_seconds).
+    """
+    quote = get_rate_quote(from_currency, to_currency)
+    return quote['rate'] if quote else None
 
 if __name__ == '__main__':
     # Simple test cases
@@ -115,7 +260,7 @@ if __name__ == '__main__':
     print(f"EUR to BTC (cached): {rate_btc_cached}")
 
     print("\n--- Testing Unsupported ---")
-    rate_eth = get_current_exchange_rate("EUR", "ETH") # Assuming ETH is not in COINGECKO_COIN_IDS
+    rate_eth = get_current_exchange_rate("EUR", "ETH") # ETH is not in SUPPORTED_SYMBOLS
     print(f"EUR to ETH (unsupported in map): {rate_eth}")
 
     rate_usd_btc = get_current_exchange_rate("USD", "BTC") # Unsupported 'from_currency'
@@ -126,4 +271,4 @@ if __name__ == '__main__':
     # time.sleep(CACHE_DURATION_SECONDS + 5)
     # rate_btc_expired_cache = get_current_exchange_rate("EUR", "BTC")
     # print(f"EUR to BTC (after cache expiry): {rate_btc_expired_cache}")
-    # print(f"Cache content: {RATES_CACHE}")
+    # print(f"Cache content: {_rates}")
@@ -0,0 +1,76 @@
+import logging
+import queue
+import threading
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# In-process work queue for finalizing confirmed crypto payments.
+# payment_monitor enqueues a payment_id the moment it transitions to 'confirmed_unprocessed',
+# so finalization starts within milliseconds instead of waiting for the next periodic sweep.
+# The sweep (payment_monitor.process_confirmed_payments) is kept as a safety net and feeds
+# anything it finds into the same queue.
+
+FINALIZATION_WORKERS = getattr(config, 'FINALIZATION_WORKERS', 2)
+
+_work_queue = queue.Queue()
+_queued_payment_ids = set() # Payment IDs queued or being finalized, to avoid duplicate jobs
+_queued_payment_ids_lock = threading.Lock()
+_bot_instance = None
+_worker_threads = []
+
+
+def is_running() -> bool:
+    return bool(_worker_threads)
+
+
+def start_finalization_workers(bot_instance, worker_count: int = None):
+    """Starts the finalization worker threads. Safe to call more than once."""
+    global _bot_instance
+    if _worker_threads:
+        logger.debug("Finalization workers already running.")
+        return
+    _bot_instance = bot_instance
+    worker_count = worker_count or FINALIZATION_WORKERS
+    for worker_number in range(worker_count):
+        worker_thread = threading.Thread(target=_worker_loop, name=f"finalization-worker-{worker_number}", daemon=True)
+        worker_thread.start()
+        _worker_threads.append(worker_thread)
+    logger.info(f"Started {worker_count} finalization worker(s).")
+
+
+def enqueue_finalization(payment_id: int) -> bool:
+    """
+    Queues a confirmed payment for finalization. Returns False if it was already queued/in progress
+    or if no workers are running (the periodic sweep will pick it up in that case).
+    """
+    if not _worker_threads:
+        logger.debug(f"Finalization workers not running; payment_id {payment_id} left for the periodic sweep.")
+        return False
+    with _queued_payment_ids_lock:
+        if payment_id in _queued_payment_ids:
+            logger.debug(f"Payment_id {payment_id} already queued for finalization.")
+            return False
+        _queued_payment_ids.add(payment_id)
+    _work_queue.put(payment_id)
+    logger.info(f"Queued payment_id {payment_id} for finalization (queue size ~{_work_queue.qsize()}).")
+    return True
+
+
+def get_queue_size() -> int:
+    return _work_queue.qsize()
+
+
+def _worker_loop():
+    from modules import payment_monitor # Imported here: payment_monitor imports this module
+    while True:
+        payment_id = _work_queue.get()
+        try:
+            payment_monitor.process_confirmed_payment_by_id(payment_id, _bot_instance)
+        except Exception as e:
+            logger.exception(f"Finalization worker: unexpected error while finalizing payment_id {payment_id}: {e}")
+        finally:
+            with _queued_payment_ids_lock:
+                _queued_payment_ids.discard(payment_id)
+            _work_queue.task_done()
@@ -1,10 +1,9 @@
 import logging
-import os
-import time # For QR code filenames
-import qrcode # For QR code generation
+import threading
 from mnemonic import Mnemonic # For seed phrase validation and generation (if needed)
 from bip_utils import (
-    Bip39SeedGenerator, Bip44, Bip44Coins, Bip44Changes,
+    Bip39SeedGenerator, Bip44, Bip44Coins, Bip44Changes, Bip44ConfGetter,
+    P2PKHAddrDecoder, TrxAddrDecoder,
     Base58ChecksumError, # For handling potential address errors if we were to validate them
 )
 import config # For SEED_PHRASE and other potential configs
@@ -25,15 +24,14 @@ COIN_MAP = {
     # Add other supported coins here if needed
 }
 
-# Directory for storing generated QR codes
-QR_CODE_DIR = os.path.join("assets", "qr_codes")
-if not os.path.exists(QR_CODE_DIR):
-    try:
-        os.makedirs(QR_CODE_DIR)
-        logger.info(f"Created QR code directory at: {QR_CODE_DIR}")
-    except OSError as e:
-        logger.exception(f"Could not create QR code directory at {QR_CODE_DIR}: {e}")
-        # Depending on how critical QR codes are, this could raise an error or just log.
+# Decoders matching the address encoding Bip44 uses for each coin (P2PKH for BTC/LTC, base58check for Tron)
+ADDRESS_DECODERS = {
+    "BTC": P2PKHAddrDecoder,
+    "LTC": P2PKHAddrDecoder,
+    "TRX": TrxAddrDecoder,
+}
+
+PLACEHOLDER_SEED_PHRASE = "your actual twelve (or 24) word bip39 mnemonic seed phrase here replace this entire string"
 
 def validate_seed_phrase() -> bool:
     """
@@ -42,7 +40,7 @@ def validate_seed_phrase() -> bool:
     """
     seed_phrase = getattr(config, 'SEED_PHRASE', None)
 
-    if not seed_phrase or seed_phrase == "your actual twelve (or 24) word bip39 mnemonic seed phrase here replace this entire string":
+    if not seed_phrase or seed_phrase == PLACEHOLDER_SEED_PHRASE:
         logger.critical("SEED_PHRASE is not configured or is still set to the placeholder value in config.py. HD wallet functionality will not work.")
         logger.critical("Please generate a secure seed phrase and update config.py. FOR DEVELOPMENT/TESTING ONLY, NEVER USE REAL FUNDS WITH A SEED PHRASE STORED THIS WAY IN PRODUCTION.")
         return False
@@ -60,22 +58,64 @@ def validate_seed_phrase() -> bool:
     logger.info("SEED_PHRASE successfully validated (format appears correct).")
     return True
 
-def generate_address(coin_symbol: str, index: int) -> str | None:
-    """
-    Generates a cryptocurrency address for the given coin symbol and index
-    using the SEED_PHRASE from config.py and standard BIP44 derivation.
+# Seed -> BIP44 change-level contexts, built once per seed phrase. Deriving an address is then a single
+# non-hardened child step instead of PBKDF2 (2048 rounds) plus the full walk from master. Only the
+# extended *public* key of each change level is kept, so no private key stays in memory.
+_derivation_lock = threading.Lock()
+_derivation_seed_phrase = None
+_change_contexts = {} # coin_symbol -> public-only Bip44 context at m/44'/coin'/account'/change
 
-    Args:
-        coin_symbol: The symbol of the coin (e.g., "BTC", "LTC", "TRX").
-        index: The address index to derive.
 
-    Returns:
-        The generated address string, or None if an error occurs.
-    """
-    logger.debug(f"Attempting to generate address for {coin_symbol}, index {index}.")
+def _get_configured_seed_phrase() -> str | None:
     seed_phrase = getattr(config, 'SEED_PHRASE', None)
+    if not seed_phrase or seed_phrase == PLACEHOLDER_SEED_PHRASE:
+        return None
+    return seed_phrase
+
+
+def _get_change_context(coin_symbol: str, seed_phrase: str):
+    """Returns the cached change-level context for coin_symbol, deriving the seed and account path on first use."""
+    global _derivation_seed_phrase
+    with _derivation_lock:
+        if _derivation_seed_phrase != seed_phrase: # First use, or SEED_PHRASE changed at runtime
+            _change_contexts.clear()
+            _derivation_seed_phrase = seed_phrase
+        change_ctx = _change_contexts.get(coin_symbol)
+        if change_ctx is None:
+            coin_type = COIN_MAP[coin_symbol]["coin_type"]
+            seed_bytes = Bip39SeedGenerator(seed_phrase).Generate()
+            # Derive path: m / purpose' / coin_type' / account' / change
+            private_change_ctx = Bip44.FromSeed(seed_bytes, coin_type).Purpose().Coin().Account(BIP44_ACCOUNT).Change(BIP44_CHANGE)
+            change_ctx = Bip44.FromExtendedKey(private_change_ctx.PublicKey().ToExtended(), coin_type)
+            _change_contexts[coin_symbol] = change_ctx
+            logger.info(f"Cached BIP44 change-level key for {coin_symbol}.")
+        return change_ctx
+
+
+def warm_up_derivation_contexts() -> bool:
+    """Derives the change-level contexts of all supported coins up front (called at startup)."""
+    seed_phrase = _get_configured_seed_phrase()
+    if seed_phrase is None:
+        return False
+    try:
+        for coin_symbol in COIN_MAP:
+            _get_change_context(coin_symbol, seed_phrase)
+        return True
+    except Exception as e:
+        logger.exception(f"Error preparing HD derivation contexts: {e}")
+        return False
+
 
-    if not seed_phrase or seed_phrase == "your actual twelve (or 24) word bip39 mnemonic seed phrase here replace this entire string":
+def generate_addresses(coin_symbol: str, start: int, count: int) -> list[str] | None:
+    """
+    Derives `count` consecutive addresses for coin_symbol starting at address index `start`
+    (m / 44' / coin_type' / account' / change / start..start+count-1).
+
+    Returns:
+        The list of addresses in index order, or None if an error occurs.
+    """
+    seed_phrase = _get_configured_seed_phrase()
+    if seed_phrase is None:
         logger.error(f"Cannot generate address for {coin_symbol}: SEED_PHRASE is not configured or is a placeholder.")
         return None
 
@@ -83,93 +123,51 @@ def generate_address(coin_symbol: str, index: int) -> str | None:
         logger.error(f"Unsupported coin symbol for address generation: {coin_symbol}")
         return None
 
-    coin_config = COIN_MAP[coin_symbol]
+    if start < 0 or count < 0:
+        logger.error(f"Invalid address range for {coin_symbol}: start {start}, count {count}")
+        return None
 
     try:
-        seed_bytes = Bip39SeedGenerator(seed_phrase).Generate()
-        bip44_mst_ctx = Bip44.FromSeed(seed_bytes, coin_config["coin_type"])
-
-        # Derive path: m / purpose' / coin_type' / account' / change / address_index
-        bip44_acc_ctx = bip44_mst_ctx.Purpose(BIP44_PURPOSE).Coin().Account(BIP44_ACCOUNT)
-        bip44_chg_ctx = bip44_acc_ctx.Change(BIP44_CHANGE) # External chain
-        bip44_addr_ctx = bip44_chg_ctx.AddressIndex(index)
-
-        address = bip44_addr_ctx.PublicKey().ToAddress()
-        logger.info(f"Generated {coin_symbol} address at index {index}: {address}")
-        return address
-
+        change_ctx = _get_change_context(coin_symbol, seed_phrase)
+        return [change_ctx.AddressIndex(index).PublicKey().ToAddress() for index in range(start, start + count)]
     except Exception as e_bip:
         # Catching a general Exception as Bip32DerivationError might not be directly importable
-        # In a production environment, it's better to import the specific error if possible.
-        # For now, we log the exception and return None.
-        logger.exception(f"Error deriving address for {coin_symbol} at index {index}: {e_bip}")
+        logger.exception(f"Error deriving {coin_symbol} addresses {start}..{start + count - 1}: {e_bip}")
         return None
 
 
-def generate_qr_code_for_address(address: str, crypto_amount: str | None = None, coin_symbol: str | None = None, message: str | None = None) -> str | None:
+def validate_address(coin_symbol: str, address: str) -> bool:
+    """Checks that address decodes (checksum and network version) as a receiving address of coin_symbol."""
+    decoder_class = ADDRESS_DECODERS.get(coin_symbol)
+    if decoder_class is None or not address:
+        return False
+    try:
+        decoder_class().DecodeAddr(address, **Bip44ConfGetter.GetConfig(COIN_MAP[coin_symbol]["coin_type"]).AddrParams())
+        return True
+    except (ValueError, TypeError) as e:
+        logger.warning(f"Address {address} failed {coin_symbol} validation: {e}")
+        return False
+
+
+def generate_address(coin_symbol: str, index: int) -> str | None:
     """
-    Generates a QR code for a given cryptocurrency address, optionally including amount and message
-    as part of a payment URI (e.g., bitcoin:address?amount=0.1).
-    Saves the QR code image to 'assets/qr_codes/' and returns the file path.
+    Generates a cryptocurrency address for the given coin symbol and index
+    using the SEED_PHRASE from config.py and standard BIP44 derivation.
 
     Args:
-        address: The cryptocurrency address.
-        crypto_amount: Optional. The amount of cryptocurrency for the payment URI.
-        coin_symbol: Optional. The coin symbol (e.g., "BTC", "LTC") to determine URI prefix.
-        message: Optional. A message/label for the payment URI.
+        coin_symbol: The symbol of the coin (e.g., "BTC", "LTC", "TRX").
+        index: The address index to derive.
 
     Returns:
-        The file path to the generated QR code image, or None if an error occurs.
+        The generated address string, or None if an error occurs.
     """
-    if not address:
-        logger.warning("generate_qr_code_for_address called with no address.")
+    logger.debug(f"Attempting to generate address for {coin_symbol}, index {index}.")
+    addresses = generate_addresses(coin_symbol, index, 1)
+    if not addresses:
         return None
+    logger.info(f"Generated {coin_symbol} address at index {index}: {addresses[0]}")
+    return addresses[0]
 
-    payment_uri = address
-    if coin_symbol and coin_symbol in COIN_MAP:
-        uri_prefix = COIN_MAP[coin_symbol]["uri_prefix"]
-        payment_uri = f"{uri_prefix}:{address}"
-
-        params = []
-        if crypto_amount:
-            # Ensure crypto_amount is URL-safe if it can contain special characters (though usually just a number)
-            params.append(f"amount={crypto_amount}")
-        if message:
-            # qrcode.escape might not be standard. Use urllib.parse.quote_plus for URI parameters.
-            from urllib.parse import quote_plus
-            params.append(f"message={quote_plus(message)}")
-
-        if params:
-            payment_uri += "?" + "&".join(params)
-    else: # No coin symbol or not in map, QR will just be the address
-        logger.info(f"Generating QR code for address only: {address} (no coin symbol or prefix found).")
-
-
-    logger.debug(f"Generating QR code for payment URI: {payment_uri}")
-
-    try:
-        # Ensure QR_CODE_DIR exists (it's created at module load, but double check)
-        if not os.path.exists(QR_CODE_DIR):
-            os.makedirs(QR_CODE_DIR)
-            logger.info(f"Re-created QR code directory at: {QR_CODE_DIR}")
-
-        img = qrcode.make(payment_uri)
-
-        # Create a somewhat unique filename
-        # Using a hash of the address + timestamp for more uniqueness if needed,
-        # but simple address might be fine if overwriting is acceptable or if address itself is unique enough.
-        # For simplicity, let's use address (sanitized) and a timestamp to avoid clashes.
-        sanitized_address = "".join(c for c in address if c.isalnum())
-        filename = f"qr_{sanitized_address}_{int(time.time())}.png"
-        qr_file_path = os.path.join(QR_CODE_DIR, filename)
-
-        img.save(qr_file_path)
-        logger.info(f"QR code generated and saved to: {qr_file_path}")
-        return qr_file_path
-
-    except Exception as e:
-        logger.exception(f"Error generating or saving QR code for address {address}: {e}")
-        return None
 
 # Example self-check on module load (optional, can be called from bot.py)
 # if not validate_seed_phrase():
@@ -0,0 +1,257 @@
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import config
+from modules import metrics
+
+try:
+    import httpx # Optional: only used when HTTP/2 is enabled in config
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+# Shared HTTP client for all outbound non-Telegram HTTP calls made from modules/
+# (block explorers, exchange-rate APIs). One requests.Session is kept for the
+# whole process so TCP/TLS connections to the same host are pooled and reused
+# (keep-alive) instead of being re-established for every request.
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'TelegramCryptoBot/1.0',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+CONNECT_TIMEOUT_SECONDS = getattr(config, 'HTTP_CONNECT_TIMEOUT_SECONDS', 5)
+READ_TIMEOUT_SECONDS = getattr(config, 'HTTP_READ_TIMEOUT_SECONDS', 15)
+POOL_CONNECTIONS = getattr(config, 'HTTP_POOL_CONNECTIONS', 10) # Number of per-host pools kept
+POOL_MAXSIZE = getattr(config, 'HTTP_POOL_MAXSIZE', 20) # Max keep-alive connections per host
+GET_RETRIES = getattr(config, 'HTTP_GET_RETRIES', 2)
+RETRY_BACKOFF_FACTOR = getattr(config, 'HTTP_RETRY_BACKOFF_FACTOR', 0.5)
+# 429 is deliberately not retried here: payment_monitor treats it as a signal to back off
+# until the next cycle, which is cheaper than blocking a worker on Retry-After.
+RETRY_STATUS_CODES = tuple(getattr(config, 'HTTP_RETRY_STATUS_CODES', (500, 502, 503, 504)))
+HTTP2_ENABLED = getattr(config, 'HTTP_CLIENT_HTTP2_ENABLED', False)
+
+_session = None
+_http2_client = None
+_client_lock = threading.Lock()
+
+# Per-host counters: {"blockstream.info": {"requests": n, "errors": n, "rate_limited": n}}
+_host_stats = {}
+_stats_lock = threading.Lock()
+
+
+class _RetryPolicy(Retry):
+    # urllib3 otherwise retries a 429 whenever it carries Retry-After, sleeping in the caller's thread
+    RETRY_AFTER_STATUS_CODES = frozenset(Retry.RETRY_AFTER_STATUS_CODES) - {429}
+
+
+def _build_retry_policy() -> Retry:
+    """Retry policy for idempotent requests only (GET/HEAD). POSTs are never retried automatically."""
+    return _RetryPolicy(
+        total=GET_RETRIES,
+        connect=GET_RETRIES,
+        read=GET_RETRIES,
+        status=GET_RETRIES,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True,
+        raise_on_status=False, # Hand the final response back so callers map the status code themselves
+    )
+
+
+if httpx is not None:
+    class _IdempotentRetryTransport(httpx.BaseTransport):
+        """HTTP/2 transport that retries failed connection attempts for GET/HEAD only, like _build_retry_policy.
+        httpx applies transport retries to every method, so POSTs go through a second transport without them."""
+
+        def __init__(self, **transport_kwargs):
+            self._retrying = httpx.HTTPTransport(retries=GET_RETRIES, **transport_kwargs)
+            self._single_attempt = httpx.HTTPTransport(retries=0, **transport_kwargs)
+
+        def handle_request(self, request):
+            transport = self._retrying if request.method in ('GET', 'HEAD') else self._single_attempt
+            return transport.handle_request(request)
+
+        def close(self):
+            self._retrying.close()
+            self._single_attempt.close()
+
+
+def get_session() -> requests.Session:
+    """Returns the process-wide pooled session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _client_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                                      max_retries=_build_retry_policy())
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update(DEFAULT_HEADERS)
+                _session = session
+                logger.info(f"HTTP client session created (pool_connections={POOL_CONNECTIONS}, pool_maxsize={POOL_MAXSIZE}, get_retries={GET_RETRIES}).")
+    return _session
+
+
+def _get_http2_client():
+    """Returns a shared httpx client with HTTP/2 enabled, or None if HTTP/2 is disabled or unavailable."""
+    global _http2_client, HTTP2_ENABLED
+    if not HTTP2_ENABLED:
+        return None
+    if _http2_client is None:
+        with _client_lock:
+            if _http2_client is None:
+                if httpx is None:
+                    logger.warning("HTTP_CLIENT_HTTP2_ENABLED is set but httpx is not installed. Falling back to HTTP/1.1 pooled session.")
+                    HTTP2_ENABLED = False
+                    return None
+                try:
+                    _http2_client = httpx.Client(
+                        http2=True,
+                        headers={k: v for k, v in DEFAULT_HEADERS.items() if k != 'Connection'}, # Not allowed in HTTP/2
+                        timeout=httpx.Timeout(READ_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS),
+                        transport=_IdempotentRetryTransport(http2=True, limits=httpx.Limits(
+                            max_connections=POOL_MAXSIZE * POOL_CONNECTIONS, max_keepalive_connections=POOL_MAXSIZE)),
+                    )
+                    logger.info("HTTP/2 client created via httpx.")
+                except ImportError as e: # httpx installed without the 'h2' extra
+                    logger.warning(f"Could not enable HTTP/2 ({e}). Falling back to HTTP/1.1 pooled session.")
+                    HTTP2_ENABLED = False
+                    return None
+    return _http2_client
+
+
+def _normalize_timeout(timeout):
+    """Accepts None, a single read timeout or a (connect, read) tuple and returns a (connect, read) tuple."""
+    if timeout is None:
+        return (CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS)
+    if isinstance(timeout, (tuple, list)):
+        return tuple(timeout)
+    return (min(CONNECT_TIMEOUT_SECONDS, timeout), timeout)
+
+
+PROVIDER_REQUESTS = metrics.counter('bot_http_requests_total', 'Outbound HTTP requests by host and status (error = no response).', ('host', 'status'))
+PROVIDER_REQUEST_SECONDS = metrics.histogram('bot_http_request_seconds', 'Outbound HTTP request latency by host.', ('host',))
+
+
+def _record_request(host: str, status_code: int = None, error: bool = False):
+    PROVIDER_REQUESTS.inc(host, str(status_code) if status_code is not None else 'error')
+    with _stats_lock:
+        stats = _host_stats.setdefault(host, {'requests': 0, 'errors': 0, 'rate_limited': 0})
+        stats['requests'] += 1
+        if error or (status_code is not None and status_code >= 400):
+            stats['errors'] += 1
+        if status_code == 429:
+            stats['rate_limited'] += 1
+
+
+def _request_http2(client, method: str, url: str, params, headers, json_body, timeout):
+    """Performs a request through httpx and translates its exceptions into requests' exception types,
+    so callers only need to handle one family of errors regardless of the transport in use."""
+    connect_timeout, read_timeout = timeout
+    try:
+        response = client.request(method, url, params=params, headers=headers, json=json_body,
+                                  timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        response.raise_for_status()
+        return response
+    except httpx.TimeoutException as e:
+        raise requests.exceptions.Timeout(str(e)) from e
+    except (httpx.ConnectError, httpx.NetworkError) as e:
+        raise requests.exceptions.ConnectionError(str(e)) from e
+    except httpx.HTTPStatusError as e:
+        raise requests.exceptions.HTTPError(str(e), response=e.response) from e
+    except httpx.HTTPError as e:
+        raise requests.exceptions.RequestException(str(e)) from e
+
+
+def request(method: str, url: str, params: dict = None, headers: dict = None, json_body=None, timeout=None):
+    """
+    Sends an HTTP request through the shared pooled client and raises for 4xx/5xx responses.
+    Always raises requests.exceptions.* (Timeout, ConnectionError, HTTPError, RequestException),
+    even when the HTTP/2 transport is in use, so existing error handling keeps working.
+    `timeout` may be a single read timeout or a (connect, read) tuple.
+    """
+    host = urlsplit(url).hostname or url
+    effective_timeout = _normalize_timeout(timeout)
+    started = time.perf_counter()
+    try:
+        http2_client = _get_http2_client()
+        if http2_client is not None:
+            response = _request_http2(http2_client, method.upper(), url, params, headers, json_body, effective_timeout)
+        else:
+            response = get_session().request(method.upper(), url, params=params, headers=headers,
+                                             json=json_body, timeout=effective_timeout)
+            response.raise_for_status()
+        _record_request(host, status_code=response.status_code)
+        return response
+    except requests.exceptions.HTTPError as e:
+        _record_request(host, status_code=e.response.status_code if e.response is not None else None, error=True)
+        raise
+    except requests.exceptions.RequestException:
+        _record_request(host, error=True)
+        raise
+    finally:
+        PROVIDER_REQUEST_SECONDS.observe(time.perf_counter() - started, host)
+
+
+def get(url: str, params: dict = None, headers: dict = None, timeout=None):
+    return request("GET", url, params=params, headers=headers, timeout=timeout)
+
+
+def post(url: str, params: dict = None, headers: dict = None, json_body=None, timeout=None):
+    return request("POST", url, params=params, headers=headers, json_body=json_body, timeout=timeout)
+
+
+def get_connection_stats() -> dict:
+    """
+    Returns per-host request counters and connection reuse figures, e.g.
+    {"blockstream.info": {"requests": 120, "errors": 1, "rate_limited": 0, "new_connections": 2, "reuse_rate": 0.983}}
+    Connection counts come from urllib3's pools and are only available for the HTTP/1.1 session.
+    """
+    with _stats_lock:
+        stats = {host: dict(values) for host, values in _host_stats.items()}
+
+    if _session is not None:
+        opened_per_host = {}
+        for adapter in set(_session.adapters.values()):
+            pool_manager = getattr(adapter, 'poolmanager', None)
+            if pool_manager is None:
+                continue
+            for pool_key in list(pool_manager.pools.keys()):
+                pool = pool_manager.pools.get(pool_key)
+                if pool is None:
+                    continue
+                opened_per_host[pool.host] = opened_per_host.get(pool.host, 0) + pool.num_connections
+        for host, opened in opened_per_host.items():
+            host_stats = stats.setdefault(host, {'requests': 0, 'errors': 0, 'rate_limited': 0})
+            host_stats['new_connections'] = opened
+            if host_stats['requests']:
+                host_stats['reuse_rate'] = round(max(0.0, 1 - opened / host_stats['requests']), 3)
+    return stats
+
+
+def log_connection_stats():
+    for host, host_stats in sorted(get_connection_stats().items()):
+        logger.info(f"HTTP client stats for {host}: {host_stats}")
+
+
+def close():
+    """Closes pooled connections. Mainly useful for tests and orderly shutdown."""
+    global _session, _http2_client
+    with _client_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+        if _http2_client is not None:
+            _http2_client.close()
+            _http2_client = None
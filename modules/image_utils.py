@@ -1,6 +1,9 @@
+import logging
 import qrcode
 import io
 
+logger = logging.getLogger(__name__)
+
 def generate_qr_code_image(data_string: str):
     """
     Generates a QR code image from the given data string.
@@ -33,7 +36,7 @@ def generate_qr_code_image(data_string: str):
 
         return img_byte_arr
     except Exception as e:
-        print(f"Error generating QR code for data '{data_string[:50]}...': {e}")
+        logger.exception(f"Error generating QR code for data '{data_string[:50]}...': {e}")
         return None
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+import datetime
+import logging
+import os
+
+import config
+from modules import catalog_index
+from modules import db_utils
+from modules import metrics
+
+logger = logging.getLogger(__name__)
+
+# Item instances are reserved for a buyer when they pick a size, so concurrent buyers of the same size are
+# handed different folders. The claim is a row in item_reservations; a partial unique index allows one
+# active row per instance, so it holds across threads and processes.
+#
+# Lifecycle: a short selection hold (ITEM_RESERVATION_HOLD_MINUTES) when the size is picked, extended to the
+# invoice expiry when an invoice is created, open-ended once the payment is confirmed (so finalization
+# retries cannot outlive it), then 'consumed' when the item is delivered or 'released' when the invoice is
+# cancelled or expires. Holds that simply lapse (buyer walked away) stop counting at
+# expires_at without any cleanup job.
+
+ITEM_RESERVATION_HOLD_MINUTES = getattr(config, 'ITEM_RESERVATION_HOLD_MINUTES', 15)
+ITEM_RESERVATION_HISTORY_DAYS = getattr(config, 'ITEM_RESERVATION_HISTORY_DAYS', 30)
+ITEM_RESERVATION_CLAIM_ATTEMPTS = 5 # Retries when other buyers claim the chosen instance first
+
+RESERVATIONS = metrics.counter('bot_item_reservations_total', 'Item reservation events (claimed, sold_out, released, consumed).', ('event',))
+
+
+def reserve_oldest_instance(user_id: int, city: str, area: str, item_type: str, size: str) -> dict | None:
+    """
+    Reserves the oldest instance of a size that no other buyer holds: {'reservation_id', 'instance_path'},
+    or None if every instance is sold out or held. Instance folders that vanished from disk are skipped.
+    """
+    hold_until = datetime.datetime.utcnow() + datetime.timedelta(minutes=ITEM_RESERVATION_HOLD_MINUTES)
+    for _ in range(ITEM_RESERVATION_CLAIM_ATTEMPTS):
+        held_paths = db_utils.get_held_item_instances(city, area, item_type, size, exclude_user_id=user_id)
+        instance_path = catalog_index.get_oldest_instance(city, area, item_type, size, exclude=held_paths)
+        if instance_path is None:
+            RESERVATIONS.inc('sold_out')
+            return None
+        reservation = db_utils.claim_item_instance(user_id, city, area, item_type, size, instance_path, hold_until)
+        if not reservation: # Another buyer claimed it between the two reads
+            continue
+        instance_path = reservation['instance_path'] # The buyer's existing hold, if they had one
+        if os.path.isdir(instance_path):
+            RESERVATIONS.inc('claimed')
+            logger.info(f"Reserved {instance_path} for user {user_id} (reservation {reservation['reservation_id']}).")
+            return {'reservation_id': reservation['reservation_id'], 'instance_path': instance_path}
+        logger.warning(f"Catalog index: instance {instance_path} no longer exists; dropping it.")
+        release(reservation_id=reservation['reservation_id'])
+        catalog_index.remove_instance(instance_path)
+    logger.warning(f"Could not reserve an instance of {city}/{area}/{item_type}/{size} for user {user_id} after {ITEM_RESERVATION_CLAIM_ATTEMPTS} attempts.")
+    return None
+
+
+def attach_to_invoice(reservation_id: int, user_id: int, transaction_id: int, expires_at: datetime.datetime) -> bool:
+    """Keeps the buyer's instance reserved until the invoice expires. False if it went to another buyer."""
+    return db_utils.attach_item_reservation(reservation_id, user_id, transaction_id, expires_at)
+
+
+def hold_for_confirmed_payment(transaction_id: int) -> bool:
+    """Keeps a paid invoice's instance reserved until it is consumed or released, however long finalization takes."""
+    return db_utils.hold_item_reservation_until_closed(transaction_id)
+
+
+def release(reservation_id: int = None, transaction_id: int = None) -> int:
+    """Frees a held instance for other buyers (invoice cancelled or expired, or delivery failed)."""
+    released = db_utils.close_item_reservations('released', reservation_id=reservation_id, transaction_id=transaction_id)
+    if released:
+        RESERVATIONS.inc('released')
+        reference = f"reservation {reservation_id}" if reservation_id is not None else f"transaction {transaction_id}"
+        logger.info(f"Released item reservation ({reference}).")
+    return released
+
+
+def consume(reservation_id: int = None, transaction_id: int = None) -> int:
+    """Marks a reservation as delivered (the instance has been moved to the buyer's purchased folder)."""
+    consumed = db_utils.close_item_reservations('consumed', reservation_id=reservation_id, transaction_id=transaction_id)
+    if consumed:
+        RESERVATIONS.inc('consumed')
+    return consumed
+
+
+def get_reserved_counts(exclude_user_id: int = None) -> dict:
+    """
+    Held instances per catalog node, keyed like catalog_index counts: {(), (city,), (city, area), ...: count}.
+    exclude_user_id leaves out that buyer's own selection hold, which they can still pick.
+    """
+    counts = {}
+    for row in db_utils.get_active_item_reservation_counts(exclude_user_id):
+        path = (row['city'], row['area'], row['item_type'], row['size'])
+        for depth in range(len(path) + 1):
+            counts[path[:depth]] = counts.get(path[:depth], 0) + row['reserved']
+    return counts
+
+
+def purge_history() -> int:
+    older_than = datetime.datetime.utcnow() - datetime.timedelta(days=ITEM_RESERVATION_HISTORY_DAYS)
+    purged = db_utils.purge_item_reservations(older_than)
+    logger.info(f"Purged {purged} item reservation(s) closed before {older_than.isoformat()}.")
+    return purged
@@ -0,0 +1,249 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# In-process metrics registry with a Prometheus text-format /metrics endpoint.
+#
+# Counters, gauges and histograms keep their values in plain dicts keyed by the label-value tuple and
+# guarded by one lock per metric, so an observation costs a dict lookup and an addition (a few
+# microseconds). Gauge functions are evaluated only when /metrics is scraped, which suits values that
+# need a database query (e.g. the payment backlog).
+#
+#     REQUESTS = metrics.counter('bot_provider_requests_total', 'Provider requests.', ('host', 'status'))
+#     REQUESTS.inc('blockstream.info', '200')
+#     with metrics.timer(DB_LATENCY, 'get_user'): ...
+
+METRICS_ENABLED = getattr(config, 'METRICS_ENABLED', True)
+METRICS_BIND_HOST = getattr(config, 'METRICS_BIND_HOST', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9464)
+MAX_LABEL_SETS_PER_METRIC = 500 # Further label combinations are folded into one 'other' series
+
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = {} # name -> metric, in registration order
+_registry_lock = threading.Lock()
+_server = None
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, extra: str = '') -> str:
+    parts = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labelvalues: tuple) -> tuple:
+        if labelvalues in self._values or len(self._values) < MAX_LABEL_SETS_PER_METRIC:
+            return labelvalues
+        return ('other',) * len(self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            items = list(self._values.items())
+        for labelvalues, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            key = self._key(labelvalues)
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def set(self, value: float, *labelvalues):
+        with self._lock:
+            self._values[self._key(labelvalues)] = value
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            key = self._key(labelvalues)
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class GaugeFunction(_Metric):
+    """Gauge whose value(s) come from a callable at scrape time. The callable returns a number, or a
+    dict {labelvalues tuple: number} when the gauge has labels."""
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def render(self) -> list[str]:
+        try:
+            result = self.function()
+        except Exception as e:
+            logger.warning(f"Metrics: gauge function for {self.name} failed: {e}")
+            return []
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        if result is None:
+            return lines
+        values = result if isinstance(result, dict) else {(): result}
+        for labelvalues, value in values.items():
+            if value is not None:
+                lines.append(f"{self.name}{_format_labels(self.labelnames, tuple(labelvalues))} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelvalues):
+        bucket_index = bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labelvalues)
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bucket_index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labelvalues, (list(series[0]), series[1], series[2])) for labelvalues, series in self._values.items()]
+        for labelvalues, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                le_label = f'le="{_format_value(upper_bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+
+def _register(metric_class, name: str, *args, **kwargs):
+    with _registry_lock:
+        existing = _registry.get(name)
+        if existing is not None:
+            return existing
+        metric = metric_class(name, *args, **kwargs)
+        _registry[name] = metric
+        return metric
+
+
+def counter(name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+    return _register(Gauge, name, documentation, labelnames)
+
+
+def gauge_function(name: str, documentation: str, function, labelnames: tuple = ()) -> GaugeFunction:
+    return _register(GaugeFunction, name, documentation, function, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+class timer:
+    """Context manager observing the elapsed seconds into a histogram: `with timer(HIST, 'label'): ...`"""
+    __slots__ = ('histogram', 'labelvalues', 'started')
+
+    def __init__(self, histogram_metric: Histogram, *labelvalues):
+        self.histogram = histogram_metric
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labelvalues)
+        return False
+
+
+# --- Cache hit/miss counters shared by the modules that keep caches ---
+CACHE_REQUESTS = counter('bot_cache_requests_total', 'Cache lookups by cache and result (hit/miss).', ('cache', 'result'))
+
+
+def record_cache_lookup(cache_name: str, hit: bool):
+    CACHE_REQUESTS.inc(cache_name, 'hit' if hit else 'miss')
+
+
+def render_metrics() -> str:
+    with _registry_lock:
+        registered = list(_registry.values())
+    lines = []
+    for metric in registered:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes are frequent; keep them out of bot_activity.log
+
+
+def start_metrics_server(port: int = None, host: str = None) -> bool:
+    """Serves /metrics from a daemon thread. Returns False if disabled or the port cannot be bound."""
+    global _server
+    if not METRICS_ENABLED:
+        logger.info("Metrics endpoint disabled (METRICS_ENABLED = False).")
+        return False
+    if _server is not None:
+        return True
+    port = METRICS_PORT if port is None else port
+    host = host or METRICS_BIND_HOST
+    try:
+        _server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    except OSError as e:
+        logger.error(f"Could not start metrics endpoint on {host}:{port}: {e}")
+        return False
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return True
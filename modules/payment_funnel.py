@@ -0,0 +1,98 @@
+import logging
+import datetime
+import math
+
+from modules import db_utils
+
+logger = logging.getLogger(__name__)
+
+# Latency report over the payment funnel timestamps stored on pending_crypto_payments:
+# invoice created -> first seen by the API -> required confirmations -> finalization started
+# -> finalization finished / user notified. Percentiles are computed per coin and per provider.
+
+# (stage name, start column, end column)
+FUNNEL_STAGES = (
+    ('invoice_to_seen', 'created_at', 'first_seen_at'),
+    ('seen_to_confirmed', 'first_seen_at', 'confirmed_at'),
+    ('confirmed_to_finalizing', 'confirmed_at', 'finalization_started_at'),
+    ('finalization', 'finalization_started_at', 'finalization_finished_at'),
+    ('finalizing_to_notified', 'finalization_started_at', 'user_notified_at'),
+    ('invoice_to_notified', 'created_at', 'user_notified_at'),
+)
+REPORT_PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: list[float], pct: float) -> float | None:
+    """Nearest-rank percentile of values (None for an empty list)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def _stage_seconds(row, start_column: str, end_column: str) -> float | None:
+    if not row[start_column] or not row[end_column]:
+        return None
+    try:
+        started = datetime.datetime.fromisoformat(row[start_column])
+        ended = datetime.datetime.fromisoformat(row[end_column])
+    except ValueError:
+        return None
+    return max(0.0, (ended - started).total_seconds())
+
+
+def build_latency_report(days: int = 7) -> dict:
+    """
+    Returns {'days': days, 'payments': n, 'groups': {('coin', 'BTC'): {stage: {'count', 'p50', 'p95', 'p99'}}, ...}}
+    for payments created in the last `days` days. Only payments that reached both ends of a stage count towards it.
+    """
+    rows = db_utils.get_payment_funnel_rows(datetime.datetime.utcnow() - datetime.timedelta(days=days))
+    samples = {} # (group_kind, group_value) -> {stage: [seconds]}
+    for row in rows:
+        group_keys = [('coin', row['coin_symbol']), ('provider', row['provider'] or 'unknown')]
+        for stage_name, start_column, end_column in FUNNEL_STAGES:
+            seconds = _stage_seconds(row, start_column, end_column)
+            if seconds is None:
+                continue
+            for group_key in group_keys:
+                samples.setdefault(group_key, {}).setdefault(stage_name, []).append(seconds)
+
+    groups = {}
+    for group_key, stage_samples in samples.items():
+        groups[group_key] = {}
+        for stage_name, values in stage_samples.items():
+            stage_stats = {'count': len(values)}
+            for pct in REPORT_PERCENTILES:
+                stage_stats[f"p{pct}"] = percentile(values, pct)
+            groups[group_key][stage_name] = stage_stats
+    return {'days': days, 'payments': len(rows), 'groups': groups}
+
+
+def _format_duration(seconds: float | None) -> str:
+    if seconds is None:
+        return "-"
+    if seconds < 120:
+        return f"{seconds:.0f}s"
+    if seconds < 7200:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds / 3600:.1f}h"
+
+
+def format_latency_report(report: dict) -> str:
+    """Plain-text rendering of build_latency_report() for the admin command."""
+    lines = [f"Payment funnel latency, last {report['days']} day(s): {report['payments']} invoice(s)"]
+    if not report['groups']:
+        lines.append("No funnel data recorded yet.")
+        return "\n".join(lines)
+    for group_kind in ('coin', 'provider'):
+        for group_key in sorted(key for key in report['groups'] if key[0] == group_kind):
+            lines.append("")
+            lines.append(f"[{group_kind}: {group_key[1]}]")
+            for stage_name, _, _ in FUNNEL_STAGES:
+                stage_stats = report['groups'][group_key].get(stage_name)
+                if not stage_stats:
+                    continue
+                percentiles = " ".join(f"p{pct}={_format_duration(stage_stats[f'p{pct}'])}" for pct in REPORT_PERCENTILES)
+                lines.append(f"{stage_name}: n={stage_stats['count']} {percentiles}")
+    return "\n".join(lines)
@@ -0,0 +1,144 @@
+import logging
+import datetime
+from decimal import Decimal
+
+import config
+from modules import db_utils
+from modules import hd_wallet_utils
+from modules import address_recycling
+from modules import address_pool
+
+logger = logging.getLogger(__name__)
+
+# Creates the pending payment (address + exact expected amount) behind a crypto invoice.
+#
+# 'dedicated' mode (default): every invoice gets its own HD address, taken from the recycling pool of
+# expired, never-funded invoice addresses when one is free (see address_recycling), otherwise from the
+# pre-derived address pool (see address_pool), and only derived on the spot when both are empty.
+# 'shared' mode (opt-in per coin via SHARED_ADDRESS_INVOICING_COINS): invoices are spread over a small,
+# fixed pool of addresses per coin and each gets a unique amount, raised by a few smallest units where
+# needed. payment_monitor then matches incoming transfers by (address, exact amount), so the number of
+# watched addresses stays at the pool size however many invoices are open. This suits USDT-TRC20, where
+# wallets send exact token amounts; for BTC/LTC the sender's wallet must also send the exact amount.
+
+SHARED_ADDRESS_INVOICING_COINS = set(getattr(config, 'SHARED_ADDRESS_INVOICING_COINS', ())) # e.g. {'USDT_TRX'}
+SHARED_ADDRESS_POOL_SIZE = getattr(config, 'SHARED_ADDRESS_POOL_SIZE', 3)
+SHARED_ADDRESS_MAX_AMOUNT_OFFSET_UNITS = getattr(config, 'SHARED_ADDRESS_MAX_AMOUNT_OFFSET_UNITS', 999)
+SHARED_ADDRESS_AMOUNT_REUSE_GUARD_MINUTES = getattr(config, 'SHARED_ADDRESS_AMOUNT_REUSE_GUARD_MINUTES', 360)
+
+PRECISION_MAP = {"BTC": 8, "LTC": 8, "USDT": 6}
+
+
+def get_payment_coin_details(crypto_currency: str) -> dict:
+    """Maps a user-facing currency ('BTC', 'LTC', 'USDT') to the symbols used for HD derivation and pending payments."""
+    if crypto_currency == "USDT":
+        return {'display_coin': "USDT", 'hd_coin': "TRX", 'db_coin': "USDT_TRX", 'network': "TRC20 (Tron)", 'decimals': PRECISION_MAP["USDT"]}
+    return {'display_coin': crypto_currency, 'hd_coin': crypto_currency, 'db_coin': crypto_currency,
+            'network': crypto_currency, 'decimals': PRECISION_MAP.get(crypto_currency, 8)}
+
+
+def quote_smallest_units(amount_eur: Decimal, rate: Decimal, decimals: int) -> int:
+    """amount_eur / rate in smallest units, rounded up. Exact integer arithmetic on the Decimals' ratios."""
+    amount_numerator, amount_denominator = amount_eur.as_integer_ratio()
+    rate_numerator, rate_denominator = rate.as_integer_ratio()
+    return -(-(amount_numerator * rate_denominator * 10 ** decimals) // (amount_denominator * rate_numerator))
+
+
+def quote_crypto_amount(amount_eur: Decimal, rate: Decimal, crypto_currency: str) -> tuple[Decimal, int]:
+    """Returns (human-readable amount rounded up to the coin's precision, same amount in smallest units)."""
+    decimals = get_payment_coin_details(crypto_currency)['decimals']
+    amount_smallest_unit = quote_smallest_units(amount_eur, rate, decimals)
+    return Decimal(amount_smallest_unit).scaleb(-decimals), amount_smallest_unit
+
+
+def smallest_units_to_display_amount(amount_smallest_unit: int, crypto_currency: str) -> Decimal:
+    decimals = get_payment_coin_details(crypto_currency)['decimals']
+    return Decimal(amount_smallest_unit).scaleb(-decimals).quantize(Decimal('1e-' + str(decimals)))
+
+
+def uses_shared_addresses(db_coin_symbol: str) -> bool:
+    return db_coin_symbol in SHARED_ADDRESS_INVOICING_COINS
+
+
+def get_invoice_warning(invoice_mode: str) -> str:
+    """Closing warning of an invoice message for its invoice mode, as plain text (callers escape it for MarkdownV2)."""
+    if invoice_mode == 'shared':
+        return "⚠️ Send exactly this amount using the correct network. Payments to this address are matched by amount."
+    return ("⚠️ Send the exact amount using the correct network. This address belongs to this invoice only: "
+            "do not send to it after it expires, as it may be reassigned.")
+
+
+def ensure_shared_address_pool(db_coin_symbol: str, hd_coin_symbol: str) -> int:
+    """Derives addresses until the coin's shared pool has SHARED_ADDRESS_POOL_SIZE entries. Returns the pool size."""
+    pool = db_utils.get_shared_invoice_addresses(db_coin_symbol)
+    missing = SHARED_ADDRESS_POOL_SIZE - len(pool)
+    for _ in range(max(0, missing)):
+        hd_index = db_utils.get_next_address_index(hd_coin_symbol)
+        address = hd_wallet_utils.generate_address(hd_coin_symbol, hd_index)
+        if not address:
+            logger.error(f"Shared pool: failed to derive {hd_coin_symbol} address at index {hd_index}.")
+            break
+        db_utils.add_shared_invoice_address(db_coin_symbol, address, hd_index)
+    return len(db_utils.get_shared_invoice_addresses(db_coin_symbol))
+
+
+def create_invoice_payment(transaction_id: int, user_id: int, crypto_currency: str, expected_amount_hr: Decimal,
+                           expires_at: datetime.datetime, paid_from_balance_eur: float = 0.0,
+                           exchange_rate_id: int | None = None) -> dict | None:
+    """
+    Allocates the address and final expected amount for an invoice and creates its pending payment.
+    exchange_rate_id is the exchange_rates row the amount was quoted with; it is stored on the payment for audit.
+    Returns {'payment_id', 'address', 'expected_crypto_amount_hr', 'expected_crypto_amount_smallest_unit',
+    'network', 'invoice_mode'} or None on failure (details are logged).
+    """
+    coin_details = get_payment_coin_details(crypto_currency)
+    decimals = coin_details['decimals']
+    base_amount_smallest_unit = int(expected_amount_hr.scaleb(decimals))
+
+    if uses_shared_addresses(coin_details['db_coin']):
+        if ensure_shared_address_pool(coin_details['db_coin'], coin_details['hd_coin']) == 0:
+            return None
+        created = db_utils.create_shared_address_pending_payment(
+            transaction_id=transaction_id, user_id=user_id, coin_symbol=coin_details['db_coin'], network=coin_details['network'],
+            base_amount_smallest_unit=base_amount_smallest_unit, max_offset_units=SHARED_ADDRESS_MAX_AMOUNT_OFFSET_UNITS,
+            expires_at=expires_at, paid_from_balance_eur=paid_from_balance_eur,
+            amount_reuse_guard_seconds=SHARED_ADDRESS_AMOUNT_REUSE_GUARD_MINUTES * 60, exchange_rate_id=exchange_rate_id)
+        if not created:
+            return None
+        payment_id, address, amount_smallest_unit = created
+        invoice_mode = 'shared'
+    else:
+        recycled = address_recycling.claim_recycled_address(coin_details['hd_coin'])
+        pooled = None if recycled else address_pool.claim_pool_address(coin_details['hd_coin'])
+        if recycled:
+            address, hd_index = recycled
+        elif pooled:
+            address, hd_index = pooled
+        else:
+            hd_index = db_utils.get_next_address_index(coin_details['hd_coin'])
+            address = hd_wallet_utils.generate_address(coin_details['hd_coin'], hd_index)
+            if not address:
+                logger.error(f"Failed to derive {coin_details['hd_coin']} address at index {hd_index} for main tx {transaction_id}.")
+                return None
+        amount_smallest_unit = base_amount_smallest_unit
+        payment_id = db_utils.create_pending_payment(
+            transaction_id=transaction_id, user_id=user_id, address=address, coin_symbol=coin_details['db_coin'],
+            network=coin_details['network'], expected_crypto_amount=str(amount_smallest_unit),
+            expires_at=expires_at, paid_from_balance_eur=paid_from_balance_eur,
+            hd_index=hd_index, recycled_address=bool(recycled), exchange_rate_id=exchange_rate_id)
+        if not payment_id:
+            if recycled:
+                address_recycling.return_unused_address(address)
+            elif pooled:
+                address_pool.return_unused_address(address)
+            return None
+        invoice_mode = 'dedicated'
+
+    return {
+        'payment_id': payment_id,
+        'address': address,
+        'expected_crypto_amount_hr': smallest_units_to_display_amount(amount_smallest_unit, crypto_currency),
+        'expected_crypto_amount_smallest_unit': amount_smallest_unit,
+        'network': coin_details['network'],
+        'invoice_mode': invoice_mode,
+    }
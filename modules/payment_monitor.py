@@ -1,10 +1,19 @@
 import logging
 import time
 import datetime
+import json
+import os
+import socket
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from decimal import Decimal, InvalidOperation
 import requests
 
 from modules import db_utils
+from modules import finalization_queue
+from modules import address_recycling
+from modules import item_reservations
+from modules import metrics
 from modules import blockchain_apis # Imports the module with custom exceptions
 from modules.blockchain_apis import ( # Import custom exceptions
     BlockchainAPIError, BlockchainAPITimeoutError,
@@ -22,6 +31,15 @@ from modules.text_utils import escape_md
 logger = logging.getLogger(__name__)
 
 USDT_DECIMALS = 6
+AMOUNT_KEY_MAP = {"BTC": "amount_satoshi", "LTC": "amount_litoshi", "USDT_TRX": "amount_smallest_unit"}
+
+# Monitor leases (see db_utils.claim_pending_payments_for_monitoring). The lease must outlive the check of
+# one payment (API timeouts plus BLOCKCHAIN_API_CALL_DELAY_SECONDS); it is renewed after every payment.
+PAYMENT_MONITOR_BATCH_SIZE = getattr(config, 'PAYMENT_MONITOR_BATCH_SIZE', 25)
+PAYMENT_LEASE_SECONDS = getattr(config, 'PAYMENT_LEASE_SECONDS', 120)
+MONITOR_WORKER_ID_PREFIX = f"{socket.gethostname()}:{os.getpid()}"
+# A payment left in 'processing' longer than this (its worker died) is handed back to the sweep.
+PROCESSING_RECLAIM_SECONDS = getattr(config, 'PAYMENT_PROCESSING_RECLAIM_SECONDS', 600)
 
 def _get_min_confirmations(coin_symbol_from_db: str) -> int:
     base_coin_symbol = coin_symbol_from_db.split('_')[0].upper()
@@ -38,6 +56,9 @@ def _handle_api_error_for_payment_check(payment_id, address, coin_symbol, error)
 
     # Based on the error type, decide if the payment should be marked with a specific error status
     # or if it's a transient issue allowing retries.
+    if isinstance(error, (BlockchainAPITimeoutError, BlockchainAPIUnavailableError, BlockchainAPIRateLimitError)):
+        # Counts as checked for this cycle, so check_pending_payments moves on instead of re-claiming it
+        db_utils.mark_pending_payment_checked(payment_id)
     if isinstance(error, BlockchainAPITimeoutError):
         logger.warning(f"API Timeout for payment_id {payment_id}. Will retry next cycle.")
         # No status change, allow retry by default
@@ -61,121 +82,480 @@ def _handle_api_error_for_payment_check(payment_id, address, coin_symbol, error)
         db_utils.update_pending_payment_status(payment_id, 'error_monitoring_unexpected')
 
 
-def check_pending_payments():
-    logger.info("Starting check_pending_payments cycle.")
-    pending_payments = db_utils.get_pending_payments_to_monitor()
-
-    if not pending_payments:
-        logger.info("No payments currently in 'monitoring' state and not expired.")
-        return
-
-    logger.info(f"Found {len(pending_payments)} payments to check.")
+def _load_history_cursor(payment) -> dict:
+    raw_cursor = payment['history_cursor'] if 'history_cursor' in payment.keys() else None
+    if not raw_cursor:
+        return {}
+    try:
+        return json.loads(raw_cursor)
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring unreadable history cursor for payment_id {payment['payment_id']}.")
+        return {}
 
-    for payment in pending_payments:
-        payment_id = payment['payment_id']
-        address = payment['address']
-        coin_symbol = payment['coin_symbol']
-        expected_amount_str = payment['expected_crypto_amount']
-        created_at_dt = datetime.datetime.fromisoformat(payment['created_at'])
-        current_db_confirmations = payment['confirmations']
-        current_db_blockchain_tx_id = payment['blockchain_tx_id']
-        # current_db_received_amount = payment['received_crypto_amount'] # Not needed for direct check logic here
 
-        logger.debug(f"Checking payment_id: {payment_id}, address: {address}, coin: {coin_symbol}")
+def _utc_epoch_seconds(naive_utc_dt: datetime.datetime) -> float:
+    return naive_utc_dt.replace(tzinfo=datetime.timezone.utc).timestamp()
 
-        api_transactions = [] # Initialize to empty list
-        time.sleep(getattr(config, 'BLOCKCHAIN_API_CALL_DELAY_SECONDS', 2.0))
 
+def _tx_epoch_seconds(tx_info: dict) -> float | None:
+    """Best-effort time a transaction was seen/mined, from whichever field the coin's API provides."""
+    if tx_info.get('timestamp_ms') is not None:
+        return tx_info['timestamp_ms'] / 1000
+    if isinstance(tx_info.get('block_time'), (int, float)):
+        return tx_info['block_time']
+    received_time = tx_info.get('received_time')
+    if isinstance(received_time, str):
         try:
-            if coin_symbol == "BTC":
-                api_transactions = blockchain_apis.get_address_transactions_btc(address)
-            elif coin_symbol == "LTC":
-                api_transactions = blockchain_apis.get_address_transactions_ltc(address)
-            elif coin_symbol == "USDT_TRX":
-                since_ts_ms = int(created_at_dt.timestamp() * 1000) - (60 * 1000 * 5)
-                api_transactions = blockchain_apis.get_trc20_transfers_usdt_trx(address, since_timestamp_ms=since_ts_ms)
-            else:
-                logger.warning(f"Unsupported coin_symbol '{coin_symbol}' for payment_id {payment_id}. Skipping.")
-                db_utils.update_pending_payment_status(payment_id, 'error_monitoring_unsupported')
-                continue
-        except BlockchainAPIError as e_api: # Catch specific custom exceptions
-            _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_api)
+            parsed = datetime.datetime.fromisoformat(received_time.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        return parsed.timestamp() if parsed.tzinfo else _utc_epoch_seconds(parsed)
+    return None
+
+
+# Tolerance when comparing explorer timestamps with invoice creation on reused (shared or recycled) addresses.
+ADDRESS_REUSE_CLOCK_SKEW_SECONDS = 120
+
+
+def _fetch_address_transactions(coin_symbol: str, address: str, history_cursor: dict, since_timestamp_ms: int) -> list[dict] | None:
+    if coin_symbol == "BTC":
+        return blockchain_apis.get_address_transactions_btc(address, cursor=history_cursor)
+    if coin_symbol == "LTC":
+        return blockchain_apis.get_address_transactions_ltc(address, cursor=history_cursor)
+    if coin_symbol == "USDT_TRX":
+        return blockchain_apis.get_trc20_transfers_usdt_trx(address, since_timestamp_ms=since_timestamp_ms, cursor=history_cursor)
+    return None
+
+
+def _fetch_api_transactions(payment, shared_address_cache: dict | None = None) -> list[dict] | None:
+    """
+    Fetches incoming transactions for a pending payment's address, resuming from the history cursor
+    persisted on the payment row so only new activity is downloaded. The updated cursor is saved back.
+    Shared-address payments go through the per-address index instead (see _fetch_shared_address_index).
+    Returns None for unsupported coins. API errors propagate to the caller.
+    """
+    coin_symbol = payment['coin_symbol']
+    address = payment['address']
+    if _invoice_mode(payment) == 'shared':
+        address_index = _fetch_shared_address_index(coin_symbol, address, shared_address_cache)
+        if address_index is None:
+            return None
+        return _select_shared_address_transactions(payment, address_index)
+
+    history_cursor = _load_history_cursor(payment)
+    cursor_before = json.dumps(history_cursor, sort_keys=True)
+
+    created_at_dt = datetime.datetime.fromisoformat(payment['created_at'])
+    since_ts_ms = int(created_at_dt.timestamp() * 1000) - (60 * 1000 * 5)
+    api_transactions = _fetch_address_transactions(coin_symbol, address, history_cursor, since_ts_ms)
+    if api_transactions is None:
+        return None
+    if 'recycled_address' in payment.keys() and payment['recycled_address']:
+        # A recycled address was verified unused, but a late transfer meant for its old invoice must not pay this one.
+        not_before = _utc_epoch_seconds(created_at_dt) - ADDRESS_REUSE_CLOCK_SKEW_SECONDS
+        api_transactions = [tx_info for tx_info in api_transactions
+                            if _tx_epoch_seconds(tx_info) is None or _tx_epoch_seconds(tx_info) >= not_before]
+
+    cursor_after = json.dumps(history_cursor, sort_keys=True)
+    if cursor_after != cursor_before:
+        db_utils.update_pending_payment_history_cursor(payment['payment_id'], cursor_after)
+    return api_transactions
+
+
+# --- Shared-address invoices (see modules/payment_invoicing.py) ---
+# All invoices on a shared address are served by one fetch per address and cycle. Transfers are indexed
+# in memory by exact amount; each invoice only accepts a transfer of exactly its (unique) amount that was
+# seen after the invoice was created and is not already recorded against another invoice.
+SHARED_ADDRESS_HISTORY_RETENTION_MINUTES = getattr(config, 'SHARED_ADDRESS_HISTORY_RETENTION_MINUTES', 24 * 60)
+
+
+def _invoice_mode(payment) -> str:
+    return payment['invoice_mode'] if 'invoice_mode' in payment.keys() and payment['invoice_mode'] else 'dedicated'
+
+
+def _fetch_shared_address_index(coin_symbol: str, address: str, shared_address_cache: dict | None = None) -> dict | None:
+    """Returns {amount_smallest_unit_str: [tx, ...]} for a shared address, fetched at most once per cache."""
+    cache_key = (coin_symbol, address)
+    if shared_address_cache is not None and cache_key in shared_address_cache:
+        return shared_address_cache[cache_key]
+
+    raw_cursor = db_utils.get_shared_address_history_cursor(address)
+    try:
+        history_cursor = json.loads(raw_cursor) if raw_cursor else {}
+    except ValueError:
+        logger.warning(f"Ignoring unreadable history cursor for shared address {address}.")
+        history_cursor = {}
+    cursor_before = json.dumps(history_cursor, sort_keys=True)
+
+    retention_start = datetime.datetime.utcnow() - datetime.timedelta(minutes=SHARED_ADDRESS_HISTORY_RETENTION_MINUTES)
+    retention_start_epoch = _utc_epoch_seconds(retention_start)
+    api_transactions = _fetch_address_transactions(coin_symbol, address, history_cursor, int(retention_start_epoch * 1000))
+    if api_transactions is None:
+        return None
+
+    # The cursor accumulates every transfer ever seen on the address; forget those too old to match an invoice.
+    known_txs = history_cursor.get('txs')
+    if isinstance(known_txs, dict):
+        for txid in [txid for txid, tx_info in known_txs.items()
+                     if isinstance(tx_info, dict) and (_tx_epoch_seconds(tx_info) or retention_start_epoch) < retention_start_epoch]:
+            del known_txs[txid]
+    cursor_after = json.dumps(history_cursor, sort_keys=True)
+    if cursor_after != cursor_before:
+        db_utils.update_shared_address_history_cursor(address, cursor_after)
+
+    amount_key = AMOUNT_KEY_MAP[coin_symbol]
+    address_index = {}
+    for tx in api_transactions:
+        if tx.get(amount_key) is None:
             continue
-        except Exception as e_generic: # Catch any other unexpected error from the API call layer
-             _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_generic)
-             continue
-
+        try:
+            amount_key_normalized = str(int(Decimal(str(tx[amount_key]))))
+        except (InvalidOperation, ValueError):
+            continue
+        address_index.setdefault(amount_key_normalized, []).append(tx)
+    logger.debug(f"Indexed {len(api_transactions)} transfers on shared address {address} ({coin_symbol}).")
+
+    if shared_address_cache is not None:
+        shared_address_cache[cache_key] = address_index
+    return address_index
+
+
+def _select_shared_address_transactions(payment, address_index: dict) -> list[dict]:
+    candidates = address_index.get(str(payment['expected_crypto_amount']), [])
+    if not candidates:
+        return []
+    payment_id = payment['payment_id']
+    created_at_epoch = _utc_epoch_seconds(datetime.datetime.fromisoformat(payment['created_at']))
+    claimed_tx_ids = db_utils.get_claimed_blockchain_tx_ids(payment['address'])
+    selected = []
+    for tx in candidates:
+        claimed_by = claimed_tx_ids.get(tx.get('txid'))
+        if claimed_by is not None and claimed_by != payment_id:
+            continue
+        seen_at = _tx_epoch_seconds(tx)
+        if seen_at is not None and seen_at < created_at_epoch - ADDRESS_REUSE_CLOCK_SKEW_SECONDS:
+            continue
+        selected.append(tx)
+    return selected
+
+
+def _apply_api_transactions(payment, api_transactions: list[dict]) -> tuple[bool, str]:
+    """
+    Matches API transactions against a pending payment and applies the resulting DB updates.
+    Shared by the scheduled monitor and on-demand checks.
+    Returns (newly_confirmed, status_after_check); status_after_check may be 'monitoring_updated'
+    when a tracked tx gained confirmations without reaching the required number.
+    """
+    payment_id = payment['payment_id']
+    address = payment['address']
+    coin_symbol = payment['coin_symbol']
+    expected_amount_str = payment['expected_crypto_amount']
+    current_status = payment['status']
+    current_db_confirmations = payment['confirmations']
+    current_db_blockchain_tx_id = payment['blockchain_tx_id']
 
-        found_matching_tx_for_confirmation = False
-        if api_transactions: # api_transactions is now guaranteed to be a list
-            logger.debug(f"Found {len(api_transactions)} API transactions for address {address} ({coin_symbol}).")
+    if not api_transactions:
+        logger.debug(f"No transactions found from API for address {address} ({coin_symbol}), payment_id {payment_id}. Updating last_checked_at.")
+        db_utils.update_pending_payment_check_details(payment_id, current_db_confirmations)
+        return False, current_status
 
-            for tx_data_from_api in api_transactions:
-                tx_confirmations_api = tx_data_from_api.get('confirmations', 0)
-                blockchain_tx_id_api = tx_data_from_api.get('txid')
+    logger.debug(f"Found {len(api_transactions)} API transactions for address {address} ({coin_symbol}).")
 
-                # Determine amount key based on coin_symbol more robustly
-                amount_key_map = {"BTC": "amount_satoshi", "LTC": "amount_litoshi", "USDT_TRX": "amount_smallest_unit"}
-                amount_key = amount_key_map.get(coin_symbol)
-                if not amount_key: # Should have been caught by unsupported coin_symbol earlier
-                    logger.error(f"Logic error: Undefined amount key for coin_symbol {coin_symbol}, payment_id {payment_id}"); continue
+    amount_key = AMOUNT_KEY_MAP.get(coin_symbol)
+    if not amount_key: # Should have been caught by unsupported coin_symbol earlier
+        logger.error(f"Logic error: Undefined amount key for coin_symbol {coin_symbol}, payment_id {payment_id}")
+        return False, current_status
 
-                received_amount_smallest_unit_api_str = tx_data_from_api.get(amount_key)
+    newly_confirmed_this_check = False
+    status_after_check = current_status
 
-                if not received_amount_smallest_unit_api_str or not blockchain_tx_id_api:
-                    logger.warning(f"Skipping tx for payment_id {payment_id} due to missing amount or txid. Data: {tx_data_from_api}")
-                    continue
+    for tx_data_from_api in api_transactions:
+        tx_confirmations_api = tx_data_from_api.get('confirmations', 0)
+        blockchain_tx_id_api = tx_data_from_api.get('txid')
+        received_amount_smallest_unit_api_str = tx_data_from_api.get(amount_key)
 
-                try:
-                    received_decimal_api = Decimal(received_amount_smallest_unit_api_str)
-                    expected_decimal_db = Decimal(expected_amount_str)
-                except InvalidOperation:
-                    logger.error(f"Could not convert amounts to Decimal for payment_id {payment_id}, tx {blockchain_tx_id_api}. API_RX: '{received_amount_smallest_unit_api_str}', DB_EXP: '{expected_amount_str}'. Skipping tx.")
-                    continue
+        if not received_amount_smallest_unit_api_str or not blockchain_tx_id_api:
+            logger.warning(f"Skipping tx for payment_id {payment_id} due to missing amount or txid. Data: {tx_data_from_api}")
+            continue
 
-                if current_db_blockchain_tx_id and current_db_blockchain_tx_id == blockchain_tx_id_api:
-                    found_matching_tx_for_confirmation = True
-                    logger.info(f"Re-checking known tx {blockchain_tx_id_api} for payment_id {payment_id}. API_Confs: {tx_confirmations_api}, DB_Confs: {current_db_confirmations}")
+        try:
+            received_decimal_api = Decimal(received_amount_smallest_unit_api_str)
+            expected_decimal_db = Decimal(expected_amount_str)
+        except InvalidOperation:
+            logger.error(f"Could not convert amounts to Decimal for payment_id {payment_id}, tx {blockchain_tx_id_api}. API_RX: '{received_amount_smallest_unit_api_str}', DB_EXP: '{expected_amount_str}'. Skipping tx.")
+            continue
 
-                    db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
+        min_confs_needed = _get_min_confirmations(coin_symbol)
+        if current_db_blockchain_tx_id and current_db_blockchain_tx_id == blockchain_tx_id_api:
+            logger.info(f"Re-checking known tx {blockchain_tx_id_api} for payment_id {payment_id}. API_Confs: {tx_confirmations_api}, DB_Confs: {current_db_confirmations}")
+            db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
 
-                    min_confs_needed = _get_min_confirmations(coin_symbol)
-                    if tx_confirmations_api >= min_confs_needed:
-                        logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) CONFIRMED with {tx_confirmations_api} confs.")
-                        db_utils.update_pending_payment_status(payment_id, 'confirmed_unprocessed')
-                    break
-                elif not current_db_blockchain_tx_id:
+            if tx_confirmations_api >= min_confs_needed:
+                if current_status == 'monitoring':
                     if received_decimal_api >= expected_decimal_db:
-                        logger.info(f"Found NEW potential matching tx for payment_id {payment_id}: txid {blockchain_tx_id_api}, received {received_decimal_api}, expected {expected_decimal_db}.")
-                        found_matching_tx_for_confirmation = True
-                        min_confs_needed = _get_min_confirmations(coin_symbol)
-
-                        db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
-                        # current_db_blockchain_tx_id = blockchain_tx_id_api # No need to set here, will be re-fetched next cycle if not confirmed
-
-                        if tx_confirmations_api >= min_confs_needed:
-                            logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) CONFIRMED with {tx_confirmations_api} confs.")
-                            db_utils.update_pending_payment_status(payment_id, 'confirmed_unprocessed')
-                        else:
-                            logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) found, but only {tx_confirmations_api}/{min_confs_needed} confirmations. Now tracking this TX.")
-                        break
-
-                    elif received_decimal_api > 0:
-                        logger.warning(f"UNDERPAYMENT detected for payment_id {payment_id}, address {address}. Expected: {expected_decimal_db}, Received: {received_decimal_api} in tx {blockchain_tx_id_api}.")
-                        db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
+                        logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) CONFIRMED with {tx_confirmations_api} confs.")
+                        _mark_payment_confirmed(payment_id, payment['transaction_id'])
+                        newly_confirmed_this_check = True
+                        status_after_check = 'confirmed_unprocessed'
+                    else:
                         db_utils.update_pending_payment_status(payment_id, 'underpaid')
-                        found_matching_tx_for_confirmation = True
-                        break
+                        status_after_check = 'underpaid'
+            else:
+                status_after_check = 'monitoring_updated' if current_status == 'monitoring' else current_status
+            break
+
+        elif not current_db_blockchain_tx_id:
+            if received_decimal_api > 0: # Any incoming transfer counts as seen, underpayments included
+                db_utils.record_payment_funnel_event('first_seen', payment_id, provider=blockchain_apis.PROVIDER_BY_COIN.get(coin_symbol))
+            if received_decimal_api >= expected_decimal_db:
+                logger.info(f"Found NEW potential matching tx for payment_id {payment_id}: txid {blockchain_tx_id_api}, received {received_decimal_api}, expected {expected_decimal_db}.")
+                db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
+                if tx_confirmations_api >= min_confs_needed:
+                    logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) CONFIRMED with {tx_confirmations_api} confs.")
+                    _mark_payment_confirmed(payment_id, payment['transaction_id'])
+                    newly_confirmed_this_check = True
+                    status_after_check = 'confirmed_unprocessed'
+                else:
+                    logger.info(f"Payment {payment_id} (tx {blockchain_tx_id_api}) found, but only {tx_confirmations_api}/{min_confs_needed} confirmations. Now tracking this TX.")
+                    status_after_check = 'monitoring_updated'
+                break
+            elif received_decimal_api > 0:
+                logger.warning(f"UNDERPAYMENT detected for payment_id {payment_id}, address {address}. Expected: {expected_decimal_db}, Received: {received_decimal_api} in tx {blockchain_tx_id_api}.")
+                db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
+                db_utils.update_pending_payment_status(payment_id, 'underpaid')
+                status_after_check = 'underpaid'
+                break
+
+    if not newly_confirmed_this_check and status_after_check == current_status:
+        logger.debug(f"No new or tracked matching tx found for payment_id {payment_id}. Updating last_checked_at.")
+        db_utils.update_pending_payment_check_details(payment_id, current_db_confirmations)
+
+    return newly_confirmed_this_check, status_after_check
+
+
+def _check_leased_payment(payment, shared_address_cache: dict | None = None):
+    payment_id = payment['payment_id']
+    address = payment['address']
+    coin_symbol = payment['coin_symbol']
+
+    logger.debug(f"Checking payment_id: {payment_id}, address: {address}, coin: {coin_symbol}")
 
-        if not found_matching_tx_for_confirmation:
-            logger.debug(f"No new or tracked matching tx found for payment_id {payment_id}. Updating last_checked_at.")
-            db_utils.update_pending_payment_check_details(payment_id, current_db_confirmations)
+    try:
+        api_transactions = _fetch_api_transactions(payment, shared_address_cache)
+        if api_transactions is None:
+            logger.warning(f"Unsupported coin_symbol '{coin_symbol}' for payment_id {payment_id}. Skipping.")
+            db_utils.update_pending_payment_status(payment_id, 'error_monitoring_unsupported')
+            return
+    except BlockchainAPIError as e_api: # Catch specific custom exceptions
+        _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_api)
+        return
+    except Exception as e_generic: # Catch any other unexpected error from the API call layer
+        _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_generic)
+        return
 
-    logger.info("Finished check_pending_payments cycle.")
+    newly_confirmed, status_after_check = _apply_api_transactions(payment, api_transactions)
+    _cache_check_result(payment['transaction_id'], newly_confirmed, status_after_check)
+
+
+def check_pending_payments(worker_id: str = None):
+    """
+    Checks all unexpired 'monitoring' payments. Payments are leased in batches of PAYMENT_MONITOR_BATCH_SIZE,
+    so any number of monitor workers (threads or processes sharing the database) can run this at the same
+    time and each payment is checked by exactly one of them per cycle. Leases are renewed after every
+    payment and released when the batch is done; a crashed worker's leases simply expire.
+    """
+    worker_id = worker_id or f"{MONITOR_WORKER_ID_PREFIX}:{threading.get_ident()}"
+    cycle_started_iso = datetime.datetime.utcnow().isoformat()
+    logger.info(f"Starting check_pending_payments cycle as {worker_id}.")
+    checked_count = 0
+    shared_address_cache = {} # One fetch per shared address per cycle, however many invoices it carries
+    tried_ids = set() # Each payment is tried at most once per cycle, even if recording its check failed
+
+    while True:
+        batch = db_utils.claim_pending_payments_for_monitoring(worker_id, limit=PAYMENT_MONITOR_BATCH_SIZE,
+                                                               lease_seconds=PAYMENT_LEASE_SECONDS,
+                                                               checked_before_iso=cycle_started_iso)
+        already_tried = [payment['payment_id'] for payment in batch if payment['payment_id'] in tried_ids]
+        if already_tried:
+            db_utils.release_pending_payment_leases(worker_id, already_tried)
+            batch = [payment for payment in batch if payment['payment_id'] not in tried_ids]
+        if not batch:
+            break
+        tried_ids.update(payment['payment_id'] for payment in batch)
+        logger.info(f"{worker_id} leased {len(batch)} payments to check.")
+        remaining_ids = [payment['payment_id'] for payment in batch]
+        try:
+            for payment in batch:
+                if _invoice_mode(payment) != 'shared' or (payment['coin_symbol'], payment['address']) not in shared_address_cache:
+                    time.sleep(getattr(config, 'BLOCKCHAIN_API_CALL_DELAY_SECONDS', 2.0))
+                _check_leased_payment(payment, shared_address_cache)
+                checked_count += 1
+                remaining_ids.remove(payment['payment_id'])
+                db_utils.release_pending_payment_leases(worker_id, [payment['payment_id']])
+                if remaining_ids:
+                    db_utils.renew_pending_payment_leases(worker_id, remaining_ids, PAYMENT_LEASE_SECONDS)
+        finally:
+            db_utils.release_pending_payment_leases(worker_id, remaining_ids)
+
+    if checked_count:
+        logger.info(f"Finished check_pending_payments cycle as {worker_id}: {checked_count} payments checked.")
+    else:
+        logger.info("No payments currently in 'monitoring' state and not expired (or all leased by other workers).")
+
+
+def _mark_payment_confirmed(payment_id: int, transaction_id: int):
+    """
+    Moves a payment to 'confirmed_unprocessed' and hands it straight to the finalization workers. A reserved
+    item instance stays held until finalization consumes it.
+    In a process without finalization workers (e.g. a standalone job worker), a durable
+    'finalize_payment' job is queued instead.
+    """
+    if db_utils.update_pending_payment_status(payment_id, 'confirmed_unprocessed'):
+        db_utils.record_payment_funnel_event('confirmed', payment_id)
+        item_reservations.hold_for_confirmed_payment(transaction_id)
+        if not finalization_queue.is_running():
+            db_utils.enqueue_job('finalize_payment', {'payment_id': payment_id}, priority=10,
+                                 dedupe_key=f"finalize_payment:{payment_id}")
+            return
+        finalization_queue.enqueue_finalization(payment_id)
+
+
+def _queue_user_notification(bot_instance, user_id: int, text: str, parse_mode: str = None):
+    """
+    Queues a durable 'send_user_notification' job so Telegram errors are retried with backoff.
+    Falls back to sending directly if the job cannot be queued.
+    """
+    if db_utils.enqueue_job('send_user_notification', {'user_id': user_id, 'text': text, 'parse_mode': parse_mode}, priority=50):
+        return
+    if bot_instance:
+        bot_instance.send_message(user_id, text, parse_mode=parse_mode)
+
+
+def process_confirmed_payment(payment, bot_instance=None) -> bool:
+    """
+    Finalizes one payment (balance top-up or item delivery). Returns True on success.
+    The payment must already be claimed ('processing', see process_confirmed_payment_by_id); the
+    finalizers record each side effect in the finalization ledger, so a retry after a crash is safe.
+    """
+    payment_id = payment['payment_id']
+    user_id = payment['user_id']
+    main_tx_id = payment['transaction_id']
+    coin_symbol = payment['coin_symbol']
+    received_amount_str = payment['received_crypto_amount']
+    blockchain_tx_id = payment['blockchain_tx_id']
+    paid_from_balance_eur_str_from_payment = str(payment['paid_from_balance_eur'] or '0.0')
+
+    logger.info(f"Processing confirmed payment_id {payment_id} for main_transaction_id {main_tx_id} (user {user_id}).")
+
+    main_tx_details = db_utils.get_transaction_by_id(main_tx_id)
+
+    if not main_tx_details:
+        logger.error(f"Main transaction {main_tx_id} not found for confirmed payment_id {payment_id}. Marking as error.")
+        db_utils.update_pending_payment_status(payment_id, 'error_processing_tx_missing')
+        return False
+
+    if main_tx_details['payment_status'] == 'completed':
+        logger.warning(f"Main transaction {main_tx_id} already marked 'completed'. Pending payment {payment_id} might be a duplicate signal. Marking 'processed'.")
+        db_utils.update_pending_payment_status(payment_id, 'processed_tx_already_complete')
+        return False
+
+    processing_success = False
+    finalization_notes = (f"Crypto payment confirmed. Coin: {coin_symbol}, "
+                          f"Blockchain TXID: {blockchain_tx_id}, "
+                          f"Received (smallest unit): {received_amount_str}. "
+                          f"Processed by payment_monitor.")
+
+
+    if main_tx_details['type'] == 'balance_top_up':
+        amount_to_add_str = str(main_tx_details['original_add_balance_amount'])
+        if main_tx_details['original_add_balance_amount'] is None:
+            logger.error(f"Critical: original_add_balance_amount is NULL for balance_top_up tx {main_tx_id}, payment_id {payment_id}.")
+            db_utils.update_transaction_status(main_tx_id, 'failed_data_error')
+            db_utils.update_pending_payment_status(payment_id, 'error_finalizing_data')
+            return False
+
+        logger.info(f"Calling finalize_successful_top_up for payment_id {payment_id}, main_tx_id {main_tx_id}, user {user_id}, amount {amount_to_add_str}.")
+        processing_success = finalize_successful_top_up(
+            bot_instance=bot_instance,
+            main_transaction_id=main_tx_id,
+            user_id=user_id,
+            original_add_balance_amount_str=amount_to_add_str,
+            received_crypto_amount_str=received_amount_str,
+            coin_symbol=coin_symbol,
+            blockchain_tx_id=blockchain_tx_id
+        )
+        if not processing_success:
+             logger.error(f"finalize_successful_top_up handler failed for main_tx_id {main_tx_id}, payment_id {payment_id}.")
+             db_utils.update_transaction_status(main_tx_id, 'failed_finalization_handler')
+
+
+    elif main_tx_details['type'] == 'purchase_crypto':
+        if not main_tx_details['item_details_json']:
+            logger.error(f"Critical: item_details_json is NULL for purchase_crypto tx {main_tx_id}, payment_id {payment_id}.")
+            db_utils.update_transaction_status(main_tx_id, 'failed_data_error')
+            db_utils.update_pending_payment_status(payment_id, 'error_finalizing_data')
+            return False
+
+        logger.info(f"Calling finalize_successful_crypto_purchase for payment_id {payment_id}, main_tx_id {main_tx_id}, user {user_id}.")
+        processing_success = finalize_successful_crypto_purchase(
+            bot_instance=bot_instance,
+            main_transaction_id=main_tx_id,
+            user_id=user_id,
+            paid_from_balance_eur_str=paid_from_balance_eur_str_from_payment,
+            received_crypto_amount_str=received_amount_str,
+            coin_symbol=coin_symbol,
+            blockchain_tx_id=blockchain_tx_id
+        )
+        if not processing_success:
+            logger.error(f"finalize_successful_crypto_purchase handler failed for main_tx_id {main_tx_id}, payment_id {payment_id}.")
+            db_utils.update_transaction_status(main_tx_id, 'failed_finalization_handler')
+    else:
+        logger.error(f"Unknown transaction type '{main_tx_details['type']}' for main_tx_id {main_tx_id}, payment_id {payment_id}. Payment: {dict(payment)}")
+        db_utils.update_pending_payment_status(payment_id, 'error_unknown_type')
+        return False
+
+    if processing_success:
+        db_utils.update_pending_payment_status(payment_id, 'processed')
+        db_utils.record_payment_funnel_event('finalization_finished', payment_id)
+        updated_notes = (main_tx_details['notes'] + " | " + finalization_notes).strip(" | ") if main_tx_details['notes'] else finalization_notes
+        conn = db_utils.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE transactions SET notes = ?, updated_at = CURRENT_TIMESTAMP WHERE transaction_id = ?", (updated_notes, main_tx_id))
+            conn.commit()
+        except sqlite3.Error as e_notes:
+            logger.error(f"Failed to update notes for main tx {main_tx_id}: {e_notes}")
+        finally:
+            conn.close()
+    else:
+        logger.error(f"Failed to finalize main transaction {main_tx_id} (type: {main_tx_details['type']}) after payment {payment_id} was confirmed.")
+        db_utils.update_pending_payment_status(payment_id, 'error_finalizing')
+    return processing_success
+
+
+def process_confirmed_payment_by_id(payment_id: int, bot_instance=None) -> bool:
+    """
+    Entry point for all finalization paths. Claims the payment with a single conditional UPDATE
+    ('confirmed_unprocessed' -> 'processing'), so when several workers race for the same payment
+    exactly one of them finalizes it.
+    """
+    owner = f"{MONITOR_WORKER_ID_PREFIX}:{threading.get_ident()}"
+    payment = db_utils.claim_confirmed_payment_for_processing(payment_id, owner)
+    if not payment:
+        logger.info(f"Finalization: payment_id {payment_id} is not 'confirmed_unprocessed' (already claimed or finalized). Skipping.")
+        return False
+    db_utils.record_payment_funnel_event('finalization_started', payment_id)
+    return process_confirmed_payment(payment, bot_instance)
 
 
 def process_confirmed_payments(bot_instance=None):
+    """
+    Safety-net sweep for 'confirmed_unprocessed' payments (e.g. left over from a restart or confirmed
+    by another process). When finalization workers are running, payments are handed to them;
+    otherwise they are finalized inline.
+    """
     logger.info("Starting process_confirmed_payments cycle.")
+    db_utils.reclaim_stale_processing_payments(PROCESSING_RECLAIM_SECONDS)
     confirmed_payments = db_utils.get_confirmed_unprocessed_payments(limit=20)
 
     if not confirmed_payments:
@@ -185,101 +565,10 @@ def process_confirmed_payments(bot_instance=None):
     logger.info(f"Found {len(confirmed_payments)} 'confirmed_unprocessed' payments to process.")
 
     for payment in confirmed_payments:
-        payment_id = payment['payment_id']
-        user_id = payment['user_id']
-        main_tx_id = payment['transaction_id']
-        coin_symbol = payment['coin_symbol']
-        received_amount_str = payment['received_crypto_amount']
-        blockchain_tx_id = payment['blockchain_tx_id']
-        paid_from_balance_eur_str_from_payment = str(payment.get('paid_from_balance_eur', '0.0'))
-
-
-        logger.info(f"Processing confirmed payment_id {payment_id} for main_transaction_id {main_tx_id} (user {user_id}).")
-
-        main_tx_details = db_utils.get_transaction_by_id(main_tx_id)
-
-        if not main_tx_details:
-            logger.error(f"Main transaction {main_tx_id} not found for confirmed payment_id {payment_id}. Marking as error.")
-            db_utils.update_pending_payment_status(payment_id, 'error_processing_tx_missing')
-            continue
-
-        if main_tx_details['payment_status'] == 'completed':
-            logger.warning(f"Main transaction {main_tx_id} already marked 'completed'. Pending payment {payment_id} might be a duplicate signal. Marking 'processed'.")
-            db_utils.update_pending_payment_status(payment_id, 'processed_tx_already_complete')
-            continue
-
-        processing_success = False
-        finalization_notes = (f"Crypto payment confirmed. Coin: {coin_symbol}, "
-                              f"Blockchain TXID: {blockchain_tx_id}, "
-                              f"Received (smallest unit): {received_amount_str}. "
-                              f"Processed by payment_monitor.")
-
-
-        if main_tx_details['type'] == 'balance_top_up':
-            amount_to_add_str = str(main_tx_details['original_add_balance_amount'])
-            if main_tx_details['original_add_balance_amount'] is None:
-                logger.error(f"Critical: original_add_balance_amount is NULL for balance_top_up tx {main_tx_id}, payment_id {payment_id}.")
-                db_utils.update_transaction_status(main_tx_id, 'failed_data_error')
-                db_utils.update_pending_payment_status(payment_id, 'error_finalizing_data')
-                continue
-
-            logger.info(f"Calling finalize_successful_top_up for payment_id {payment_id}, main_tx_id {main_tx_id}, user {user_id}, amount {amount_to_add_str}.")
-            processing_success = finalize_successful_top_up(
-                bot_instance=bot_instance,
-                main_transaction_id=main_tx_id,
-                user_id=user_id,
-                original_add_balance_amount_str=amount_to_add_str,
-                received_crypto_amount_str=received_amount_str,
-                coin_symbol=coin_symbol,
-                blockchain_tx_id=blockchain_tx_id
-            )
-            if not processing_success:
-                 logger.error(f"finalize_successful_top_up handler failed for main_tx_id {main_tx_id}, payment_id {payment_id}.")
-                 db_utils.update_transaction_status(main_tx_id, 'failed_finalization_handler')
-
-
-        elif main_tx_details['type'] == 'purchase_crypto':
-            product_id = main_tx_details['product_id']
-            if product_id is None:
-                logger.error(f"Critical: product_id is NULL for purchase_crypto tx {main_tx_id}, payment_id {payment_id}.")
-                db_utils.update_transaction_status(main_tx_id, 'failed_data_error')
-                db_utils.update_pending_payment_status(payment_id, 'error_finalizing_data')
-                continue
-
-            logger.info(f"Calling finalize_successful_crypto_purchase for payment_id {payment_id}, main_tx_id {main_tx_id}, user {user_id}, product {product_id}.")
-            processing_success = finalize_successful_crypto_purchase(
-                bot_instance=bot_instance,
-                main_transaction_id=main_tx_id,
-                user_id=user_id,
-                product_id=product_id,
-                paid_from_balance_eur_str=paid_from_balance_eur_str_from_payment,
-                received_crypto_amount_str=received_amount_str,
-                coin_symbol=coin_symbol,
-                blockchain_tx_id=blockchain_tx_id
-            )
-            if not processing_success:
-                logger.error(f"finalize_successful_crypto_purchase handler failed for main_tx_id {main_tx_id}, payment_id {payment_id}.")
-                db_utils.update_transaction_status(main_tx_id, 'failed_finalization_handler')
-        else:
-            logger.error(f"Unknown transaction type '{main_tx_details['type']}' for main_tx_id {main_tx_id}, payment_id {payment_id}. Payment: {payment}")
-            db_utils.update_pending_payment_status(payment_id, 'error_unknown_type')
-            continue
-
-        if processing_success:
-            db_utils.update_pending_payment_status(payment_id, 'processed')
-            updated_notes = (main_tx_details['notes'] + " | " + finalization_notes).strip(" | ") if main_tx_details['notes'] else finalization_notes
-            conn = db_utils.get_db_connection()
-            cursor = conn.cursor()
-            try:
-                cursor.execute("UPDATE transactions SET notes = ?, updated_at = CURRENT_TIMESTAMP WHERE transaction_id = ?", (updated_notes, main_tx_id))
-                conn.commit()
-            except sqlite3.Error as e_notes:
-                logger.error(f"Failed to update notes for main tx {main_tx_id}: {e_notes}")
-            finally:
-                conn.close()
+        if finalization_queue.is_running():
+            finalization_queue.enqueue_finalization(payment['payment_id'])
         else:
-            logger.error(f"Failed to finalize main transaction {main_tx_id} (type: {main_tx_details['type']}) after payment {payment_id} was confirmed.")
-            db_utils.update_pending_payment_status(payment_id, 'error_finalizing')
+            process_confirmed_payment_by_id(payment['payment_id'], bot_instance)
 
     logger.info("Finished process_confirmed_payments cycle.")
 
@@ -307,6 +596,10 @@ def expire_stale_monitoring_payments(bot_instance=None):
             logger.error(f"Failed to update pending payment {payment_id} status to 'expired'. Skipping associated main transaction update for now.")
             continue
 
+        if pending_payment_full:
+            address_recycling.register_expired_invoice_address(pending_payment_full)
+        item_reservations.release(transaction_id=main_tx_id)
+
         main_tx_status_update = 'failed_expired_notfound'
         expiry_notification_suffix = "as no payment was detected in time."
         if pending_payment_full and pending_payment_full['blockchain_tx_id']:
@@ -318,25 +611,28 @@ def expire_stale_monitoring_payments(bot_instance=None):
         if not db_utils.update_transaction_status(main_tx_id, main_tx_status_update):
             logger.error(f"Failed to update main transaction {main_tx_id} status to '{main_tx_status_update}' for expired pending payment {payment_id}.")
 
-        if bot_instance:
-            try:
-                main_tx_details = db_utils.get_transaction_by_id(main_tx_id)
-                if main_tx_details:
-                    type_escaped = escape_md(main_tx_details['type'].replace('_', ' ').title())
-                    bot_instance.send_message(user_id,
-                        f"⚠️ Your payment attempt \\(Order \\#{main_tx_id}, Type: {type_escaped}\\) for address `{escape_md(address)}` has expired {expiry_notification_suffix} "
-                        f"Please try again or contact support if you believe this is an error\\.",
-                        parse_mode="MarkdownV2"
-                    )
-                    logger.info(f"Notified user {user_id} about expired payment {payment_id} for main_tx_id {main_tx_id}.")
-                else:
-                    logger.warning(f"Could not fetch main_tx_details for {main_tx_id} to notify user {user_id} about expired payment {payment_id}.")
-            except Exception as e_notify_expire:
-                logger.error(f"Failed to notify user {user_id} about expired payment {payment_id} (main_tx_id {main_tx_id}): {e_notify_expire}")
+        try:
+            main_tx_details = db_utils.get_transaction_by_id(main_tx_id)
+            if main_tx_details:
+                type_escaped = escape_md(main_tx_details['type'].replace('_', ' ').title())
+                _queue_user_notification(bot_instance, user_id,
+                    f"⚠️ Your payment attempt \\(Order \\#{main_tx_id}, Type: {type_escaped}\\) for address `{escape_md(address)}` has expired {expiry_notification_suffix} "
+                    f"Please try again or contact support if you believe this is an error\\.",
+                    parse_mode="MarkdownV2"
+                )
+                logger.info(f"Queued notification for user {user_id} about expired payment {payment_id} for main_tx_id {main_tx_id}.")
+            else:
+                logger.warning(f"Could not fetch main_tx_details for {main_tx_id} to notify user {user_id} about expired payment {payment_id}.")
+        except Exception as e_notify_expire:
+            logger.error(f"Failed to notify user {user_id} about expired payment {payment_id} (main_tx_id {main_tx_id}): {e_notify_expire}")
 
     logger.info("Finished expire_stale_monitoring_payments cycle.")
 
 def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | None]:
+    """
+    Checks one payment against the blockchain API right now. This blocks on network I/O, so Telegram
+    handlers should go through submit_on_demand_check() instead of calling it directly.
+    """
     logger.info(f"On-demand check initiated for transaction_id: {transaction_id}")
     pending_payment = db_utils.get_pending_payment_by_transaction_id(transaction_id)
 
@@ -348,7 +644,6 @@ def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | Non
 
     payment_id = pending_payment['payment_id']
     current_status = pending_payment['status']
-    current_db_confirmations = pending_payment['confirmations']
     current_db_blockchain_tx_id = pending_payment['blockchain_tx_id']
 
     if current_status not in ['monitoring', 'underpaid']:
@@ -359,6 +654,8 @@ def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | Non
     if datetime.datetime.utcnow() >= expires_at_dt and current_status == 'monitoring':
         logger.info(f"On-demand check: Payment {payment_id} (tx: {transaction_id}) has expired. Updating status.")
         db_utils.update_pending_payment_status(payment_id, 'expired')
+        address_recycling.register_expired_invoice_address(pending_payment)
+        item_reservations.release(transaction_id=transaction_id)
         status_to_set = 'failed_expired_notfound'
         if current_db_blockchain_tx_id: status_to_set = 'failed_expired_unconfirmed'
         db_utils.update_transaction_status(transaction_id, status_to_set)
@@ -366,104 +663,118 @@ def check_specific_pending_payment(transaction_id: int) -> tuple[bool, str | Non
 
     address = pending_payment['address']
     coin_symbol = pending_payment['coin_symbol']
-    expected_amount_str = pending_payment['expected_crypto_amount']
-    created_at_dt = datetime.datetime.fromisoformat(pending_payment['created_at'])
-
-    logger.debug(f"On-demand check: Performing blockchain API call for payment_id: {payment_id}, address: {address}, coin: {coin_symbol}")
 
-    api_call_delay = getattr(config, 'BLOCKCHAIN_API_CALL_DELAY_SECONDS', 2.0)
-    time.sleep(api_call_delay / 2 if api_call_delay > 1 else 0.5)
+    # Take the same lease the monitor workers use, so the on-demand check never races a scheduled one.
+    lease_owner = f"{MONITOR_WORKER_ID_PREFIX}:on-demand:{threading.get_ident()}"
+    if not db_utils.try_lease_pending_payment(payment_id, lease_owner, PAYMENT_LEASE_SECONDS):
+        logger.info(f"On-demand check: Payment {payment_id} (tx: {transaction_id}) is being checked by a monitor worker right now. Returning current status.")
+        return False, current_status
 
+    logger.debug(f"On-demand check: Performing blockchain API call for payment_id: {payment_id}, address: {address}, coin: {coin_symbol}")
 
-    api_transactions = []
     try:
-        if coin_symbol == "BTC":
-            api_transactions = blockchain_apis.get_address_transactions_btc(address)
-        elif coin_symbol == "LTC":
-            api_transactions = blockchain_apis.get_address_transactions_ltc(address)
-        elif coin_symbol == "USDT_TRX":
-            since_ts_ms = int(created_at_dt.timestamp() * 1000) - (60 * 1000 * 5)
-            api_transactions = blockchain_apis.get_trc20_transfers_usdt_trx(address, since_timestamp_ms=since_ts_ms)
-        else: # Should be caught by earlier validation
-            logger.error(f"On-demand check: Unsupported coin_symbol '{coin_symbol}' for payment_id {payment_id}.")
-            return False, 'error_config'
-    except BlockchainAPIError as e_api:
-        _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_api)
-        return False, 'error_api' # Return a generic API error status for the caller
-    except Exception as e_generic:
-        _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_generic)
-        return False, 'error_api'
-
-
-    if not api_transactions:
-        logger.info(f"On-demand check: No transactions found from API for address {address} ({coin_symbol}), payment_id {payment_id}.")
-        db_utils.update_pending_payment_check_details(payment_id, current_db_confirmations)
-        return False, current_status
+        try:
+            api_transactions = _fetch_api_transactions(pending_payment)
+            if api_transactions is None: # Should be caught by earlier validation
+                logger.error(f"On-demand check: Unsupported coin_symbol '{coin_symbol}' for payment_id {payment_id}.")
+                return False, 'error_config'
+        except BlockchainAPIError as e_api:
+            _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_api)
+            return False, 'error_api' # Return a generic API error status for the caller
+        except Exception as e_generic:
+            _handle_api_error_for_payment_check(payment_id, address, coin_symbol, e_generic)
+            return False, 'error_api'
+
+        return _apply_api_transactions(pending_payment, api_transactions)
+    finally:
+        db_utils.release_pending_payment_leases(lease_owner, [payment_id])
+
+
+# --- On-demand ("Check Payment" button) checks ---
+# Checks run on a small thread pool instead of the Telegram polling thread. Concurrent clicks for the
+# same payment share one in-flight check, and recent results (from either an on-demand check or the
+# scheduled monitor) are served from a short-TTL cache without touching the blockchain API.
+ON_DEMAND_CHECK_WORKERS = getattr(config, 'ON_DEMAND_CHECK_WORKERS', 4)
+CHECK_RESULT_CACHE_SECONDS = getattr(config, 'PAYMENT_CHECK_RESULT_CACHE_SECONDS', 15)
+
+_on_demand_executor = ThreadPoolExecutor(max_workers=ON_DEMAND_CHECK_WORKERS, thread_name_prefix="payment-check")
+_inflight_checks = {} # {transaction_id: Future}
+_inflight_checks_lock = threading.Lock()
+_check_result_cache = {} # {transaction_id: {"result": (newly_confirmed, status), "checked_at": timestamp}}
+_check_result_cache_lock = threading.Lock()
+
+
+def _cache_check_result(transaction_id: int, newly_confirmed: bool, status: str | None):
+    """Caches a check result. The confirmation is only "new" for whoever ran the check, so cached
+    readers always get newly_confirmed=False and just see the status."""
+    if status == 'error_api': # Never cache transient failures
+        return
+    with _check_result_cache_lock:
+        _check_result_cache[transaction_id] = {"result": (False, status), "checked_at": time.time()}
 
-    logger.debug(f"On-demand check: Found {len(api_transactions)} API transactions for address {address} ({coin_symbol}).")
 
-    newly_confirmed_this_check = False
-    status_after_check = current_status
+def get_cached_check_result(transaction_id: int) -> tuple[bool, str | None] | None:
+    """Returns a check result younger than CHECK_RESULT_CACHE_SECONDS, or None."""
+    with _check_result_cache_lock:
+        entry = _check_result_cache.get(transaction_id)
+        if entry and time.time() - entry["checked_at"] > CHECK_RESULT_CACHE_SECONDS:
+            del _check_result_cache[transaction_id]
+            entry = None
+    metrics.record_cache_lookup('payment_check_result', entry is not None)
+    return entry["result"] if entry else None
 
-    for tx_data_from_api in api_transactions:
-        tx_confirmations_api = tx_data_from_api.get('confirmations', 0)
-        blockchain_tx_id_api = tx_data_from_api.get('txid')
 
-        amount_key_map = {"BTC": "amount_satoshi", "LTC": "amount_litoshi", "USDT_TRX": "amount_smallest_unit"}
-        amount_key = amount_key_map.get(coin_symbol)
-        if not amount_key: continue
-        received_amount_smallest_unit_api_str = tx_data_from_api.get(amount_key)
+def _run_on_demand_check(transaction_id: int) -> tuple[bool, str | None]:
+    result = check_specific_pending_payment(transaction_id)
+    _cache_check_result(transaction_id, *result)
+    return result
 
-        if not received_amount_smallest_unit_api_str or not blockchain_tx_id_api:
-            continue
 
-        try:
-            received_decimal_api = Decimal(received_amount_smallest_unit_api_str)
-            expected_decimal_db = Decimal(expected_amount_str)
-        except InvalidOperation:
-            continue
+def _forget_inflight_check(transaction_id: int, future: Future):
+    with _inflight_checks_lock:
+        if _inflight_checks.get(transaction_id) is future:
+            del _inflight_checks[transaction_id]
 
-        if current_db_blockchain_tx_id and current_db_blockchain_tx_id == blockchain_tx_id_api:
-            db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
-            min_confs_needed = _get_min_confirmations(coin_symbol)
 
-            if tx_confirmations_api >= min_confs_needed:
-                if current_status == 'monitoring':
-                     if received_decimal_api >= expected_decimal_db:
-                        db_utils.update_pending_payment_status(payment_id, 'confirmed_unprocessed')
-                        newly_confirmed_this_check = True
-                        status_after_check = 'confirmed_unprocessed'
-                     else:
-                        db_utils.update_pending_payment_status(payment_id, 'underpaid')
-                        status_after_check = 'underpaid'
-                elif current_status == 'underpaid':
-                    status_after_check = 'underpaid'
+def _invoke_on_complete(on_complete, transaction_id: int, future: Future):
+    try:
+        result = future.result()
+    except Exception as e:
+        logger.exception(f"On-demand check for transaction_id {transaction_id} failed: {e}")
+        result = (False, 'error_api')
+    try:
+        on_complete(result)
+    except Exception as e:
+        logger.exception(f"On-demand check completion callback failed for transaction_id {transaction_id}: {e}")
+
+
+def submit_on_demand_check(transaction_id: int, on_complete=None) -> Future:
+    """
+    Schedules a non-blocking check for one payment and returns a Future resolving to
+    (newly_confirmed, status). `on_complete(result)` is called when the result is ready,
+    on a worker thread (or immediately on the caller's thread for cached results).
+    """
+    cached_result = get_cached_check_result(transaction_id)
+    if cached_result is not None:
+        logger.debug(f"On-demand check for transaction_id {transaction_id} served from cache: {cached_result}")
+        future = Future()
+        future.set_result(cached_result)
+    else:
+        with _inflight_checks_lock:
+            future = _inflight_checks.get(transaction_id)
+            if future is None:
+                future = _on_demand_executor.submit(_run_on_demand_check, transaction_id)
+                _inflight_checks[transaction_id] = future
+                created = True
             else:
-                status_after_check = 'monitoring_updated' if current_status == 'monitoring' else 'underpaid'
-            break
-
-        elif not current_db_blockchain_tx_id:
-            if received_decimal_api >= expected_decimal_db:
-                min_confs_needed = _get_min_confirmations(coin_symbol)
-                db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
-                if tx_confirmations_api >= min_confs_needed:
-                    db_utils.update_pending_payment_status(payment_id, 'confirmed_unprocessed')
-                    newly_confirmed_this_check = True
-                    status_after_check = 'confirmed_unprocessed'
-                else:
-                    status_after_check = 'monitoring_updated'
-                break
-            elif received_decimal_api > 0:
-                logger.warning(f"On-demand check: Potential UNDERPAYMENT for payment_id {payment_id}. Expected: {expected_decimal_db}, Received: {received_decimal_api} in tx {blockchain_tx_id_api}.")
-                db_utils.update_pending_payment_check_details(payment_id, tx_confirmations_api, str(received_decimal_api), blockchain_tx_id_api)
-                db_utils.update_pending_payment_status(payment_id, 'underpaid')
-                status_after_check = 'underpaid'
-                break
-
-    if not newly_confirmed_this_check and status_after_check == current_status :
-        db_utils.update_pending_payment_check_details(payment_id, current_db_confirmations)
-
-    return newly_confirmed_this_check, status_after_check
+                logger.info(f"On-demand check for transaction_id {transaction_id} already in flight. Joining it.")
+                created = False
+        if created:
+            future.add_done_callback(lambda f: _forget_inflight_check(transaction_id, f))
+
+    if on_complete is not None:
+        future.add_done_callback(lambda f: _invoke_on_complete(on_complete, transaction_id, f))
+    return future
 
 
 if __name__ == '__main__':
@@ -1,10 +1,14 @@
 import os
 import shutil
 import glob
+import threading
 import uuid
 from datetime import datetime
 import logging
 
+from modules import catalog_index
+from modules import item_reservations
+
 logger = logging.getLogger(__name__)
 
 # Import config to use ITEMS_BASE_DIR
@@ -22,78 +26,52 @@ except ImportError:
 os.makedirs(BASE_PRODUCT_DIR, exist_ok=True)
 os.makedirs(PURCHASED_ITEMS_DIR, exist_ok=True)
 
+# Browsing is answered from the in-memory catalog index (modules/catalog_index.py); the functions
+# below that add or move instances keep it up to date.
+
+_price_cache = {} # Instance path -> price from its description.txt (None if unreadable)
+_price_cache_lock = threading.Lock()
+
 def get_available_cities():
-    """Scans the base product directory and returns a list of city names."""
-    try:
-        if not os.path.exists(BASE_PRODUCT_DIR) or not os.path.isdir(BASE_PRODUCT_DIR):
-            logger.warning(f"Base product directory {BASE_PRODUCT_DIR} does not exist or is not a directory.")
-            return []
-        return [d for d in os.listdir(BASE_PRODUCT_DIR) if os.path.isdir(os.path.join(BASE_PRODUCT_DIR, d))]
-    except Exception as e:
-        logger.exception(f"Error listing cities from {BASE_PRODUCT_DIR}: {e}")
-        return []
+    """Returns a list of city names in the catalog."""
+    return catalog_index.get_children()
 
 def get_available_areas(city_name):
-    """Scans a city directory and returns a list of area names."""
-    city_path = os.path.join(BASE_PRODUCT_DIR, city_name)
-    try:
-        return [d for d in os.listdir(city_path) if os.path.isdir(os.path.join(city_path, d))]
-    except FileNotFoundError:
-        logger.warning(f"City directory {city_path} not found.")
-        return []
-    except Exception as e:
-        logger.exception(f"Error listing areas for city {city_name}: {e}")
-        return []
+    """Returns a list of area names for a city."""
+    return catalog_index.get_children(city_name)
 
 def get_available_item_types(city_name, area_name):
-    """Scans an area directory and returns a list of item type names."""
-    area_path = os.path.join(BASE_PRODUCT_DIR, city_name, area_name)
-    try:
-        return [d for d in os.listdir(area_path) if os.path.isdir(os.path.join(area_path, d))]
-    except FileNotFoundError:
-        logger.warning(f"Area directory {area_path} not found.")
-        return []
-    except Exception as e:
-        logger.exception(f"Error listing item types for {city_name}/{area_name}: {e}")
-        return []
+    """Returns a list of item type names for an area."""
+    return catalog_index.get_children(city_name, area_name)
 
 def get_available_sizes(city_name, area_name, item_type_name):
-    """Scans an item type directory and returns a list of size names."""
-    item_type_path = os.path.join(BASE_PRODUCT_DIR, city_name, area_name, item_type_name)
-    try:
-        return [d for d in os.listdir(item_type_path) if os.path.isdir(os.path.join(item_type_path, d))]
-    except FileNotFoundError:
-        logger.warning(f"Item type directory {item_type_path} not found.")
-        return []
-    except Exception as e:
-        logger.exception(f"Error listing sizes for {city_name}/{area_name}/{item_type_name}: {e}")
-        return []
+    """Returns a list of size names for an item type."""
+    return catalog_index.get_children(city_name, area_name, item_type_name)
+
+# Buyer-facing variants: only branches with at least one available instance, as (name, instance count).
+# Instances reserved by other buyers (modules/item_reservations.py) are not counted; pass the buyer's
+# user_id so their own selection hold, which picking the size again reuses, still counts as available.
+# The admin add-item flow keeps using the get_available_* functions above, which include empty folders.
+
+def get_cities_in_stock(user_id=None):
+    return catalog_index.get_children_in_stock(reserved=item_reservations.get_reserved_counts(user_id))
+
+def get_areas_in_stock(city_name, user_id=None):
+    return catalog_index.get_children_in_stock(city_name, reserved=item_reservations.get_reserved_counts(user_id))
+
+def get_item_types_in_stock(city_name, area_name, user_id=None):
+    return catalog_index.get_children_in_stock(city_name, area_name, reserved=item_reservations.get_reserved_counts(user_id))
+
+def get_sizes_in_stock(city_name, area_name, item_type_name, user_id=None):
+    return catalog_index.get_children_in_stock(city_name, area_name, item_type_name, reserved=item_reservations.get_reserved_counts(user_id))
 
 def get_oldest_available_item_instance(city_name, area_name, item_type_name, size_name):
     """
-    Scans a size directory for instance folders and returns the path to the oldest one.
-    Oldest is determined by folder creation time.
+    Returns the path to the oldest instance folder of a size, or None.
+    Oldest is the lowest sequence number in the size's manifest (see catalog_index), i.e. the first added.
+    Reservations are not taken into account; buyers go through item_reservations.reserve_oldest_instance.
     """
-    size_path = os.path.join(BASE_PRODUCT_DIR, city_name, area_name, item_type_name, size_name)
-    try:
-        instance_folders = [os.path.join(size_path, d) for d in os.listdir(size_path)
-                            if os.path.isdir(os.path.join(size_path, d))]
-        if not instance_folders:
-            return None
-
-        # Sort by creation time (oldest first)
-        # os.path.getctime might vary based on OS and filesystem nuances for directories.
-        # A more robust way if strict ordering is needed is to embed timestamp in folder name.
-        # For now, using ctime.
-        instance_folders.sort(key=lambda x: os.path.getctime(x))
-        return instance_folders[0]
-
-    except FileNotFoundError:
-        logger.warning(f"Size directory {size_path} not found.")
-        return None
-    except Exception as e:
-        logger.exception(f"Error getting oldest instance for {size_path}: {e}")
-        return None
+    return catalog_index.get_oldest_instance(city_name, area_name, item_type_name, size_name)
 
 def get_item_instance_details(instance_path):
     """
@@ -141,6 +119,31 @@ def get_item_instance_details(instance_path):
             'image_paths': []
         }
 
+def _read_instance_price(instance_path) -> float | None:
+    desc_file_path = os.path.join(instance_path, "description.txt")
+    try:
+        with open(desc_file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.lower().startswith("price:"):
+                    return float(line.split(":")[1].strip())
+    except (OSError, ValueError, IndexError) as e:
+        logger.warning(f"Could not read price from {desc_file_path}: {e}")
+    return None
+
+def get_catalog_prices() -> set[float]:
+    """
+    Distinct prices of all available item instances. Instances come from the catalog index and each
+    description.txt is read once; the price is cached until the instance leaves the index.
+    """
+    instance_paths = catalog_index.get_all_instances()
+    with _price_cache_lock:
+        for stale_path in _price_cache.keys() - set(instance_paths):
+            del _price_cache[stale_path]
+        for instance_path in instance_paths:
+            if instance_path not in _price_cache:
+                _price_cache[instance_path] = _read_instance_price(instance_path)
+        return {price for price in _price_cache.values() if price is not None}
+
 def move_item_instance_to_purchased(instance_path, user_id):
     """Moves an item instance folder to the purchased items directory for the user."""
     if not os.path.isdir(instance_path):
@@ -157,6 +160,7 @@ def move_item_instance_to_purchased(instance_path, user_id):
         destination_path = os.path.join(user_purchase_dir, new_instance_name)
 
         shutil.move(instance_path, destination_path)
+        catalog_index.remove_instance(instance_path)
         logger.info(f"Moved {instance_path} to {destination_path}")
         return True
     except Exception as e:
@@ -165,7 +169,8 @@ def move_item_instance_to_purchased(instance_path, user_id):
 
 def add_item_instance(city, area, item_type, size, price: float, images: list[tuple[str, bytes]], description: str):
     """
-    Adds a new item instance to the filesystem.
+    Adds a new item instance to the filesystem. The catalog index gives it the next sequence number
+    of its size, so it is sold after every instance added before it.
     Images is a list of (original_filename, file_bytes).
     """
     instance_folder_name = str(uuid.uuid4()) # Unique folder name for the instance
@@ -190,6 +195,7 @@ def add_item_instance(city, area, item_type, size, price: float, images: list[tu
             with open(image_path, 'wb') as f:
                 f.write(file_bytes)
 
+        catalog_index.add_instance(instance_path)
         logger.info(f"Successfully added new item instance to {instance_path}")
         return instance_path
 
@@ -235,13 +241,7 @@ if __name__ == '__main__':
     added_path2 = add_item_instance(test_city, test_area, test_type, test_size, 12.50, [("img.jpeg", dummy_image_bytes)], "Another item.")
     if added_path2:
         logger.info(f"Second item added to: {added_path2}")
-        # Make this one seem older for testing get_oldest_available_item_instance
-        # This is tricky as ctime is hard to modify directly.
-        # For real testing, folder names with timestamps would be better.
-        # We'll rely on the order of creation for this simple test.
-        if os.path.exists(added_path) and os.path.exists(added_path2) and added_path != added_path2:
-             # Ensure added_path is older by touching it with an older timestamp (platform dependent)
-            pass
+        # The index orders instances by the sequence add_item_instance assigned, so added_path comes first.
 
 
     # Test listing functions
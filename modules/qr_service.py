@@ -0,0 +1,110 @@
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import quote_plus
+
+import config
+from modules import hd_wallet_utils
+from modules import image_utils
+from modules import metrics
+
+logger = logging.getLogger(__name__)
+
+# Renders payment QR codes in memory. Recent renders are kept in a bounded LRU keyed by payment URI, so
+# re-showing an invoice (or the same deposit address) does not re-encode the image, and nothing is
+# written to disk. Telegram gets a fresh BytesIO over the cached PNG bytes for every send.
+
+QR_CACHE_MAX_ENTRIES = getattr(config, 'QR_CACHE_MAX_ENTRIES', 256)
+LEGACY_QR_CODE_DIR = os.path.join("assets", "qr_codes") # Where invoice QR files used to be written
+LEGACY_QR_CLEANUP_MARKER = os.path.join("assets", ".legacy_qr_codes_removed") # Written once the cleanup has run
+
+_cache = OrderedDict() # payment URI -> PNG bytes, least recently used first
+_cache_lock = threading.Lock()
+
+
+def build_payment_uri(address: str, crypto_amount: str | None = None, coin_symbol: str | None = None, message: str | None = None) -> str:
+    """
+    Payment URI for a wallet QR code, e.g. bitcoin:address?amount=0.1. Coins without a known URI scheme
+    (including the display symbol 'USDT') get the bare address, as amount parameters are not portable there.
+    """
+    if coin_symbol not in hd_wallet_utils.COIN_MAP:
+        return address
+    payment_uri = f"{hd_wallet_utils.COIN_MAP[coin_symbol]['uri_prefix']}:{address}"
+    params = []
+    if crypto_amount:
+        params.append(f"amount={crypto_amount}")
+    if message:
+        params.append(f"message={quote_plus(message)}")
+    if params:
+        payment_uri += "?" + "&".join(params)
+    return payment_uri
+
+
+def render_qr_png(payment_uri: str) -> bytes | None:
+    """PNG bytes of the QR code for payment_uri, from the LRU cache when recently rendered. None on failure."""
+    if not payment_uri:
+        return None
+    with _cache_lock:
+        png_bytes = _cache.get(payment_uri)
+        if png_bytes is not None:
+            _cache.move_to_end(payment_uri)
+    metrics.record_cache_lookup('qr_png', png_bytes is not None)
+    if png_bytes is not None:
+        return png_bytes
+
+    image_stream = image_utils.generate_qr_code_image(payment_uri)
+    if image_stream is None:
+        return None
+    png_bytes = image_stream.getvalue()
+    with _cache_lock:
+        _cache[payment_uri] = png_bytes
+        _cache.move_to_end(payment_uri)
+        while len(_cache) > QR_CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return png_bytes
+
+
+def get_payment_qr(address: str, crypto_amount: str | None = None, coin_symbol: str | None = None, message: str | None = None) -> io.BytesIO | None:
+    """QR code for an address/amount as a byte stream ready for send_photo, or None if it could not be rendered."""
+    if not address:
+        logger.warning("get_payment_qr called with no address.")
+        return None
+    png_bytes = render_qr_png(build_payment_uri(address, crypto_amount, coin_symbol, message))
+    return io.BytesIO(png_bytes) if png_bytes is not None else None
+
+
+def cleanup_legacy_qr_files(directory: str = LEGACY_QR_CODE_DIR, marker_path: str = LEGACY_QR_CLEANUP_MARKER) -> int:
+    """
+    One-off migration: deletes the invoice QR PNGs older versions left in assets/qr_codes. Returns the number
+    removed. A marker file records a clean pass, so later startups skip the directory scan.
+    """
+    if os.path.exists(marker_path):
+        return 0
+    removed = 0
+    failed = 0
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if not (filename.startswith("qr_") and filename.endswith(".png")):
+                continue
+            try:
+                os.remove(os.path.join(directory, filename))
+                removed += 1
+            except OSError as e:
+                failed += 1
+                logger.error(f"Could not remove legacy QR code file {filename}: {e}")
+        try:
+            os.rmdir(directory) # Only succeeds if nothing else is stored there
+        except OSError:
+            pass
+    if removed:
+        logger.info(f"Removed {removed} legacy QR code file(s) from {directory}.")
+    if not failed: # Retry on the next startup if some files could not be removed
+        try:
+            os.makedirs(os.path.dirname(marker_path) or ".", exist_ok=True)
+            with open(marker_path, "w") as marker_file:
+                marker_file.write("Legacy invoice QR code files removed; delete this file to run the cleanup again.\n")
+        except OSError as e:
+            logger.warning(f"Could not write the legacy QR cleanup marker {marker_path}: {e}")
+    return removed
@@ -0,0 +1,115 @@
+import logging
+import threading
+from decimal import Decimal, InvalidOperation
+
+import config
+from modules import exchange_rate_utils
+from modules import metrics
+from modules import payment_invoicing
+from modules import product_fs_utils
+
+logger = logging.getLogger(__name__)
+
+# Price matrix: the crypto amount of every distinct catalog price (plus SERVICE_FEE_EUR) in every payment
+# coin, rebuilt whenever the exchange rates change. Item screens can then show crypto prices with a
+# dictionary lookup, and invoices reuse the same amount instead of dividing again.
+#
+# Amounts are computed with integer arithmetic on each rate's exact ratio (one multiply and one floor
+# division per price), and match payment_invoicing.quote_crypto_amount exactly: EUR / rate, rounded up to
+# the coin's smallest unit. Amounts not in the matrix (partial payments from balance, top-ups, items added
+# since the last rebuild) are computed on the spot with the same function.
+
+QUOTE_COINS = ("BTC", "LTC", "USDT")
+CENT = Decimal('0.01')
+
+_matrix = {'rates': {}, 'quotes': {}} # rates: {coin: {'rate', 'rate_id', 'fetched_at'}}; quotes: {(eur_cents, coin): smallest units}
+_matrix_lock = threading.Lock()
+_rebuild_lock = threading.Lock()
+
+
+def get_service_fee_eur() -> Decimal:
+    try:
+        return Decimal(str(config.SERVICE_FEE_EUR))
+    except (AttributeError, ValueError, TypeError, InvalidOperation):
+        logger.critical(f"SERVICE_FEE_EUR ('{getattr(config, 'SERVICE_FEE_EUR', 'NOT SET')}') is not a valid Decimal. Defaulting to 0.0.")
+        return Decimal('0.0')
+
+
+def _to_cents(amount_eur: Decimal) -> int | None:
+    """Whole cents, or None if the amount has finer precision (it is then quoted directly)."""
+    cents = amount_eur * 100
+    return int(cents) if cents == cents.to_integral_value() else None
+
+
+def _quote_column(amounts_cents: list[int], rate: Decimal, decimals: int) -> list[int]:
+    """Smallest units for many EUR amounts at one rate: ceil(cents * 10^decimals / (100 * rate)) each."""
+    rate_numerator, rate_denominator = rate.as_integer_ratio()
+    numerator_factor = rate_denominator * 10 ** decimals
+    denominator = 100 * rate_numerator
+    return [-(-(cents * numerator_factor) // denominator) for cents in amounts_cents]
+
+
+def rebuild_price_matrix() -> int:
+    """Recomputes the matrix from the catalog and the cached rates. Returns the number of entries."""
+    with _rebuild_lock:
+        service_fee = get_service_fee_eur()
+        amounts_cents = sorted({cents for cents in (_to_cents((Decimal(str(price)) + service_fee).quantize(CENT))
+                                                    for price in product_fs_utils.get_catalog_prices() if price > 0)
+                                if cents})
+        rates = {coin: entry for coin, entry in exchange_rate_utils.get_cached_rates().items() if coin in QUOTE_COINS}
+        quotes = {}
+        for coin, entry in rates.items():
+            decimals = payment_invoicing.get_payment_coin_details(coin)['decimals']
+            quotes.update(zip(((cents, coin) for cents in amounts_cents), _quote_column(amounts_cents, entry['rate'], decimals)))
+        with _matrix_lock:
+            _matrix['rates'] = rates
+            _matrix['quotes'] = quotes
+    logger.info(f"Price matrix rebuilt: {len(amounts_cents)} price(s) x {len(rates)} coin(s).")
+    return len(quotes)
+
+
+def get_quote(amount_eur, crypto_currency: str, fetch: bool = True) -> dict | None:
+    """
+    Crypto amount due for amount_eur: {'amount_hr': Decimal, 'amount_smallest_unit': int, 'rate': Decimal,
+    'rate_id': int | None}, or None if no usable rate is available. With fetch=False (display only) a missing
+    rate is not fetched.
+    """
+    rate_quote = exchange_rate_utils.get_rate_quote("EUR", crypto_currency, fetch=fetch)
+    if not rate_quote:
+        return None
+    coin = "USDT" if "USDT" in crypto_currency.upper() else crypto_currency.upper()
+    decimals = payment_invoicing.get_payment_coin_details(coin)['decimals']
+    amount_eur = Decimal(str(amount_eur))
+    cents = _to_cents(amount_eur)
+
+    amount_smallest_unit = None
+    with _matrix_lock:
+        matrix_rate = _matrix['rates'].get(coin)
+        if matrix_rate and matrix_rate['rate'] == rate_quote['rate'] and matrix_rate['fetched_at'] == rate_quote['fetched_at']:
+            amount_smallest_unit = _matrix['quotes'].get((cents, coin))
+    metrics.record_cache_lookup('price_matrix', amount_smallest_unit is not None)
+    if amount_smallest_unit is None:
+        amount_smallest_unit = payment_invoicing.quote_smallest_units(amount_eur, rate_quote['rate'], decimals)
+
+    return {
+        'amount_hr': Decimal(amount_smallest_unit).scaleb(-decimals),
+        'amount_smallest_unit': amount_smallest_unit,
+        'rate': rate_quote['rate'],
+        'rate_id': rate_quote['rate_id'],
+    }
+
+
+def get_display_amounts(amount_eur) -> dict:
+    """{coin: amount_hr} for the coins that currently have a rate, for showing prices on item screens."""
+    amounts = {}
+    for coin in QUOTE_COINS:
+        quote = get_quote(amount_eur, coin, fetch=False)
+        if quote:
+            amounts[coin] = quote['amount_hr']
+    return amounts
+
+
+def start():
+    """Builds the matrix and keeps it in step with rate refreshes."""
+    exchange_rate_utils.register_refresh_listener(rebuild_price_matrix)
+    rebuild_price_matrix()
@@ -0,0 +1,306 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from decimal import Decimal, InvalidOperation
+
+import requests
+
+import config
+from modules import http_client
+from modules import metrics
+
+logger = logging.getLogger(__name__)
+
+# Exchange rate sources for modules/exchange_rate_utils.py. Every enabled source is asked for all coins
+# concurrently. Once RATE_SOURCE_QUORUM sources have answered, the rest get RATE_SOURCE_QUORUM_GRACE_SECONDS
+# more; nothing waits past RATE_SOURCE_DEADLINE_SECONDS, so one slow or rate-limiting source does not hold
+# up pricing. Per coin, quotes further than RATE_SOURCE_MAX_DEVIATION from the median are rejected as
+# outliers and the remaining quotes are combined with a weighted median.
+#
+# Each source's health is tracked as moving averages of its latency and error rate; the weight of its
+# quotes drops as either grows. A source that answers 429 (or keeps failing) is skipped for a cool-down
+# period. A source is a function (symbols, vs_currency) -> {symbol: Decimal} registered in RATE_SOURCES;
+# the base URLs are configurable so the public tickers can be replaced by local stubs
+# (tools/fake_rate_provider.py).
+
+COINGECKO_API_BASE_URL = getattr(config, 'COINGECKO_API_BASE_URL', "https://api.coingecko.com/api/v3")
+KRAKEN_API_BASE_URL = getattr(config, 'KRAKEN_API_BASE_URL', "https://api.kraken.com/0/public")
+COINBASE_API_BASE_URL = getattr(config, 'COINBASE_API_BASE_URL', "https://api.coinbase.com/v2")
+
+RATE_SOURCES_ENABLED = tuple(getattr(config, 'RATE_SOURCES_ENABLED', ('coingecko', 'kraken', 'coinbase')))
+RATE_SOURCE_QUORUM = getattr(config, 'RATE_SOURCE_QUORUM', 2)
+RATE_SOURCE_QUORUM_GRACE_SECONDS = getattr(config, 'RATE_SOURCE_QUORUM_GRACE_SECONDS', 0.5)
+RATE_SOURCE_DEADLINE_SECONDS = getattr(config, 'RATE_SOURCE_DEADLINE_SECONDS', 5)
+RATE_SOURCE_MAX_DEVIATION = Decimal(str(getattr(config, 'RATE_SOURCE_MAX_DEVIATION', 0.02))) # 2% from the median
+RATE_SOURCE_REQUEST_TIMEOUT_SECONDS = 10 # Per request; the aggregate deadline above is what callers wait for
+RATE_SOURCE_COOLDOWN_SECONDS = 60 # Skip a source this long after a 429 (or Retry-After, if longer)
+RATE_SOURCE_MAX_CONSECUTIVE_FAILURES = 3 # ...or after this many failures in a row
+HEALTH_SMOOTHING = 0.2 # Weight of the newest sample in the moving averages
+LATENCY_REFERENCE_SECONDS = 1.0 # A source averaging this latency gets half the weight of an instant one
+
+COINGECKO_COIN_IDS = {
+    "BTC": "bitcoin",
+    "LTC": "litecoin",
+    "USDT": "tether", # Used for USDT_TRX as well
+}
+KRAKEN_PAIRS = { # symbol: (request pair, key in the response)
+    "BTC": ("XBTEUR", "XXBTZEUR"),
+    "LTC": ("LTCEUR", "XLTCZEUR"),
+    "USDT": ("USDTEUR", "USDTEUR"),
+}
+
+SOURCE_REQUESTS = metrics.counter('bot_rate_source_requests_total', 'Exchange rate source requests by source and result.', ('source', 'result'))
+SOURCE_REQUEST_SECONDS = metrics.histogram('bot_rate_source_request_seconds', 'Exchange rate source latency by source.', ('source',))
+
+
+class RateSourceError(Exception):
+    """A source answered with something other than usable rates."""
+
+
+class RateSourceRateLimitedError(RateSourceError):
+    def __init__(self, message: str, retry_after_seconds: float = None):
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
+
+def _get_json(url: str, params: dict = None) -> dict:
+    try:
+        return http_client.get(url, params=params, timeout=RATE_SOURCE_REQUEST_TIMEOUT_SECONDS).json()
+    except requests.exceptions.HTTPError as http_err:
+        response = http_err.response
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get('Retry-After')
+            raise RateSourceRateLimitedError(f"Rate limited by {url}",
+                                             float(retry_after) if retry_after and retry_after.isdigit() else None) from http_err
+        raise
+
+
+def _to_decimal(value) -> Decimal | None:
+    try:
+        rate = Decimal(str(value))
+    except (InvalidOperation, TypeError):
+        return None
+    return rate if rate.is_finite() and rate > 0 else None
+
+
+def fetch_coingecko(symbols: list[str], vs_currency: str) -> dict:
+    ids = {COINGECKO_COIN_IDS[symbol]: symbol for symbol in symbols if symbol in COINGECKO_COIN_IDS}
+    data = _get_json(f"{COINGECKO_API_BASE_URL}/simple/price", {'ids': ",".join(sorted(ids)), 'vs_currencies': vs_currency.lower()})
+    rates = {}
+    for coingecko_id, symbol in ids.items():
+        rate = _to_decimal((data.get(coingecko_id) or {}).get(vs_currency.lower()))
+        if rate is not None:
+            rates[symbol] = rate
+    return rates
+
+
+def fetch_kraken(symbols: list[str], vs_currency: str) -> dict:
+    if vs_currency != "EUR":
+        return {} # KRAKEN_PAIRS only lists EUR pairs
+    pairs = {symbol: KRAKEN_PAIRS[symbol] for symbol in symbols if symbol in KRAKEN_PAIRS}
+    data = _get_json(f"{KRAKEN_API_BASE_URL}/Ticker", {'pair': ",".join(request_pair for request_pair, _ in pairs.values())})
+    if data.get('error'):
+        raise RateSourceError(f"Kraken returned errors: {data['error']}")
+    result = data.get('result') or {}
+    rates = {}
+    for symbol, (request_pair, response_key) in pairs.items():
+        ticker = result.get(response_key) or result.get(request_pair) or {}
+        rate = _to_decimal((ticker.get('c') or [None])[0]) # 'c' = [last trade price, lot volume]
+        if rate is not None:
+            rates[symbol] = rate
+    return rates
+
+
+def fetch_coinbase(symbols: list[str], vs_currency: str) -> dict:
+    data = _get_json(f"{COINBASE_API_BASE_URL}/exchange-rates", {'currency': vs_currency})
+    coin_per_vs = (data.get('data') or {}).get('rates') or {}
+    rates = {}
+    for symbol in symbols:
+        inverse = _to_decimal(coin_per_vs.get(symbol)) # Coinbase quotes coins per unit of vs_currency
+        if inverse is not None:
+            rates[symbol] = (Decimal(1) / inverse).quantize(Decimal('1e-8'))
+    return rates
+
+
+RATE_SOURCES = {
+    'coingecko': fetch_coingecko,
+    'kraken': fetch_kraken,
+    'coinbase': fetch_coinbase,
+}
+
+_health = {} # source name -> {'latency', 'error_rate', 'consecutive_failures', 'cooldown_until', 'last_error'}
+_health_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def register_rate_source(name: str, fetcher):
+    """Adds (or replaces) a source. It is used if its name is in RATE_SOURCES_ENABLED."""
+    RATE_SOURCES[name] = fetcher
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Extra threads so a source still hanging from the previous round does not block the next one
+            _executor = ThreadPoolExecutor(max_workers=max(4, len(RATE_SOURCES) * 2), thread_name_prefix="rate-source")
+        return _executor
+
+
+def _source_health(name: str) -> dict:
+    return _health.setdefault(name, {'latency': None, 'error_rate': 0.0, 'consecutive_failures': 0,
+                                     'cooldown_until': 0.0, 'last_error': None})
+
+
+def _record_result(name: str, elapsed: float, error: Exception = None):
+    with _health_lock:
+        health = _source_health(name)
+        health['latency'] = elapsed if health['latency'] is None else (1 - HEALTH_SMOOTHING) * health['latency'] + HEALTH_SMOOTHING * elapsed
+        health['error_rate'] = (1 - HEALTH_SMOOTHING) * health['error_rate'] + HEALTH_SMOOTHING * (1.0 if error else 0.0)
+        if error is None:
+            health['consecutive_failures'] = 0
+            return
+        health['consecutive_failures'] += 1
+        health['last_error'] = str(error)
+        if isinstance(error, RateSourceRateLimitedError):
+            health['cooldown_until'] = time.time() + max(RATE_SOURCE_COOLDOWN_SECONDS, error.retry_after_seconds or 0)
+        elif health['consecutive_failures'] >= RATE_SOURCE_MAX_CONSECUTIVE_FAILURES:
+            health['cooldown_until'] = time.time() + RATE_SOURCE_COOLDOWN_SECONDS
+
+
+def source_weight(name: str) -> float:
+    """Weight of a source's quotes: lower for sources with a high error rate or latency."""
+    with _health_lock:
+        health = _source_health(name)
+        latency = health['latency'] or 0.0
+        return max(0.05, 1.0 - health['error_rate']) / (1.0 + latency / LATENCY_REFERENCE_SECONDS)
+
+
+def _call_source(name: str, symbols: list[str], vs_currency: str) -> dict:
+    started = time.monotonic()
+    try:
+        rates = RATE_SOURCES[name](symbols, vs_currency)
+        if not rates:
+            raise RateSourceError(f"{name} returned no usable rates")
+    except Exception as e:
+        elapsed = time.monotonic() - started
+        _record_result(name, elapsed, e)
+        result = 'rate_limited' if isinstance(e, RateSourceRateLimitedError) else 'error'
+        SOURCE_REQUESTS.inc(name, result)
+        SOURCE_REQUEST_SECONDS.observe(elapsed, name)
+        logger.warning(f"Rate source {name} failed after {elapsed:.2f}s: {e}")
+        raise
+    elapsed = time.monotonic() - started
+    _record_result(name, elapsed)
+    SOURCE_REQUESTS.inc(name, 'ok')
+    SOURCE_REQUEST_SECONDS.observe(elapsed, name)
+    return rates
+
+
+def weighted_median(values: list[tuple[Decimal, float]]) -> Decimal:
+    """Weighted median of [(value, weight)]: the value where the cumulative weight first reaches half."""
+    ordered = sorted(values, key=lambda item: item[0])
+    half = sum(weight for _, weight in ordered) / 2
+    cumulative = 0.0
+    for value, weight in ordered:
+        cumulative += weight
+        if cumulative >= half:
+            return value
+    return ordered[-1][0]
+
+
+def aggregate_quotes(quotes: dict, reference_rate: Decimal = None, log_outliers: bool = True) -> tuple[Decimal, list[str]] | None:
+    """
+    Combines one coin's quotes {source: Decimal}. Quotes further than RATE_SOURCE_MAX_DEVIATION from the
+    plain median are dropped; the rest are combined with a weighted median. If no quote is close to the
+    median (two sources that disagree), reference_rate (the last accepted rate) decides instead.
+    Returns (rate, sources used) or None if no quote survives.
+    """
+    if not quotes:
+        return None
+    ordered = sorted(quotes.values())
+    middle = len(ordered) // 2
+    median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+    accepted = {name: rate for name, rate in quotes.items() if abs(rate - median) / median <= RATE_SOURCE_MAX_DEVIATION}
+    if not accepted and reference_rate:
+        median = reference_rate
+        accepted = {name: rate for name, rate in quotes.items() if abs(rate - median) / median <= RATE_SOURCE_MAX_DEVIATION}
+    if not accepted:
+        return None
+    for name in (quotes.keys() - accepted.keys()) if log_outliers else ():
+        logger.warning(f"Rejected outlier rate {quotes[name]} from {name} (median {median}).")
+    rate = weighted_median([(rate, source_weight(name)) for name, rate in accepted.items()])
+    return rate, sorted(accepted)
+
+
+def _quotes_agree(answered: dict, symbols: list[str]) -> bool:
+    """True if every symbol quoted by any answered source aggregates without rejecting a quote."""
+    for symbol in symbols:
+        quotes = {name: rates[symbol] for name, rates in answered.items() if symbol in rates}
+        result = aggregate_quotes(quotes, log_outliers=False)
+        if quotes and (result is None or len(result[1]) < len(quotes)):
+            return False
+    return True
+
+
+def fetch_rates(symbols: list[str], vs_currency: str, reference_rates: dict = None) -> dict:
+    """
+    Asks every enabled, non-cooling-down source concurrently and aggregates per coin. reference_rates
+    {symbol: Decimal} are the last accepted rates, used to settle disagreements between two sources.
+    Returns {symbol: (rate, [source names])}; coins no source could price are missing.
+    """
+    now = time.time()
+    with _health_lock:
+        names = [name for name in RATE_SOURCES_ENABLED if name in RATE_SOURCES and _source_health(name)['cooldown_until'] <= now]
+    if not names:
+        logger.error("No exchange rate source available (all disabled or cooling down).")
+        return {}
+
+    executor = _get_executor()
+    futures = {executor.submit(_call_source, name, symbols, vs_currency): name for name in names}
+    started = time.monotonic()
+    deadline = started + RATE_SOURCE_DEADLINE_SECONDS
+    quorum = min(RATE_SOURCE_QUORUM, len(names))
+    pending = set(futures)
+    answered = {}
+    quorum_reached_at = None
+    while pending:
+        timeout = deadline - time.monotonic()
+        if quorum_reached_at is not None:
+            timeout = min(timeout, RATE_SOURCE_QUORUM_GRACE_SECONDS - (time.monotonic() - quorum_reached_at))
+        if timeout <= 0:
+            break
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                answered[futures[future]] = future.result()
+                # Only start the grace period once the answers agree; otherwise wait for a tie-breaker
+                if quorum_reached_at is None and len(answered) >= quorum and _quotes_agree(answered, symbols):
+                    quorum_reached_at = time.monotonic()
+    if pending:
+        logger.info(f"Rate sources not waited for: {', '.join(sorted(futures[future] for future in pending))}.")
+
+    aggregated = {}
+    for symbol in symbols:
+        result = aggregate_quotes({name: rates[symbol] for name, rates in answered.items() if symbol in rates},
+                                  (reference_rates or {}).get(symbol))
+        if result is not None:
+            aggregated[symbol] = result
+    return aggregated
+
+
+def get_source_health() -> dict:
+    """Snapshot of each source's health and current weight, for logs and admin tooling."""
+    snapshot = {}
+    for name in RATE_SOURCES_ENABLED:
+        weight = source_weight(name)
+        with _health_lock:
+            snapshot[name] = dict(_source_health(name), weight=weight,
+                                  cooling_down=_source_health(name)['cooldown_until'] > time.time())
+    return snapshot
+
+
+metrics.gauge_function('bot_rate_source_weight', 'Current weight of each exchange rate source.',
+                       lambda: {(name,): health['weight'] for name, health in get_source_health().items()}, ('source',))
@@ -0,0 +1,190 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from modules import db_utils
+from modules import hd_wallet_utils
+from modules import blockchain_apis
+from modules.blockchain_apis import (
+    BlockchainAPIError, BlockchainAPIRateLimitError, BlockchainAPIUnavailableError, BlockchainAPITimeoutError,
+)
+from modules.address_recycling import HD_COIN_BY_PAYMENT_COIN
+from modules.deposit_addresses import AMOUNT_KEY_MAP, DISPLAY_COIN_BY_DEPOSIT_COIN
+from modules.payment_invoicing import smallest_units_to_display_amount
+
+logger = logging.getLogger(__name__)
+
+# Gap-limit account discovery over the bot's receiving chain (m/44'/coin'/0'/0/i), for recovering
+# hd_address_indices after it was lost or restored from an old backup.
+#
+# Addresses are derived in batches from the cached change-level key and looked up concurrently through
+# blockchain_apis (one lightweight summary request per address). Scanning stops once
+# ACCOUNT_DISCOVERY_GAP_LIMIT consecutive addresses after the last used one have no transactions, but never
+# before the highest index the database still knows about. Expired invoices leave runs of unused indices,
+# so raise the gap limit if many invoices expire unpaid. Indices whose lookup kept failing are reported and
+# do not count towards the gap.
+
+DISCOVERY_GAP_LIMIT = getattr(config, 'ACCOUNT_DISCOVERY_GAP_LIMIT', 20)
+DISCOVERY_BATCH_SIZE = getattr(config, 'WALLET_DISCOVERY_BATCH_SIZE', 50)
+DISCOVERY_CONCURRENCY = getattr(config, 'WALLET_DISCOVERY_CONCURRENCY', 8)
+DISCOVERY_MAX_ATTEMPTS = 4
+DISCOVERY_RETRY_BASE_DELAY_SECONDS = 1.0
+DISCOVERY_COINS = tuple(HD_COIN_BY_PAYMENT_COIN) # 'BTC', 'LTC', 'USDT_TRX'
+
+LATE_FUNDS_STATUSES = ('expired', 'user_cancelled')
+
+
+def _get_address_summary(payment_coin_symbol: str, address: str) -> dict | None:
+    """Address summary with backoff on rate limits and transient failures. None if every attempt failed."""
+    for attempt in range(1, DISCOVERY_MAX_ATTEMPTS + 1):
+        try:
+            return blockchain_apis.get_address_summary(payment_coin_symbol, address)
+        except (BlockchainAPIRateLimitError, BlockchainAPIUnavailableError, BlockchainAPITimeoutError) as e:
+            if attempt == DISCOVERY_MAX_ATTEMPTS:
+                logger.warning(f"Discovery: giving up on {payment_coin_symbol} address {address} after {attempt} attempts: {e}")
+                return None
+            time.sleep(DISCOVERY_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1))
+        except BlockchainAPIError as e:
+            logger.warning(f"Discovery: lookup of {payment_coin_symbol} address {address} failed: {e}")
+            return None
+    return None
+
+
+def scan_coin(payment_coin_symbol: str, gap_limit: int = None, batch_size: int = None, concurrency: int = None,
+              scan_to_index: int = None) -> dict:
+    """
+    Scans one coin's receiving chain. Returns {'coin', 'hd_coin', 'used': [{'index', 'address', 'tx_count',
+    'received', 'balance'}], 'errors': [{'index', 'address'}], 'last_used_index', 'scanned_to_index',
+    'known_max_index', 'stored_last_used_index', 'complete'}. Amounts are in smallest units.
+    """
+    gap_limit = gap_limit or DISCOVERY_GAP_LIMIT
+    batch_size = batch_size or DISCOVERY_BATCH_SIZE
+    hd_coin_symbol = HD_COIN_BY_PAYMENT_COIN[payment_coin_symbol]
+    payment_coins_for_hd_coin = [coin for coin, hd_coin in HD_COIN_BY_PAYMENT_COIN.items() if hd_coin == hd_coin_symbol]
+    known_max_index = db_utils.get_max_known_hd_index(hd_coin_symbol, payment_coins_for_hd_coin)
+    scan_at_least_to = max(scan_to_index if scan_to_index is not None else -1, known_max_index if known_max_index is not None else -1)
+
+    result = {
+        'coin': payment_coin_symbol, 'hd_coin': hd_coin_symbol, 'used': [], 'errors': [],
+        'last_used_index': -1, 'scanned_to_index': -1, 'known_max_index': known_max_index,
+        'stored_last_used_index': db_utils.get_last_used_address_index(hd_coin_symbol), 'complete': False,
+    }
+    last_unresolved_index = -1 # Last index that was used or could not be checked; the gap is counted from here
+    next_index = 0
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency or DISCOVERY_CONCURRENCY, thread_name_prefix="wallet-discovery") as executor:
+        while True:
+            addresses = hd_wallet_utils.generate_addresses(hd_coin_symbol, next_index, batch_size)
+            if not addresses:
+                logger.error(f"Discovery: could not derive {hd_coin_symbol} addresses from index {next_index}; stopping {payment_coin_symbol} scan.")
+                break
+            summaries = list(executor.map(lambda address: _get_address_summary(payment_coin_symbol, address), addresses))
+            for index, address, summary in zip(range(next_index, next_index + batch_size), addresses, summaries):
+                if summary is None:
+                    result['errors'].append({'index': index, 'address': address})
+                    last_unresolved_index = index
+                elif summary['tx_count'] > 0 or summary.get('account_active'):
+                    result['used'].append({'index': index, 'address': address, **summary})
+                    result['last_used_index'] = last_unresolved_index = index
+            result['scanned_to_index'] = next_index + batch_size - 1
+            next_index += batch_size
+
+            if all(summary is None for summary in summaries):
+                logger.error(f"Discovery: every lookup in {payment_coin_symbol} batch {next_index - batch_size}..{next_index - 1} failed; stopping scan.")
+                break
+            if result['scanned_to_index'] >= scan_at_least_to and result['scanned_to_index'] - last_unresolved_index >= gap_limit:
+                result['complete'] = True
+                break
+
+    elapsed = time.monotonic() - started
+    logger.info(f"Discovery: {payment_coin_symbol} scanned indices 0..{result['scanned_to_index']} in {elapsed:.1f}s; "
+                f"{len(result['used'])} used, last used {result['last_used_index']}, {len(result['errors'])} lookup error(s).")
+    return result
+
+
+def find_late_funds(coin_result: dict, flag_payments: bool = False) -> list[dict]:
+    """
+    Finds expired or cancelled dedicated invoices whose address received a transaction no payment accounts for.
+    Returns [{'payment_id', 'address', 'status', 'txids', 'amount'}] and optionally flags the payments.
+    """
+    used_addresses = [used['address'] for used in coin_result['used']]
+    payments_by_address = {}
+    for payment in db_utils.get_pending_payments_by_addresses(used_addresses):
+        if payment['coin_symbol'] == coin_result['coin'] and payment['invoice_mode'] == 'dedicated':
+            payments_by_address.setdefault(payment['address'], []).append(payment)
+
+    amount_key = AMOUNT_KEY_MAP[coin_result['coin']]
+    late_funds = []
+    for address, payments in payments_by_address.items():
+        late_payments = [payment for payment in payments if payment['status'] in LATE_FUNDS_STATUSES]
+        if not late_payments:
+            continue
+        try:
+            transactions = blockchain_apis.get_incoming_transactions(coin_result['coin'], address) or []
+        except BlockchainAPIError as e:
+            logger.warning(f"Discovery: could not fetch history of {address} to check for late funds: {e}")
+            continue
+        accounted_txids = {payment['blockchain_tx_id'] for payment in payments if payment['blockchain_tx_id']}
+        unaccounted = [tx for tx in transactions if tx['txid'] not in accounted_txids]
+        if not unaccounted:
+            continue
+        payment = late_payments[-1] # The most recent invoice that gave up on this address
+        late_funds.append({
+            'payment_id': payment['payment_id'], 'address': address, 'status': payment['status'],
+            'txids': [tx['txid'] for tx in unaccounted], 'amount': sum(int(tx[amount_key]) for tx in unaccounted),
+        })
+        if flag_payments and db_utils.flag_payment_late_funds(payment['payment_id']):
+            logger.warning(f"Discovery: payment {payment['payment_id']} ({payment['status']}) has late funds on {address}: "
+                           f"{', '.join(tx['txid'] for tx in unaccounted)}")
+    return late_funds
+
+
+def run_discovery(coins: list[str] = None, gap_limit: int = None, batch_size: int = None, concurrency: int = None,
+                  scan_to_index: int = None, reseed_indices: bool = False, flag_late_payments: bool = False) -> list[dict]:
+    """
+    Scans each coin and returns its scan_coin() result extended with 'late_funds' and 'reseeded_to'.
+    With reseed_indices, hd_address_indices is raised (never lowered) to the larger of the last used index and
+    the highest index the database knows about, but only for coins whose scan completed without lookup errors.
+    """
+    results = []
+    for payment_coin_symbol in coins or DISCOVERY_COINS:
+        coin_result = scan_coin(payment_coin_symbol, gap_limit, batch_size, concurrency, scan_to_index)
+        coin_result['late_funds'] = find_late_funds(coin_result, flag_payments=flag_late_payments)
+        coin_result['reseeded_to'] = None
+        if reseed_indices:
+            if not coin_result['complete'] or coin_result['errors']:
+                logger.error(f"Discovery: not re-seeding {coin_result['hd_coin']} index; the {payment_coin_symbol} scan was incomplete or had lookup errors.")
+            else:
+                floor_index = max(coin_result['last_used_index'], coin_result['known_max_index'] if coin_result['known_max_index'] is not None else -1)
+                if floor_index >= 0:
+                    coin_result['reseeded_to'] = db_utils.raise_address_index_floor(coin_result['hd_coin'], floor_index)
+        results.append(coin_result)
+    return results
+
+
+def format_discovery_report(results: list[dict]) -> str:
+    lines = []
+    for coin_result in results:
+        display_coin = DISPLAY_COIN_BY_DEPOSIT_COIN[coin_result['coin']]
+        total_balance = sum(used['balance'] for used in coin_result['used'])
+        lines.append(f"[{coin_result['coin']}] scanned 0..{coin_result['scanned_to_index']}"
+                     f"{'' if coin_result['complete'] else ' (INCOMPLETE)'}: {len(coin_result['used'])} used address(es), "
+                     f"last used index {coin_result['last_used_index']}, stored index {coin_result['stored_last_used_index']}, "
+                     f"highest index in database {coin_result['known_max_index']}")
+        lines.append(f"  Balance: {smallest_units_to_display_amount(total_balance, display_coin)} {display_coin}")
+        # USDT_TRX counts and amounts cover USDT transfers only; TRX-only activity shows as an active account
+        activity_label = "USDT transfer(s)" if coin_result['coin'] == 'USDT_TRX' else "tx"
+        for used in coin_result['used']:
+            account_note = " (Tron account active)" if used.get('account_active') and not used['tx_count'] else ""
+            lines.append(f"  #{used['index']} {used['address']}: {used['tx_count']} {activity_label}{account_note}, received "
+                         f"{smallest_units_to_display_amount(used['received'], display_coin)}, balance "
+                         f"{smallest_units_to_display_amount(used['balance'], display_coin)}")
+        if coin_result['errors']:
+            lines.append(f"  Lookup errors at indices: {', '.join(str(error['index']) for error in coin_result['errors'])}")
+        for late in coin_result['late_funds']:
+            lines.append(f"  LATE FUNDS: payment {late['payment_id']} ({late['status']}) on {late['address']}: "
+                         f"{smallest_units_to_display_amount(late['amount'], display_coin)} {display_coin} in {', '.join(late['txids'])}")
+        if coin_result['reseeded_to'] is not None:
+            lines.append(f"  hd_address_indices[{coin_result['hd_coin']}] is now {coin_result['reseeded_to']}")
+    return "\n".join(lines)
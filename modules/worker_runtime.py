@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import datetime
+
+import config
+from modules import db_utils
+from modules import metrics
+
+logger = logging.getLogger(__name__)
+
+# Runs jobs from the durable `jobs` table (see db_utils "Durable Job Queue").
+# The same runtime is used inside the bot process (RUN_JOB_WORKER_IN_PROCESS) and by the
+# standalone `python main.py worker` process, so background work survives restarts and can be
+# spread over several processes that share the database.
+#
+# A job is leased to one worker for JOB_VISIBILITY_TIMEOUT_SECONDS. While the handler runs, the
+# lease is renewed periodically; if the worker dies, the lease expires and another worker retries it.
+# A handler signals failure by raising; the job is then retried with exponential backoff until
+# max_attempts is reached and it is moved to 'dead'.
+
+JOB_WORKER_THREADS = getattr(config, 'JOB_WORKER_THREADS', 2)
+JOB_POLL_INTERVAL_SECONDS = getattr(config, 'JOB_POLL_INTERVAL_SECONDS', 2)
+JOB_VISIBILITY_TIMEOUT_SECONDS = getattr(config, 'JOB_VISIBILITY_TIMEOUT_SECONDS', 300)
+JOB_MAX_ATTEMPTS = getattr(config, 'JOB_MAX_ATTEMPTS', 5)
+JOB_RETRY_BASE_DELAY_SECONDS = getattr(config, 'JOB_RETRY_BASE_DELAY_SECONDS', 10)
+JOB_RETRY_MAX_DELAY_SECONDS = getattr(config, 'JOB_RETRY_MAX_DELAY_SECONDS', 900)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+JOB_START_LAG_SECONDS = metrics.histogram('bot_job_start_lag_seconds', 'Delay between a job becoming due and a worker starting it.', ('job_type',),
+                                          buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900))
+JOB_RUN_SECONDS = metrics.histogram('bot_job_run_seconds', 'Job handler run time.', ('job_type',),
+                                    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+JOB_RESULTS = metrics.counter('bot_jobs_total', 'Finished job runs by result (done, retry, dead).', ('job_type', 'result'))
+
+# job_type -> {'handler': callable(payload: dict), 'max_attempts': int}
+_job_handlers = {}
+# job_type -> {'interval': seconds, 'initial_delay': seconds, 'priority': int, 'slots': int}
+_recurring_jobs = {}
+_worker_threads = []
+_stop_event = threading.Event()
+
+
+def register_job_handler(job_type: str, handler, max_attempts: int = None):
+    """Registers the function that runs jobs of job_type. The handler receives the job payload dict."""
+    _job_handlers[job_type] = {'handler': handler, 'max_attempts': max_attempts or JOB_MAX_ATTEMPTS}
+    logger.debug(f"Registered job handler for '{job_type}'.")
+
+
+def register_recurring_job(job_type: str, handler, interval_seconds: float, initial_delay_seconds: float = 0,
+                           priority: int = 100, max_attempts: int = 3, slots: int = 1):
+    """
+    Registers a job that re-enqueues itself every interval_seconds (replacement for a sleep loop).
+    Exactly `slots` instances are ever queued/running across all workers (dedupe key
+    'recurring:<job_type>[:<slot>]'); use more than one slot for work that shards itself, such as the
+    lease-based payment monitor. The slot number is passed to the handler as payload['slot'].
+    A failing run is retried with backoff; once its attempts are exhausted the next regular run is scheduled.
+    """
+    register_job_handler(job_type, handler, max_attempts=max_attempts)
+    _recurring_jobs[job_type] = {'interval': interval_seconds, 'initial_delay': initial_delay_seconds,
+                                 'priority': priority, 'slots': max(1, slots)}
+
+
+def _recurring_dedupe_key(job_type: str, slot: int = 0) -> str:
+    if _recurring_jobs[job_type]['slots'] == 1:
+        return f"recurring:{job_type}"
+    return f"recurring:{job_type}:{slot}"
+
+
+def _schedule_recurring_job(job_type: str, delay_seconds: float, slot: int = 0):
+    spec = _recurring_jobs[job_type]
+    db_utils.enqueue_job(job_type, {'slot': slot}, priority=spec['priority'],
+                         run_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=delay_seconds),
+                         max_attempts=_job_handlers[job_type]['max_attempts'],
+                         dedupe_key=_recurring_dedupe_key(job_type, slot))
+
+
+def schedule_recurring_jobs():
+    """Seeds the first run of every recurring job. A job already queued or running (e.g. by another worker) is left alone."""
+    for job_type, spec in _recurring_jobs.items():
+        for slot in range(spec['slots']):
+            _schedule_recurring_job(job_type, spec['initial_delay'], slot)
+        logger.info(f"Recurring job '{job_type}': initial delay {spec['initial_delay']}s, interval {spec['interval']}s, {spec['slots']} slot(s).")
+
+
+def enqueue(job_type: str, payload: dict = None, priority: int = 100, delay_seconds: float = 0,
+            dedupe_key: str = None, max_attempts: int = None) -> int | None:
+    """Queues a one-off job. Returns the job_id, or None if a job with the same dedupe_key is already active."""
+    handler_spec = _job_handlers.get(job_type)
+    if max_attempts is None:
+        max_attempts = handler_spec['max_attempts'] if handler_spec else JOB_MAX_ATTEMPTS
+    run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay_seconds) if delay_seconds else None
+    return db_utils.enqueue_job(job_type, payload, priority=priority, run_at=run_at,
+                                max_attempts=max_attempts, dedupe_key=dedupe_key)
+
+
+def _retry_delay_seconds(attempts: int) -> float:
+    return min(JOB_RETRY_MAX_DELAY_SECONDS, JOB_RETRY_BASE_DELAY_SECONDS * (2 ** max(0, attempts - 1)))
+
+
+def _heartbeat(job_id: int, done_event: threading.Event):
+    """Renews the lease of a running job until done_event is set."""
+    interval = max(1, JOB_VISIBILITY_TIMEOUT_SECONDS / 3)
+    while not done_event.wait(interval):
+        if not db_utils.extend_job_lease(job_id, WORKER_ID, JOB_VISIBILITY_TIMEOUT_SECONDS):
+            logger.warning(f"Lost lease on job {job_id}; another worker may pick it up.")
+            return
+
+
+def _run_job(job):
+    job_id = job['job_id']
+    job_type = job['job_type']
+    handler_spec = _job_handlers.get(job_type)
+    if handler_spec is None:
+        logger.error(f"No handler registered for job {job_id} of type '{job_type}'.")
+        db_utils.fail_job(job_id, WORKER_ID, f"No handler registered for '{job_type}'", _retry_delay_seconds(job['attempts']))
+        return
+
+    try:
+        payload = json.loads(job['payload_json'] or '{}')
+    except ValueError:
+        payload = {}
+
+    try:
+        due_at = datetime.datetime.fromisoformat(job['run_at'])
+        JOB_START_LAG_SECONDS.observe(max(0.0, (datetime.datetime.utcnow() - due_at).total_seconds()), job_type)
+    except (TypeError, ValueError):
+        pass
+
+    done_event = threading.Event()
+    heartbeat_thread = threading.Thread(target=_heartbeat, args=(job_id, done_event), name=f"job-heartbeat-{job_id}", daemon=True)
+    heartbeat_thread.start()
+    started = time.monotonic()
+    try:
+        handler_spec['handler'](payload)
+    except Exception as e:
+        done_event.set()
+        JOB_RUN_SECONDS.observe(time.monotonic() - started, job_type)
+        retry_delay = _retry_delay_seconds(job['attempts'])
+        if job_type in _recurring_jobs:
+            retry_delay = min(retry_delay, _recurring_jobs[job_type]['interval'])
+        new_status = db_utils.fail_job(job_id, WORKER_ID, f"{type(e).__name__}: {e}", retry_delay)
+        JOB_RESULTS.inc(job_type, 'dead' if new_status == 'dead' else 'retry')
+        if new_status == 'dead':
+            logger.exception(f"Job {job_id} ({job_type}) failed on attempt {job['attempts']}/{job['max_attempts']} and was dead-lettered: {e}")
+            if job_type in _recurring_jobs:
+                _schedule_recurring_job(job_type, _recurring_jobs[job_type]['interval'], payload.get('slot', 0))
+        else:
+            logger.exception(f"Job {job_id} ({job_type}) failed on attempt {job['attempts']}/{job['max_attempts']}; retrying in {retry_delay}s: {e}")
+        return
+    done_event.set()
+    JOB_RUN_SECONDS.observe(time.monotonic() - started, job_type)
+    JOB_RESULTS.inc(job_type, 'done')
+    db_utils.complete_job(job_id, WORKER_ID)
+    logger.debug(f"Job {job_id} ({job_type}) completed in {time.monotonic() - started:.2f}s.")
+    if job_type in _recurring_jobs:
+        _schedule_recurring_job(job_type, _recurring_jobs[job_type]['interval'], payload.get('slot', 0))
+
+
+def _dead_letter_expired_jobs(job_types: list[str]):
+    """Dead-letters jobs whose worker died on their final attempt; recurring ones get their next run queued."""
+    for job in db_utils.dead_letter_expired_jobs(job_types):
+        job_type = job['job_type']
+        JOB_RESULTS.inc(job_type, 'dead')
+        logger.error(f"Job {job['job_id']} ({job_type}) lease expired on attempt {job['attempts']}/{job['max_attempts']}; dead-lettered.")
+        if job_type in _recurring_jobs:
+            try:
+                slot = json.loads(job['payload_json'] or '{}').get('slot', 0)
+            except ValueError:
+                slot = 0
+            _schedule_recurring_job(job_type, _recurring_jobs[job_type]['interval'], slot)
+
+
+def _worker_loop():
+    job_types = list(_job_handlers.keys())
+    while not _stop_event.is_set():
+        try:
+            _dead_letter_expired_jobs(job_types)
+            jobs = db_utils.claim_jobs(WORKER_ID, job_types=job_types, limit=1,
+                                       visibility_timeout_seconds=JOB_VISIBILITY_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.exception(f"Job worker: unexpected error while claiming jobs: {e}")
+            jobs = []
+        if not jobs:
+            _stop_event.wait(JOB_POLL_INTERVAL_SECONDS)
+            continue
+        for job in jobs:
+            try:
+                _run_job(job)
+            except Exception as e:
+                logger.exception(f"Job worker: unexpected error while running job {job['job_id']}: {e}")
+
+
+def start_workers(thread_count: int = None):
+    """Seeds recurring jobs and starts worker threads in the background. Safe to call more than once."""
+    if _worker_threads:
+        logger.debug("Job workers already running.")
+        return
+    _stop_event.clear()
+    schedule_recurring_jobs()
+    thread_count = thread_count or JOB_WORKER_THREADS
+    for worker_number in range(thread_count):
+        worker_thread = threading.Thread(target=_worker_loop, name=f"job-worker-{worker_number}", daemon=True)
+        worker_thread.start()
+        _worker_threads.append(worker_thread)
+    logger.info(f"Started {thread_count} job worker thread(s) as {WORKER_ID} for job types: {sorted(_job_handlers.keys())}.")
+
+
+def run_forever(thread_count: int = None):
+    """Starts the workers and blocks until interrupted. Used by `python main.py worker`."""
+    start_workers(thread_count)
+    try:
+        while not _stop_event.is_set():
+            _stop_event.wait(60)
+            logger.info(f"Job queue status: {db_utils.get_job_counts_by_status()}")
+    except KeyboardInterrupt:
+        logger.info("Job worker interrupted. Stopping...")
+    finally:
+        stop_workers()
+
+
+def stop_workers(timeout: float = 10):
+    """Signals worker threads to stop after their current job. Unfinished jobs are picked up again once their lease expires."""
+    _stop_event.set()
+    for worker_thread in _worker_threads:
+        worker_thread.join(timeout)
+    _worker_threads.clear()
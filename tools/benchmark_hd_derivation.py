@@ -0,0 +1,78 @@
+"""
+Benchmark of HD address derivation in modules/hd_wallet_utils.py.
+
+Compares, per coin:
+    - uncached: BIP39 seed (PBKDF2, 2048 rounds) + full BIP44 walk from master for every address
+      (what generate_address did before the change-level contexts were cached)
+    - generate_address: one call per address using the cached change-level key
+    - generate_addresses: one batch call for all addresses
+
+Uses a throwaway test mnemonic unless --seed-phrase is given; never pass a seed phrase holding real funds.
+
+    python tools/benchmark_hd_derivation.py --count 2000 --coins BTC,LTC,TRX
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from bip_utils import Bip39SeedGenerator, Bip44
+
+TEST_MNEMONIC = "abandon abandon abandon abandon abandon abandon abandon abandon abandon abandon abandon about"
+
+
+def derive_uncached(hd_wallet_utils, coin_symbol: str, index: int) -> str:
+    seed_bytes = Bip39SeedGenerator(config.SEED_PHRASE).Generate()
+    master_ctx = Bip44.FromSeed(seed_bytes, hd_wallet_utils.COIN_MAP[coin_symbol]["coin_type"])
+    change_ctx = master_ctx.Purpose().Coin().Account(hd_wallet_utils.BIP44_ACCOUNT).Change(hd_wallet_utils.BIP44_CHANGE)
+    return change_ctx.AddressIndex(index).PublicKey().ToAddress()
+
+
+def measure(label: str, count: int, derive) -> list[str]:
+    started = time.perf_counter()
+    addresses = derive()
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<18} {count:>6} addresses in {elapsed:7.3f}s  {count / elapsed:10.0f} addresses/sec  "
+          f"{elapsed / count * 1000:8.3f} ms/address")
+    return addresses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark HD address derivation.")
+    parser.add_argument("--count", type=int, default=1000, help="Addresses derived per coin and method.")
+    parser.add_argument("--uncached-count", type=int, default=100, help="Addresses for the (slow) uncached baseline.")
+    parser.add_argument("--coins", default="BTC,LTC,TRX")
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--seed-phrase", default=TEST_MNEMONIC)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    config.SEED_PHRASE = args.seed_phrase
+    from modules import hd_wallet_utils # Imported after SEED_PHRASE is set
+    logging.getLogger(hd_wallet_utils.__name__).setLevel(logging.WARNING) # generate_address logs every address at INFO
+
+    started = time.perf_counter()
+    hd_wallet_utils.warm_up_derivation_contexts()
+    print(f"Warm-up (seed + change-level keys for {len(hd_wallet_utils.COIN_MAP)} coins): {time.perf_counter() - started:.3f}s")
+
+    for coin_symbol in [coin.strip() for coin in args.coins.split(',') if coin.strip()]:
+        print(f"\n{coin_symbol}")
+        uncached = measure("uncached", args.uncached_count,
+                           lambda: [derive_uncached(hd_wallet_utils, coin_symbol, index)
+                                    for index in range(args.start, args.start + args.uncached_count)])
+        single = measure("generate_address", args.count,
+                         lambda: [hd_wallet_utils.generate_address(coin_symbol, index)
+                                  for index in range(args.start, args.start + args.count)])
+        batch = measure("generate_addresses", args.count,
+                        lambda: hd_wallet_utils.generate_addresses(coin_symbol, args.start, args.count))
+        if single != batch or uncached != batch[:len(uncached)]:
+            print(f"  MISMATCH: derivation methods returned different addresses for {coin_symbol}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
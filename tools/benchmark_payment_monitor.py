@@ -0,0 +1,175 @@
+"""
+Load benchmark for payment_monitor.check_pending_payments against tools/fake_blockchain_provider.py.
+
+Seeds N pending payments in a throwaway database, scripts an on-chain payment for each at a random
+time within --send-window seconds, and runs monitor cycles (optionally several concurrent workers, as
+with PAYMENT_MONITOR_PARALLELISM) until every payment is confirmed or --timeout is reached.
+
+Reported:
+    - seen latency: tx visible at the provider -> payment row has its blockchain_tx_id
+    - confirmation latency: tx reached the required confirmations -> payment is 'confirmed_unprocessed'
+    - provider API calls per payment (by route and status)
+    - cycle time of check_pending_payments
+
+    python tools/benchmark_payment_monitor.py --payments 500 --coins BTC,LTC,USDT_TRX --block-interval 5 --workers 2
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from tools.fake_blockchain_provider import FakeChain, start_fake_provider, base_urls
+
+AMOUNT_RANGES = {"BTC": (10_000, 5_000_000), "LTC": (100_000, 50_000_000), "USDT_TRX": (1_000_000, 500_000_000)}
+
+
+def format_distribution(label: str, values: list[float], unit: str = "s") -> str:
+    if not values:
+        return f"{label}: no samples"
+    from modules.payment_funnel import percentile # Imported after configure(), like the other bot modules
+    return (f"{label}: n={len(values)} p50={percentile(values, 50):.2f}{unit} p95={percentile(values, 95):.2f}{unit} "
+            f"p99={percentile(values, 99):.2f}{unit} max={max(values):.2f}{unit}")
+
+
+def configure(args, provider_urls: dict, database_path: str):
+    """Config overrides must be in place before the bot modules are imported (they read config at import time)."""
+    for key, url in provider_urls.items():
+        setattr(config, key, url)
+    config.DATABASE_NAME = database_path
+    config.BLOCKCHAIN_API_CALL_DELAY_SECONDS = args.api_call_delay
+    config.BLOCKCHAIN_TIP_HEIGHT_CACHE_SECONDS = args.tip_cache_seconds
+    config.MIN_CONFIRMATIONS_BTC = args.confirmations
+    config.MIN_CONFIRMATIONS_LTC = args.confirmations
+    config.MIN_CONFIRMATIONS_TRX = args.confirmations
+    config.PAYMENT_MONITOR_BATCH_SIZE = args.batch_size
+
+
+def seed_payments(db_utils, chain: FakeChain, args, rng: random.Random) -> list[dict]:
+    coins = [coin.strip() for coin in args.coins.split(',') if coin.strip()]
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=args.timeout + 3600)
+    seeded = []
+    for number in range(args.payments):
+        coin = coins[number % len(coins)]
+        user_id = 1_000_000 + number
+        db_utils.get_or_create_user(user_id)
+        transaction_id = db_utils.record_transaction(user_id=user_id, type='balance_top_up', eur_amount=10.0,
+                                                     payment_status='awaiting_payment', notes="benchmark")
+        address = f"bench{coin.lower()}{number:06d}"
+        amount = rng.randint(*AMOUNT_RANGES[coin])
+        payment_id = db_utils.create_pending_payment(transaction_id, user_id, address, coin, coin, str(amount), expires_at)
+        tx = chain.add_payment(coin, address, amount, delay_seconds=rng.uniform(0, args.send_window))
+        seeded.append({'payment_id': payment_id, 'coin': coin, 'tx': tx, 'seen_at': None, 'confirmed_at': None})
+    return seeded
+
+
+def run_cycle(payment_monitor, workers: int) -> float:
+    started = time.monotonic()
+    if workers == 1:
+        payment_monitor.check_pending_payments(worker_id="bench-0")
+    else:
+        threads = [threading.Thread(target=payment_monitor.check_pending_payments, kwargs={'worker_id': f"bench-{worker}"})
+                   for worker in range(workers)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    return time.monotonic() - started
+
+
+def collect_progress(db_utils, seeded: list[dict]):
+    """Stamps seen/confirmed times on payments whose DB state changed since the last cycle."""
+    now = time.time()
+    conn = db_utils.get_db_connection()
+    try:
+        rows = {row['payment_id']: row for row in conn.execute("SELECT payment_id, status, blockchain_tx_id FROM pending_crypto_payments")}
+    finally:
+        conn.close()
+    for payment in seeded:
+        row = rows.get(payment['payment_id'])
+        if row is None:
+            continue
+        if payment['seen_at'] is None and row['blockchain_tx_id']:
+            payment['seen_at'] = now
+        if payment['confirmed_at'] is None and row['status'] in ('confirmed_unprocessed', 'processing', 'completed'):
+            payment['confirmed_at'] = now
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark check_pending_payments against the fake blockchain provider.")
+    parser.add_argument("--payments", type=int, default=200)
+    parser.add_argument("--coins", default="BTC,LTC,USDT_TRX")
+    parser.add_argument("--send-window", type=float, default=30.0, help="Payments are sent at random times within this many seconds.")
+    parser.add_argument("--block-interval", type=float, default=5.0)
+    parser.add_argument("--confirmations", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1, help="Concurrent monitor runs per cycle.")
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--cycle-interval", type=float, default=0.0, help="Pause between cycles (the scheduler interval).")
+    parser.add_argument("--api-call-delay", type=float, default=0.0, help="BLOCKCHAIN_API_CALL_DELAY_SECONDS during the run.")
+    parser.add_argument("--tip-cache-seconds", type=float, default=2.0)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--latency-jitter-ms", type=float, default=10)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper(), logging.WARNING),
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    rng = random.Random(args.seed)
+
+    chain = FakeChain(block_interval_seconds=args.block_interval, seed=args.seed)
+    chain.set_faults(args.latency_ms, args.latency_jitter_ms, args.rate_429, args.rate_5xx)
+    server = start_fake_provider(chain, tron_confirm_blocks=args.confirmations)
+    work_dir = tempfile.mkdtemp(prefix="payment-monitor-bench-")
+    configure(args, base_urls(server), os.path.join(work_dir, "bench.db"))
+
+    from modules import db_utils, payment_monitor # Imported after configure(); they read config at import time
+    db_utils.initialize_database()
+    seeded = seed_payments(db_utils, chain, args, rng)
+    print(f"Seeded {len(seeded)} payments ({args.coins}); database {config.DATABASE_NAME}")
+
+    cycle_times = []
+    started = time.time()
+    while time.time() - started < args.timeout:
+        cycle_times.append(run_cycle(payment_monitor, args.workers))
+        collect_progress(db_utils, seeded)
+        if all(payment['confirmed_at'] for payment in seeded):
+            break
+        if args.cycle_interval:
+            time.sleep(args.cycle_interval)
+    elapsed = time.time() - started
+    chain.stop()
+    server.shutdown()
+
+    seen_latencies, confirmation_latencies = [], []
+    for payment in seeded:
+        visible_at = payment['tx']['sent_at'] if payment['coin'] != "USDT_TRX" else chain.confirmed_at(payment['tx'], 1)
+        if payment['seen_at'] and visible_at:
+            seen_latencies.append(max(0.0, payment['seen_at'] - visible_at))
+        confirmable_at = chain.confirmed_at(payment['tx'], args.confirmations)
+        if payment['confirmed_at'] and confirmable_at:
+            confirmation_latencies.append(max(0.0, payment['confirmed_at'] - confirmable_at))
+
+    stats = chain.stats()
+    confirmed_count = sum(1 for payment in seeded if payment['confirmed_at'])
+    print(f"\nConfirmed {confirmed_count}/{len(seeded)} payments in {elapsed:.1f}s over {len(cycle_times)} cycles "
+          f"({args.workers} worker(s), batch {args.batch_size}).")
+    print(format_distribution("Seen latency", seen_latencies))
+    print(format_distribution("Confirmation latency", confirmation_latencies))
+    print(format_distribution("Cycle time", cycle_times))
+    print(f"Provider API calls: {stats['total_requests']} total, {stats['total_requests'] / max(1, len(seeded)):.1f} per payment, "
+          f"{stats['total_requests'] / max(1, len(seeded) * len(cycle_times)):.2f} per payment per cycle")
+    for route, counts in sorted(stats['requests'].items()):
+        print(f"  {route}: " + ", ".join(f"{status}={count}" for status, count in sorted(counts.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Gap-limit discovery of used receiving addresses (see modules/wallet_discovery.py).
+
+Prints a used-address/balance report per coin. Optionally raises hd_address_indices to the last used
+index (--reseed-indices) and flags expired/cancelled invoices whose address received funds that no
+payment accounts for (--flag-late-payments). Run it with the bot's config.py and database.
+
+    python tools/discover_wallet_addresses.py --coins BTC,LTC,USDT_TRX --gap-limit 50 --concurrency 8
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import db_utils
+from modules import wallet_discovery
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Discover used HD wallet addresses and reconcile the database.")
+    parser.add_argument("--coins", default=",".join(wallet_discovery.DISCOVERY_COINS))
+    parser.add_argument("--gap-limit", type=int, default=wallet_discovery.DISCOVERY_GAP_LIMIT)
+    parser.add_argument("--batch-size", type=int, default=wallet_discovery.DISCOVERY_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=wallet_discovery.DISCOVERY_CONCURRENCY)
+    parser.add_argument("--scan-to", type=int, default=None, help="Scan at least up to this index regardless of the gap limit.")
+    parser.add_argument("--reseed-indices", action="store_true", help="Raise hd_address_indices to the last used index found.")
+    parser.add_argument("--flag-late-payments", action="store_true", help="Flag expired/cancelled invoices that received funds.")
+    parser.add_argument("--json", action="store_true", help="Print the raw results as JSON instead of the text report.")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper(), logging.WARNING),
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_utils.initialize_database()
+    results = wallet_discovery.run_discovery(
+        coins=[coin.strip() for coin in args.coins.split(',') if coin.strip()], gap_limit=args.gap_limit,
+        batch_size=args.batch_size, concurrency=args.concurrency, scan_to_index=args.scan_to,
+        reseed_indices=args.reseed_indices, flag_late_payments=args.flag_late_payments)
+    print(json.dumps(results, indent=2) if args.json else wallet_discovery.format_discovery_report(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""
+Local stand-in for the block explorer APIs used by modules/blockchain_apis.py, for load and latency
+testing of the payment monitor without touching public services.
+
+Emulated endpoints (only the fields blockchain_apis reads):
+    /btc/blocks/tip/height, /btc/address/<addr> (with ETag), /btc/address/<addr>/txs      Blockstream
+    /ltc  (chain info), /ltc/addrs/<addr>/full?after=, /ltc/addrs/<addr>/balance          BlockCypher
+    /tron/v1/accounts/<addr>/transactions/trc20?min_block_timestamp=&fingerprint=         TronGrid
+    /tron/v1/accounts/<addr>                                                              TronGrid
+
+Blocks are produced every --block-interval seconds per coin. Payments are scripted through the control
+API (or FakeChain.add_payment when used in-process): a payment enters the mempool at its send time and
+is mined into the next block. Latency, 429s and 5xx responses can be injected on every provider request.
+
+Control API (JSON):
+    POST /_control/payments   {"coin": "BTC"|"LTC"|"USDT_TRX", "address": ..., "amount": <smallest units>, "delay_seconds": 0}
+    POST /_control/mine       {"coin": "BTC", "blocks": 1}
+    POST /_control/faults     {"latency_ms": 50, "latency_jitter_ms": 20, "rate_429": 0.01, "rate_5xx": 0.01}
+    GET  /_control/stats      request counts per route and status
+
+Point the bot at it with BLOCKSTREAM_API_BASE_URL_BTC = "http://127.0.0.1:8765/btc",
+BLOCKCYPHER_API_BASE_URL_LTC = "http://127.0.0.1:8765/ltc" and TRONGRID_API_BASE_URL = "http://127.0.0.1:8765/tron".
+
+    python tools/fake_blockchain_provider.py --port 8765 --block-interval 10
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+COINS = ("BTC", "LTC", "USDT_TRX")
+CHAIN_BY_COIN = {"BTC": "BTC", "LTC": "LTC", "USDT_TRX": "TRX"}
+TRONGRID_PAGE_SIZE = 50
+START_HEIGHTS = {"BTC": 850000, "LTC": 2700000, "TRX": 60000000}
+USDT_TRC20_CONTRACT_ADDRESS = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+
+
+class FakeChain:
+    """Blocks, scripted payments and request statistics shared by all request handler threads."""
+
+    def __init__(self, block_interval_seconds: float = 10.0, seed: int | None = None):
+        self.block_interval_seconds = block_interval_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tip_heights = dict(START_HEIGHTS)
+        self.block_times = {chain: {height: time.time()} for chain, height in START_HEIGHTS.items()}
+        self.payments = {} # address -> [payment dict]
+        self.latency_ms = 0
+        self.latency_jitter_ms = 0
+        self.rate_429 = 0.0
+        self.rate_5xx = 0.0
+        self.request_counts = {} # route -> {status: count}
+        self._txid_counter = 0
+        self._stop_event = threading.Event()
+        self._miner_thread = None
+
+    # --- Chain simulation ---
+    def add_payment(self, coin: str, address: str, amount_smallest_unit: int, delay_seconds: float = 0) -> dict:
+        if coin not in COINS:
+            raise ValueError(f"Unsupported coin {coin}")
+        with self.lock:
+            self._txid_counter += 1
+            payment = {
+                'txid': hashlib.sha256(f"{coin}:{address}:{self._txid_counter}".encode()).hexdigest(),
+                'coin': coin,
+                'address': address,
+                'amount': int(amount_smallest_unit),
+                'sent_at': time.time() + delay_seconds,
+                'block_height': None,
+                'block_time': None,
+            }
+            self.payments.setdefault(address, []).append(payment)
+        return payment
+
+    def mine(self, coin: str, blocks: int = 1):
+        chain = CHAIN_BY_COIN.get(coin, coin)
+        with self.lock:
+            for _ in range(blocks):
+                self._mine_block(chain)
+
+    def _mine_block(self, chain: str):
+        height = self.tip_heights[chain] + 1
+        now = time.time()
+        self.tip_heights[chain] = height
+        self.block_times[chain][height] = now
+        for address_payments in self.payments.values():
+            for payment in address_payments:
+                if CHAIN_BY_COIN[payment['coin']] == chain and payment['block_height'] is None and payment['sent_at'] <= now:
+                    payment['block_height'] = height
+                    payment['block_time'] = int(now)
+
+    def confirmed_at(self, payment: dict, confirmations: int) -> float | None:
+        """Wall-clock time at which the payment reached `confirmations` confirmations, or None if it has not yet."""
+        with self.lock:
+            if payment['block_height'] is None:
+                return None
+            chain = CHAIN_BY_COIN[payment['coin']]
+            return self.block_times[chain].get(payment['block_height'] + max(1, confirmations) - 1)
+
+    def _confirmations(self, payment: dict) -> int:
+        if payment['block_height'] is None:
+            return 0
+        return self.tip_heights[CHAIN_BY_COIN[payment['coin']]] - payment['block_height'] + 1
+
+    def _visible_payments(self, coin: str, address: str) -> list[dict]:
+        now = time.time()
+        return [payment for payment in self.payments.get(address, []) if payment['coin'] == coin and payment['sent_at'] <= now]
+
+    def start_mining(self):
+        if self.block_interval_seconds <= 0 or self._miner_thread:
+            return
+
+        def mine_forever():
+            while not self._stop_event.wait(self.block_interval_seconds):
+                with self.lock:
+                    for chain in self.tip_heights:
+                        self._mine_block(chain)
+
+        self._miner_thread = threading.Thread(target=mine_forever, name="fake-chain-miner", daemon=True)
+        self._miner_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    # --- Faults and statistics ---
+    def set_faults(self, latency_ms: float = None, latency_jitter_ms: float = None, rate_429: float = None, rate_5xx: float = None):
+        with self.lock:
+            if latency_ms is not None: self.latency_ms = latency_ms
+            if latency_jitter_ms is not None: self.latency_jitter_ms = latency_jitter_ms
+            if rate_429 is not None: self.rate_429 = rate_429
+            if rate_5xx is not None: self.rate_5xx = rate_5xx
+
+    def injected_fault(self) -> tuple[float, int | None]:
+        """Returns (delay_seconds, status_code_to_fail_with or None) for one provider request."""
+        with self.lock:
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.latency_jitter_ms, self.latency_jitter_ms)) / 1000
+            roll = self.random.random()
+            if roll < self.rate_429:
+                return delay, 429
+            if roll < self.rate_429 + self.rate_5xx:
+                return delay, self.random.choice((500, 502, 503))
+            return delay, None
+
+    def count_request(self, route: str, status: int):
+        with self.lock:
+            route_counts = self.request_counts.setdefault(route, {})
+            route_counts[status] = route_counts.get(status, 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'requests': {route: dict(counts) for route, counts in self.request_counts.items()},
+                'total_requests': sum(sum(counts.values()) for counts in self.request_counts.values()),
+                'tip_heights': dict(self.tip_heights),
+                'payments': sum(len(address_payments) for address_payments in self.payments.values()),
+            }
+
+    # --- Provider responses ---
+    def btc_tip_height(self) -> str:
+        with self.lock:
+            return str(self.tip_heights["BTC"])
+
+    def btc_address_stats(self, address: str) -> dict:
+        with self.lock:
+            payments = self._visible_payments("BTC", address)
+            confirmed = [payment for payment in payments if payment['block_height'] is not None]
+            mempool = [payment for payment in payments if payment['block_height'] is None]
+            return {
+                'address': address,
+                'chain_stats': {'tx_count': len(confirmed), 'funded_txo_sum': sum(payment['amount'] for payment in confirmed), 'spent_txo_sum': 0},
+                'mempool_stats': {'tx_count': len(mempool), 'funded_txo_sum': sum(payment['amount'] for payment in mempool), 'spent_txo_sum': 0},
+            }
+
+    def btc_address_txs(self, address: str) -> list[dict]:
+        with self.lock:
+            payments = self._visible_payments("BTC", address)
+            mempool = [payment for payment in payments if payment['block_height'] is None]
+            confirmed = sorted((payment for payment in payments if payment['block_height'] is not None),
+                               key=lambda payment: payment['block_height'], reverse=True)
+            return [{
+                'txid': payment['txid'],
+                'status': {'confirmed': payment['block_height'] is not None, 'block_height': payment['block_height'],
+                           'block_time': payment['block_time']},
+                'vout': [{'scriptpubkey_address': address, 'value': payment['amount']}],
+            } for payment in mempool + confirmed]
+
+    def ltc_chain_info(self) -> dict:
+        with self.lock:
+            return {'name': "LTC.main", 'height': self.tip_heights["LTC"]}
+
+    def ltc_address_full(self, address: str, after: int | None) -> dict:
+        with self.lock:
+            txs = []
+            for payment in self._visible_payments("LTC", address):
+                if after is not None and payment['block_height'] is not None and payment['block_height'] <= after:
+                    continue
+                txs.append({
+                    'hash': payment['txid'],
+                    'block_height': payment['block_height'] if payment['block_height'] is not None else -1,
+                    'confirmations': self._confirmations(payment),
+                    'received': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(payment['sent_at'])),
+                    'outputs': [{'addresses': [address], 'value': payment['amount']}],
+                })
+            return {'address': address, 'txs': txs}
+
+    def ltc_address_balance(self, address: str) -> dict:
+        with self.lock:
+            payments = self._visible_payments("LTC", address)
+            received = sum(payment['amount'] for payment in payments)
+            return {'address': address, 'n_tx': len(payments), 'final_n_tx': len(payments), 'total_received': received, 'final_balance': received}
+
+    def tron_account(self, address: str, contract_address: str) -> dict:
+        with self.lock:
+            payments = [payment for payment in self._visible_payments("USDT_TRX", address) if payment['block_height'] is not None]
+            if not payments:
+                return {'success': True, 'data': []} # Never activated
+            return {'success': True, 'data': [{'address': address, 'trc20': [{contract_address: str(sum(payment['amount'] for payment in payments))}]}]}
+
+    def tron_trc20_transfers(self, address: str, min_block_timestamp: int, offset: int, confirm_blocks: int) -> dict:
+        with self.lock:
+            transfers = sorted((payment for payment in self._visible_payments("USDT_TRX", address)
+                                if payment['block_height'] is not None and payment['block_time'] * 1000 >= min_block_timestamp),
+                               key=lambda payment: payment['block_height'])
+            page = transfers[offset:offset + TRONGRID_PAGE_SIZE]
+            meta = {'page_size': len(page)}
+            if offset + TRONGRID_PAGE_SIZE < len(transfers):
+                meta['fingerprint'] = str(offset + TRONGRID_PAGE_SIZE)
+            return {
+                'success': True,
+                'meta': meta,
+                'data': [{
+                    'transaction_id': payment['txid'],
+                    'token_info': {'symbol': "USDT", 'decimals': 6},
+                    'to': address,
+                    'value': str(payment['amount']),
+                    'confirmed': self._confirmations(payment) >= confirm_blocks,
+                    'block_timestamp': payment['block_time'] * 1000,
+                } for payment in page],
+            }
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    chain: FakeChain = None
+    tron_confirm_blocks = 1
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real explorers
+
+    def log_message(self, format, *args):
+        pass # Request logging would dominate a load test
+
+    def _send(self, status: int, body, content_type: str = "application/json", headers: dict = None):
+        payload = body if isinstance(body, bytes) else (body if isinstance(body, str) else json.dumps(body)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        try:
+            body = self._read_json()
+            if path == "/_control/payments":
+                payment = self.chain.add_payment(body['coin'], body['address'], int(body['amount']), float(body.get('delay_seconds', 0)))
+                return self._send(200, {'txid': payment['txid'], 'sent_at': payment['sent_at']})
+            if path == "/_control/mine":
+                self.chain.mine(body.get('coin', "BTC"), int(body.get('blocks', 1)))
+                return self._send(200, self.chain.stats()['tip_heights'])
+            if path == "/_control/faults":
+                self.chain.set_faults(body.get('latency_ms'), body.get('latency_jitter_ms'), body.get('rate_429'), body.get('rate_5xx'))
+                return self._send(200, {'ok': True})
+        except (KeyError, ValueError) as e:
+            return self._send(400, {'error': str(e)})
+        self._send(404, {'error': "not found"})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if path == "/_control/stats":
+            return self._send(200, self.chain.stats())
+
+        route, responder = self._route(path, query)
+        if route is None:
+            return self._send(404, {'error': "not found"})
+
+        delay, fault_status = self.chain.injected_fault()
+        if delay:
+            time.sleep(delay)
+        if fault_status:
+            self.chain.count_request(route, fault_status)
+            return self._send(fault_status, {'error': "injected fault"})
+        status, body, content_type, headers = responder()
+        self.chain.count_request(route, status)
+        self._send(status, body, content_type, headers)
+
+    def _route(self, path: str, query: dict):
+        parts = path.strip('/').split('/')
+        chain = self.chain
+        if parts[:3] == ["btc", "blocks", "tip"]:
+            return "btc_tip", lambda: (200, chain.btc_tip_height(), "text/plain", None)
+        if len(parts) == 3 and parts[:2] == ["btc", "address"]:
+            def stats_response():
+                stats = chain.btc_address_stats(parts[2])
+                etag = '"' + hashlib.md5(json.dumps(stats, sort_keys=True).encode()).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    return 304, b"", "application/json", {'ETag': etag}
+                return 200, stats, "application/json", {'ETag': etag}
+            return "btc_address", stats_response
+        if len(parts) == 4 and parts[:2] == ["btc", "address"] and parts[3] == "txs":
+            return "btc_txs", lambda: (200, chain.btc_address_txs(parts[2]), "application/json", None)
+        if parts == ["ltc"]:
+            return "ltc_tip", lambda: (200, chain.ltc_chain_info(), "application/json", None)
+        if len(parts) == 4 and parts[:2] == ["ltc", "addrs"] and parts[3] == "full":
+            after = int(query['after']) if query.get('after') else None
+            return "ltc_full", lambda: (200, chain.ltc_address_full(parts[2], after), "application/json", None)
+        if len(parts) == 4 and parts[:2] == ["ltc", "addrs"] and parts[3] == "balance":
+            return "ltc_balance", lambda: (200, chain.ltc_address_balance(parts[2]), "application/json", None)
+        if len(parts) == 4 and parts[:3] == ["tron", "v1", "accounts"]:
+            return "tron_account", lambda: (200, chain.tron_account(parts[3], USDT_TRC20_CONTRACT_ADDRESS), "application/json", None)
+        if len(parts) == 6 and parts[:3] == ["tron", "v1", "accounts"] and parts[4:] == ["transactions", "trc20"]:
+            min_block_timestamp = int(query.get('min_block_timestamp') or 0)
+            offset = int(query.get('fingerprint') or 0)
+            return "tron_trc20", lambda: (200, chain.tron_trc20_transfers(parts[3], min_block_timestamp, offset, self.tron_confirm_blocks),
+                                          "application/json", None)
+        return None, None
+
+
+def start_fake_provider(chain: FakeChain, host: str = "127.0.0.1", port: int = 0, tron_confirm_blocks: int = 1) -> ThreadingHTTPServer:
+    """Starts the provider in a background thread and returns the server (server.server_address holds the bound port)."""
+    handler_class = type("BoundFakeProviderHandler", (FakeProviderHandler,), {'chain': chain, 'tron_confirm_blocks': tron_confirm_blocks})
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-blockchain-provider", daemon=True).start()
+    chain.start_mining()
+    return server
+
+
+def base_urls(server: ThreadingHTTPServer) -> dict:
+    """Config overrides pointing blockchain_apis at a running fake provider."""
+    host, port = server.server_address[:2]
+    root = f"http://{host}:{port}"
+    return {
+        'BLOCKSTREAM_API_BASE_URL_BTC': f"{root}/btc",
+        'BLOCKCYPHER_API_BASE_URL_LTC': f"{root}/ltc",
+        'TRONGRID_API_BASE_URL': f"{root}/tron",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Blockstream/BlockCypher/TronGrid provider for payment monitor testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--block-interval", type=float, default=10.0, help="Seconds between blocks on every chain (0 = mine only via the control API).")
+    parser.add_argument("--tron-confirm-blocks", type=int, default=1, help="Blocks after which a TRC20 transfer is reported as confirmed.")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of provider requests answered with 429.")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="Fraction of provider requests answered with 500/502/503.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    chain = FakeChain(block_interval_seconds=args.block_interval, seed=args.seed)
+    chain.set_faults(args.latency_ms, args.latency_jitter_ms, args.rate_429, args.rate_5xx)
+    server = start_fake_provider(chain, args.host, args.port, args.tron_confirm_blocks)
+    print(f"Fake blockchain provider listening on http://{args.host}:{server.server_address[1]}")
+    for key, url in base_urls(server).items():
+        print(f"  {key} = \"{url}\"")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        chain.stop()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Local stand-in for the exchange rate sources used by modules/rate_sources.py, for testing aggregation,
+outlier rejection and source health without touching public services.
+
+Emulated endpoints (only the fields rate_sources reads):
+    /coingecko/simple/price?ids=&vs_currencies=     CoinGecko
+    /kraken/Ticker?pair=                            Kraken
+    /coinbase/exchange-rates?currency=              Coinbase
+
+All sources quote the same base prices, each skewed by its own bias. Latency, 429s and 5xx responses are
+injected per source, so one source can be made slow, rate-limited or wrong while the others stay healthy.
+
+Control API (JSON):
+    POST /_control/prices   {"BTC": 60000, "LTC": 80, "USDT": 0.92}
+    POST /_control/faults   {"source": "kraken", "latency_ms": 3000, "rate_429": 0, "rate_5xx": 0, "bias": 0.05}
+    GET  /_control/stats    request counts per source and status
+
+Point the bot at it with COINGECKO_API_BASE_URL = "http://127.0.0.1:8766/coingecko",
+KRAKEN_API_BASE_URL = "http://127.0.0.1:8766/kraken" and COINBASE_API_BASE_URL = "http://127.0.0.1:8766/coinbase".
+
+    python tools/fake_rate_provider.py --port 8766
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+SOURCES = ("coingecko", "kraken", "coinbase")
+DEFAULT_PRICES_EUR = {"BTC": 60000.0, "LTC": 80.0, "USDT": 0.92}
+COINGECKO_IDS = {"bitcoin": "BTC", "litecoin": "LTC", "tether": "USDT"}
+KRAKEN_PAIRS = {"XBTEUR": ("BTC", "XXBTZEUR"), "LTCEUR": ("LTC", "XLTCZEUR"), "USDTEUR": ("USDT", "USDTEUR")}
+
+
+class FakeRates:
+    """Base prices, per-source faults and request statistics shared by all request handler threads."""
+
+    def __init__(self, seed: int | None = None):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.prices = dict(DEFAULT_PRICES_EUR)
+        self.faults = {source: {'latency_ms': 0.0, 'rate_429': 0.0, 'rate_5xx': 0.0, 'bias': 0.0} for source in SOURCES}
+        self.request_counts = {} # source -> {status: count}
+
+    def set_prices(self, prices: dict):
+        with self.lock:
+            self.prices.update({symbol: float(price) for symbol, price in prices.items()})
+
+    def set_faults(self, source: str, **faults):
+        with self.lock:
+            self.faults[source].update({name: float(value) for name, value in faults.items() if value is not None})
+
+    def price(self, source: str, symbol: str) -> float | None:
+        with self.lock:
+            price = self.prices.get(symbol)
+            return None if price is None else price * (1 + self.faults[source]['bias'])
+
+    def injected_fault(self, source: str) -> tuple[float, int | None]:
+        """Returns (delay_seconds, status_code_to_fail_with or None) for one request to source."""
+        with self.lock:
+            faults = self.faults[source]
+            roll = self.random.random()
+            if roll < faults['rate_429']:
+                return faults['latency_ms'] / 1000, 429
+            if roll < faults['rate_429'] + faults['rate_5xx']:
+                return faults['latency_ms'] / 1000, 503
+            return faults['latency_ms'] / 1000, None
+
+    def count_request(self, source: str, status: int):
+        with self.lock:
+            source_counts = self.request_counts.setdefault(source, {})
+            source_counts[status] = source_counts.get(status, 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'requests': {source: dict(counts) for source, counts in self.request_counts.items()},
+                    'prices': dict(self.prices), 'faults': {source: dict(faults) for source, faults in self.faults.items()}}
+
+    # --- Source responses ---
+    def coingecko_simple_price(self, ids: str, vs_currency: str) -> dict:
+        return {coingecko_id: {vs_currency: self.price("coingecko", COINGECKO_IDS[coingecko_id])}
+                for coingecko_id in ids.split(',') if coingecko_id in COINGECKO_IDS}
+
+    def kraken_ticker(self, pairs: str) -> dict:
+        result = {}
+        for pair in pairs.split(','):
+            if pair in KRAKEN_PAIRS:
+                symbol, response_key = KRAKEN_PAIRS[pair]
+                result[response_key] = {'c': [f"{self.price('kraken', symbol):.8f}", "0.01"]}
+        return {'error': [], 'result': result}
+
+    def coinbase_exchange_rates(self, currency: str) -> dict:
+        rates = {symbol: f"{1 / self.price('coinbase', symbol):.12f}" for symbol in DEFAULT_PRICES_EUR}
+        return {'data': {'currency': currency, 'rates': rates}}
+
+
+class FakeRateHandler(BaseHTTPRequestHandler):
+    rates: FakeRates = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body, headers: dict = None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        try:
+            body = self._read_json()
+            if path == "/_control/prices":
+                self.rates.set_prices(body)
+                return self._send(200, {'ok': True})
+            if path == "/_control/faults":
+                self.rates.set_faults(body['source'], latency_ms=body.get('latency_ms'), rate_429=body.get('rate_429'),
+                                      rate_5xx=body.get('rate_5xx'), bias=body.get('bias'))
+                return self._send(200, {'ok': True})
+        except (KeyError, ValueError) as e:
+            return self._send(400, {'error': str(e)})
+        self._send(404, {'error': "not found"})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if path == "/_control/stats":
+            return self._send(200, self.rates.stats())
+
+        rates = self.rates
+        routes = {
+            "/coingecko/simple/price": ("coingecko", lambda: rates.coingecko_simple_price(query.get('ids', ''), query.get('vs_currencies', 'eur'))),
+            "/kraken/Ticker": ("kraken", lambda: rates.kraken_ticker(query.get('pair', ''))),
+            "/coinbase/exchange-rates": ("coinbase", lambda: rates.coinbase_exchange_rates(query.get('currency', 'EUR'))),
+        }
+        if path not in routes:
+            return self._send(404, {'error': "not found"})
+        source, responder = routes[path]
+        delay, fault_status = rates.injected_fault(source)
+        if delay:
+            time.sleep(delay)
+        if fault_status:
+            rates.count_request(source, fault_status)
+            return self._send(fault_status, {'error': "injected fault"}, {'Retry-After': "30"} if fault_status == 429 else None)
+        rates.count_request(source, 200)
+        self._send(200, responder())
+
+
+def start_fake_rate_provider(rates: FakeRates, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Starts the provider in a background thread and returns the server (server.server_address holds the bound port)."""
+    handler_class = type("BoundFakeRateHandler", (FakeRateHandler,), {'rates': rates})
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-rate-provider", daemon=True).start()
+    return server
+
+
+def base_urls(server: ThreadingHTTPServer) -> dict:
+    """Config overrides pointing rate_sources at a running fake provider."""
+    host, port = server.server_address[:2]
+    root = f"http://{host}:{port}"
+    return {
+        'COINGECKO_API_BASE_URL': f"{root}/coingecko",
+        'KRAKEN_API_BASE_URL': f"{root}/kraken",
+        'COINBASE_API_BASE_URL': f"{root}/coinbase",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake CoinGecko/Kraken/Coinbase rate provider for rate aggregation testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = start_fake_rate_provider(FakeRates(seed=args.seed), args.host, args.port)
+    print(f"Fake rate provider listening on http://{args.host}:{server.server_address[1]}")
+    for key, url in base_urls(server).items():
+        print(f"  {key} = \"{url}\"")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()